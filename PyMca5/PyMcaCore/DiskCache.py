@@ -0,0 +1,213 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Content-addressed cache of python objects on disk.
+
+Objects are stored in one file per key in a cache directory. The key is
+a hash of the objects that determine the cached result. When the total
+size of the cache exceeds its limit, the least recently used files are
+removed.
+
+.. code:: python
+
+    cache = DiskCache("/tmp/mycache")
+    key = cache.key(config, version)
+    result = cache.get(key)
+    if result is None:
+        result = calculate(config)
+        cache.set(key, result)
+"""
+import os
+import sys
+import hashlib
+import logging
+import tempfile
+import numpy
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_logger = logging.getLogger(__name__)
+
+EXTENSION = ".pkl"
+MAXSIZE = 100 * 1024**2
+
+
+def _canonical(obj):
+    """
+    Convert an object to nested tuples of builtin types with a
+    reproducible representation (e.g. dictionaries are sorted).
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((str(k), _canonical(v)) for k, v in obj.items()))
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_canonical(v) for v in obj)
+    elif isinstance(obj, numpy.ndarray):
+        return ('ndarray', obj.dtype.str, obj.shape,
+                hashlib.sha1(numpy.ascontiguousarray(obj).tobytes()).hexdigest())
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    else:
+        return obj
+
+
+class DiskCache(object):
+
+    def __init__(self, directory, maxsize=None):
+        """
+        :param str directory: created when it does not exist
+        :param int maxsize: maximal size of the cache in bytes
+        """
+        self.directory = directory
+        if maxsize is None:
+            maxsize = MAXSIZE
+        self.maxsize = maxsize
+
+    @staticmethod
+    def key(*objs):
+        """
+        :returns str: hash of the objects
+        """
+        txt = repr(_canonical(objs))
+        if sys.version_info >= (3,):
+            txt = txt.encode('utf-8')
+        return hashlib.sha1(txt).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def get(self, key):
+        """
+        :param str key:
+        :returns: cached object or None
+        """
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                value = pickle.load(f)
+        except Exception:
+            _logger.warning("Corrupt cache file %s removed", filename)
+            self._remove(filename)
+            return None
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        """
+        :param str key:
+        :param value: object which can be pickled
+        :returns bool: success
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first so that concurrent
+            # processes never read a partial file
+            fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        except Exception as e:
+            _logger.warning("Cannot write to cache %s: %s",
+                            self.directory, e)
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=2)
+            filename = self.filename(key)
+            if hasattr(os, 'replace'):
+                os.replace(tmpname, filename)
+            else:
+                if os.path.exists(filename):
+                    self._remove(filename)
+                os.rename(tmpname, filename)
+        except Exception as e:
+            _logger.warning("Cannot write to cache %s: %s",
+                            self.directory, e)
+            self._remove(tmpname)
+            return False
+        self.evict()
+        return True
+
+    def clear(self):
+        for filename, _, _ in self._files():
+            self._remove(filename)
+
+    def size(self):
+        """
+        :returns int: size of the cache in bytes
+        """
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache
+        no longer exceeds its maximal size.
+        """
+        files = self._files()
+        total = sum(size for _, size, _ in files)
+        if total <= self.maxsize:
+            return
+        files.sort(key=lambda item: item[2])
+        for filename, size, _ in files:
+            if total <= self.maxsize:
+                break
+            if self._remove(filename):
+                total -= size
+
+    def _files(self):
+        files = []
+        if not os.path.isdir(self.directory):
+            return files
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTENSION):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((filename, stat.st_size, stat.st_mtime))
+        return files
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            return False
+        return True
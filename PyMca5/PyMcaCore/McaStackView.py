@@ -31,10 +31,18 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 
+import sys
 import numpy
 import logging
 import numbers
 import itertools
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 _logger = logging.getLogger(__name__)
 
@@ -402,10 +410,75 @@ def chunks_in_memory(shape, dtype, axis=-1, margin=0.01, maximal=None):
         return n_chunks
 
 
+def chunkAlignedRows(nRows, chunks):
+    """
+    Number of rows (first dimension) rounded down to a multiple of the
+    dataset chunk size when at least one chunk
+
+    :param int nRows:
+    :param tuple chunks: chunk shape of the dataset (or None)
+    :returns int:
+    """
+    if chunks and nRows >= chunks[0]:
+        nRows -= nRows % chunks[0]
+    return nRows
+
+
+def chunkAlignedNMca(data, nMca, mcaAxis=-1):
+    """
+    Number of spectra of the blocks of a chunked 3D stack with the channels
+    along the last axis: whole rows, a multiple of the dataset chunk size
+    when possible.
+
+    :param array data: nD array (numpy.ndarray or h5py.Dataset)
+    :param int nMca: maximal number of spectra
+    :param int mcaAxis:
+    :returns int:
+    """
+    shape = data.shape
+    chunks = getattr(data, 'chunks', None)
+    if chunks and len(shape) == 3 and mcaAxis in (2, -1):
+        nRows = chunkAlignedRows(max(nMca // shape[1], 1), chunks)
+        nMca = nRows * shape[1]
+    return nMca
+
+
+def threadedMap(function, iterable, nthreads=None, ordered=True):
+    """
+    Yields function(item) for all items. With several threads the items
+    are processed by a pool of threads, which is worth it when the
+    function releases the GIL (numpy, FFTs, reading HDF5 datasets, ...).
+
+    :param callable function:
+    :param iterable:
+    :param int nthreads: number of threads (0: number of CPU's,
+                         None or 1: no threads)
+    :param bool ordered: yield the results in the order of the items,
+                         otherwise as soon as they are available
+    """
+    if nthreads == 0:
+        nthreads = multiprocessing.cpu_count()
+    if nthreads is not None and nthreads > 1:
+        pool = ThreadPool(processes=nthreads)
+        try:
+            if ordered:
+                results = pool.imap(function, iterable)
+            else:
+                results = pool.imap_unordered(function, iterable)
+            for result in results:
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for item in iterable:
+            yield function(item)
+
+
 class ChunkedView(object):
 
     def __init__(self, data, nMca=None, mcaAxis=None, mcaSlice=None,
-                 dtype=None, readonly=True):
+                 dtype=None, readonly=True, writer=None):
         """
         :param array data: nD array (numpy.ndarray or h5py.Dataset)
         :param num or tuple nMca: maximal number of MCA spectra to be
@@ -414,6 +487,8 @@ def __init__(self, data, nMca=None, mcaAxis=None, mcaSlice=None,
         :param slice mcaSlice: slice along the MCA axis
         :param dtype:
         :param bool readonly:
+        :param writer: writes the chunks instead of assigning them to the
+                       data (see OutputBuffer.BackgroundWriter)
         """
         self.mcaAxis = mcaAxis
         self.mcaSlice = mcaSlice
@@ -425,6 +500,7 @@ def __init__(self, data, nMca=None, mcaAxis=None, mcaSlice=None,
         self._buffer = None
         self._data = data
         self.readonly = readonly
+        self.writer = writer
         self._isNdarray = isinstance(data, numpy.ndarray)
 
     @property
@@ -612,10 +688,11 @@ def _idxFullMask(self, idx, mask):
             idx[axis] = ind
         return idx
 
-    def items(self, keyType='all'):
-        """Yields (index(tuple), shape(tuple)), chunk(array))
+    def _itemsInfo(self):
+        """
+        Chunk index generator and the information needed
+        to read/write one chunk from/to the data
         """
-        nChan = self.nChan
         data = self._data
         chunkGenerator, chunkAxes, axesOrder, nMca = self.chunkInfo
         axesOrderSorted = tuple(sorted(axesOrder))
@@ -637,38 +714,136 @@ def items(self, keyType='all'):
             transposeAxes = axesOrderSorted + chunkAxes
             h5pyMultiList = False
         itransposeAxes = tuple(numpy.argsort(transposeAxes).tolist())
+        info = {'axesOrder': axesOrder,
+                'axesOrderSorted': axesOrderSorted,
+                'masked': masked,
+                'transposeAxes': transposeAxes,
+                'itransposeAxes': itransposeAxes,
+                'h5pyMultiList': h5pyMultiList}
+        return chunkGenerator, info
+
+    def _getChunk(self, value, idxChunk, nMca, info):
+        if info['h5pyMultiList']:
+            h5pyMultiListGet(self._data, value, idxChunk, info['axesOrder'])
+        else:
+            value[()] = numpy.transpose(self._data[idxChunk],
+                                        info['transposeAxes'])\
+                             .reshape(nMca, self.nChan)
+
+    def _setChunk(self, value, idxChunk, idxShape, info):
+        if info['h5pyMultiList']:
+            if self.writer is not None:
+                self.writer.flush()
+            h5pyMultiListSet(self._data, value, idxChunk, info['axesOrder'])
+        else:
+            idxShape = tuple(idxShape[i] for i in info['transposeAxes'])
+            value = numpy.transpose(value.reshape(idxShape),
+                                    info['itransposeAxes'])
+            if self.writer is None:
+                self._data[idxChunk] = value
+            else:
+                self.writer.write(self._data, idxChunk, value)
 
-        # Yield key, value pairs:
-        #  value: nMca x nChan chunk of buffer
+    @staticmethod
+    def _chunkKey(idxChunk, idxShape, nMca, keyType, info):
         #  key: index applied to data and resulting shape
         #   keyType == 'all': including mcaAxis
         #   keyType == 'select': excluding mcaAxis
+        if keyType == 'select':
+            axesOrderSorted = info['axesOrderSorted']
+            if info['masked']:
+                key = tuple(idxChunk[i] for i in axesOrderSorted),\
+                      (nMca,)
+            else:
+                key = tuple(idxChunk[i] for i in axesOrderSorted),\
+                      tuple(idxShape[i] for i in axesOrderSorted)
+        else:
+            key = idxChunk, idxShape
+        return key
+
+    def items(self, keyType='all'):
+        """Yields (index(tuple), shape(tuple)), chunk(array))
+        """
+        chunkGenerator, info = self._itemsInfo()
+
+        # Yield key, value pairs:
+        #  value: nMca x nChan chunk of buffer
+        #  key: see _chunkKey
         post_copy = self._prepareAccess()
         buffer = self._buffer
         for idxChunk, idxShape, nMca in chunkGenerator:
             value = buffer[:nMca, :]
-            if h5pyMultiList:
-                h5pyMultiListGet(data, value, idxChunk, axesOrder)
-            else:
-                value[()] = numpy.transpose(data[idxChunk], transposeAxes)\
-                                 .reshape(nMca, nChan)
-            if keyType == 'select':
-                if masked:
-                    key = tuple(idxChunk[i] for i in axesOrderSorted),\
-                          (nMca,)
-                else:
-                    key = tuple(idxChunk[i] for i in axesOrderSorted),\
-                          tuple(idxShape[i] for i in axesOrderSorted)
-            else:
-                key = idxChunk, idxShape
-            yield key, value
+            self._getChunk(value, idxChunk, nMca, info)
+            yield self._chunkKey(idxChunk, idxShape, nMca, keyType, info), value
             if post_copy:
-                if h5pyMultiList:
-                    h5pyMultiListSet(data, value, idxChunk, axesOrder)
-                else:
-                    idxShape = tuple(idxShape[i] for i in transposeAxes)
-                    data[idxChunk] = numpy.transpose(value.reshape(idxShape),
-                                                     itransposeAxes)
+                self._setChunk(value, idxChunk, idxShape, info)
+
+    def imapItems(self, function, keyType='all', nthreads=None,
+                  ordered=False):
+        """Yields function(key, chunk) for all chunks (see `items`).
+        With several threads each chunk is read, into a new array, and
+        processed by a thread of the pool.
+
+        :param callable function:
+        :param str keyType: see `items`
+        :param int nthreads: see `threadedMap`
+        :param bool ordered: see `threadedMap`
+        """
+        if nthreads == 0:
+            nthreads = multiprocessing.cpu_count()
+        if nthreads is not None and nthreads > 1:
+            def process(chunkIndex):
+                key, chunk = self.getItem(chunkIndex, keyType=keyType)
+                return function(key, chunk)
+            for result in threadedMap(process, self.chunkIndex(),
+                                      nthreads=nthreads, ordered=ordered):
+                yield result
+        else:
+            for key, chunk in self.items(keyType=keyType):
+                yield function(key, chunk)
+
+    def chunkIndex(self):
+        """List of chunks in iteration order
+
+        :returns list(tuple): (index(tuple), shape(tuple), nMca(int))
+        """
+        return list(self.chunkInfo[0])
+
+    def getKey(self, chunkIndex, keyType='all'):
+        """Key of one chunk without reading it
+
+        :param tuple chunkIndex: item of `chunkIndex()`
+        :param str keyType: see `items`
+        :returns tuple: index(tuple), shape(tuple)
+        """
+        idxChunk, idxShape, nMca = chunkIndex
+        _, info = self._itemsInfo()
+        return self._chunkKey(idxChunk, idxShape, nMca, keyType, info)
+
+    def getItem(self, chunkIndex, keyType='all'):
+        """Read one chunk (a new array, not the internal buffer)
+
+        :param tuple chunkIndex: item of `chunkIndex()`
+        :param str keyType: see `items`
+        :returns tuple: (index(tuple), shape(tuple)), chunk(array)
+        """
+        idxChunk, idxShape, nMca = chunkIndex
+        _, info = self._itemsInfo()
+        value = numpy.empty((nMca, self.nChan), self.dtype)
+        self._getChunk(value, idxChunk, nMca, info)
+        return self._chunkKey(idxChunk, idxShape, nMca, keyType, info), value
+
+    def setItem(self, chunkIndex, value):
+        """Write one chunk
+
+        :param tuple chunkIndex: item of `chunkIndex()`
+        :param array value: nMca x nChan
+        """
+        if self.readonly:
+            raise RuntimeError('View is read-only')
+        idxChunk, idxShape, nMca = chunkIndex
+        _, info = self._itemsInfo()
+        self._setChunk(value, idxChunk, idxShape, info)
 
 
 class FullView(MaskedView):
@@ -682,3 +857,137 @@ def __init__(self, data, **kwargs):
         :param **kwargs: see MaskedView
         """
         super(FullView, self).__init__(data, mask=None, **kwargs)
+
+    @property
+    def chunkShape(self):
+        """
+        Chunk shape of an HDF5 dataset with the shape of the data, aligned
+        with the chunks of this view. It covers the complete MCA axis.
+
+        :returns tuple:
+        """
+        idxChunk, idxShape, nMca = next(iter(self.chunkInfo[0]))
+        chunkShape = list(idxShape)
+        chunkShape[self.mcaAxis] = self.nChanOrg
+        return tuple(chunkShape)
+
+
+class ReadAheadRows(object):
+    """
+    Iterate over the first dimension of a stack (e.g. the rows of an MCA map).
+    The rows are read in slabs, aligned with the chunks of the dataset, by a
+    background thread while the previous slab is being processed.
+
+    .. code:: python
+
+        for i, row in ReadAheadRows(data, nbytes=100*1024**2):
+            if row is None:
+                # error while reading this row (logged)
+                continue
+            ...
+    """
+
+    def __init__(self, data, nbytes=None, prefetch=1, start=0, stop=None):
+        """
+        :param array data: nD array (numpy.ndarray or h5py.Dataset)
+        :param int nbytes: maximal memory used by all buffered slabs
+                           (default: see `chunks_in_memory`)
+        :param int prefetch: number of slabs to read in advance
+        :param int start: first row
+        :param int stop: last row (excluded)
+        """
+        self._data = data
+        self.prefetch = max(prefetch, 1)
+        self.nbytes = nbytes
+        self.start = start
+        if stop is None:
+            stop = data.shape[0]
+        self.stop = stop
+
+    @property
+    def nRowsPerSlab(self):
+        """
+        Number of rows in one slab: a multiple of the dataset chunk size
+        when possible and within the memory budget
+        """
+        shape = self._data.shape
+        if len(shape) < 2:
+            return 1
+        # slab being processed + prefetched slabs + slab being read
+        nSlabs = self.prefetch + 2
+        if self.nbytes:
+            itemsize = numpy.array(0, dtype=self._data.dtype).itemsize
+            nbytesRow = numpy.prod(shape[1:]) * itemsize
+            nRows = int(self.nbytes // (nbytesRow * nSlabs))
+        else:
+            nRows = chunks_in_memory(shape, self._data.dtype, axis=0)
+            if nRows is None:
+                nRows = 1
+            else:
+                nRows //= nSlabs
+        nRows = chunkAlignedRows(max(nRows, 1),
+                                 getattr(self._data, 'chunks', None))
+        return min(nRows, max(self.stop - self.start, 1))
+
+    def __iter__(self):
+        if isinstance(self._data, numpy.ndarray):
+            # Already in memory
+            for i in range(self.start, self.stop):
+                yield i, self._data[i]
+            return
+        nRows = self.nRowsPerSlab
+        _logger.debug('Read ahead in slabs of %d rows', nRows)
+        slabs = queue.Queue(maxsize=self.prefetch)
+        stopEvent = threading.Event()
+        thread = threading.Thread(target=self._reader,
+                                  args=(slabs, stopEvent, nRows))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                slab = slabs.get()
+                if slab is None:
+                    break
+                i0, rows = slab
+                for i, row in enumerate(rows, i0):
+                    yield i, row
+        finally:
+            stopEvent.set()
+            # Unblock the reader
+            try:
+                while True:
+                    slabs.get_nowait()
+            except queue.Empty:
+                pass
+            thread.join()
+
+    def _reader(self, slabs, stopEvent, nRows):
+        data = self._data
+        for i0 in range(self.start, self.stop, nRows):
+            if stopEvent.is_set():
+                break
+            i1 = min(i0 + nRows, self.stop)
+            try:
+                rows = list(data[i0:i1])
+            except Exception:
+                # Try row by row
+                rows = []
+                for i in range(i0, i1):
+                    try:
+                        rows.append(data[i])
+                    except Exception:
+                        _logger.error("Error reading dataset row %d", i)
+                        _logger.error(str(sys.exc_info()))
+                        rows.append(None)
+            while not stopEvent.is_set():
+                try:
+                    slabs.put((i0, rows), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        while not stopEvent.is_set():
+            try:
+                slabs.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
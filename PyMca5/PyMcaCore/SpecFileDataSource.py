@@ -80,13 +80,22 @@ def __init__(self, nameInput):
         self.refresh()
 
     def refresh(self):
+        previousList = getattr(self, "_sourceObjectList", [])
         self._sourceObjectList=[]
         self.__fileHeaderList = []
         #for name in self.__sourceNameList:
         #    if not os.path.exists(name):
         #        raise ValueError("File %s does not exists" % name)
-        for name in self.__sourceNameList:
-            self._sourceObjectList.append(specfile.Specfile(name))
+        for i, name in enumerate(self.__sourceNameList):
+            if i < len(previousList) and \
+               hasattr(previousList[i], "update") and \
+               os.path.exists(name):
+                # SPEC files only need to read what was appended to them
+                sourceObject = previousList[i]
+                sourceObject.update()
+            else:
+                sourceObject = specfile.Specfile(name)
+            self._sourceObjectList.append(sourceObject)
             self.__fileHeaderList.append(False)
         self.__lastKeyInfo = {}
 
@@ -93,6 +93,7 @@ def __init__(self):
                               'Background': None}
 
         self.__ROIImageCalculationIsUsingSuppliedEnergyAxis = False
+        self._ROIImageIndex = None
 
         self._ROIImageList = []
         self._ROIImageNames = []
@@ -251,6 +252,8 @@ def stackUpdated(self, positioners=None):
         """
         Recalculates the different images associated to the stack
         """
+        # the data may have changed
+        self._ROIImageIndex = None
         self._tryNumpy = True
         if hasattr(self._stack.data, "size"):
             if self._stack.data.size > self._dynamicLimit:
@@ -526,6 +529,29 @@ def getStackROIImagesAndNames(self):
     def getStackOriginalImage(self):
         return self._stackImageData
 
+    def buildROIImageIndex(self, filename=None, **kw):
+        """
+        Build (or load) the index used to calculate the ROI images without
+        reading all the channels of the ROI. It is discarded when the stack
+        is updated.
+
+        :param str filename: directory where the index is saved and loaded
+                             from (see StackROIIndex.getDefaultFilename to
+                             put it next to the data). In memory when None.
+        :param **kw: see StackROIIndex.StackROIIndex
+        """
+        from PyMca5.PyMcaCore import StackROIIndex
+        t0 = time.time()
+        self._ROIImageIndex = StackROIIndex.StackROIIndex(self._stack.data,
+                                                          mcaAxis=self.mcaIndex,
+                                                          filename=filename,
+                                                          **kw)
+        logger.debug("ROI image index elapsed = %f", time.time() - t0)
+        return self._ROIImageIndex
+
+    def getROIImageIndex(self):
+        return self._ROIImageIndex
+
     def calculateMcaDataObject(self, normalize=False):
         #original ICR mca
         if self._stackImageData is None:
@@ -762,6 +788,16 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                       'Background': dummy}
             return imageDict
 
+        if self._ROIImageIndex is not None:
+            t0 = time.time()
+            imageDict = self._ROIImageIndex.calculateROIImages(i1, i2,
+                                                               imiddle=imiddle,
+                                                               energy=energy)
+            self.__ROIImageCalculationIsUsingSuppliedEnergyAxis = True
+            logger.debug("Indexed ROI image calculation elapsed = %f",
+                         time.time() - t0)
+            return imageDict
+
         isUsingSuppliedEnergyAxis = False
         if self.fileIndex == 0:
             if self.mcaIndex == 1:
@@ -37,6 +37,8 @@
 import numpy
 import logging
 import copy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaIO.OutputBuffer import OutputBuffer as OutputBufferBase
 from PyMca5.PyMcaCore import McaStackView
@@ -53,6 +55,112 @@ def __init__(self, saveResiduals=False, saveFit=False, saveData=False,
         self.fileProcessDefault = 'roi_sum'
 
 
+class RoiKernel(object):
+    """Raw sum, net sum and x at maximum and minimum of a set of ROIs
+    for a chunk of spectra (nMca x nChan) in a single pass.
+
+    The sums of all ROIs covering a contiguous range of channels are
+    obtained with one reduction over the chunk. Other ROIs (x not
+    monotonic) are calculated one by one.
+    """
+
+    def __init__(self, xw, idx, iXMinList, iXMaxList, xAtMinMax=False):
+        """
+        :param list xw: x-values of each ROI (None for an empty ROI)
+        :param list idx: channel indices of each ROI
+        :param list iXMinList: index in xw of min(xw) for each ROI
+        :param list iXMaxList: index in xw of max(xw) for each ROI
+        :param bool xAtMinMax: calculate x at maximum and minimum
+        """
+        self.nRois = len(xw)
+        self.xAtMinMax = xAtMinMax
+        self._xw = xw
+        self._idx = idx
+        # Linear background of each ROI:
+        #   sum(left + slope * (xw - xw[iXMin]))
+        #   = left * npoints + slope * sumDeltaX
+        npoints = numpy.zeros(self.nRois)
+        deltaX = numpy.ones(self.nRois)
+        sumDeltaX = numpy.zeros(self.nRois)
+        valid = numpy.zeros(self.nRois, dtype=bool)
+        left = numpy.zeros(self.nRois, dtype=int)
+        right = numpy.zeros(self.nRois, dtype=int)
+        contiguous = []
+        other = []
+        for j in range(self.nRois):
+            if xw[j] is None:
+                continue
+            npoints[j] = len(xw[j])
+            left[j] = idx[j][iXMinList[j]]
+            right[j] = idx[j][iXMaxList[j]]
+            dx = xw[j][iXMaxList[j]] - xw[j][iXMinList[j]]
+            if abs(dx) > 0.0:
+                valid[j] = True
+                deltaX[j] = dx
+                sumDeltaX[j] = (xw[j] - xw[j][iXMinList[j]]).sum(dtype=numpy.float64)
+            if (numpy.diff(idx[j]) == 1).all():
+                contiguous.append(j)
+            else:
+                other.append(j)
+        self._npoints = npoints[:, numpy.newaxis]
+        self._deltaX = deltaX[:, numpy.newaxis]
+        self._sumDeltaX = sumDeltaX[:, numpy.newaxis]
+        self._valid = valid[:, numpy.newaxis]
+        self._left = left
+        self._right = right
+        self._other = other
+        # numpy.add.reduceat sums [first, last) of every pair of
+        # indices. The last channel of the ROI is added separately
+        # so that all indices are within the chunk.
+        self._contiguous = numpy.array(contiguous, dtype=int)
+        first = [idx[j][0] for j in contiguous]
+        last = [idx[j][-1] for j in contiguous]
+        self._reduceIdx = numpy.array(first + last, dtype=int)
+        self._reduceIdx[0::2] = first
+        self._reduceIdx[1::2] = last
+        self._last = numpy.array(last, dtype=int)
+        self._single = (numpy.array(first) == self._last)[:, numpy.newaxis]
+        self._slices = [slice(idx[j][0], idx[j][-1] + 1)
+                        if j in contiguous else idx[j]
+                        for j in range(self.nRois)]
+
+    def calculate(self, chunk):
+        """
+        :param array chunk: nMca x nChan
+        :returns tuple: raw sum, net sum, x at maximum and x at minimum,
+                        arrays of shape nRois x nMca (the last two are
+                        None when not requested). All zero for empty ROIs.
+        """
+        nMca = chunk.shape[0]
+        rawSum = numpy.zeros((self.nRois, nMca), dtype=numpy.float64)
+        if self._contiguous.size:
+            partial = numpy.add.reduceat(chunk, self._reduceIdx, axis=1,
+                                         dtype=numpy.float64)[:, 0::2].T
+            lastChannel = chunk[:, self._last].T
+            rawSum[self._contiguous] = numpy.where(self._single, partial,
+                                                   partial + lastChannel)
+        for j in self._other:
+            rawSum[j] = chunk[:, self._idx[j]].sum(axis=1, dtype=numpy.float64)
+        left = chunk[:, self._left].T
+        right = chunk[:, self._right].T
+        slope = (right - left) / self._deltaX
+        background = left * self._npoints + slope * self._sumDeltaX
+        netSum = numpy.where(self._valid, rawSum - background, 0.)
+        if not self.xAtMinMax:
+            return rawSum, netSum, None, None
+        maxImage = numpy.zeros((self.nRois, nMca), dtype=numpy.float64)
+        minImage = numpy.zeros((self.nRois, nMca), dtype=numpy.float64)
+        for j in range(self.nRois):
+            xw = self._xw[j]
+            if xw is None:
+                continue
+            # a view of the chunk for contiguous ROIs
+            roichunk = chunk[:, self._slices[j]]
+            maxImage[j] = xw[numpy.argmax(roichunk, axis=1)]
+            minImage[j] = xw[numpy.argmin(roichunk, axis=1)]
+        return rawSum, netSum, maxImage, minImage
+
+
 class StackROIBatch(object):
 
     def __init__(self):
@@ -73,7 +181,7 @@ def setConfigurationFile(self, ffile):
     def batchROIMultipleSpectra(self, x=None, y=None, configuration=None,
                                 net=True, xAtMinMax=False, index=None,
                                 xLabel=None, outbuffer=None, save=True,
-                                **outbufferinitargs):
+                                nthreads=None, **outbufferinitargs):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -86,6 +194,9 @@ def batchROIMultipleSpectra(self, x=None, y=None, configuration=None,
         :param xLabel: Type of ROI to be used.
         :param outbuffer:
         :param save: set to False to postpone saving the in-memory buffers
+        :param nthreads: number of threads processing chunks of spectra
+                         concurrently (0 means one per CPU). Default is
+                         to process them sequentially.
         :return OutputBuffer:
         """
         data, x, index = self._parseData(x=x, y=y, index=index)
@@ -101,11 +212,12 @@ def batchROIMultipleSpectra(self, x=None, y=None, configuration=None,
                               roiList=roiList,
                               roiDict=config["ROI"]["roidict"],
                               outbuffer=outbuffer,
-                              xAtMinMax=xAtMinMax)
+                              xAtMinMax=xAtMinMax,
+                              nthreads=nthreads)
         return outbuffer
 
     def _extractRois(self, data, x, mcaAxis, roiList=None, roiDict=None,
-                     outbuffer=None, xAtMinMax=False):
+                     outbuffer=None, xAtMinMax=False, nthreads=None):
         nRois = len(roiList)
         nRows = data.shape[0]
         nColumns = data.shape[1]
@@ -158,45 +270,51 @@ def idxmin(i): return i + 3 * nRois
                                            groupAttrs={'default': True},
                                            memtype='ram')
 
-        # Allocate memory of partial result
+        # Process the spectra in chunks
         nMca = 2, 'MB'
         _logger.debug('Process spectra in chunks of {}'.format(nMca))
         datastack = McaStackView.FullView(data, mcaAxis=mcaAxis, nMca=nMca)
-        for (resultidx, resultshape), chunk in datastack.items(keyType='select'):
+        kernel = RoiKernel(xw, idx, iXMinList, iXMaxList, xAtMinMax=xAtMinMax)
+        if nthreads == 0:
+            nthreads = multiprocessing.cpu_count()
+        if nthreads is not None and nthreads > 1:
+            chunks = self._iterRoisThreaded(datastack, kernel, nthreads)
+        else:
+            chunks = ((key, kernel.calculate(chunk))
+                      for key, chunk in datastack.items(keyType='select'))
+        for (resultidx, resultshape), (rawSum, netSum, maxImage, minImage) in chunks:
             for j, roi in enumerate(roiList):
-                # Calculate ROI sum
-                if xw[j] is None:
-                    # no points in the ROI       
-                    rawSum = 0.0
-                    netSum = 0.0
-                else:
-                    roichunk = chunk[:, idx[j]]
-                    rawSum = roichunk.sum(axis=1, dtype=numpy.float)
-                    deltaX = xw[j][iXMaxList[j]] - xw[j][iXMinList[j]]
-                    left = roichunk[:, iXMinList[j]]
-                    right = roichunk[:, iXMaxList[j]]
-                    deltaY = right - left
-                    if abs(deltaX) > 0.0:
-                        slope = deltaY / float(deltaX)
-                        background = left * len(xw[j]) + slope * \
-                                    (xw[j] - xw[j][iXMinList[j]]).sum(dtype=numpy.float)
-                        netSum = rawSum - background
-                    else:
-                        netSum = 0.0
-                    rawSum = rawSum.reshape(resultshape)
-                    netSum = netSum.reshape(resultshape)
-                results[idxraw(j)][resultidx] = rawSum  # ROI sum
-                results[idxnet(j)][resultidx] = netSum  # ROI sum minus linear background
-                # Calculate x-value of the minimum and maximum within the ROI
+                results[idxraw(j)][resultidx] = rawSum[j].reshape(resultshape)  # ROI sum
+                results[idxnet(j)][resultidx] = netSum[j].reshape(resultshape)  # ROI sum minus linear background
+                # x-value of the minimum and maximum within the ROI
                 if xAtMinMax:
                     if xw[j] is None:
                         # what can be the Min and the Max when there is nothing in the ROI?
                         _logger.warning("No Min. Max for ROI <%s>. Empty ROI" % roi)
                     else:
-                        maxImage = xw[j][numpy.argmax(roichunk, axis=1)]
-                        results[idxmax(j)][resultidx] = maxImage.reshape(resultshape)
-                        minImage = xw[j][numpy.argmin(roichunk, axis=1)]
-                        results[idxmin(j)][resultidx] = minImage.reshape(resultshape)
+                        results[idxmax(j)][resultidx] = maxImage[j].reshape(resultshape)
+                        results[idxmin(j)][resultidx] = minImage[j].reshape(resultshape)
+
+    @staticmethod
+    def _iterRoisThreaded(datastack, kernel, nthreads):
+        """Read and process chunks concurrently. NumPy and h5py release
+        the GIL so the threads run in parallel. The results are yielded
+        in the order they are ready.
+        """
+        def process(chunkIndex):
+            key, chunk = datastack.getItem(chunkIndex, keyType='select')
+            return key, kernel.calculate(chunk)
+
+        chunkIndex = datastack.chunkIndex()
+        _logger.debug('Process %d chunks with %d threads',
+                      len(chunkIndex), nthreads)
+        pool = ThreadPool(processes=nthreads)
+        try:
+            for result in pool.imap_unordered(process, chunkIndex):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
 
     def _parseData(self, x=None, y=None, index=None):
         if y is None:
@@ -357,7 +475,7 @@ def main():
                    'tif=', 'edf=', 'csv=', 'h5=', 'dat=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
                    'outroot=', 'outentry=', 'outprocess=',
-                   'overwrite=', 'multipage=']
+                   'overwrite=', 'multipage=', 'nthreads=']
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -381,6 +499,7 @@ def main():
     dat = 0
     overwrite = 1
     multipage = 0
+    nthreads = None
     for opt, arg in opts:
         if opt in ('--cfg'):
             configurationFile = arg
@@ -424,6 +543,8 @@ def main():
             overwrite = int(arg)
         elif opt == '--multipage':
             multipage = int(arg)
+        elif opt == '--nthreads':
+            nthreads = int(arg)
     if filepattern is not None:
         if (begin is None) or (end is None):
             raise ValueError(
@@ -452,7 +573,8 @@ def main():
                              overwrite=overwrite)
     with outbuffer.saveContext():
         worker.batchROIMultipleSpectra(y=dataStack,
-                                       outbuffer=outbuffer)
+                                       outbuffer=outbuffer,
+                                       nthreads=nthreads)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
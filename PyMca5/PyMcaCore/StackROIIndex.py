@@ -0,0 +1,406 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Index of a stack of spectra to calculate ROI images without reading
+all the channels of the ROI.
+
+The index is built in a single pass over the stack and contains:
+
+- the cumulative spectrum of every pixel, so that the sum over any
+  channel range is the difference of two images
+- a pyramid of the maximum and minimum (and their channel) over blocks
+  of 2**k * blockSize channels, so that the maximum and minimum over any
+  channel range only need a few images of the pyramid plus at most
+  2 * blockSize channel images read from the stack
+
+The float64 cumulative sums take 8 bytes per channel and pixel (twice a
+float32 stack, four times a uint16 stack), the pyramid less than half
+the size of the stack. An index that does not fit in the physical memory
+must be given a filename.
+
+The index can be saved in a directory (e.g. next to the data) in which
+case its arrays are memory mapped numpy files. It is reused when the
+shape and type of the stack and a checksum of a sample of its spectra
+(see SIGNATURE_SPECTRA) did not change: modifications of the other
+spectra are not detected.
+
+.. code:: python
+
+    index = StackROIIndex(data, mcaAxis=2, filename="data.h5.roiindex")
+    roiImage = index.sum(100, 400)
+    imageDict = index.calculateROIImages(100, 400)
+"""
+import os
+import json
+import hashlib
+import logging
+import numpy
+from PyMca5.PyMcaCore import McaStackView
+from PyMca5.PyMcaMisc import PhysicalMemory
+
+_logger = logging.getLogger(__name__)
+
+VERSION = 2
+INFO_FILE = "info.json"
+# number of spectra of the checksum identifying the stack
+SIGNATURE_SPECTRA = 64
+
+
+def getDefaultFilename(sourceName):
+    """
+    :param sourceName: file name of the stack (or list of file names)
+    :returns str: index directory next to the (first) data file or None
+                  when the stack does not come from a file
+    """
+    if isinstance(sourceName, (list, tuple)):
+        if not len(sourceName):
+            return None
+        sourceName = sourceName[0]
+    try:
+        if not os.path.isfile(sourceName):
+            return None
+    except TypeError:
+        return None
+    return sourceName + ".roiindex"
+
+
+class StackROIIndex(object):
+
+    def __init__(self, data, mcaAxis=-1, filename=None, blockSize=16,
+                 chunkSize=(10, 'MB')):
+        """
+        :param array data: 3D array (numpy.ndarray, h5py.Dataset or any
+                           object supporting slicing)
+        :param int mcaAxis: axis of the channels
+        :param str filename: directory where the index is saved. It is
+                             loaded when it exists and corresponds to the
+                             data. It is kept in memory when not given, in
+                             which case MemoryError is raised when it does
+                             not fit in the physical memory.
+        :param int blockSize: number of channels in the smallest block of
+                              the maximum/minimum pyramid
+        :param chunkSize: number of spectra read at once while building
+        """
+        self.data = data
+        if mcaAxis < 0:
+            mcaAxis += len(data.shape)
+        self.mcaAxis = mcaAxis
+        self.filename = filename
+        self.blockSize = blockSize
+        self.nChan = data.shape[mcaAxis]
+        self.imageShape = tuple(n for i, n in enumerate(data.shape)
+                                if i != mcaAxis)
+        self.dtype = numpy.dtype(data.dtype)
+        self.nLevels = 0
+        n = self.nChan // blockSize
+        while n:
+            self.nLevels += 1
+            n //= 2
+        self.signature = self._signature()
+        if filename and self._load():
+            _logger.info("ROI index loaded from %s", filename)
+        else:
+            self._build(chunkSize)
+
+    def _info(self):
+        return {"version": VERSION,
+                "shape": list(self.data.shape),
+                "dtype": self.dtype.str,
+                "mcaAxis": self.mcaAxis,
+                "blockSize": self.blockSize,
+                "signature": self.signature}
+
+    def _signature(self):
+        """
+        :returns str: checksum of SIGNATURE_SPECTRA spectra evenly spread
+                      over the stack, the first and the last included
+        """
+        nPixels = int(numpy.prod(self.imageShape))
+        pixels = numpy.unique(numpy.linspace(0, nPixels - 1,
+                                             SIGNATURE_SPECTRA).astype(int))
+        checksum = hashlib.sha1()
+        for pixel in pixels:
+            idx = list(numpy.unravel_index(pixel, self.imageShape))
+            idx.insert(self.mcaAxis, slice(None))
+            spectrum = numpy.asarray(self.data[tuple(idx)], dtype=self.dtype)
+            checksum.update(numpy.ascontiguousarray(spectrum).tobytes())
+        return checksum.hexdigest()
+
+    def _channels(self, first, last):
+        """
+        :returns array: images of the channels first to last (excluded)
+                        read from the stack
+        """
+        idx = [slice(None)] * len(self.data.shape)
+        idx[self.mcaAxis] = slice(first, last)
+        return numpy.moveaxis(numpy.asarray(self.data[tuple(idx)]),
+                              self.mcaAxis, 0)
+
+    def _arrayNames(self):
+        names = ["cumsum"]
+        for k in range(self.nLevels):
+            for name in ["maxValue", "maxIndex", "minValue", "minIndex"]:
+                names.append("%s%d" % (name, k))
+        return names
+
+    def _allocate(self, name, shape, dtype):
+        if self.filename:
+            return numpy.lib.format.open_memmap(
+                            os.path.join(self.filename, name + ".npy"),
+                            mode="w+", dtype=dtype, shape=shape)
+        else:
+            return numpy.zeros(shape, dtype=dtype)
+
+    def _load(self):
+        infoFile = os.path.join(self.filename, INFO_FILE)
+        if not os.path.exists(infoFile):
+            return False
+        try:
+            with open(infoFile, "r") as f:
+                info = json.load(f)
+            if info != self._info():
+                _logger.info("ROI index %s does not match the data",
+                             self.filename)
+                return False
+            arrays = {}
+            for name in self._arrayNames():
+                arrays[name] = numpy.load(os.path.join(self.filename,
+                                                       name + ".npy"),
+                                          mmap_mode="r")
+        except Exception:
+            _logger.warning("Cannot read ROI index %s", self.filename)
+            return False
+        self._setArrays(arrays)
+        return True
+
+    def _setArrays(self, arrays):
+        self.cumsum = arrays["cumsum"]
+        self._maxValue = [arrays["maxValue%d" % k] for k in range(self.nLevels)]
+        self._maxIndex = [arrays["maxIndex%d" % k] for k in range(self.nLevels)]
+        self._minValue = [arrays["minValue%d" % k] for k in range(self.nLevels)]
+        self._minIndex = [arrays["minIndex%d" % k] for k in range(self.nLevels)]
+
+    def _build(self, chunkSize):
+        if self.filename and not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+        infoFile = None
+        if self.filename:
+            infoFile = os.path.join(self.filename, INFO_FILE)
+            if os.path.exists(infoFile):
+                os.remove(infoFile)
+        if not self.filename:
+            self._checkMemory()
+        arrays = {}
+        arrays["cumsum"] = self._allocate("cumsum",
+                                          (self.nChan + 1,) + self.imageShape,
+                                          numpy.float64)
+        nBlocks = self.nChan // self.blockSize
+        for k in range(self.nLevels):
+            shape = (nBlocks,) + self.imageShape
+            for name in ["maxValue", "minValue"]:
+                arrays["%s%d" % (name, k)] = self._allocate(
+                                    "%s%d" % (name, k), shape, self.dtype)
+            for name in ["maxIndex", "minIndex"]:
+                arrays["%s%d" % (name, k)] = self._allocate(
+                                    "%s%d" % (name, k), shape, numpy.int32)
+            nBlocks //= 2
+        self._setArrays(arrays)
+        self.cumsum[0] = 0
+
+        datastack = McaStackView.FullView(self.data, mcaAxis=self.mcaAxis,
+                                          nMca=chunkSize)
+        for (idx, shape), chunk in datastack.items(keyType='select'):
+            nMca = chunk.shape[0]
+            cumsum = numpy.cumsum(chunk, axis=1, dtype=numpy.float64)
+            self.cumsum[(slice(1, None),) + idx] = \
+                                cumsum.T.reshape((self.nChan,) + shape)
+            if not self.nLevels:
+                continue
+            nBlocks = self.nChan // self.blockSize
+            blocks = chunk[:, :nBlocks * self.blockSize]
+            blocks = blocks.reshape(nMca, nBlocks, self.blockSize)
+            offset = numpy.arange(nBlocks) * self.blockSize
+            maxIndex = numpy.argmax(blocks, axis=2) + offset
+            minIndex = numpy.argmin(blocks, axis=2) + offset
+            rows = numpy.arange(nMca)[:, numpy.newaxis]
+            maxValue = chunk[rows, maxIndex]
+            minValue = chunk[rows, minIndex]
+            for k in range(self.nLevels):
+                if k:
+                    # combine pairs of blocks of the previous level,
+                    # the first one wins on equality like numpy.argmax
+                    n = maxValue.shape[1] // 2
+                    second = maxValue[:, 1:2 * n:2] > maxValue[:, 0:2 * n:2]
+                    maxValue = numpy.where(second, maxValue[:, 1:2 * n:2],
+                                           maxValue[:, 0:2 * n:2])
+                    maxIndex = numpy.where(second, maxIndex[:, 1:2 * n:2],
+                                           maxIndex[:, 0:2 * n:2])
+                    second = minValue[:, 1:2 * n:2] < minValue[:, 0:2 * n:2]
+                    minValue = numpy.where(second, minValue[:, 1:2 * n:2],
+                                           minValue[:, 0:2 * n:2])
+                    minIndex = numpy.where(second, minIndex[:, 1:2 * n:2],
+                                           minIndex[:, 0:2 * n:2])
+                n = maxValue.shape[1]
+                key = (slice(None),) + idx
+                self._maxValue[k][key] = maxValue.T.reshape((n,) + shape)
+                self._maxIndex[k][key] = maxIndex.T.reshape((n,) + shape)
+                self._minValue[k][key] = minValue.T.reshape((n,) + shape)
+                self._minIndex[k][key] = minIndex.T.reshape((n,) + shape)
+
+        if infoFile:
+            for array in arrays.values():
+                array.flush()
+            # written last: an interrupted build is never loaded
+            with open(infoFile, "w") as f:
+                json.dump(self._info(), f)
+            _logger.info("ROI index saved in %s", self.filename)
+
+    def _checkMemory(self):
+        nPixels = int(numpy.prod(self.imageShape))
+        needed = (self.nChan + 1) * nPixels * 8
+        nBlocks = self.nChan // self.blockSize
+        for k in range(self.nLevels):
+            needed += nBlocks * nPixels * 2 * (self.dtype.itemsize + 4)
+            nBlocks //= 2
+        if isinstance(self.data, numpy.ndarray):
+            needed += self.data.nbytes
+        physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+        if physicalMemory is not None:
+            # spare 5% of memory
+            if physicalMemory < (1.05 * needed):
+                raise MemoryError("Not enough physical memory for the ROI "
+                                  "index, give it a filename")
+
+    def plane(self, i):
+        """
+        :param int i: channel
+        :returns array: image of channel i
+        """
+        return numpy.array(self._channels(i, i + 1)[0])
+
+    def sum(self, i1, i2):
+        """
+        :param int i1: first channel
+        :param int i2: last channel (excluded)
+        :returns array: image of the sum over the channels (float64)
+        """
+        return self.cumsum[i2] - self.cumsum[i1]
+
+    def _segments(self, i1, i2):
+        """Decompose a channel range in blocks of the pyramid and
+        ranges of channel images.
+
+        :returns list: (level, block) or (None, (first, last + 1))
+        """
+        segments = []
+        p = i1
+        while p < i2:
+            for k in range(self.nLevels - 1, -1, -1):
+                size = self.blockSize << k
+                if (p % size == 0) and (p + size <= i2) and \
+                   (p // size < self._maxValue[k].shape[0]):
+                    segments.append((k, p // size))
+                    p += size
+                    break
+            else:
+                q = min((p // self.blockSize + 1) * self.blockSize, i2)
+                if segments and segments[-1][0] is None:
+                    segments[-1] = (None, (segments[-1][1][0], q))
+                else:
+                    segments.append((None, (p, q)))
+                p = q
+        return segments
+
+    def argMinMax(self, i1, i2):
+        """
+        :param int i1: first channel
+        :param int i2: last channel (excluded)
+        :returns tuple: images of the channel of the maximum and of the
+                        minimum (first occurrence as numpy.argmax)
+        """
+        maxValue = maxIndex = minValue = minIndex = None
+        for level, item in self._segments(i1, i2):
+            if level is None:
+                first, last = item
+                block = self._channels(first, last)
+                vMaxIndex = numpy.argmax(block, axis=0)
+                vMinIndex = numpy.argmin(block, axis=0)
+                vMax = block.max(axis=0)
+                vMin = block.min(axis=0)
+                vMaxIndex += first
+                vMinIndex += first
+            else:
+                vMax = self._maxValue[level][item]
+                vMaxIndex = self._maxIndex[level][item]
+                vMin = self._minValue[level][item]
+                vMinIndex = self._minIndex[level][item]
+            if maxValue is None:
+                maxValue = numpy.array(vMax)
+                maxIndex = numpy.array(vMaxIndex, dtype=numpy.int32)
+                minValue = numpy.array(vMin)
+                minIndex = numpy.array(vMinIndex, dtype=numpy.int32)
+                continue
+            update = vMax > maxValue
+            maxValue[update] = vMax[update]
+            maxIndex[update] = vMaxIndex[update]
+            update = vMin < minValue
+            minValue[update] = vMin[update]
+            minIndex[update] = vMinIndex[update]
+        return maxIndex, minIndex
+
+    def calculateROIImages(self, i1, i2, imiddle=None, energy=None):
+        """
+        Same output as StackBase.calculateROIImages
+
+        :param int i1: first channel
+        :param int i2: last channel (excluded)
+        :param int imiddle: middle channel
+        :param array energy: x values of the channels
+        :returns dict:
+        """
+        if imiddle is None:
+            imiddle = int(0.5 * (i1 + i2))
+        if energy is None:
+            energy = numpy.arange(self.nChan)
+        leftImage = self.plane(i1)
+        middleImage = self.plane(imiddle)
+        rightImage = self.plane(i2 - 1)
+        background = 0.5 * (i2 - i1) * (leftImage + rightImage)
+        maxIndex, minIndex = self.argMinMax(i1, i2)
+        return {'ROI': self.sum(i1, i2),
+                'Maximum': energy[maxIndex],
+                'Minimum': energy[minIndex],
+                'Left': leftImage,
+                'Middle': middleImage,
+                'Right': rightImage,
+                'Background': background}
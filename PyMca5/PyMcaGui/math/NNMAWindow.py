@@ -50,7 +50,8 @@ def __init__(self, parent=None, options=[1, 2, 3, 4, 5, 10], regions=False):
         self.methodOptions = qt.QGroupBox(self)
         self.methodOptions.setTitle('NNMA Method to use')
         self.methods = ['RRI', 'NNSC', 'NMF', 'SNMF', 'NMFKL',
-                        'FNMAI', 'ALS', 'FastHALS', 'GDCLS']
+                        'FNMAI', 'ALS', 'FastHALS', 'GDCLS',
+                        'Chunked HALS', 'Online HALS']
         self.methodOptions.mainLayout = qt.QGridLayout(self.methodOptions)
         self.methodOptions.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.methodOptions.mainLayout.setSpacing(2)
@@ -304,6 +305,11 @@ def getParameters(self):
         ddict['npc']     = self.nPC.value()
         ddict['kw']   = {'eps':eps,
                          'maxcount':maxcount}
+        if ddict['methodlabel'] in ['Chunked HALS', 'Online HALS']:
+            # out-of-core decomposition
+            ddict['function'] = NNMAModule.chunkedNNMA
+            ddict['kw']['online'] = ddict['methodlabel'] == 'Online HALS'
+            ddict['kw']['nthreads'] = 0
         mask = None
         if self.__regions:
             regions = self.regionsWidget.getRegions()
@@ -61,16 +61,21 @@ def __init__(self, parent=None, options=[1, 2, 3, 4, 5, 10],
         self.methods = ['Covariance', 'Correlation',
                         'Expectation Max.',
                         'Cov. Multiple Arrays',
-                        'Corr. Multiple Arrays']
+                        'Corr. Multiple Arrays',
+                        'Randomized']
         self._multipleIndex = [3, 4]
         self.functions = [PCAModule.numpyCovariancePCA,
                           PCAModule.numpyCorrelationPCA,
                           PCAModule.expectationMaximizationPCA,
                           PCAModule.multipleArrayCovariancePCA,
-                          PCAModule.multipleArrayCorrelationPCA]
+                          PCAModule.multipleArrayCorrelationPCA,
+                          PCAModule.randomizedPCA]
         self.methodOptions.mainLayout = qt.QGridLayout(self.methodOptions)
         self.methodOptions.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.methodOptions.mainLayout.setSpacing(2)
+        if index != 0:
+            self.methods.append("Incremental")
+            self.functions.append(PCAModule.incrementalPCA)
         if MDP and (index != 0):
             #self.methods.append("MDP (PCA + ICA)")
             self.methods.append("MDP (SVD float32)")
@@ -33,9 +33,14 @@
 from PyMca5.PyMcaGui import PyMcaQt as qt
 from PyMca5.PyMcaGui import ExternalImagesWindow
 from PyMca5.PyMcaGui import PyMcaFileDialogs
-import pyopencl
-import silx.opencl
-from silx.image import sift
+try:
+    import pyopencl
+    import silx.opencl
+    from silx.image import sift
+except ImportError:
+    # numpy implementation of the same interface
+    silx = None
+    from PyMca5.PyMcaMath import sift
 
 DEBUG = 0
 
@@ -60,7 +65,9 @@
 You can restrict the region of the images to be used by drawing a mask.
 
 If you do not find any device listed under OpenCL devices that could mean
-you do not have any OpenCL driver installed in your system.
+you do not have any OpenCL driver installed in your system. The alignment
+can still be performed on the CPU (without OpenCL) selecting the
+"(-1, -1) CPU" device, processing several images at a time.
 
 Windows users can at least install the CPU OpenCL drivers from AMD.
 You can easily find them searching the internet for AMD Accelerated Parallel
@@ -112,6 +119,7 @@ def __init__(self, parent=None, ndim=2):
             self.deviceSelector.clear()
             for device in devices:
                 self.deviceSelector.addItem("(%d, %d) %s" % (device[0], device[1], device[2]))
+            self.deviceSelector.addItem("(-1, -1) CPU (without OpenCL)")
 
     def _build(self):
         self.mainLayout = qt.QGridLayout(self)
@@ -128,7 +136,7 @@ def _build(self):
         label = qt.QLabel(self)
         label.setText("OpenCL Device:")
         self.deviceSelector = qt.QComboBox(self)
-        self.deviceSelector.addItem("(-1, -1) No OpenCL device found")
+        self.deviceSelector.addItem("(-1, -1) CPU (no OpenCL device found)")
         #self.mainLayout.addWidget(self.aboutSiftButton, 0, 0, 1, 2)
         self.mainLayout.addWidget(self._infoDocument, 0, 0, 2, 2)
         self.mainLayout.addWidget(label, 2, 0)
@@ -147,6 +155,8 @@ def _showInfo(self):
 
     def getOpenCLDevices(self):
         devices = []
+        if silx is None:
+            return devices
         if silx.opencl.ocl is not None:
             for platformid, platform in enumerate(silx.opencl.ocl.platforms):
                 for deviceid, dev in enumerate(platform.devices):
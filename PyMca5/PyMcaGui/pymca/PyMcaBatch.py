@@ -33,6 +33,7 @@
 import time
 import subprocess
 import signal
+import tempfile
 import atexit
 import logging
 from glob import glob
@@ -54,7 +55,9 @@
 except ImportError:
     HDF5SUPPORT = False
 from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import OutputBuffer
 from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+from PyMca5.PyMcaPhysics.xrf import XRFBatchScheduler
 from PyMca5.PyMcaGui.physics.xrf import QtMcaAdvancedFitReport
 from PyMca5.PyMcaGui.io import PyMcaFileDialogs
 from PyMca5.PyMcaGui.io import ConfigurationFileDialogs
@@ -478,6 +481,7 @@ def __init__(self,parent=None,name="PyMca batch fitting",fl=None,
         self._showResult = showresult
         self._timer = None
         self._processList = []
+        self._sharedDir = None
         self._selection = None
         self.__build(actions, **guikwargs)
         if filelist is None:
@@ -501,7 +505,9 @@ def __init__(self,parent=None,name="PyMca batch fitting",fl=None,
     def __build(self, actions, roifit=0, roiwidth=ROIWIDTH, overwrite=1,
                 concentrations=0, fitfiles=0, diagnostics=0, multipage=0,
                 tif=0, edf=1, csv=0, h5=1, dat=0, nproc=1,
-                table=2, html=0):
+                table=2, html=0, readbuffer=None, warmstart=0):
+        self._readBuffer = readbuffer
+        self._warmStart = warmstart
         self.__grid= qt.QWidget(self)
         self._layout.addWidget(self.__grid)
         #self.__grid.setGeometry(qt.QRect(30,30,288,156))
@@ -1298,6 +1304,10 @@ def start(self, blocking=False):
         cmd.addOption('mcastep', value=1)
         cmd.addOption('fitfiles', value=self.__fitBox.isChecked(), format="{:d}")
         cmd.addOption('selection', value=self._selection, format="{:d}", convert=bool)
+        if self._readBuffer:
+            cmd.addOption('readbuffer', value=self._readBuffer)
+        if self._warmStart:
+            cmd.addOption('warmstart', value=self._warmStart, format="{:d}")
 
         if cmd.roifit:
             cmd.addOption('roiwidth', value=float(qt.safe_str(self.__roiSpin.text())))
@@ -1425,7 +1435,17 @@ def _runInProcessMonitored(self, cmd):
         processList = []
         nFiles = len(self.fileList)
         nBatches = self._nProcesses
-        if nBatches > 1:
+        if nBatches > 1 and not (cmd.fitfiles or cmd.html):
+            # One process distributing blocks of the map to its workers
+            cmd.addOption('workers', value=nBatches)
+            self._runInProcess(cmd, blocking=False,
+                               processList=processList)
+        elif nBatches > 1:
+            # The processes fill the same memory-mapped images which
+            # are saved once when all of them are finished
+            self._sharedDir = tempfile.mkdtemp(prefix='shared_',
+                                               dir=self.outputDir)
+            cmd.addOption('shared', value=self._sharedDir, format='"{}"')
             def launch(cmd):
                 self._runInProcess(cmd, blocking=False,
                                    processList=processList)
@@ -1518,6 +1538,13 @@ def _pollProcessList(self):
 
     def _mergeProcessResults(self):
         _logger.info('Merging multi-process results...')
+        if self._sharedDir:
+            sharedDir, self._sharedDir = self._sharedDir, None
+            try:
+                OutputBuffer.saveSharedBuffers(sharedDir)
+            except:
+                _logger.error("Error saving %s\n: %s", sharedDir, sys.exc_info()[1])
+        # Outputs without shared buffers (e.g. concentrations text file)
         work = PyMcaBatchBuildOutput.PyMcaBatchBuildOutput(inputdir=self.outputDir)
         delete = _logger.getEffectiveLevel() != logging.DEBUG
         basename = McaAdvancedFitBatch.getRootName(self.fileList)
@@ -1643,6 +1670,18 @@ def __pauseMethod(self):
             qt.QApplication.postEvent(self.parent, McaCustomEvent.McaCustomEvent({'event':'batchResumed'}))
 
 
+class McaScheduledBatch(XRFBatchScheduler.BatchScheduler, McaBatch):
+    """
+    Batch fitting thread which distributes the map to worker processes
+    """
+
+    def __init__(self, parent, configfile, **kwargs):
+        XRFBatchScheduler.BatchScheduler.__init__(self, configfile, **kwargs)
+        qt.QThread.__init__(self)
+        self.parent = parent
+        self.pleasePause = 0
+
+
 class McaBatchWindow(qt.QWidget):
     """
     Widget to control batch fitting threads
@@ -2007,7 +2046,8 @@ def main():
                    'nativefiledialogs=','selection=', 'exitonend=',
                    'edf=', 'h5=', 'csv=', 'tif=', 'dat=', 'diagnostics=',
                    'logging=', 'debug=', 'gui=', 'multipage=', 'nproc=',
-                   'showresult=']
+                   'showresult=', 'readbuffer=', 'warmstart=', 'workers=',
+                   'shared=']
     filelist = None
     outdir = None
     cfg = None
@@ -2039,6 +2079,10 @@ def main():
     dat = 1
     multipage = 0
     nproc = 1
+    readbuffer = None
+    warmstart = 0
+    workers = 0
+    shared = None
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -2113,6 +2157,14 @@ def main():
             multipage = int(arg)
         elif opt == '--nproc':
             nproc = max(int(arg), 0)
+        elif opt == '--readbuffer':
+            readbuffer = float(arg)
+        elif opt == '--warmstart':
+            warmstart = int(arg)
+        elif opt == '--workers':
+            workers = int(arg)
+        elif opt == '--shared':
+            shared = arg
     level = getLoggingLevel(opts)
     logging.basicConfig(level=level)
     _logger.setLevel(level)
@@ -2160,7 +2212,8 @@ def main():
                         concentrations=concentrations, fitfiles=fitfiles,
                         diagnostics=diagnostics, multipage=multipage,
                         tif=tif, edf=edf, csv=csv, h5=h5, dat=dat, nproc=nproc,
-                        table=table, html=html)
+                        table=table, html=html, readbuffer=readbuffer,
+                        warmstart=warmstart)
         w.show()
         w.raise_()
     else:
@@ -2171,13 +2224,24 @@ def main():
                                 outputdir=outdir,html=html, htmlindex=htmlindex, table=table,
                                 chunk=chunk, exitonend=exitonend, showresult=showresult)
         try:
-            thread = McaBatch(window,cfg,filelist=filelist,outputdir=outdir,roifit=roifit,roiwidth=roiwidth,
+            kwargs = {}
+            if workers > 1 and not fitfiles:
+                batchclass = McaScheduledBatch
+                kwargs["nworkers"] = workers
+            else:
+                batchclass = McaBatch
+                kwargs["chunk"] = chunk
+                if shared:
+                    kwargs["sharedDir"] = shared
+            thread = batchclass(window,cfg,filelist=filelist,outputdir=outdir,roifit=roifit,roiwidth=roiwidth,
                               overwrite=overwrite, filestep=filestep, mcastep=mcastep,
                               concentrations=concentrations, fitfiles=fitfiles,
                               filebeginoffset=filebeginoffset,fileendoffset=fileendoffset,
-                              mcaoffset=mcaoffset, chunk=chunk, selection=selection,
+                              mcaoffset=mcaoffset, selection=selection,
                               diagnostics=diagnostics, multipage=multipage,
-                              tif=tif, edf=edf, csv=csv, h5=h5, dat=dat)
+                              tif=tif, edf=edf, csv=csv, h5=h5, dat=dat,
+                              readbuffer=readbuffer, warmstart=warmstart,
+                              **kwargs)
         except:
             if exitonend:
                 _logger.warning("Error: ", sys.exc_info()[1])
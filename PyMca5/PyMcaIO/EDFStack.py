@@ -48,6 +48,12 @@
 except:
     pass
 
+try:
+    from PyMca5.PyMcaIO import PilatusCBF
+    PILATUS_CBF_SUPPORT = True
+except ImportError:
+    PILATUS_CBF_SUPPORT = False
+
 
 SOURCE_TYPE = "EdfFileStack"
 _logger = logging.getLogger(__name__)
@@ -57,8 +63,126 @@
 Y_AXIS=1
 Z_AXIS=2
 
+class EdfArray(object):
+    """
+    Read-only 3D array made of one image per file. The images are memory
+    mapped when first accessed and only the requested part is read.
+    """
+    def __init__(self, filelist, shape, dtype, fileaxis=0):
+        """
+        :param list filelist: EDF files with one uncompressed image each
+        :param tuple shape: 3D shape of the stack
+        :param dtype: data type of the returned arrays
+        :param int fileaxis: axis of the stack indexing the files
+        """
+        self.__fileList = filelist
+        self.__shape = tuple(shape)
+        self.__dtype = numpy.dtype(dtype)
+        self.__fileAxis = fileaxis
+        self.__imageShape = tuple(n for i, n in enumerate(self.__shape)
+                                  if i != fileaxis)
+        self.__images = [None] * len(filelist)
+
+    def getImage(self, index):
+        """
+        :param int index: file index
+        :returns array: view of the image (a copy when a conversion
+                        of data type or shape is needed)
+        """
+        image = self.__images[index]
+        if image is None:
+            fileName = self.__fileList[index]
+            image = EdfFile.EdfFile(fileName, 'rb').GetMemmap(0)
+            if image.shape != self.__imageShape:
+                _logger.warning(" ERROR on file %s", fileName)
+                _logger.warning(" Assuming missing data were at the end!!!")
+                padded = numpy.zeros(self.__imageShape, self.__dtype)
+                s0 = min(image.shape[0], padded.shape[0])
+                s1 = min(image.shape[1], padded.shape[1])
+                padded[:s0, :s1] = image[:s0, :s1]
+                image = padded
+            self.__images[index] = image
+        if image.dtype != self.__dtype:
+            image = image.astype(self.__dtype)
+        return image
+
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        if Ellipsis in args:
+            i = args.index(Ellipsis)
+            args = args[:i] + \
+                   (slice(None),) * (len(self.__shape) - len(args) + 1) + \
+                   args[i + 1:]
+        args = args + (slice(None),) * (len(self.__shape) - len(args))
+        fileArg = args[self.__fileAxis]
+        imageArgs = tuple(arg for i, arg in enumerate(args)
+                          if i != self.__fileAxis)
+        if isinstance(fileArg, (int, numpy.integer)):
+            return numpy.array(self.getImage(fileArg)[imageArgs],
+                               dtype=self.__dtype, copy=False)
+        indices = numpy.arange(self.__shape[self.__fileAxis])[fileArg]
+        # position of the file axis in the output
+        axis = len([arg for arg in args[:self.__fileAxis]
+                    if not isinstance(arg, (int, numpy.integer))])
+        nImages = len(indices)
+        output = None
+        for i, index in enumerate(indices):
+            image = self.getImage(index)[imageArgs]
+            if output is None:
+                shape = list(numpy.shape(image))
+                shape.insert(axis, nImages)
+                output = numpy.empty(shape, dtype=self.__dtype)
+                idx = [slice(None)] * len(shape)
+            idx[axis] = i
+            output[tuple(idx)] = image
+        if output is None:
+            shape = list(numpy.zeros(self.__imageShape)[imageArgs].shape)
+            shape.insert(axis, 0)
+            output = numpy.empty(shape, dtype=self.__dtype)
+        return output
+
+    def __array__(self, dtype=None):
+        data = self[()]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __len__(self):
+        return self.__shape[0]
+
+    def getShape(self):
+        return self.__shape
+    shape = property(getShape)
+
+    def getDtype(self):
+        return self.__dtype
+    dtype = property(getDtype)
+
+    def getSize(self):
+        s = 1
+        for item in self.__shape:
+            s *= item
+        return s
+    size = property(getSize)
+
+    def getNdim(self):
+        return len(self.__shape)
+    ndim = property(getNdim)
+
+
 class EDFStack(DataObject.DataObject):
-    def __init__(self, filelist = None, imagestack=None, dtype=None):
+    def __init__(self, filelist = None, imagestack=None, dtype=None,
+                 dynamic=None):
+        """
+        :param list filelist: files of the stack
+        :param bool imagestack: True when each file is an image of the
+                                stack, False when it is a set of spectra
+        :param dtype: data type of the stack
+        :param bool dynamic: True to memory map the files instead of
+                             reading them, None to do it only when there
+                             is not enough memory to hold the stack
+        """
         DataObject.DataObject.__init__(self)
         self.incrProgressBar=0
         self.__keyList = []
@@ -67,6 +191,7 @@ def __init__(self, filelist = None, imagestack=None, dtype=None):
         else:
             self.__imageStack = imagestack
         self.__dtype = dtype
+        self.__dynamic = dynamic
         if filelist is not None:
             if type(filelist) != type([]):
                 filelist = [filelist]
@@ -75,7 +200,7 @@ def __init__(self, filelist = None, imagestack=None, dtype=None):
             else:
                 self.loadFileList(filelist)
 
-    def loadFileList(self, filelist, fileindex=0):
+    def loadFileList(self, filelist, fileindex=0, dynamic=None):
         if type(filelist) == type(''):filelist = [filelist]
         self.__keyList = []
         self.sourceName = filelist
@@ -110,6 +235,10 @@ def loadFileList(self, filelist, fileindex=0):
         if self.__dtype is None:
             self.__dtype = arrRet.dtype
 
+        if self._loadDynamicFileList(filelist, fileindex, nImages, arrRet,
+                                     dynamic):
+            return
+
         self.onBegin(self.nbFiles)
         singleImageShape = arrRet.shape
         actualImageStack = False
@@ -176,7 +305,17 @@ def loadFileList(self, filelist, fileindex=0):
                                                      arrRet.shape[1]),
                                                      self.__dtype)
                             self.incrProgressBar=0
-                            for tempEdfFileName in filelist:
+                            if (nImages == 1) and \
+                               self._isPilatusCBFList(filelist):
+                                # decode the files in parallel
+                                PilatusCBF.readStack(filelist, out=self.data,
+                                                     nthreads=0)
+                                self.incrProgressBar = self.nbFiles
+                                self.onProgress(self.incrProgressBar)
+                                filesToRead = []
+                            else:
+                                filesToRead = filelist
+                            for tempEdfFileName in filesToRead:
                                 tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
                                 pieceOfStack=tempEdf.GetData(0)
                                 self.data[self.incrProgressBar] = pieceOfStack
@@ -441,7 +580,18 @@ def loadFileList(self, filelist, fileindex=0):
                                     motorName = positionersEdf.GetHeader(i).get("Title", "Motor_%02d" % i)
                                     motorValue = positionersEdf.GetData(i)
                                     self.info["positioners"][motorName] = motorValue
-                        for tempEdfFileName in filelist:
+                        if (not ID24) and (nImages == 1) and \
+                           self._isPilatusCBFList(filelist) and \
+                           isinstance(self.data, numpy.ndarray):
+                            # decode the files in parallel
+                            PilatusCBF.readStack(filelist, out=self.data,
+                                                 nthreads=0)
+                            self.incrProgressBar = self.nbFiles
+                            self.onProgress(self.incrProgressBar)
+                            filesToRead = []
+                        else:
+                            filesToRead = filelist
+                        for tempEdfFileName in filesToRead:
                             tempEdf=EdfFile.EdfFile(tempEdfFileName, 'rb')
                             if ID24:
                                 pieceOfStack=-numpy.log((tempEdf.GetData(0) - bckData)/(i0Start[0,:] + id24idx * i0Slope))
@@ -519,6 +669,69 @@ def loadFileList(self, filelist, fileindex=0):
                 self.info["xScale"] = (originX, deltaX)
                 self.info["yScale"] = (originY, deltaY)
 
+    @staticmethod
+    def _isPilatusCBFList(filelist):
+        if not PILATUS_CBF_SUPPORT:
+            return False
+        for fname in filelist:
+            if not os.path.basename(fname).upper().endswith('.CBF'):
+                return False
+        return True
+
+    def _loadDynamicFileList(self, filelist, fileindex, nImages, arrRet,
+                             dynamic=None):
+        """
+        Use an EdfArray when the files can be memory mapped and either it
+        is requested or the stack does not fit in memory.
+
+        :returns bool: True if the stack has been loaded
+        """
+        if dynamic is None:
+            dynamic = self.__dynamic
+        if dynamic is not None and not dynamic:
+            return False
+        imageStack = (fileindex == 2) or bool(self.__imageStack)
+        if (nImages != 1) or (len(arrRet.shape) != 2) or \
+           ("_sample_" in filelist[0]):
+            # ID24 maps are processed while reading
+            return False
+        try:
+            if not EdfFile.EdfFile(filelist[0], 'rb').IsMemmapSupported(0):
+                return False
+        except Exception:
+            return False
+        if dynamic is None:
+            needed_ = self.nbFiles * arrRet.size * \
+                      numpy.dtype(self.__dtype).itemsize
+            physicalMemory = PhysicalMemory.getPhysicalMemoryOrNone()
+            if (physicalMemory is None) or (physicalMemory >= 1.05 * needed_):
+                return False
+            _logger.info("Not enough memory for the stack. Using memory mapping")
+        self.__imageStack = imageStack
+        if imageStack or (fileindex == 0):
+            shape = (self.nbFiles, arrRet.shape[0], arrRet.shape[1])
+            fileaxis = 0
+        else:
+            shape = (arrRet.shape[0], self.nbFiles, arrRet.shape[1])
+            fileaxis = 1
+        self.data = EdfArray(filelist, shape, self.__dtype,
+                             fileaxis=fileaxis)
+        self.__nFiles = self.nbFiles
+        self.__nImagesPerFile = nImages
+        for i in range(len(shape)):
+            key = 'Dim_%d' % (i+1,)
+            self.info[key] = shape[i]
+        self.info["SourceType"] = SOURCE_TYPE
+        if imageStack:
+            self.info["McaIndex"] = 0
+            self.info["FileIndex"] = 1
+        else:
+            self.info["FileIndex"] = fileindex
+        self.info["SourceName"] = self.sourceName
+        self.info["NumberOfFiles"] = self.__nFiles * 1
+        self.info["Size"] = self.__nFiles * self.__nImagesPerFile
+        return True
+
     def onBegin(self, n):
         pass
 
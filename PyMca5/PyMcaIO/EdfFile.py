@@ -40,6 +40,7 @@ class EdfFile:
         __init__(self,FileName)
         GetNumImages(self)
         def GetData(self,Index, DataType="",Pos=None,Size=None):
+        GetMemmap(self,Index)
         GetPixel(self,Index,Position)
         GetHeader(self,Index)
         GetStaticHeader(self,Index)
@@ -759,6 +760,52 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
         return Data
 
 
+    def IsMemmapSupported(self, Index):
+        """ Returns True if the data of the image can be memory mapped
+            (uncompressed EDF image in a regular file)
+            Index:          The zero-based index of the image in the file
+        """
+        if Index < 0 or Index >= self.NumImages:
+            raise ValueError("EdfFile: Index out of limit")
+        if self.ADSC or self.MARCCD or self.TIFF or self.PILATUS_CBF or \
+           self.SPE:
+            return False
+        if not self.__ownedOpen:
+            # compressed file or file object
+            return False
+        for key, value in self.Images[Index].Header.items():
+            if key.upper() == "COMPRESSION":
+                if value.upper() not in ["", "NONE", "NO"]:
+                    return False
+        return True
+
+    def GetMemmap(self, Index):
+        """ Returns a read-only numpy.memmap of the image data without
+            reading it. The data are read from disk when accessed.
+            The byte order of the file is kept in the dtype.
+            Index:          The zero-based index of the image in the file
+        """
+        if not self.IsMemmapSupported(Index):
+            raise IOError("EdfFile: Image %d cannot be memory mapped" % Index)
+        image = self.Images[Index]
+        datatype = numpy.dtype(self.__GetDefaultNumpyType__(image.DataType,
+                                                             index=Index))
+        if image.ByteOrder.upper() == "HIGHBYTEFIRST":
+            datatype = datatype.newbyteorder(">")
+        else:
+            datatype = datatype.newbyteorder("<")
+        if image.NumDim == 3:
+            shape = (image.Dim3, image.Dim2, image.Dim1)
+        elif image.NumDim == 2:
+            shape = (image.Dim2, image.Dim1)
+        else:
+            shape = (image.Dim1,)
+        nbytes = datatype.itemsize * int(numpy.prod(shape))
+        if os.path.getsize(self.FileName) < image.DataPosition + nbytes:
+            raise IOError("EdfFile: Image %d is truncated" % Index)
+        return numpy.memmap(self.FileName, dtype=datatype, mode="r",
+                            offset=image.DataPosition, shape=shape)
+
     def _GetPixel(self, Index, Position):
         """ Returns double value of the pixel, regardless the format of the array
             Index:      The zero-based index of the image in the file
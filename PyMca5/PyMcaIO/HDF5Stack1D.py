@@ -30,6 +30,7 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import os
 import posixpath
 import numpy
 import h5py
@@ -43,10 +44,112 @@
 
 SOURCE_TYPE = "HDF5Stack1D"
 
+
+def _virtualDataset(shape, dtype, sources):
+    """
+    Map the source datasets onto an in-memory virtual dataset.
+
+    :param shape: (dim0, dim1, mcaDim) shape of the virtual dataset
+    :param dtype: data type of the source datasets
+    :param sources: list of (file name, dataset path, dataset shape, first
+                    spectrum) of the source datasets
+    :returns: h5py virtual dataset
+    """
+    dim1 = shape[1]
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    for filename, path, sourceShape, n in sources:
+        source = h5py.VirtualSource(filename, path,
+                                    shape=sourceShape, dtype=dtype)
+        if len(sourceShape) == 1:
+            layout[n // dim1, n % dim1] = source
+            continue
+        if len(sourceShape) == 2:
+            rows = [()]
+        else:
+            rows = [(ii,) for ii in range(sourceShape[0])]
+        nRowMca = sourceShape[-2]
+        for row in rows:
+            # a row of the source may span several rows of the stack
+            k = 0
+            while k < nRowMca:
+                i, j = divmod(n + k, dim1)
+                m = min(nRowMca - k, dim1 - j)
+                layout[i, j:j + m] = source[row + (slice(k, k + m),)]
+                k += m
+            n += nRowMca
+    # the virtual dataset only lives in memory, the source files
+    # may already be open and must not be locked again
+    name = "%s_%x" % (SOURCE_TYPE, id(layout))
+    try:
+        virtualFile = h5py.File(name, "w", driver="core",
+                                backing_store=False, locking=False)
+    except TypeError:
+        virtualFile = h5py.File(name, "w", driver="core",
+                                backing_store=False)
+    return virtualFile.create_virtual_dataset("data", layout, fillvalue=0)
+
+
+class VirtualStack(object):
+    """
+    Read only 3D stack of spectra backed by an HDF5 virtual dataset.
+
+    Nothing is read until the stack is indexed and then only the parts of
+    the source datasets covered by the selection are read. Indexing follows
+    the h5py dataset rules. The spectra are divided by the monitor, if any,
+    and converted to the stack data type on the fly.
+
+    The stack can be pickled: the virtual dataset is created again from
+    the source files (e.g. in a worker process).
+    """
+    def __init__(self, shape, sourceDtype, sources, monitor=None, dtype=None):
+        """
+        :param shape: (dim0, dim1, mcaDim)
+        :param sourceDtype: data type of the source datasets
+        :param sources: see _virtualDataset
+        :param monitor: one value per spectrum
+        :param dtype: data type of the stack (source data type by default)
+        """
+        self._dataset = _virtualDataset(shape, sourceDtype, sources)
+        self._sources = sources
+        self.shape = self._dataset.shape
+        self.ndim = len(self.shape)
+        self.size = int(numpy.prod(self.shape))
+        if dtype is None:
+            dtype = self._dataset.dtype
+        self.dtype = numpy.dtype(dtype)
+        if monitor is None:
+            self._monitorValues = None
+            self._monitor = None
+        else:
+            monitor = numpy.asarray(monitor).reshape(self.shape[:-1] + (1,))
+            self._monitorValues = monitor
+            self._monitor = numpy.broadcast_to(monitor, self.shape)
+
+    def __reduce__(self):
+        return (VirtualStack, (self.shape, self._dataset.dtype, self._sources,
+                               self._monitorValues, self.dtype))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        data = self._dataset[idx]
+        if self._monitor is not None:
+            data = data / self._monitor[idx]
+        return numpy.asarray(data, dtype=self.dtype)
+
+    def __array__(self, dtype=None):
+        data = self[()]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
 class HDF5Stack1D(DataObject.DataObject):
     def __init__(self, filelist, selection,
                        scanlist=None,
-                       dtype=None):
+                       dtype=None,
+                       lazy=None):
         DataObject.DataObject.__init__(self)
 
         #the data type of the generated stack
@@ -55,11 +158,11 @@ def __init__(self, filelist, selection,
 
         if filelist is not None:
             if selection is not None:
-                self.loadFileList(filelist, selection, scanlist)
+                self.loadFileList(filelist, selection, scanlist, lazy=lazy)
 
-    def loadFileList(self, filelist, selection, scanlist=None):
+    def loadFileList(self, filelist, selection, scanlist=None, lazy=None):
         """
-        loadFileList(self, filelist, y, scanlist=None, monitor=None, x=None)
+        loadFileList(self, filelist, y, scanlist=None, lazy=None)
         filelist is the list of file names belonging to the stack
         selection is a dictionary with the keys x, y, m.
         x        is the path to the x data (the channels) in the spectrum,
@@ -73,6 +176,12 @@ def loadFileList(self, filelist, selection, scanlist=None):
                  /whatever1/whatever2/counts
                  That means scanlist = ["/whatever1"]
                  and selection['y'] = "/whatever2/counts"
+        lazy     True to read the spectra from the files on access instead of
+                 copying them into memory, False to always copy them and None
+                 to read them on access only when the stack does not fit into
+                 memory. Reading on access requires the channels to be the last
+                 dimension, a single y selection and a monitor, if any, with one
+                 value per spectrum. Otherwise the spectra are copied.
         """
         _logger.info("filelist = %s", filelist)
         _logger.info("selection = %s", selection)
@@ -282,6 +391,7 @@ def loadFileList(self, filelist, selection, scanlist=None):
         considerAsImages = False
         dim0, dim1, mcaDim = self.getDimensions(nFiles, nScans, shape,
                                                 index=mcaIndex)
+        LAZY = False
         try:
             if self.__dtype in [numpy.float32, numpy.int32]:
                 bytefactor = 4
@@ -311,7 +421,18 @@ def loadFileList(self, filelist, selection, scanlist=None):
             else:
                 physicalMemory /= (1024*1024.)
             _logger.info("Using physical memory %.1f GBytes" % (physicalMemory/1024))
-            if (neededMegaBytes > (0.95*physicalMemory))\
+            if (mcaIndex != 0) and (len(ySelectionList) == 1):
+                if lazy or ((lazy is None) and \
+                            (neededMegaBytes > (0.95*physicalMemory)) and \
+                            ((nFiles > 1) or (nScans > 1) or \
+                             (mSelection is not None))):
+                    virtualStack, virtualSources = self._getVirtualStack( \
+                                hdfStack, scanlist, JUST_KEYS,
+                                ySelection, mSelection, (dim0, dim1, mcaDim))
+                    if virtualStack is not None:
+                        self.data = virtualStack
+                        LAZY = True
+            if (not LAZY) and (neededMegaBytes > (0.95*physicalMemory))\
                and (nFiles == 1) and (len(shape) == 3):
                 if self.__dtype0 is None:
                     if (bytefactor == 8) and (neededMegaBytes < (2*physicalMemory)):
@@ -322,7 +443,9 @@ def loadFileList(self, filelist, selection, scanlist=None):
                         raise MemoryError("Force dynamic loading")
                 else:
                     raise MemoryError("Force dynamic loading")
-            if (mcaIndex == 0) and ( nFiles == 1) and (nScans == 1):
+            if LAZY:
+                _logger.info("Spectra read from the files on access")
+            elif (mcaIndex == 0) and ( nFiles == 1) and (nScans == 1):
                 #keep the original arrangement but in memory
                 self.data = numpy.zeros(yDataset.shape, self.__dtype)
                 considerAsImages = True
@@ -440,7 +563,34 @@ def loadFileList(self, filelist, selection, scanlist=None):
             else:
                 self._pathHasRelevantInfo = False
 
-        if (not DONE) and (not considerAsImages):
+        if LAZY:
+            self.info["McaIndex"] = 2
+            for hdf, entryPath, path, n, nMca in virtualSources:
+                if xSelectionList is not None:
+                    xDatasetList = []
+                    for xSelection in xSelectionList:
+                        xDatasetList.append(hdf[entryPath + xSelection][()])
+                if _time is None:
+                    continue
+                if "live_time" in mcaObjectPaths:
+                    timePath = NexusTools.getMcaObjectPaths(hdf, path)["live_time"]
+                else:
+                    timePath = NexusTools.getMcaObjectPaths(hdf,
+                                                            path)["elapsed_time"]
+                timeData = None
+                if timePath in hdf:
+                    timeData = hdf[timePath][()]
+                elif "::" in timePath:
+                    externalFile, externalPath = timePath.split("::")
+                    with h5py.File(externalFile, "r") as timeHdf:
+                        timeData = timeHdf[externalPath][()]
+                if (timeData is None) or (numpy.size(timeData) != nMca):
+                    _logger.warning("I do not know how to handle this time data")
+                    _logger.warning("Ignoring time information")
+                    _time = None
+                else:
+                    _time[n:n + nMca] = numpy.ravel(timeData)
+        elif (not DONE) and (not considerAsImages):
             _logger.info("Data in memory as spectra")
             self.info["McaIndex"] = 2
             n = 0
@@ -895,6 +1045,78 @@ def loadFileList(self, filelist, selection, scanlist=None):
                 self.info["xScale"] = xScale
                 self.info["yScale"] = yScale
 
+    def _getVirtualStack(self, hdfStack, scanlist, JUST_KEYS,
+                         ySelection, mSelection, shape):
+        """
+        Map the selected datasets of all the files onto a virtual dataset
+        of the given (dim0, dim1, mcaDim) shape.
+
+        Returns the VirtualStack and the list of (hdf, entry path, dataset
+        path, first spectrum, number of spectra) of the mapped datasets or
+        (None, None) when the selection cannot be mapped.
+        """
+        if not hasattr(h5py, "VirtualLayout"):
+            _logger.info("Virtual datasets not supported by h5py")
+            return None, None
+        dim0, dim1, mcaDim = shape
+        nSpectra = dim0 * dim1
+        if mSelection is not None:
+            monitor = numpy.zeros((nSpectra,), dtype=numpy.float64)
+        else:
+            monitor = None
+        sources = []
+        dtype = None
+        n = 0
+        for hdf in hdfStack._sourceObjectList:
+            if JUST_KEYS:
+                goodEntryNames = []
+                for entry in hdf["/"].keys():
+                    tmpPath = "/" + entry
+                    try:
+                        if hasattr(hdf[tmpPath], "keys"):
+                            goodEntryNames.append(entry)
+                    except KeyError:
+                        _logger.info("Broken link with key? <%s>" % tmpPath)
+            for scan in scanlist:
+                if JUST_KEYS:
+                    entryPath = "/" + \
+                                goodEntryNames[int(scan.split(".")[-1])-1]
+                else:
+                    entryPath = scan
+                path = entryPath + ySelection
+                yDataset = hdf[path]
+                if (len(yDataset.shape) > 3) or \
+                   (yDataset.shape[-1] != mcaDim):
+                    return None, None
+                if dtype is None:
+                    dtype = yDataset.dtype
+                elif yDataset.dtype != dtype:
+                    return None, None
+                nMca = yDataset.size // mcaDim
+                if (n + nMca) > nSpectra:
+                    return None, None
+                if monitor is not None:
+                    mData = numpy.asarray(hdf[entryPath + mSelection][()],
+                                          dtype=numpy.float64)
+                    if mData.size != nMca:
+                        # not a monitor value per spectrum
+                        return None, None
+                    monitor[n:n + nMca] = mData.reshape(-1)
+                sources.append((hdf, entryPath, path, yDataset.shape, n, nMca))
+                n += nMca
+        if n != nSpectra:
+            return None, None
+
+        virtualStack = VirtualStack(shape, dtype,
+                                    [(os.path.abspath(hdf.filename), path,
+                                      sourceShape, n) \
+                                     for hdf, entryPath, path, sourceShape, n, nMca \
+                                     in sources],
+                                    monitor=monitor, dtype=self.__dtype)
+        return virtualStack, [(hdf, entryPath, path, n, nMca) \
+                              for hdf, entryPath, path, sourceShape, n, nMca \
+                              in sources]
+
     def getDimensions(self, nFiles, nScans, shape, index=None):
         #somebody may want to overwrite this
         """
@@ -36,6 +36,8 @@
 from PyMca5.PyMcaCore import DataObject
 import sys
 SOURCE_TYPE = "EdfFileStack"
+# number of events binned at once
+CHUNK_SIZE = 4 * 1024 * 1024
 
 class OmdaqLmf(list):
     """
@@ -60,11 +62,14 @@ class OmdaqLmf(list):
                     2:1047,
                     3:1055,
                     4:3604} # discrepancy with documentation
-    def __init__(self, filelist):
+    def __init__(self, filelist, firstEvent=0, lastEvent=None):
         """
         Parse a list of files into a list of stacks. One for each stack
         The maximum number of stacks is 8.
         An ADC with no hits will give a stack equal to None 
+
+        The optional event window [firstEvent, lastEvent) is applied to
+        every file.
         """
         super(OmdaqLmf, self).__init__()
         for i in range(8):
@@ -72,13 +77,23 @@ def __init__(self, filelist):
         if type(filelist) not in [type([]), type((1,))]:
             filelist = [filelist]
         for fname in filelist:
-            self.parseFile(fname)
+            self.parseFile(fname, firstEvent=firstEvent, lastEvent=lastEvent)
 
-    def parseFile(self, fname):
-        f = open(fname, "rb")
-        d = f.read()
-        f.close()
-        informationHeader = parseInformationHeader(d)
+    def parseFile(self, fname, firstEvent=0, lastEvent=None):
+        """
+        Add the events of a file to the stacks.
+
+        The file is memory mapped and the events are binned in chunks
+        of consecutive blocks.
+
+        :param str fname: list mode file
+        :param int firstEvent: index of the first event to consider
+        :param int lastEvent: index of the event after the last event to
+            consider. All events until the end of the file when None.
+        :returns int: number of events read
+        """
+        d = numpy.memmap(fname, dtype=numpy.uint8, mode="r")
+        informationHeader = parseInformationHeader(d[:6].tobytes())
         if informationHeader["Identifier"] != 66:
             raise IOError("Not an OMDAQ File")
         if informationHeader["ListMode"] != 2:
@@ -88,50 +103,174 @@ def parseFile(self, fname):
         adc_offset = self.GENERAL_SIZE + self.RUNDATA_SIZE[hv]
         adc_list = parseAdcInfo(d, hv, offset=adc_offset)
 
-        # the offset to the events is unclear, but we know they
-        # are at the end of the file, how they end and the block size
-        block_size = informationHeader["ListModeBlockSize"]
-        n_blocks = len(d) // block_size
-        for i in range(n_blocks):
-            block_end = len(d) - i * block_size
-            block_start = block_end - block_size
-            events = parseLmfBlock(d[block_start:block_end],
-                          lmf_version=informationHeader["ListModeVersion"],
-                          offset=0)
-            n_events = events.shape[0]
-            for idx in range(n_events):
-                adc, row, col, energy = events[idx]
-                #print(adc, energy, row, col)
-                nChannels = int(adc_list[adc]["Calibration"][-1])
-                if nChannels < 1:
-                    continue
-                if self[adc] is None:
-                    self[adc] = DataObject.DataObject()
-                    self[adc].data = numpy.zeros((256, 256, nChannels),
-                                                      dtype=numpy.uint32)
-                    self[adc].info = {}
-                    self[adc].info["SourceType"] = SOURCE_TYPE
-                    try:
-                        name = adc_list[adc]["Name"]
-                        if hasattr(name, "decode"):
-                            name = name.decode("utf-8").strip(chr(0))
-                        self[adc].info["SourceName"] = name
-                    except:
-                        self[adc].info["SourceName"] = adc_list[adc]["Name"]
-                    self[adc].info["McaCalib"] = [\
-                                adc_list[adc]["Calibration"][0],
-                                adc_list[adc]["Calibration"][1],
-                                0.0]
-                    self[adc].info["Channel0"] = 0.0
-                    nSpectra = 256 * 256
-                    nRows = 256
-                    nFiles = nSpectra // nRows
-                    self[adc].info["Size"] = nFiles
-                    self[adc].info["NumberOfFiles"] = nFiles
-                    self[adc].info["FileIndex"] = 0
-                if energy >= nChannels:
-                    continue
-                self[adc].data[row, col, energy] += 1
+        nRead = 0
+        for events in iterLmfEvents(d, informationHeader,
+                                    firstEvent=firstEvent,
+                                    lastEvent=lastEvent):
+            self.addEvents(events, adc_list)
+            nRead += events.shape[0]
+        return nRead
+
+    def addEvents(self, events, adc_list):
+        """
+        Bin events into the stacks.
+
+        :param events: array of (adc, row, col, energy) events as
+            returned by parseLmfBlock
+        :param list adc_list: ADC information as returned by parseAdcInfo
+        """
+        adc = events[:, 0]
+        for iAdc in numpy.unique(adc):
+            nChannels = int(adc_list[iAdc]["Calibration"][-1])
+            if nChannels < 1:
+                continue
+            if self[iAdc] is None:
+                self[iAdc] = self._createStack(adc_list[iAdc], nChannels)
+            data = self[iAdc].data
+            nChannels = min(nChannels, data.shape[-1])
+            selected = events[adc == iAdc]
+            row = selected[:, 1]
+            col = selected[:, 2]
+            energy = selected[:, 3]
+            goodEvents = (energy < nChannels) & \
+                         (row < data.shape[0]) & \
+                         (col < data.shape[1])
+            if not goodEvents.all():
+                row = row[goodEvents]
+                col = col[goodEvents]
+                energy = energy[goodEvents]
+            index = (row.astype(numpy.intp) * data.shape[1] + col) * \
+                    data.shape[2] + energy
+            _histogram(data.reshape(-1), index)
+
+    @staticmethod
+    def _createStack(adc_info, nChannels):
+        stack = DataObject.DataObject()
+        stack.data = numpy.zeros((256, 256, nChannels), dtype=numpy.uint32)
+        stack.info = {}
+        stack.info["SourceType"] = SOURCE_TYPE
+        try:
+            name = adc_info["Name"]
+            if hasattr(name, "decode"):
+                name = name.decode("utf-8").strip(chr(0))
+            stack.info["SourceName"] = name
+        except:
+            stack.info["SourceName"] = adc_info["Name"]
+        stack.info["McaCalib"] = [adc_info["Calibration"][0],
+                                  adc_info["Calibration"][1],
+                                  0.0]
+        stack.info["Channel0"] = 0.0
+        nSpectra = 256 * 256
+        nRows = 256
+        nFiles = nSpectra // nRows
+        stack.info["Size"] = nFiles
+        stack.info["NumberOfFiles"] = nFiles
+        stack.info["FileIndex"] = 0
+        return stack
+
+def _histogram(flatData, index):
+    """
+    Increment flatData at the given (repeated) indices.
+    """
+    if not index.size:
+        return
+    if 16 * index.size >= flatData.size:
+        counts = numpy.bincount(index)
+        numpy.add(flatData[:counts.size], counts,
+                  out=flatData[:counts.size], casting="unsafe")
+    else:
+        # sparse histogram
+        index, counts = numpy.unique(index, return_counts=True)
+        flatData[index] += counts.astype(flatData.dtype)
+
+def _lmfRecordDtype(lmf_version):
+    if lmf_version < 2:
+        return numpy.dtype([("row", "u1"), ("col", "u1"),
+                            ("adc_energy", "<u2")])
+    else:
+        return numpy.dtype([("row", "<u4"), ("col", "<u4"),
+                            ("adc_energy", "<u4")])
+
+def _lmfBlockEnd(block, start, end, size):
+    """
+    End of the events of the block [start, end) excluding the
+    0xffff padding at its end.
+    """
+    # size of block header
+    block_header_size = 20
+    events = block[start + block_header_size:end]
+    n = len(events) // size
+    if n < 1:
+        return end
+    # the last two bytes of the records counted from the end
+    last = len(events) - size * numpy.arange(n)
+    padding = (events[last - 2] == 0xff) & (events[last - 1] == 0xff)
+    if padding.all():
+        return end - n * size
+    return end - int(numpy.argmin(padding)) * size
+
+def _lmfEvents(records):
+    EnergyMask = 0x0fff
+    ChannelMask = 0x7000
+    events = numpy.empty((records.shape[0], 4), dtype=numpy.uint16)
+    adc_energy = records["adc_energy"]
+    events[:, 0] = (adc_energy & ChannelMask) >> 12
+    events[:, 1] = records["row"]
+    events[:, 2] = records["col"]
+    events[:, 3] = adc_energy & EnergyMask
+    return events
+
+def iterLmfEvents(d, informationHeader, firstEvent=0, lastEvent=None,
+                  chunkSize=CHUNK_SIZE):
+    """
+    Read the events of a list mode file in file order.
+
+    The events are at the end of the file in blocks of
+    ListModeBlockSize bytes.
+
+    :param d: the file contents, typically a memory mapped uint8 array
+    :param dict informationHeader: as returned by parseInformationHeader
+    :param int firstEvent: index of the first event to read
+    :param int lastEvent: index of the event after the last event to read
+    :param int chunkSize: approximate number of events per chunk
+    :returns: generator of arrays of (adc, row, col, energy) events
+    """
+    if isinstance(d, numpy.memmap):
+        # avoid the overhead of slicing memmap instances
+        d = d.view(numpy.ndarray)
+    block_size = informationHeader["ListModeBlockSize"]
+    recordDtype = _lmfRecordDtype(informationHeader["ListModeVersion"])
+    size = recordDtype.itemsize
+    block_header_size = 20
+    n_blocks = len(d) // block_size
+    first_block = len(d) - n_blocks * block_size
+    iEvent = 0
+    pieces = []
+    nPieces = 0
+    for i in range(n_blocks):
+        if (lastEvent is not None) and (iEvent >= lastEvent):
+            break
+        block_start = first_block + i * block_size
+        block_end = _lmfBlockEnd(d, block_start, block_start + block_size,
+                                 size)
+        events_start = block_start + block_header_size
+        n_events = (block_end - events_start) // size
+        # restrict to the requested window
+        i0 = max(firstEvent - iEvent, 0)
+        i1 = n_events
+        if lastEvent is not None:
+            i1 = min(lastEvent - iEvent, n_events)
+        iEvent += n_events
+        if i1 <= i0:
+            continue
+        pieces.append(d[events_start + i0 * size:events_start + i1 * size])
+        nPieces += i1 - i0
+        if nPieces >= chunkSize:
+            yield _lmfEvents(numpy.concatenate(pieces).view(recordDtype))
+            pieces = []
+            nPieces = 0
+    if nPieces:
+        yield _lmfEvents(numpy.concatenate(pieces).view(recordDtype))
 
 def parseAdcInfo(block, header_version, offset=0):
     HV_ADC_OFFSETS = {1: 122,
@@ -161,30 +300,17 @@ def parseAdcInfo(block, header_version, offset=0):
     return adc
 
 def parseLmfBlock(block, lmf_version=0, offset=0):
-    EnergyMask = 0x0fff
-    ChannelMask = 0x7000
-    if lmf_version < 2:
-        fmt = "<BBH"
-    else:
-        fmt = "<III"
+    recordDtype = _lmfRecordDtype(lmf_version)
     # size of block header
     block_header_size = 20
-    size = struct.calcsize(fmt)
+    size = recordDtype.itemsize
+    if not isinstance(block, numpy.ndarray):
+        block = numpy.frombuffer(block, dtype=numpy.uint8)
     block_start = offset + block_header_size
-    block_end = len(block)
-    while block[block_end - 2: block_end] == b'\xff\xff':
-        block_end -= size
-    offset = block_start
-    n_events = (block_end - offset) // size
-    events = numpy.zeros((n_events, 4), dtype=numpy.uint16)
-    for event in range(n_events):
-        row, col, adc_energy = struct.unpack(fmt,
-                                             block[offset:offset+size])
-        adc = (adc_energy & ChannelMask) >> 12
-        energy = (adc_energy & EnergyMask)
-        events[event] = adc, row, col, energy
-        offset += size
-    return events
+    block_end = _lmfBlockEnd(block, offset, len(block), size)
+    n_events = (block_end - block_start) // size
+    records = block[block_start:block_start + n_events * size]
+    return _lmfEvents(numpy.ascontiguousarray(records).view(recordDtype))
   
 def parseInformationHeader(d):
     """
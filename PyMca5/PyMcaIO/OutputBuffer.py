@@ -38,17 +38,33 @@
 import time
 import re
 import itertools
+import threading
+import tempfile
+import zlib
+import errno
+import shutil
+import json
 if sys.version_info[0] < 3:
     string_types = basestring,
 else:
     string_types = str,
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from contextlib import contextmanager
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 try:
     from collections.abc import MutableMapping
 except ImportError:
     from collections import MutableMapping
 from . import NexusUtils
+from . import ConfigDict
+try:
+    # compression filters other than gzip and lzf
+    import hdf5plugin
+except Exception:
+    hdf5plugin = None
 
 _logger = logging.getLogger(__name__)
 
@@ -57,6 +73,274 @@
 else:
     bufferTypes = list,  numpy.ndarray, NexusUtils.h5py.Dataset
 
+compressionTypes = 'gzip', 'lzf', 'bitshuffle', 'bitshuffle-lz4', 'lz4'
+
+SHARED_STATE = 'outputbuffer.json'
+
+
+def compressionArguments(compression=None, level=None):
+    """
+    HDF5 dataset creation arguments for compression
+
+    :param str compression: None, 'gzip', 'lzf', 'bitshuffle' (with LZ4)
+                            or 'lz4'. The last two need hdf5plugin and are
+                            replaced by gzip when it is missing.
+    :param int level: gzip compression level (default: 4)
+    :returns dict: see h5py.Group.create_dataset
+    """
+    if not compression:
+        return {}
+    compression = compression.lower()
+    if compression in ('bitshuffle', 'bitshuffle-lz4', 'lz4'):
+        if hdf5plugin is not None:
+            if compression == 'lz4':
+                return dict(hdf5plugin.LZ4())
+            else:
+                return dict(hdf5plugin.Bitshuffle())
+        _logger.warning('hdf5plugin not installed: gzip instead of %s compression',
+                        compression)
+        compression = 'gzip'
+    if compression == 'gzip':
+        if level is None:
+            level = 4
+        return {'compression': 'gzip', 'compression_opts': level,
+                'shuffle': True}
+    elif compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    raise ValueError('Unknown compression {}'.format(repr(compression)))
+
+
+_JSON_TAGS = ['__array__', '__scalar__', '__dtype__', '__tuple__',
+              '__ConfigDict__', '__dict__']
+
+
+def _toJson(obj):
+    """
+    JSON compatible version of the allocation arguments and the state
+    of an `OutputBuffer` (see `_fromJson`)
+    """
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype.kind not in 'biufU':
+            raise TypeError('Unsupported array type {}'.format(obj.dtype))
+        return {'__array__': [obj.dtype.str, obj.tolist()]}
+    elif isinstance(obj, numpy.generic):
+        return {'__scalar__': [obj.dtype.str, obj.item()]}
+    elif isinstance(obj, numpy.dtype) or \
+         (isinstance(obj, type) and issubclass(obj, (numpy.generic, bool,
+                                                     int, float))):
+        return {'__dtype__': numpy.dtype(obj).str}
+    elif isinstance(obj, (bool, int, float) + string_types) or obj is None:
+        return obj
+    elif isinstance(obj, list):
+        return [_toJson(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_toJson(item) for item in obj]}
+    elif isinstance(obj, dict):
+        items = [(key, _toJson(value)) for key, value in obj.items()]
+        if isinstance(obj, ConfigDict.ConfigDict):
+            return {'__ConfigDict__': [[_toJson(key), value]
+                                       for key, value in items]}
+        elif type(obj) not in (dict, OrderedDict, defaultdict):
+            raise TypeError('Unsupported type {}'.format(type(obj)))
+        elif all(isinstance(key, string_types) for key, value in items) and \
+             not (len(items) == 1 and items[0][0] in _JSON_TAGS):
+            return OrderedDict(items)
+        return {'__dict__': [[_toJson(key), value] for key, value in items]}
+    raise TypeError('Unsupported type {}'.format(type(obj)))
+
+
+def _fromJson(obj):
+    """
+    Object hook of `json.loads` reverting `_toJson`
+    """
+    if len(obj) != 1:
+        return obj
+    tag, value = list(obj.items())[0]
+    if tag == '__array__':
+        return numpy.array(value[1], dtype=_jsonDtype(value[0]))
+    elif tag == '__scalar__':
+        return _jsonDtype(value[0]).type(value[1])
+    elif tag == '__dtype__':
+        return _jsonDtype(value)
+    elif tag == '__tuple__':
+        return tuple(value)
+    elif tag == '__ConfigDict__':
+        cDict = ConfigDict.ConfigDict()
+        cDict.update(value)
+        return cDict
+    elif tag == '__dict__':
+        return OrderedDict(value)
+    return obj
+
+
+def _jsonDtype(dtype):
+    dtype = numpy.dtype(str(dtype))
+    if dtype.kind not in 'biufU':
+        raise TypeError('Unsupported array type {}'.format(dtype))
+    return dtype
+
+
+class BackgroundWriter(object):
+    """
+    Write blocks of data to datasets in a background thread, in the order
+    in which they are submitted, so that compressing and writing a block
+    overlaps with calculating the next ones.
+
+    Blocks covering complete chunks of gzip compressed HDF5 datasets are
+    compressed with zlib, which does not hold the interpreter lock, and
+    written as raw chunks.
+
+    Usage:
+        with BackgroundWriter() as writer:
+            writer.write(dataset, idx, value)
+    """
+
+    def __init__(self, background=True, maxsize=4):
+        """
+        :param bool background: write immediately when disabled
+        :param int maxsize: maximal number of blocks waiting to be written
+        """
+        self.background = background
+        self.maxsize = maxsize
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            # do not hide the original exception
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def write(self, dataset, idx, value):
+        """
+        Same as `dataset[idx] = value`. The value is copied.
+
+        :param dataset: h5py.Dataset or numpy.ndarray
+        :param tuple idx:
+        :param array value:
+        """
+        self._raiseError()
+        if not self.background:
+            self._write(dataset, idx, value)
+            return
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((dataset, idx, numpy.array(value)))
+
+    def flush(self):
+        """
+        Wait until all blocks are written
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+        self._raiseError()
+
+    def _raiseError(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except BaseException as e:
+                    # raised by the next call to write or flush
+                    self._error = e
+
+    def _write(self, dataset, idx, value):
+        if not self._writeChunks(dataset, idx, value):
+            dataset[idx] = value
+
+    @staticmethod
+    def _gzipFilters(dataset):
+        """
+        :returns tuple or None: gzip level and shuffle flag when gzip
+                                is the only compression filter
+        """
+        h5py = NexusUtils.h5py
+        if h5py is None or not isinstance(dataset, h5py.Dataset):
+            return None
+        if dataset.compression != 'gzip' or dataset.chunks is None:
+            return None
+        if not hasattr(dataset.id, 'write_direct_chunk'):
+            return None
+        if not dataset.dtype.isnative:
+            return None
+        plist = dataset.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        if filters == [h5py.h5z.FILTER_DEFLATE]:
+            shuffle = False
+        elif filters == [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE]:
+            shuffle = True
+        else:
+            return None
+        return dataset.compression_opts, shuffle
+
+    def _writeChunks(self, dataset, idx, value):
+        """
+        Compress and write the block when it covers complete chunks
+
+        :returns bool: False when the block cannot be written as chunks
+        """
+        gzip = self._gzipFilters(dataset)
+        if gzip is None:
+            return False
+        level, shuffle = gzip
+        shape = dataset.shape
+        chunks = dataset.chunks
+        if not isinstance(idx, tuple) or len(idx) != len(shape):
+            return False
+        starts = []
+        stops = []
+        for index, n, nchunk in zip(idx, shape, chunks):
+            if not isinstance(index, slice):
+                return False
+            start, stop, step = index.indices(n)
+            if step != 1 or stop <= start:
+                return False
+            if start % nchunk or (stop % nchunk and stop != n):
+                return False
+            starts.append(start)
+            stops.append(stop)
+        blockShape = tuple(b - a for a, b in zip(starts, stops))
+        value = numpy.asarray(value, dtype=dataset.dtype).reshape(blockShape)
+        itemsize = dataset.dtype.itemsize
+        offsets = [range(a, b, nchunk) for a, b, nchunk in
+                   zip(starts, stops, chunks)]
+        for offset in itertools.product(*offsets):
+            chunk = value[tuple(slice(o - a, o - a + nchunk) for o, a, nchunk
+                                in zip(offset, starts, chunks))]
+            if chunk.shape != chunks:
+                # edge chunks are stored complete
+                padded = numpy.zeros(chunks, dtype=chunk.dtype)
+                padded[tuple(slice(0, n) for n in chunk.shape)] = chunk
+                chunk = padded
+            chunk = numpy.ascontiguousarray(chunk)
+            if shuffle and itemsize > 1:
+                chunk = numpy.ascontiguousarray(
+                    chunk.reshape(-1).view(numpy.uint8).reshape(-1, itemsize).T)
+            dataset.id.write_direct_chunk(offset, zlib.compress(chunk, level))
+        return True
+
 
 class OutputBuffer(MutableMapping):
     """
@@ -77,7 +361,9 @@ def __init__(self, outputDir=None, outputRoot=None, fileEntry=None,
                  fileProcess=None, suffix=None, h5=True,
                  tif=False, edf=False, csv=False, dat=False,
                  multipage=False, overwrite=False,
-                 nosave=False, dtype=None):
+                 nosave=False, dtype=None, compression=None,
+                 compressionLevel=None, backgroundWriter=True,
+                 sharedDir=None):
         """
         Dictionary will be saved as:
          .h5 : outputDir/outputRoot+suffix.h5::/fileEntry/fileProcess
@@ -97,6 +383,15 @@ def __init__(self, outputDir=None, outputRoot=None, fileEntry=None,
         :param str suffix: default: None
         :param bool nosave: prevent saving (everything will be in memory)
         :param dtype: force dtype on memory allocation
+        :param str compression: compression of the datasets allocated in
+                                HDF5 (see `compressionArguments`)
+        :param int compressionLevel: gzip compression level
+        :param bool backgroundWriter: write chunks in a background thread
+                                      (see `chunkWriter`)
+        :param str sharedDir: directory of memory-mapped buffers shared by
+                              several processes. Saving is done once by
+                              `saveSharedBuffers` after all processes
+                              are finished.
         """
         self._inBufferContext = False
         self._inSaveContext = False
@@ -104,6 +399,7 @@ def __init__(self, outputDir=None, outputRoot=None, fileEntry=None,
         self._info = {}
         self._results = {}
         self._labels = {}
+        self._allocations = OrderedDict()
         self._nxprocess = None
         self._labelFormats = defaultdict(lambda: '')
         self._defaultgroups = ()
@@ -129,6 +425,10 @@ def __init__(self, outputDir=None, outputRoot=None, fileEntry=None,
         self.multipage = multipage
         self.overwrite = overwrite
         self.nosave = nosave
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        self.backgroundWriter = backgroundWriter
+        self.sharedDir = sharedDir
 
     def __getitem__(self, key):
         try:
@@ -145,6 +445,7 @@ def __setitem__(self, key, value):
     def __delitem__(self, key):
         try:
             del self._buffers[key]
+            self._allocations.pop(key, None)
         except KeyError:
             del self._info[key]
 
@@ -289,6 +590,44 @@ def nosave(self, value):
         self._checkBufferContext()
         self._nosave = bool(value)
 
+    @property
+    def compression(self):
+        return self._compression
+
+    @compression.setter
+    def compression(self, value):
+        self._checkBufferContext()
+        if value and value.lower() not in compressionTypes:
+            raise ValueError('Unknown compression {}'.format(repr(value)))
+        self._compression = value
+
+    @property
+    def compressionLevel(self):
+        return self._compressionLevel
+
+    @compressionLevel.setter
+    def compressionLevel(self, value):
+        self._checkBufferContext()
+        self._compressionLevel = value
+
+    @property
+    def sharedDir(self):
+        return self._sharedDir
+
+    @sharedDir.setter
+    def sharedDir(self, value):
+        self._checkBufferContext()
+        self._sharedDir = value
+
+    def chunkWriter(self):
+        """
+        Writer of chunks to the allocated buffers. Use it as a context
+        manager: all chunks are written when leaving the context.
+
+        :returns BackgroundWriter:
+        """
+        return BackgroundWriter(background=self.backgroundWriter)
+
     def _checkBufferContext(self):
         if self._inBufferContext:
             raise RuntimeError('Buffer is locked')
@@ -334,12 +673,31 @@ def allocateMemory(self, label, group=None, memtype='ram', **kwargs):
                 _logger.warning('Allocate in memory instead of Hdf5 (no output directory specified)')
             else:
                 allocH5 = True
-        if allocH5:
+        if self.sharedDir:
+            allocH5 = False
+            buffer = self._allocateShared(label, group=group, memtype=memtype,
+                                          **kwargs)
+        elif allocH5:
             buffer = self._allocateHdf5(label, group=group, **kwargs)
         else:
             buffer = self._allocateRam(label, group=group, **kwargs)
+        # Needed to restore the buffer from a checkpoint
+        allocation = dict(kwargs)
+        allocation.pop('data', None)
+        self._allocations[label] = group, memtype, allocH5, allocation
         return buffer
 
+    def allocations(self):
+        """
+        Arguments of `allocateMemory` for all allocated buffers (except
+        for the data) in order of allocation.
+
+        :returns list(tuple): label, group, memtype (as requested),
+                              allocated in HDF5 or not, keyword arguments
+        """
+        return [(label,) + allocation
+                for label, allocation in self._allocations.items()]
+
     def _allocateRam(self, label, group=None, fill_value=None, dataAttrs=None,
                      data=None, shape=None, dtype=None, labels=None,
                      groupAttrs=None, **unused):
@@ -376,6 +734,61 @@ def _allocateRam(self, label, group=None, fill_value=None, dataAttrs=None,
             self._addResult(group, label, name, buffer, dataAttrs, groupAttrs)
         return buffer
 
+    def _allocateShared(self, label, group=None, memtype='ram', fill_value=None,
+                        data=None, shape=None, dtype=None, **kwargs):
+        """
+        Memory-mapped buffer in `sharedDir`. The first process which
+        allocates it creates and initializes the file, the other
+        processes use it as it is.
+
+        :param str label:
+        :param str group: group name of this dataset (in hdf5 this is the nxdata name)
+        :param str memtype: memory type when saving the buffer
+        :param num fill_value: initial buffer item value
+        :param ndarray data: dataset or stack of datasets
+        :param tuple shape: buffer shape
+        :param dtype: buffer type
+        :param **kwargs: see _allocateRam
+        """
+        if data is not None:
+            data = numpy.asarray(data, dtype=dtype)
+            shape, dtype = data.shape, data.dtype
+        elif shape is None:
+            raise ValueError("Provide 'data' or 'shape'")
+        name = re.sub(r'[^\w\-]', '_', str(label))
+        fileName = os.path.join(self.sharedDir, name + '.npy')
+        if not os.path.exists(fileName):
+            NexusUtils.mkdir(self.sharedDir)
+            fd, tmpName = tempfile.mkstemp(suffix='.tmp', dir=self.sharedDir)
+            os.close(fd)
+            try:
+                buffer = numpy.lib.format.open_memmap(tmpName, mode='w+',
+                                                      dtype=dtype, shape=shape)
+                if data is not None:
+                    buffer[()] = data
+                if fill_value is not None:
+                    buffer[()] = fill_value
+                buffer.flush()
+                del buffer
+                # Hard link: fails when created by another process meanwhile
+                try:
+                    os.link(tmpName, fileName)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                else:
+                    allocation = {'index': len(self._allocations),
+                                  'label': label, 'group': group,
+                                  'memtype': memtype, 'kwargs': kwargs}
+                    with open(os.path.join(self.sharedDir, name + '.json'), 'w') as f:
+                        json.dump(_toJson(allocation), f)
+            finally:
+                os.remove(tmpName)
+        buffer = numpy.lib.format.open_memmap(fileName, mode='r+')
+        if buffer.shape != tuple(shape):
+            raise ValueError('{} has a different shape'.format(fileName))
+        return self._allocateRam(label, group=group, data=buffer, **kwargs)
+
     def _allocateHdf5(self, label, group=None, fill_value=None, dataAttrs=None,
                       data=None, shape=None, dtype=None, labels=None,
                       groupAttrs=None, **createkwargs):
@@ -395,6 +808,13 @@ def _allocateHdf5(self, label, group=None, fill_value=None, dataAttrs=None,
             raise ValueError("Provide 'data' or 'shape'")
         if data is None and dtype is None:
             raise ValueError("Missing 'dtype' argument")
+        if 'compression' not in createkwargs:
+            createkwargs.update(compressionArguments(self.compression,
+                                                     self.compressionLevel))
+        if data is None and fill_value is not None:
+            # chunks which are never written are not stored
+            createkwargs['fillvalue'] = fill_value
+            fill_value = None
 
         # Create Nxdata group (if not already there)
         nxdata = self._getNXdataGroup(group)
@@ -602,7 +1022,7 @@ def bufferContext(self, update=True):
             self._inBufferContext = True
             _logger.debug('Enter buffering context of {}'.format(self))
             try:
-                if self.h5:
+                if self.h5 and not self.sharedDir:
                     if self._nxprocess is None and self.outputDir:
                         cleanup_funcs = []
                         try:
@@ -739,6 +1159,9 @@ def save(self):
         elif not self.outputDir:
             _logger.warning('Fit results are not saved (no output directory specified)')
             return
+        elif self.sharedDir:
+            self._saveSharedState()
+            return
         t0 = time.time()
         with self.bufferContext(update=True):
             if self.tif or self.edf or self.csv or self.dat:
@@ -748,6 +1171,222 @@ def save(self):
         t = time.time() - t0
         _logger.debug("Saving results elapsed = %f", t)
 
+    @property
+    def checkpointFilename(self):
+        return self.filename('.h5', suffix='_checkpoint')
+
+    def _checkpointEnabled(self):
+        return not self.nosave and bool(self.outputDir) and \
+               not self.sharedDir and \
+               NexusUtils.h5py is not None
+
+    def hasCheckpoint(self, signature=None):
+        """
+        :param str signature: identifies the processing (configuration,
+                              input data, ...)
+        :returns bool: a checkpoint with this signature exists
+        """
+        if not self._checkpointEnabled():
+            return False
+        fileName = self.checkpointFilename
+        if not os.path.exists(fileName):
+            return False
+        try:
+            with NexusUtils.h5py.File(fileName, mode='r') as f:
+                return f.attrs['signature'] == (signature or '')
+        except Exception:
+            _logger.warning('Cannot read checkpoint {}'.format(fileName))
+            return False
+
+    def saveCheckpoint(self, processed, signature=None):
+        """
+        Save the buffers in memory together with a mask of the processed
+        items, so that an interrupted processing can be resumed with
+        `loadCheckpoint`. Buffers allocated in HDF5 are not copied but
+        flushed to the output file.
+
+        :param ndarray processed: mask of the processed items
+        :param str signature: identifies the processing (configuration,
+                              input data, ...)
+        """
+        if not self._checkpointEnabled():
+            return
+        t0 = time.time()
+        self.flush()
+        fileName = self.checkpointFilename
+        NexusUtils.mkdir(os.path.dirname(fileName))
+        allocations = list(self._allocations.items())
+        # Write to a temporary file first so that an interruption
+        # never leaves a partial checkpoint
+        fd, tmpName = tempfile.mkstemp(suffix='.tmp',
+                                       dir=os.path.dirname(fileName))
+        os.close(fd)
+        try:
+            with NexusUtils.h5py.File(tmpName, mode='w') as f:
+                f.attrs['signature'] = signature or ''
+                # The arguments of allocateMemory as JSON: the index of
+                # an allocation is its position in the list
+                allocationList = [{'label': label, 'group': group,
+                                   'memtype': memtype, 'hdf5': allocH5,
+                                   'kwargs': kwargs}
+                                  for label, (group, memtype, allocH5, kwargs)
+                                  in allocations]
+                f['allocations'] = json.dumps(_toJson(allocationList))
+                f['processed'] = processed
+                buffers = f.create_group('buffers')
+                for i, (label, (group, memtype, allocH5, kwargs)) in enumerate(allocations):
+                    if not allocH5:
+                        buffers[str(i)] = self._buffers[label]
+            if hasattr(os, 'replace'):
+                os.replace(tmpName, fileName)
+            else:
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+                os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        _logger.debug("Saving checkpoint elapsed = %f", time.time() - t0)
+
+    def loadCheckpoint(self, signature=None):
+        """
+        Restore the buffers saved by `saveCheckpoint`. This must be done
+        before allocating memory and inside a context which updates the
+        HDF5 output (see `bufferContext`), as buffers allocated in HDF5
+        are restored from the output file.
+
+        :param str signature: identifies the processing (configuration,
+                              input data, ...)
+        :returns ndarray or None: mask of the processed items or None
+                                  when there is nothing to resume
+        """
+        if not self.hasCheckpoint(signature=signature):
+            return None
+        fileName = self.checkpointFilename
+        try:
+            with NexusUtils.h5py.File(fileName, mode='r') as f:
+                text = f['allocations'][()]
+                if isinstance(text, bytes):
+                    text = text.decode('utf-8')
+                allocations = json.loads(text, object_hook=_fromJson)
+                processed = f['processed'][()]
+                for i, allocation in enumerate(allocations):
+                    label = allocation['label']
+                    group = allocation['group']
+                    memtype = allocation['memtype']
+                    allocH5 = allocation['hdf5']
+                    kwargs = allocation['kwargs']
+                    if allocH5:
+                        self._restoreHdf5(label, group=group, **kwargs)
+                        self._allocations[label] = group, memtype, allocH5, kwargs
+                    else:
+                        kwargs.pop('fill_value', None)
+                        data = f['buffers'][str(i)][()]
+                        self.allocateMemory(label, group=group, memtype='ram',
+                                            data=data, **kwargs)
+            self._removeResults(keep=True)
+        except Exception as e:
+            _logger.warning('Cannot resume from checkpoint {} ({})'
+                            .format(fileName, e))
+            self._buffers = {}
+            self._results = {}
+            self._labels = {}
+            self._allocations = OrderedDict()
+            self._removeResults(keep=False)
+            return None
+        _logger.info('Resume from checkpoint {}'.format(fileName))
+        return processed
+
+    def removeCheckpoint(self):
+        if not self._checkpointEnabled():
+            return
+        fileName = self.checkpointFilename
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+    def _restoreHdf5(self, label, group=None, shape=None, dataAttrs=None,
+                     labels=None, groupAttrs=None, **unused):
+        """
+        Use the datasets of an earlier allocation in the HDF5 output
+        """
+        nxdata = self._nxprocess['results'][group]
+        if labels:
+            names = self._labelsToHdf5Strings(labels)
+            signalshape = None if shape is None else tuple(shape[1:])
+            buffer = []
+            for lbl, name in zip(labels, names):
+                dset = nxdata[name]
+                if signalshape is not None and dset.shape != signalshape:
+                    raise ValueError('{} has a different shape'.format(dset.name))
+                self._addResult(group, lbl, name, dset, dataAttrs, groupAttrs)
+                buffer.append(dset)
+        else:
+            name = self._labelsToHdf5Strings([label])[0]
+            buffer = nxdata[name]
+            if shape is not None and buffer.shape != tuple(shape):
+                raise ValueError('{} has a different shape'.format(buffer.name))
+            self._addResult(group, label, name, buffer, dataAttrs, groupAttrs)
+        self._buffers[label] = buffer
+        return buffer
+
+    def _removeResults(self, keep=True):
+        """
+        Remove the saved results from the HDF5 output
+
+        :param bool keep: keep the datasets of the buffers allocated in HDF5
+        """
+        if self._nxprocess is None:
+            return
+        datasets = defaultdict(list)
+        if keep:
+            for group, info in self._results.items():
+                for name, value, attrs in info['_signals']:
+                    if isinstance(value['data'], NexusUtils.h5py.Dataset):
+                        datasets[group].append(name)
+        nxresults = self._nxprocess['results']
+        for group in list(nxresults.keys()):
+            names = datasets.get(group, None)
+            if not names:
+                del nxresults[group]
+                continue
+            nxdata = nxresults[group]
+            for name in list(nxdata.keys()):
+                if name not in names:
+                    del nxdata[name]
+            # signals and axes are added again on saving
+            for attr in ['signal', 'auxiliary_signals', 'axes']:
+                if attr in nxdata.attrs:
+                    del nxdata.attrs[attr]
+
+    def _saveSharedState(self):
+        """
+        Everything but the buffers, needed by `saveSharedBuffers`
+        """
+        state = self.__dict__.copy()
+        for name in ['_buffers', '_results', '_labels', '_allocations',
+                     '_nxprocess', '_sharedDir']:
+            state.pop(name)
+        state['_labelFormats'] = dict(self._labelFormats)
+        state['_inBufferContext'] = False
+        state['_inSaveContext'] = False
+        NexusUtils.mkdir(self.sharedDir)
+        fd, tmpName = tempfile.mkstemp(suffix='.tmp', dir=self.sharedDir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(_toJson(state), f)
+            fileName = os.path.join(self.sharedDir, SHARED_STATE)
+            if hasattr(os, 'replace'):
+                os.replace(tmpName, fileName)
+            else:
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+                os.rename(tmpName, fileName)
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+
     def _imageList(self, onlylabels=False):
         imageFileLabels = []
         if onlylabels:
@@ -898,3 +1537,48 @@ def _saveH5(self):
                 if group in nxresults:
                     NexusUtils.markDefault(nxresults[group])
                     break
+
+
+def saveSharedBuffers(sharedDir, remove=True):
+    """
+    Save the buffers which several processes filled in `sharedDir`
+    (see the `sharedDir` argument of `OutputBuffer`)
+
+    :param str sharedDir:
+    :param bool remove: remove `sharedDir` afterwards
+    :returns OutputBuffer or None: None when nothing was allocated
+    """
+    fileName = os.path.join(sharedDir, SHARED_STATE)
+    if not os.path.exists(fileName):
+        _logger.warning('No shared buffers in {}'.format(sharedDir))
+        return None
+    with open(fileName, 'r') as f:
+        state = json.load(f, object_hook=_fromJson)
+    # The attributes of derived classes are part of the state and
+    # saving only uses the methods of OutputBuffer
+    outbuffer = OutputBuffer.__new__(OutputBuffer)
+    outbuffer.__dict__.update(state)
+    outbuffer._labelFormats = defaultdict(lambda: '', state['_labelFormats'])
+    outbuffer._buffers = {}
+    outbuffer._results = {}
+    outbuffer._labels = {}
+    outbuffer._allocations = OrderedDict()
+    outbuffer._nxprocess = None
+    outbuffer._sharedDir = None
+    allocations = []
+    for name in os.listdir(sharedDir):
+        if name.endswith('.json') and name != SHARED_STATE:
+            with open(os.path.join(sharedDir, name), 'r') as f:
+                allocation = json.load(f, object_hook=_fromJson)
+            allocations.append((allocation, name[:-5] + '.npy'))
+    allocations.sort(key=lambda item: item[0]['index'])
+    with outbuffer.saveContext():
+        for allocation, name in allocations:
+            data = numpy.load(os.path.join(sharedDir, name))
+            outbuffer.allocateMemory(allocation['label'],
+                                     group=allocation['group'],
+                                     memtype=allocation['memtype'],
+                                     data=data, **allocation['kwargs'])
+    if remove:
+        shutil.rmtree(sharedDir, ignore_errors=True)
+    return outbuffer
@@ -43,6 +43,13 @@
 import os
 import numpy as np
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from PyMca5.PyMcaIO import PyMcaIOHelper
+    _decodeByteOffset = getattr(PyMcaIOHelper, "decodeByteOffset", None)
+except ImportError:
+    _decodeByteOffset = None
 if sys.version < '3':
     _fileClass = file
 else:
@@ -71,8 +78,141 @@
                   }
 
 
+def decodeByteOffset(stream, npixels, out=None):
+    """
+    Decode a x-CBF_BYTE_OFFSET compressed stream.
+
+    @param stream: the compressed data
+    @type stream: bytes
+    @param npixels: number of pixels to decode
+    @type npixels: int
+    @param out: optional output array of npixels elements
+    @type out: numpy array
+    @return: the pixel values as int32 when out is not given
+    @rtype: numpy array
+    """
+    if out is None:
+        out = np.empty((npixels,), dtype=np.int32)
+    elif out.size != npixels:
+        raise ValueError("Output array does not have %d elements" % npixels)
+    if _decodeByteOffset is not None:
+        if out.dtype == np.int32 and out.flags.c_contiguous and \
+           out.flags.writeable:
+            buffer = out
+        else:
+            buffer = np.empty(out.shape, dtype=np.int32)
+        try:
+            ndecoded = _decodeByteOffset(stream, buffer)
+        except PyMcaIOHelper.Error as e:
+            raise IOError("Cannot decode CBF data: %s" % e)
+        if buffer is not out:
+            out[...] = buffer
+    else:
+        values = np.hstack(_analyseByteOffset(stream)).cumsum()
+        ndecoded = values.size
+        if ndecoded == npixels:
+            out[...] = values.reshape(out.shape)
+    if ndecoded != npixels:
+        raise IOError("CBF data contain %d pixels instead of %d" % \
+                      (ndecoded, npixels))
+    return out
+
+
+def _analyseByteOffset(stream):
+    """
+    Analyze a stream of char with any length of exception (2,4, or 8 bytes integers)
+
+    @return list of NParrays
+    """
+    listnpa = []
+    if sys.version < '3.0' or\
+       isinstance(stream, str):
+        key16 = "\x80"
+        key32 = "\x00\x80"
+        key64 = "\x00\x00\x00\x80"
+    else:
+        # I avoid the b"..." syntax to try to keep python 2.5 compatibility
+        # encoding with utf-8 does not work
+        key16 = "\x80".encode('latin-1')
+        key32 = "\x00\x80".encode('latin-1')
+        key64 = "\x00\x00\x00\x80".encode('latin-1')
+    # the stream is never sliced to keep the analysis linear
+    # in the number of exceptions
+    position = 0
+    while True:
+        idx = stream.find(key16, position)
+        if idx == -1:
+            listnpa.append(np.frombuffer(stream, dtype="int8",
+                                         offset=position))
+            break
+        listnpa.append(np.frombuffer(stream, dtype="int8",
+                                     count=idx - position, offset=position))
+        if stream[idx + 1:idx + 3] == key32:
+            if stream[idx + 3:idx + 7] == key64:
+                listnpa.append(np.frombuffer(stream, dtype="<i8", count=1,
+                                             offset=idx + 7))
+                position = idx + 15
+            else: #32 bit int
+                listnpa.append(np.frombuffer(stream, dtype="<i4", count=1,
+                                             offset=idx + 3))
+                position = idx + 7
+        else: #int16
+            listnpa.append(np.frombuffer(stream, dtype="<i2", count=1,
+                                         offset=idx + 1))
+            position = idx + 3
+    return listnpa
+
+
+def readStack(filelist, out=None, nthreads=None):
+    """
+    Read a list of single image CBF files into a 3D array.
+
+    @param filelist: the file names
+    @type filelist: list
+    @param out: optional output array of shape (nfiles, dim2, dim1).
+    Images of a different size are cropped or padded with zeros.
+    @type out: numpy array
+    @param nthreads: number of threads reading the files. None reads
+    them in the calling thread and 0 uses one thread per CPU.
+    @type nthreads: int
+    @return: the image stack
+    @rtype: numpy array
+    """
+    if out is None:
+        first = PilatusCBF(filelist[0])
+        data = first.getData()
+        out = np.zeros((len(filelist),) + data.shape, dtype=data.dtype)
+    elif len(out) != len(filelist):
+        raise ValueError("Output array does not have %d images" % \
+                         len(filelist))
+
+    def readOne(i):
+        PilatusCBF(filelist[i], out=out[i])
+        return i
+
+    if nthreads == 0:
+        nthreads = multiprocessing.cpu_count()
+    if nthreads is None or nthreads < 2:
+        for i in range(len(filelist)):
+            readOne(i)
+    else:
+        pool = ThreadPool(processes=nthreads)
+        try:
+            for i in pool.imap_unordered(readOne, range(len(filelist))):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+    return out
+
+
 class PilatusCBF(object):
-    def __init__(self, filename):
+    def __init__(self, filename, out=None):
+        """
+        @param out: optional output array. When it has the shape of the
+        image, the data are decoded into it. Otherwise the image is
+        cropped or padded with zeros to fit into it.
+        """
         if isinstance(filename, _fileClass):
             fd = filename
         else:
@@ -83,9 +223,9 @@ def __init__(self, filename):
         self.__info = {}
         #read the file
         if isinstance(filename, _fileClass):
-            self.read(filename.name)
+            self.read(filename.name, out=out)
         else:
-            self.read(filename)
+            self.read(filename, out=out)
 
     def getData(self, *var, **kw):
         return self.__data
@@ -138,68 +278,17 @@ def _readheader(self, inStream):
         if len(missing) > 0:
             _logger.debug("CBF file misses the keys %s", " ".join(missing))
 
-    def _readbinary_byte_offset(self, inStream):
+    def _readbinary_byte_offset(self, inStream, out=None):
         """
         Read in a binary part of an x-CBF_BYTE_OFFSET compressed image
 
         @param inStream: the binary image (without any CIF decorators)
         @type inStream: python string.
-        @return: a linear numpy array without shape and dtype set
+        @param out: optional output array of dim1 * dim2 elements
+        @type out: numpy array
+        @return: a linear int32 numpy array or out
         @rtype: numpy array
         """
-
-        def analyse(stream):
-            """
-            Analyze a stream of char with any length of exception (2,4, or 8 bytes integers)
-
-            @return list of NParrays
-            """
-            listnpa = []
-            if sys.version < '3.0' or\
-               isinstance(stream, str):
-                key16 = "\x80"
-                key32 = "\x00\x80"
-                key64 = "\x00\x00\x00\x80"
-            else:
-                # I avoid the b"..." syntax to try to keep python 2.5 compatibility
-                # encoding with utf-8 does not work
-                key16 = "\x80".encode('latin-1')
-                key32 = "\x00\x80".encode('latin-1')
-                key64 = "\x00\x040\x00\x80".encode('latin-1')
-#            idx = 0
-            shift = 1
-#            position = 0
-            while True:
-#                lns = len(stream)
-                idx = stream.find(key16)
-                if idx == -1:
-                    listnpa.append(np.array(np.frombuffer(stream, dtype="int8")))
-                    break
-                listnpa.append(np.array(np.frombuffer(stream[:idx], dtype="int8")))
-#                position += listnpa[-1].size
-
-                if stream[idx + 1:idx + 3] == key32:
-                    if stream[idx + 3:idx + 7] == key64:
-                        listnpa.append(np.array(np.frombuffer(stream[idx + 7:idx + 15],
-                                                              dtype="int64")))
-#                        position += 1
-#                        print "loop64 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                        shift = 15
-                    else: #32 bit int
-                        listnpa.append(np.array(np.frombuffer(stream[idx + 3:idx + 7],
-                                                              dtype="int32")))
-#                        position += 1
-#                        print "loop32 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                        shift = 7
-                else: #int16
-                    listnpa.append(np.array(np.frombuffer(stream[idx + 1:idx + 3],
-                                                          dtype="int16")))
-#                    position += 1
-#                    print "loop16 x=%4i y=%4i in idx %4i lns %4i value=%s" % ((position % 2463), (position // 2463), idx, lns, listnpa[-1])
-                    shift = 3
-                stream = stream[idx + shift:]
-            return  listnpa
-
         if sys.version < '3.0' or\
             isinstance(inStream, str):
             starter = "\x0c\x1a\x04\xd5"
@@ -209,12 +298,9 @@ def analyse(stream):
             starter = "\x0c\x1a\x04\xd5".encode('latin-1')
         startPos = inStream.find(starter) + 4
         data = inStream[ startPos: startPos + int(self.__header["X-Binary-Size"])]
-        myData = np.hstack(analyse(data)).cumsum()
-
-        assert len(myData) == self.dim1 * self.dim2
-        return myData
+        return decodeByteOffset(data, self.dim1 * self.dim2, out=out)
 
-    def read(self, fname):
+    def read(self, fname, out=None):
         self.__header = {}
         self.cif.loadCIF(fname, _bKeepComment=True)
         # backport contents of the CIF data to the headers
@@ -244,7 +330,20 @@ def read(self, fname):
             _logger.warning("Defaulting type to int32")
 
         if self.__header["conversions"] == "x-CBF_BYTE_OFFSET":
-            self.__data = self._readbinary_byte_offset(self.cif["_array_data.data"]).astype(bytecode).reshape((self.dim2, self.dim1))
+            shape = (self.dim2, self.dim1)
+            if out is not None and out.shape == shape:
+                self._readbinary_byte_offset(self.cif["_array_data.data"],
+                                             out=out)
+                self.__data = out
+            else:
+                self.__data = self._readbinary_byte_offset(self.cif["_array_data.data"]).astype(bytecode).reshape(shape)
+                if out is not None:
+                    _logger.warning("CBF file %s image shape %s differs from %s",
+                                    fname, shape, out.shape)
+                    out[...] = 0
+                    n0 = min(shape[0], out.shape[0])
+                    n1 = min(shape[1], out.shape[1])
+                    out[:n0, :n1] = self.__data[:n0, :n1]
         else:
             raise Exception(IOError, "Compression scheme not yet supported, please contact FABIO development team")
         self.__info = self.__header
@@ -33,6 +33,8 @@
 
 #include <./numpy/arrayobject.h>
 #include <stdio.h>
+#include <string.h>
+#include <math.h>
 
 struct module_state {
     PyObject *error;
@@ -49,6 +51,9 @@ static struct module_state _state;
 
 static PyObject *PyMcaIOHelper_fillSupaVisio(PyObject *dummy, PyObject *args);
 static PyObject *PyMcaIOHelper_readAifira(PyObject *dummy, PyObject *args);
+static PyObject *PyMcaIOHelper_decodeByteOffset(PyObject *dummy, PyObject *args);
+static PyObject *PyMcaIOHelper_decodeLZW(PyObject *dummy, PyObject *args);
+static PyObject *PyMcaIOHelper_parseSpecMca(PyObject *dummy, PyObject *args);
 
 /* Functions */
 
@@ -189,11 +194,535 @@ PyMcaIOHelper_readAifira(PyObject *self, PyObject *args)
     return PyArray_Return(outputArray);
 }
 
+/* CBF byte offset decompression.
+   Every pixel is stored as the difference to the previous one in one byte.
+   The byte 0x80 announces a 16 bit little endian difference, the 16 bit
+   value -32768 announces a 32 bit difference and the 32 bit value
+   -2147483648 announces a 64 bit difference.
+   Returns the number of decoded pixels or -1 if the stream is truncated. */
+static npy_intp
+byteOffsetDecode(const unsigned char *p, npy_intp nBytes,
+                 npy_int32 *out, npy_intp nPixels)
+{
+    const unsigned char *end = p + nBytes;
+    npy_uint64 value = 0;
+    npy_uint64 delta;
+    npy_intp i = 0;
+    npy_int16 delta16;
+    npy_int32 delta32;
+    int j;
+
+    while ((p < end) && (i < nPixels))
+    {
+        if (*p != 0x80)
+        {
+            value += (npy_uint64) (npy_int64) (npy_int8) *p;
+            p += 1;
+        }
+        else
+        {
+            if ((end - p) < 3)
+                return -1;
+            delta16 = (npy_int16) (npy_uint16) (p[1] | (p[2] << 8));
+            if (delta16 != -32768)
+            {
+                value += (npy_uint64) (npy_int64) delta16;
+                p += 3;
+            }
+            else
+            {
+                if ((end - p) < 7)
+                    return -1;
+                delta32 = (npy_int32) ((npy_uint32) p[3] |
+                                       ((npy_uint32) p[4] << 8) |
+                                       ((npy_uint32) p[5] << 16) |
+                                       ((npy_uint32) p[6] << 24));
+                if (delta32 != NPY_MIN_INT32)
+                {
+                    value += (npy_uint64) (npy_int64) delta32;
+                    p += 7;
+                }
+                else
+                {
+                    if ((end - p) < 15)
+                        return -1;
+                    delta = 0;
+                    for (j = 14; j > 6; j--)
+                    {
+                        delta = (delta << 8) | p[j];
+                    }
+                    value += delta;
+                    p += 15;
+                }
+            }
+        }
+        /* same wrap around as numpy casting int64 to int32 */
+        out[i] = (npy_int32) (npy_uint32) value;
+        i++;
+    }
+    return i;
+}
+
+static PyObject *
+PyMcaIOHelper_decodeByteOffset(PyObject *self, PyObject *args)
+{
+    Py_buffer input;
+    PyObject *output;
+    PyArrayObject *outputArray;
+    npy_intp nPixels;
+    npy_intp nDecoded;
+    struct module_state *st = GETSTATE(self);
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y*O", &input, &output))
+#else
+    if (!PyArg_ParseTuple(args, "s*O", &input, &output))
+#endif
+        return NULL;
+    if (!PyArray_Check(output))
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error, "Output is not a numpy array");
+        return NULL;
+    }
+    outputArray = (PyArrayObject *) output;
+    if ((PyArray_TYPE(outputArray) != NPY_INT32) ||
+        !PyArray_ISCARRAY(outputArray))
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error,
+                        "Output must be a writeable contiguous int32 array");
+        return NULL;
+    }
+    nPixels = PyArray_SIZE(outputArray);
+
+    Py_BEGIN_ALLOW_THREADS
+    nDecoded = byteOffsetDecode((const unsigned char *) input.buf,
+                                (npy_intp) input.len,
+                                (npy_int32 *) PyArray_DATA(outputArray),
+                                nPixels);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+    if (nDecoded < 0)
+    {
+        PyErr_SetString(st->error, "Truncated byte offset stream");
+        return NULL;
+    }
+#if PY_MAJOR_VERSION >= 3
+    return PyLong_FromSsize_t((Py_ssize_t) nDecoded);
+#else
+    return PyInt_FromSsize_t((Py_ssize_t) nDecoded);
+#endif
+}
+
+/* TIFF LZW decompression.
+   Codes of 9 to 12 bits are stored most significant bit first. The code
+   width is increased one code earlier than in GIF files ("early change").
+   Returns the number of decoded bytes, -1 for a corrupted stream or
+   -2 for the old style (bit reversed) LZW encoding. */
+#define LZW_CLEAR 256
+#define LZW_EOI 257
+#define LZW_FIRST 258
+#define LZW_MAX_CODES 4096
+
+static npy_intp
+lzwDecode(const unsigned char *input, npy_intp nBytes,
+          unsigned char *out, npy_intp outSize)
+{
+    npy_uint16 prefix[LZW_MAX_CODES];
+    unsigned char suffix[LZW_MAX_CODES];
+    unsigned char first[LZW_MAX_CODES];
+    npy_uint16 length[LZW_MAX_CODES];
+    npy_intp bitPosition = 0;
+    npy_intp nBits = 8 * nBytes;
+    npy_intp o = 0;
+    npy_intp k;
+    int codeWidth = 9;
+    int next = LZW_FIRST;
+    int old = -1;
+    int code, c, i, n;
+    npy_uint32 bits;
+
+    if ((nBytes > 1) && (input[0] == 0) && (input[1] & 0x1))
+        return -2;
+    for (i = 0; i < 256; i++)
+    {
+        suffix[i] = (unsigned char) i;
+        first[i] = (unsigned char) i;
+        length[i] = 1;
+    }
+    while ((bitPosition + codeWidth) <= nBits)
+    {
+        /* read the next code */
+        k = bitPosition >> 3;
+        bits = ((npy_uint32) input[k]) << 16;
+        if ((k + 1) < nBytes)
+            bits |= ((npy_uint32) input[k + 1]) << 8;
+        if ((k + 2) < nBytes)
+            bits |= (npy_uint32) input[k + 2];
+        code = (int) ((bits >> (24 - (bitPosition & 7) - codeWidth)) &
+                      ((1 << codeWidth) - 1));
+        bitPosition += codeWidth;
+        if (code == LZW_EOI)
+            break;
+        if (code == LZW_CLEAR)
+        {
+            codeWidth = 9;
+            next = LZW_FIRST;
+            old = -1;
+            continue;
+        }
+        if (old < 0)
+        {
+            if (code > 255)
+                return -1;
+            if (o < outSize)
+                out[o] = (unsigned char) code;
+            o++;
+            old = code;
+            continue;
+        }
+        if (code > next)
+            return -1;
+        if (next < LZW_MAX_CODES)
+        {
+            /* the new entry is the previous string plus the first
+               character of the current one */
+            prefix[next] = (npy_uint16) old;
+            suffix[next] = (code == next) ? first[old] : first[code];
+            first[next] = first[old];
+            length[next] = length[old] + 1;
+            next++;
+            if ((next == ((1 << codeWidth) - 1)) && (codeWidth < 12))
+                codeWidth++;
+        }
+        else if (code == next)
+        {
+            return -1;
+        }
+        /* write the string of the code backwards */
+        n = length[code];
+        c = code;
+        for (i = n - 1; i >= 0; i--)
+        {
+            if ((o + i) < outSize)
+                out[o + i] = suffix[c];
+            c = prefix[c];
+        }
+        o += n;
+        old = code;
+    }
+    return (o < outSize) ? o : outSize;
+}
+
+static PyObject *
+PyMcaIOHelper_decodeLZW(PyObject *self, PyObject *args)
+{
+    Py_buffer input;
+    Py_ssize_t outSize;
+    PyObject *output;
+    npy_intp dimensions[1];
+    npy_intp nDecoded;
+    struct module_state *st = GETSTATE(self);
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y*n", &input, &outSize))
+#else
+    if (!PyArg_ParseTuple(args, "s*n", &input, &outSize))
+#endif
+        return NULL;
+    if (outSize < 0)
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error, "Negative output size");
+        return NULL;
+    }
+    dimensions[0] = (npy_intp) outSize;
+    output = PyArray_SimpleNew(1, dimensions, NPY_UBYTE);
+    if (output == NULL)
+    {
+        PyBuffer_Release(&input);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    nDecoded = lzwDecode((const unsigned char *) input.buf,
+                         (npy_intp) input.len,
+                         (unsigned char *) PyArray_DATA((PyArrayObject *) output),
+                         dimensions[0]);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+    if (nDecoded < 0)
+    {
+        Py_DECREF(output);
+        if (nDecoded == -2)
+            PyErr_SetString(st->error, "Old style LZW codes not supported");
+        else
+            PyErr_SetString(st->error, "Corrupted LZW stream");
+        return NULL;
+    }
+    if (nDecoded < dimensions[0])
+    {
+        /* return the decoded part only */
+        PyObject *result;
+        result = PySequence_GetSlice(output, 0, (Py_ssize_t) nDecoded);
+        Py_DECREF(output);
+        return result;
+    }
+    return output;
+}
+
+/* SPEC MCA parsing.
+   Every line starting with '@' (usually "@A") is a spectrum. Its values
+   are separated by blanks and a backslash continues the spectrum on the
+   next line. The numbers are converted independently of the locale.
+   The spectra first, first + step, ... are stored in the rows of the
+   output, missing channels are set to zero and extra channels ignored.
+   Returns the number of spectra found. */
+static const double specPowersOfTen[] = {
+    1e0, 1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11,
+    1e12, 1e13, 1e14, 1e15, 1e16, 1e17, 1e18, 1e19, 1e20, 1e21, 1e22};
+
+#define SPEC_SEPARATOR(c) (((c) == ' ') || ((c) == '\t') || ((c) == '\r') || \
+                           ((c) == '\n') || ((c) == '\\'))
+
+static const char *
+specParseNumber(const char *p, const char *end, double *value)
+{
+    npy_uint64 mantissa = 0;
+    int nDigits = 0;
+    int exponent = 0;
+    int exponent10 = 0;
+    int negative = 0;
+    int negativeExponent = 0;
+    int found = 0;
+    double result;
+
+    if ((p < end) && ((*p == '-') || (*p == '+')))
+    {
+        negative = (*p == '-');
+        p++;
+    }
+    while ((p < end) && (*p >= '0') && (*p <= '9'))
+    {
+        if (nDigits < 19)
+        {
+            mantissa = 10 * mantissa + (*p - '0');
+            if (mantissa)
+                nDigits++;
+        }
+        else
+        {
+            exponent++;
+        }
+        found = 1;
+        p++;
+    }
+    if ((p < end) && (*p == '.'))
+    {
+        p++;
+        while ((p < end) && (*p >= '0') && (*p <= '9'))
+        {
+            if (nDigits < 19)
+            {
+                mantissa = 10 * mantissa + (*p - '0');
+                if (mantissa)
+                    nDigits++;
+                exponent--;
+            }
+            found = 1;
+            p++;
+        }
+    }
+    if (!found)
+        return NULL;
+    if ((p < end) && ((*p == 'e') || (*p == 'E')))
+    {
+        p++;
+        if ((p < end) && ((*p == '-') || (*p == '+')))
+        {
+            negativeExponent = (*p == '-');
+            p++;
+        }
+        while ((p < end) && (*p >= '0') && (*p <= '9'))
+        {
+            if (exponent10 < 10000)
+                exponent10 = 10 * exponent10 + (*p - '0');
+            p++;
+        }
+        exponent += negativeExponent ? -exponent10 : exponent10;
+    }
+    result = (double) mantissa;
+    if ((exponent > 0) && (exponent < 23))
+        result *= specPowersOfTen[exponent];
+    else if ((exponent < 0) && (exponent > -23))
+        result /= specPowersOfTen[-exponent];
+    else if (exponent != 0)
+        result *= pow(10.0, (double) exponent);
+    *value = negative ? -result : result;
+    return p;
+}
+
+static npy_intp
+specMcaParse(const char *p, npy_intp nBytes, double *out,
+             npy_intp nRows, npy_intp nChannels, npy_intp first, npy_intp step)
+{
+    const char *end = p + nBytes;
+    const char *lineStart;
+    const char *q;
+    const char *next;
+    double *row;
+    double value;
+    npy_intp nSpectra = 0;
+    npy_intp channel;
+    npy_intp index;
+
+    while (p < end)
+    {
+        if (*p != '@')
+        {
+            /* next line */
+            q = memchr(p, '\n', end - p);
+            p = (q == NULL) ? end : q + 1;
+            continue;
+        }
+        index = nSpectra - first;
+        nSpectra++;
+        row = NULL;
+        if ((index >= 0) && ((index % step) == 0) && ((index / step) < nRows))
+            row = out + (index / step) * nChannels;
+        if (row == NULL)
+        {
+            /* skip the spectrum and its continuation lines */
+            while (p < end)
+            {
+                lineStart = p;
+                q = memchr(p, '\n', end - p);
+                if (q == NULL)
+                {
+                    p = end;
+                    break;
+                }
+                p = q + 1;
+                while ((q > lineStart) &&
+                       ((q[-1] == ' ') || (q[-1] == '\t') || (q[-1] == '\r')))
+                    q--;
+                if ((q == lineStart) || (q[-1] != '\\'))
+                    break;
+            }
+            continue;
+        }
+        /* skip the spectrum tag */
+        while ((p < end) && !SPEC_SEPARATOR(*p))
+            p++;
+        channel = 0;
+        while (p < end)
+        {
+            if (*p == '\n')
+            {
+                p++;
+                break;
+            }
+            if (*p == '\\')
+            {
+                /* continuation line */
+                q = memchr(p, '\n', end - p);
+                p = (q == NULL) ? end : q + 1;
+                continue;
+            }
+            if (SPEC_SEPARATOR(*p))
+            {
+                p++;
+                continue;
+            }
+            next = specParseNumber(p, end, &value);
+            if (next != NULL)
+            {
+                if (channel < nChannels)
+                    row[channel] = value;
+                channel++;
+                p = next;
+            }
+            /* ignore anything else up to the next separator */
+            while ((p < end) && !SPEC_SEPARATOR(*p))
+                p++;
+        }
+        for (; channel < nChannels; channel++)
+            row[channel] = 0.0;
+    }
+    return nSpectra;
+}
+
+static PyObject *
+PyMcaIOHelper_parseSpecMca(PyObject *self, PyObject *args)
+{
+    Py_buffer input;
+    PyObject *output;
+    PyArrayObject *outputArray;
+    Py_ssize_t first = 0;
+    Py_ssize_t step = 1;
+    npy_intp nRows;
+    npy_intp nChannels;
+    npy_intp nSpectra;
+    struct module_state *st = GETSTATE(self);
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTuple(args, "y*O|nn", &input, &output, &first, &step))
+#else
+    if (!PyArg_ParseTuple(args, "s*O|nn", &input, &output, &first, &step))
+#endif
+        return NULL;
+    if ((first < 0) || (step < 1))
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error, "Invalid first spectrum or step");
+        return NULL;
+    }
+    if (!PyArray_Check(output))
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error, "Output is not a numpy array");
+        return NULL;
+    }
+    outputArray = (PyArrayObject *) output;
+    if ((PyArray_TYPE(outputArray) != NPY_DOUBLE) ||
+        (PyArray_NDIM(outputArray) != 2) ||
+        !PyArray_ISCARRAY(outputArray))
+    {
+        PyBuffer_Release(&input);
+        PyErr_SetString(st->error,
+                        "Output must be a writeable contiguous 2D float64 array");
+        return NULL;
+    }
+    nRows = PyArray_DIM(outputArray, 0);
+    nChannels = PyArray_DIM(outputArray, 1);
+
+    Py_BEGIN_ALLOW_THREADS
+    nSpectra = specMcaParse((const char *) input.buf,
+                            (npy_intp) input.len,
+                            (double *) PyArray_DATA(outputArray),
+                            nRows, nChannels,
+                            (npy_intp) first, (npy_intp) step);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&input);
+#if PY_MAJOR_VERSION >= 3
+    return PyLong_FromSsize_t((Py_ssize_t) nSpectra);
+#else
+    return PyInt_FromSsize_t((Py_ssize_t) nSpectra);
+#endif
+}
+
 /* Module methods */
 
 static PyMethodDef PyMcaIOHelper_methods[] = {
     {"fillSupaVisio", PyMcaIOHelper_fillSupaVisio, METH_VARARGS},
     {"readAifira", PyMcaIOHelper_readAifira, METH_VARARGS},
+    {"decodeByteOffset", PyMcaIOHelper_decodeByteOffset, METH_VARARGS},
+    {"decodeLZW", PyMcaIOHelper_decodeLZW, METH_VARARGS},
+    {"parseSpecMca", PyMcaIOHelper_parseSpecMca, METH_VARARGS},
 	{NULL, NULL}
 };
 
@@ -32,11 +32,19 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import re
+import mmap
 import numpy
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from PyMca5.PyMcaCore import DataObject
 from PyMca5.PyMcaIO import specfilewrapper as specfile
 from PyMca5.PyMcaCore import SpecFileDataSource
+try:
+    from PyMca5.PyMcaIO import PyMcaIOHelper
+except ImportError:
+    PyMcaIOHelper = None
 
 HDF5 = False
 try:
@@ -52,6 +60,161 @@
 Y_AXIS = 1
 Z_AXIS = 2
 
+_MCA_SPECTRUM = re.compile(b"^@\\S*((?:[^\\n]*\\\\[ \\t\\r]*\\n)*[^\\n]*)",
+                           re.MULTILINE)
+
+
+def parseSpecMca(buffer, out, first=0, step=1):
+    """
+    Parse the MCA spectra (the lines starting by @) of a SPEC scan.
+
+    @param buffer: the scan contents
+    @type buffer: bytes like object
+    @param out: contiguous float64 array of shape (number of spectra,
+    number of channels). Row j receives the spectrum first + j * step.
+    Missing channels are set to zero and extra channels are ignored.
+    @type out: numpy array
+    @return: the number of spectra in the buffer
+    @rtype: int
+    """
+    if PyMcaIOHelper is not None:
+        return PyMcaIOHelper.parseSpecMca(buffer, out, first, step)
+    nSpectra = 0
+    for match in _MCA_SPECTRUM.finditer(buffer):
+        index = nSpectra - first
+        nSpectra += 1
+        if (index < 0) or (index % step) or (index // step >= out.shape[0]):
+            continue
+        values = match.group(1).replace(b"\\", b" ").split()
+        n = min(len(values), out.shape[1])
+        row = out[index // step]
+        row[:n] = numpy.array(values[:n], dtype=numpy.float64)
+        row[n:] = 0
+    return nSpectra
+
+
+def getScanOffsets(buffer):
+    """
+    @param buffer: the contents of a SPEC file
+    @type buffer: bytes like object
+    @return: the (start, end) byte offsets of the scans in the file
+    @rtype: list
+    """
+    if not hasattr(buffer, "find"):
+        buffer = bytes(buffer)
+    starts = []
+    if buffer[:2] == b"#S":
+        starts.append(0)
+    position = buffer.find(b"\n#S")
+    while position >= 0:
+        starts.append(position + 1)
+        position = buffer.find(b"\n#S", position + 3)
+    return list(zip(starts, starts[1:] + [len(buffer)]))
+
+
+def _threadedMap(function, n, nthreads):
+    if nthreads == 0:
+        nthreads = multiprocessing.cpu_count()
+    if nthreads is None or nthreads < 2 or n < 2:
+        for i in range(n):
+            function(i)
+    else:
+        pool = ThreadPool(processes=min(nthreads, n))
+        try:
+            for i in pool.imap_unordered(function, range(n)):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def readScanMca(source, out, scanlist=None, first=0, step=1, nthreads=None):
+    """
+    Read the MCA spectra of several scans of a SPEC file in one go.
+
+    @param source: the file name or its contents. Files are memory mapped.
+    @type source: string or bytes like object
+    @param out: array of shape (number of scans, number of spectra,
+    number of channels). out[i, j] receives the spectrum first + j * step
+    of the scan scanlist[i]. Missing channels are set to zero and extra
+    channels are ignored.
+    @type out: numpy array
+    @param scanlist: the indices of the scans in the file. Negative
+    indices count from the end of the file. All the scans by default.
+    @type scanlist: list
+    @param nthreads: number of threads parsing the scans. None parses
+    them in the calling thread and 0 uses one thread per CPU.
+    @type nthreads: int
+    @return: the number of spectra of each scan
+    @rtype: list
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return readScanMca(b"", out, scanlist=scanlist, first=first,
+                                   step=step, nthreads=nthreads)
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return readScanMca(buffer, out, scanlist=scanlist, first=first,
+                               step=step, nthreads=nthreads)
+        finally:
+            buffer.close()
+
+    offsets = getScanOffsets(source)
+    if scanlist is None:
+        scanlist = range(len(offsets))
+    scanlist = list(scanlist)
+    if len(out) != len(scanlist):
+        raise ValueError("Output array does not have %d scans" % \
+                         len(scanlist))
+    nSpectra = [0] * len(scanlist)
+
+    def readOne(i):
+        start, end = offsets[scanlist[i]]
+        target = out[i]
+        # parse into a temporary when out[i] cannot be filled in place
+        copy = target.dtype != numpy.float64 or \
+               not target.flags["C_CONTIGUOUS"]
+        if copy:
+            target = numpy.empty(out.shape[1:], dtype=numpy.float64)
+        view = memoryview(source)[start:end]
+        try:
+            nSpectra[i] = parseSpecMca(view, target, first, step)
+        finally:
+            view.release()
+        if copy:
+            out[i] = target
+
+    _threadedMap(readOne, len(scanlist), nthreads)
+    return nSpectra
+
+
+def readStack(filelist, out, scan=-1, first=0, step=1, nthreads=None):
+    """
+    Read the MCA spectra of one scan of every file of a list.
+
+    @param out: array of shape (number of files, number of spectra,
+    number of channels) filled as described in readScanMca
+    @type out: numpy array
+    @param scan: the index of the scan in the files
+    @type scan: int
+    @param nthreads: number of threads reading the files. None reads
+    them in the calling thread and 0 uses one thread per CPU.
+    @type nthreads: int
+    @return: out
+    @rtype: numpy array
+    """
+    if len(out) != len(filelist):
+        raise ValueError("Output array does not have %d files" % \
+                         len(filelist))
+
+    def readOne(i):
+        readScanMca(filelist[i], out[i:i + 1], scanlist=[scan],
+                    first=first, step=step)
+
+    _threadedMap(readOne, len(filelist), nthreads)
+    return out
+
 
 class SpecFileStack(DataObject.DataObject):
     def __init__(self, filelist=None):
@@ -180,7 +343,15 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
             # when reading fast we do not read the time information
             # therefore we have to remove it from the info
             self._cleanupTimeInfo()
-            for tempFileName in filelist:
+            if self._isSpecFile(specfile.Specfile(filelist[0])):
+                # parse all the spectra of the scan at once
+                readScanMca(filelist[0], self.data, scanlist=[-1])
+                self.incrProgressBar = numberofmca
+                self.onProgress(self.incrProgressBar)
+                filesToRead = []
+            else:
+                filesToRead = filelist
+            for tempFileName in filesToRead:
                 tempInstance = specfile.Specfile(tempFileName)
                 # it can only be here if there is one scan per file
                 # prevent problems if the scan number is different
@@ -206,7 +377,17 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
                                          arrRet.shape[0]),
                                          arrRet.dtype.char)
                 filecounter = 0
-                for tempFileName in filelist:
+                if self._isSpecFile(specfile.Specfile(filelist[0])):
+                    # the last of the read spectra is the one kept
+                    readStack(filelist, self.data[:, :1, :], scan=-1,
+                              first=iterlist[-1] - 1, nthreads=0)
+                    self.incrProgressBar = self.nbFiles * len(iterlist)
+                    self.onProgress(self.incrProgressBar)
+                    filecounter = self.nbFiles
+                    filesToRead = []
+                else:
+                    filesToRead = filelist
+                for tempFileName in filesToRead:
                     tempInstance = specfile.Specfile(tempFileName)
                     # it can only be here if there is one scan per file
                     # prevent problems if the scan number is different
@@ -424,6 +605,11 @@ def loadFileList(self, filelist, fileindex=0, shape=None):
         self.info["NumberOfFiles"] = self.__nFiles * 1
         self.info["FileIndex"] = fileindex
 
+    @staticmethod
+    def _isSpecFile(fileObject):
+        # only the files read by the specfile library can be parsed in bulk
+        return type(fileObject).__name__ == "specfile"
+
     def _cleanupTimeInfo(self):
         for timeKey in ["McaElapsedTime", "McaLiveTime"]:
             if timeKey in self.info:
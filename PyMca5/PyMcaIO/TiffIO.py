@@ -35,8 +35,22 @@
 import sys
 import os
 import struct
+import zlib
+import threading
+import atexit
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
 import logging
+try:
+    from PyMca5.PyMcaIO import PyMcaIOHelper
+    _decodeLZW = getattr(PyMcaIOHelper, "decodeLZW", None)
+except ImportError:
+    _decodeLZW = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 _logger = logging.getLogger(__name__)
 
@@ -53,13 +67,17 @@
             277:"SamplesPerPixel",           # SHORT (>=3) only for RGB images
             278:"RowsPerStrip",              # S or L, number of rows in each back may be not for the last
             279:"StripByteCounts",           # S or L, The number of bytes in the strip AFTER any compression
+            284:"PlanarConfiguration",       # SHORT (1 - Chunky, 2 - Planar)
             305:"Software",                  # ASCII
             306:"Date",                      # ASCII
+            317:"Predictor",                 # SHORT (1 - None, 2 - Horizontal differencing)
             320:"Colormap",                  # Colormap of Palette-color Images
+            322:"TileWidth",                 # S or L
+            323:"TileLength",                # S or L
+            324:"TileOffsets",               # L, for each tile, the byte offset of the tile
+            325:"TileByteCounts",            # S or L, The number of bytes in the tile AFTER any compression
             339:"SampleFormat",              # SHORT Interpretation of data in each pixel
             }
-
-# TILES ARE TO BE SUPPORTED TOO
 TAG_NUMBER_OF_COLUMNS  = 256
 TAG_NUMBER_OF_ROWS     = 257
 TAG_BITS_PER_SAMPLE    = 258
@@ -71,9 +89,15 @@
 TAG_SAMPLES_PER_PIXEL  = 277
 TAG_ROWS_PER_STRIP     = 278
 TAG_STRIP_BYTE_COUNTS  = 279
+TAG_PLANAR_CONFIGURATION = 284
 TAG_SOFTWARE           = 305
 TAG_DATE               = 306
+TAG_PREDICTOR          = 317
 TAG_COLORMAP           = 320
+TAG_TILE_WIDTH         = 322
+TAG_TILE_LENGTH        = 323
+TAG_TILE_OFFSETS       = 324
+TAG_TILE_BYTE_COUNTS   = 325
 TAG_SAMPLE_FORMAT      = 339
 
 FIELD_TYPE  = {1:('BYTE', "B"),
@@ -109,10 +133,137 @@
 SAMPLE_FORMAT_COMPLEXINT    = 5
 SAMPLE_FORMAT_COMPLEXIEEEFP = 6
 
+# supported compression schemes
+COMPRESSION_NONE            = 1
+COMPRESSION_LZW             = 5
+COMPRESSION_ADOBE_DEFLATE   = 8
+COMPRESSION_PACKBITS        = 32773
+COMPRESSION_DEFLATE         = 32946
+COMPRESSION_ZSTD            = 50000
+
+# predictors
+PREDICTOR_NONE              = 1
+PREDICTOR_HORIZONTAL        = 2
+
+_threadPools = {}
+_threadPoolLock = threading.Lock()
+
+
+def _getThreadPool(nthreads):
+    """
+    Thread pool of the given size shared by all the instances decoding
+    strips and tiles. The pools are never closed while in use, they are
+    closed and joined at exit.
+    """
+    with _threadPoolLock:
+        if nthreads not in _threadPools:
+            if not _threadPools:
+                atexit.register(_closeThreadPools)
+            _threadPools[nthreads] = ThreadPool(processes=nthreads)
+        return _threadPools[nthreads]
+
+
+def _closeThreadPools():
+    with _threadPoolLock:
+        for pool in _threadPools.values():
+            pool.close()
+            pool.join()
+        _threadPools.clear()
+
+
+def unpackBits(data):
+    """
+    Decompress PackBits compressed data.
+    """
+    output = []
+    readBytes = 0
+    nBytes = len(data)
+    while readBytes < nBytes:
+        n = struct.unpack('b', data[readBytes:(readBytes + 1)])[0]
+        readBytes += 1
+        if n >= 0:
+            # should I prevent reading more than the
+            # length of the chain? Let's python raise
+            # the exception...
+            output.append(data[readBytes:readBytes + (n + 1)])
+            readBytes += (n + 1)
+        elif n > -128:
+            output.append((-n + 1) * data[readBytes:(readBytes + 1)])
+            readBytes += 1
+        else:
+            # if read -128 ignore the byte
+            continue
+    return b"".join(output)
+
+
+def decodeLZW(data, size):
+    """
+    Decompress TIFF LZW compressed data.
+
+    :param bytes data: compressed data
+    :param int size: maximum number of bytes to decode
+    :returns: the decoded bytes as bytes or as an uint8 array
+    """
+    if _decodeLZW is not None:
+        try:
+            return _decodeLZW(data, size)
+        except PyMcaIOHelper.Error as e:
+            raise IOError("Cannot decode LZW data: %s" % e)
+    data = bytes(data)
+    if len(data) > 1 and data[0:1] == b"\x00" and (ord(data[1:2]) & 0x1):
+        raise IOError("Old style LZW codes not supported")
+    # make sure the last code can be read
+    value = int.from_bytes(data + b"\x00\x00", "big") if \
+            hasattr(int, "from_bytes") else \
+            int((data + b"\x00\x00").encode("hex"), 16)
+    nBits = 8 * (len(data) + 2)
+    position = 0
+    table = []
+    output = []
+    outputSize = 0
+    codeWidth = 9
+    old = None
+    while (position + codeWidth) <= 8 * len(data) and outputSize < size:
+        code = (value >> (nBits - position - codeWidth)) & \
+               ((1 << codeWidth) - 1)
+        position += codeWidth
+        if code == 257:
+            break
+        if code == 256:
+            table = [struct.pack("B", i) for i in range(256)] + [None, None]
+            codeWidth = 9
+            old = None
+            continue
+        if not table:
+            table = [struct.pack("B", i) for i in range(256)] + [None, None]
+        if old is None:
+            string = table[code]
+        elif code < len(table):
+            string = table[code]
+            if len(table) < 4096:
+                table.append(old + string[0:1])
+        elif code == len(table):
+            string = old + old[0:1]
+            table.append(string)
+        else:
+            raise IOError("Corrupted LZW stream")
+        if len(table) == (1 << codeWidth) - 1 and codeWidth < 12:
+            codeWidth += 1
+        output.append(string)
+        outputSize += len(string)
+        old = string
+    return b"".join(output)[:size]
+
 
 
 class TiffIO(object):
-    def __init__(self, filename, mode=None, cache_length=20, mono_output=False):
+    def __init__(self, filename, mode=None, cache_length=20, mono_output=False,
+                 nthreads=0):
+        """
+        :param nthreads: number of threads decoding the strips or tiles
+            of compressed images. 0 uses one thread per CPU while None
+            or 1 decode them in the calling thread.
+        """
         if mode is None:
             mode = 'rb'
         if 'b' not in mode:
@@ -135,6 +286,9 @@ def __init__(self, filename, mode=None, cache_length=20, mono_output=False):
         self._initInternalVariables(fd)
         self._maxImageCacheLength = cache_length
         self._forceMonoOutput = mono_output
+        if nthreads == 0:
+            nthreads = multiprocessing.cpu_count()
+        self._nThreads = nthreads
 
     def _initInternalVariables(self, fd=None):
         if fd is None:
@@ -465,19 +619,50 @@ def _readInfo(self, nImage, close=True):
         else:
             date = "Unknown Date"
 
-        stripOffsets = self._readIFDEntry(TAG_STRIP_OFFSETS,
-                                          tagIDList,
-                                          fieldTypeList,
-                                          nValuesList,
-                                          valueOffsetList)
-        if TAG_ROWS_PER_STRIP in tagIDList:
+        # predictor
+        predictor = PREDICTOR_NONE
+        if TAG_PREDICTOR in tagIDList:
+            predictor = valueOffsetList[tagIDList.index(TAG_PREDICTOR)]
+
+        # planar configuration
+        planarConfiguration = 1
+        if TAG_PLANAR_CONFIGURATION in tagIDList:
+            planarConfiguration = valueOffsetList[\
+                            tagIDList.index(TAG_PLANAR_CONFIGURATION)]
+
+        # tiles
+        tileWidth = None
+        tileLength = None
+        tileOffsets = None
+        tileByteCounts = None
+        if TAG_TILE_OFFSETS in tagIDList:
+            tileWidth = valueOffsetList[tagIDList.index(TAG_TILE_WIDTH)]
+            tileLength = valueOffsetList[tagIDList.index(TAG_TILE_LENGTH)]
+            tileOffsets = self._readIFDEntry(TAG_TILE_OFFSETS,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)
+            tileByteCounts = self._readIFDEntry(TAG_TILE_BYTE_COUNTS,
+                        tagIDList, fieldTypeList, nValuesList, valueOffsetList)
+
+        if tileOffsets is not None:
+            stripOffsets = []
+        else:
+            stripOffsets = self._readIFDEntry(TAG_STRIP_OFFSETS,
+                                              tagIDList,
+                                              fieldTypeList,
+                                              nValuesList,
+                                              valueOffsetList)
+        if tileOffsets is not None:
+            rowsPerStrip = tileLength
+        elif TAG_ROWS_PER_STRIP in tagIDList:
             rowsPerStrip = self._readIFDEntry(TAG_ROWS_PER_STRIP,
                         tagIDList, fieldTypeList, nValuesList, valueOffsetList)[0]
         else:
             rowsPerStrip = nRows
             _logger.warning("WARNING: Non standard TIFF. Rows per strip TAG missing")
 
-        if TAG_STRIP_BYTE_COUNTS in tagIDList:
+        if tileOffsets is not None:
+            stripByteCounts = []
+        elif TAG_STRIP_BYTE_COUNTS in tagIDList:
             stripByteCounts = self._readIFDEntry(TAG_STRIP_BYTE_COUNTS,
                         tagIDList, fieldTypeList, nValuesList, valueOffsetList)
         else:
@@ -514,7 +699,13 @@ def _readInfo(self, nImage, close=True):
         info["imageDescription"] = imageDescription
         info["stripOffsets"] = stripOffsets  # This contains the file offsets to the data positions
         info["rowsPerStrip"] = rowsPerStrip
-        info["stripByteCounts"] = stripByteCounts  # bytes in strip since I do not support compression
+        info["stripByteCounts"] = stripByteCounts  # bytes in strip AFTER compression
+        info["tileWidth"] = tileWidth
+        info["tileLength"] = tileLength
+        info["tileOffsets"] = tileOffsets
+        info["tileByteCounts"] = tileByteCounts
+        info["predictor"] = predictor
+        info["planarConfiguration"] = planarConfiguration
         info["software"] = software
         info["date"] = date
         info["colormap"] = colormap
@@ -577,11 +768,20 @@ def _readImage(self, nImage, **kw):
         compression = info['compression']
         compression_type = info['compression_type']
         if compression:
-            if compression_type != 32773:
-                raise IOError("Compressed TIFF images not supported except packbits")
-            else:
-                # PackBits compression
-                _logger.debug("Using PackBits compression")
+            if compression_type not in [COMPRESSION_LZW,
+                                        COMPRESSION_ADOBE_DEFLATE,
+                                        COMPRESSION_PACKBITS,
+                                        COMPRESSION_DEFLATE,
+                                        COMPRESSION_ZSTD]:
+                raise IOError("Compressed TIFF images not supported except "
+                              "LZW, deflate, zstd and packbits")
+            if (compression_type == COMPRESSION_ZSTD) and (zstandard is None):
+                raise IOError("zstd compressed TIFF images require zstandard")
+            _logger.debug("Using compression %d", compression_type)
+        if info["predictor"] not in [PREDICTOR_NONE, PREDICTOR_HORIZONTAL]:
+            raise IOError("TIFF predictor %d not supported" % info["predictor"])
+        if (info["planarConfiguration"] != 1) and hasattr(info["nBits"], "index"):
+            raise IOError("Planar TIFF images not supported")
 
         interpretation = info["photometricInterpretation"]
         if interpretation == 2:
@@ -663,117 +863,47 @@ def _readImage(self, nImage, **kw):
         else:
             image = numpy.zeros((nRows, nColumns), dtype=dtype)
 
+        if (info["predictor"] == PREDICTOR_HORIZONTAL) and \
+           (image.dtype.kind == "f"):
+            raise IOError("Floating point TIFF predictor not supported")
+
         fd = self.fd
-        st = self._structChar
         stripOffsets = info["stripOffsets"] # This contains the file offsets to the data positions
         rowsPerStrip = info["rowsPerStrip"]
-        stripByteCounts = info["stripByteCounts"] # bytes in strip since I do not support compression
+        stripByteCounts = info["stripByteCounts"] # bytes in strip AFTER compression
 
-        rowStart = 0
-        if len(stripOffsets) == 1:
+        if (len(stripOffsets) == 1) and (not compression):
             bytesPerRow = int(stripByteCounts[0] / rowsPerStrip)
-            nBytes = stripByteCounts[0]
             if nRows == rowsPerStrip:
                 actualBytesPerRow = int(image.nbytes / nRows)
                 if actualBytesPerRow != bytesPerRow:
                     _logger.warning("Warning: Bogus StripByteCounts information")
-                    bytesPerRow = actualBytesPerRow 
-                    nBytes = (rowMax-rowMin+1) * bytesPerRow
+                    bytesPerRow = actualBytesPerRow
+            nBytes = (rowMax-rowMin+1) * bytesPerRow
             fd.seek(stripOffsets[0] + rowMin * bytesPerRow)
-            if self._swap:
-                readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype)).byteswap()
-            else:
-                readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype))
-            if hasattr(nBits, 'index'):
-                readout.shape = -1, nColumns, len(nBits)
-            elif info['colormap'] is not None:
-                readout = colormap[readout]
-                readout.shape = -1, nColumns, 3
+            target = image[rowMin:rowMax+1]
+            if (colormap is None) and (target.nbytes == nBytes) and \
+               hasattr(fd, "readinto"):
+                # read directly into the image
+                if fd.readinto(target.data) != nBytes:
+                    raise IOError("Truncated TIFF image")
+                if self._swap:
+                    target.byteswap(True)
             else:
-                readout.shape = -1, nColumns
-            image[rowMin:rowMax+1, :] = readout
-        else:
-            for i in range(len(stripOffsets)):
-                # the amount of rows
-                nRowsToRead = rowsPerStrip
-                rowEnd = int(min(rowStart + nRowsToRead, nRows))
-                if rowEnd < rowMin:
-                    rowStart += nRowsToRead
-                    continue
-                if (rowStart > rowMax):
-                    break
-                # we are in position
-                fd.seek(stripOffsets[i])
-                # the amount of bytes to read
-                nBytes = stripByteCounts[i]
-                if compression_type == 32773:
-                    try:
-                        bufferBytes = bytes()
-                    except:
-                        # python 2.5 ...
-                        bufferBytes = ""
-                    # packBits
-                    readBytes = 0
-                    # intermediate buffer
-                    tmpBuffer = fd.read(nBytes)
-                    while readBytes < nBytes:
-                        n = struct.unpack('b',
-                                        tmpBuffer[readBytes:(readBytes + 1)])[0]
-                        readBytes += 1
-                        if n >= 0:
-                            # should I prevent reading more than the
-                            # length of the chain? Let's python raise
-                            # the exception...
-                            bufferBytes +=  tmpBuffer[readBytes:\
-                                                      readBytes + (n + 1)]
-                            readBytes += (n + 1)
-                        elif n > -128:
-                            bufferBytes += (-n + 1) * \
-                                           tmpBuffer[readBytes:(readBytes + 1)]
-                            readBytes += 1
-                        else:
-                            # if read -128 ignore the byte
-                            continue
-                    if self._swap:
-                        readout = numpy.array(numpy.frombuffer(bufferBytes, dtype)).byteswap()
-                    else:
-                        readout = numpy.array(numpy.frombuffer(bufferBytes, dtype))
-                    if hasattr(nBits, 'index'):
-                        readout.shape = -1, nColumns, len(nBits)
-                    elif info['colormap'] is not None:
-                        readout = colormap[readout]
-                        readout.shape = -1, nColumns, 3
-                    else:
-                        readout.shape = -1, nColumns
-                    image[rowStart:rowEnd, :] = readout
+                if self._swap:
+                    readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype)).byteswap()
+                else:
+                    readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype))
+                if hasattr(nBits, 'index'):
+                    readout.shape = -1, nColumns, len(nBits)
+                elif info['colormap'] is not None:
+                    readout = colormap[readout]
+                    readout.shape = -1, nColumns, 3
                 else:
-                    if 1:
-                        # use numpy
-                        if self._swap:
-                            readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype)).byteswap()
-                        else:
-                            readout = numpy.array(numpy.frombuffer(fd.read(nBytes), dtype))
-                        if hasattr(nBits, 'index'):
-                            readout.shape = -1, nColumns, len(nBits)
-                        elif colormap is not None:
-                            readout = colormap[readout]
-                            readout.shape = -1, nColumns, 3
-                        else:
-                            readout.shape = -1, nColumns
-                        image[rowStart:rowEnd, :] = readout
-                    else:
-                        # using struct
-                        readout = numpy.array(struct.unpack(st+"%df" % int(nBytes/4), fd.read(nBytes)),
-                                              dtype=dtype)
-                        if hasattr(nBits, 'index'):
-                            readout.shape = -1, nColumns, len(nBits)
-                        elif colormap is not None:
-                            readout = colormap[readout]
-                            readout.shape = -1, nColumns, 3
-                        else:
-                            readout.shape = -1, nColumns
-                        image[rowStart:rowEnd, :] = readout
-                rowStart += nRowsToRead
+                    readout.shape = -1, nColumns
+                target[:] = readout
+        else:
+            self._readChunks(image, info, dtype, rowMin, rowMax)
         if close:
             self.__makeSureFileIsClosed()
 
@@ -794,6 +924,140 @@ def _readImage(self, nImage, **kw):
 
         return image
 
+    def _readChunks(self, image, info, dtype, rowMin, rowMax):
+        """
+        Read the strips or the tiles of the image overlapping the rows
+        [rowMin, rowMax]. Compressed chunks are decoded concurrently.
+        """
+        nRows = info["nRows"]
+        nColumns = info["nColumns"]
+        if info["tileOffsets"] is not None:
+            chunkRows = info["tileLength"]
+            chunkColumns = info["tileWidth"]
+            offsets = info["tileOffsets"]
+            byteCounts = info["tileByteCounts"]
+        else:
+            chunkRows = info["rowsPerStrip"]
+            chunkColumns = nColumns
+            offsets = info["stripOffsets"]
+            byteCounts = info["stripByteCounts"]
+        chunksPerRow = int((nColumns + chunkColumns - 1) // chunkColumns)
+        chunks = []
+        for i in range(len(offsets)):
+            rowStart = int(i // chunksPerRow) * chunkRows
+            columnStart = int(i % chunksPerRow) * chunkColumns
+            if rowStart >= nRows:
+                break
+            if (rowStart + chunkRows <= rowMin) or (rowStart > rowMax):
+                continue
+            chunks.append((offsets[i], byteCounts[i], rowStart, columnStart))
+        if (not info["compression"]) and (info["tileOffsets"] is None) and \
+           (info["colormap"] is None) and \
+           (info["predictor"] == PREDICTOR_NONE) and \
+           hasattr(self.fd, "readinto"):
+            self._readStrips(image, chunks, chunkRows)
+            return
+        rawChunks = self._readRawChunks(chunks)
+
+        def decode(i):
+            self._decodeChunk(image, info, dtype, rawChunks[i],
+                              chunks[i][2], chunks[i][3],
+                              chunkRows, chunkColumns)
+
+        if info["compression"] and (len(chunks) > 1) and \
+           (self._nThreads is not None) and (self._nThreads > 1):
+            _getThreadPool(self._nThreads).map(decode, range(len(chunks)))
+        else:
+            for i in range(len(chunks)):
+                decode(i)
+
+    def _readStrips(self, image, chunks, chunkRows):
+        """
+        Read uncompressed strips directly into the image. Consecutive
+        strips stored next to each other are read at once.
+        """
+        fd = self.fd
+        nRows = image.shape[0]
+        bytesPerRow = image[0].nbytes
+        i = 0
+        while i < len(chunks):
+            offset, nBytes, rowStart, columnStart = chunks[i]
+            rowEnd = min(rowStart + chunkRows, nRows)
+            i += 1
+            while (i < len(chunks)) and \
+                  (chunks[i][0] == offset + (rowEnd - rowStart) * bytesPerRow):
+                rowEnd = min(chunks[i][2] + chunkRows, nRows)
+                i += 1
+            target = image[rowStart:rowEnd]
+            fd.seek(offset)
+            if fd.readinto(target.data) != target.nbytes:
+                raise IOError("Truncated TIFF image")
+            if self._swap:
+                target.byteswap(True)
+
+    def _readRawChunks(self, chunks):
+        """
+        Read the bytes of the chunks, with a single read when they are
+        close to each other in the file.
+        """
+        fd = self.fd
+        if not len(chunks):
+            return []
+        start = min(chunk[0] for chunk in chunks)
+        end = max(chunk[0] + chunk[1] for chunk in chunks)
+        nBytes = sum(chunk[1] for chunk in chunks)
+        if (end - start) <= (2 * nBytes + 1024 * 1024):
+            fd.seek(start)
+            buffer = memoryview(fd.read(end - start))
+            return [buffer[chunk[0] - start:chunk[0] - start + chunk[1]]
+                    for chunk in chunks]
+        rawChunks = []
+        for offset, nBytes, rowStart, columnStart in chunks:
+            fd.seek(offset)
+            rawChunks.append(fd.read(nBytes))
+        return rawChunks
+
+    def _decodeChunk(self, image, info, dtype, raw, rowStart, columnStart,
+                     chunkRows, chunkColumns):
+        nRows = info["nRows"]
+        nColumns = info["nColumns"]
+        nBits = info["nBits"]
+        colormap = info["colormap"]
+        if hasattr(nBits, 'index'):
+            shape = [chunkRows, chunkColumns, len(nBits)]
+        else:
+            shape = [chunkRows, chunkColumns]
+        itemSize = numpy.dtype(dtype).itemsize
+        expected = int(numpy.prod(shape)) * itemSize
+        compression_type = info["compression_type"]
+        if not info["compression"]:
+            data = raw
+        elif compression_type == COMPRESSION_PACKBITS:
+            data = unpackBits(bytes(raw))
+        elif compression_type in [COMPRESSION_ADOBE_DEFLATE,
+                                  COMPRESSION_DEFLATE]:
+            data = zlib.decompress(raw)
+        elif compression_type == COMPRESSION_LZW:
+            data = decodeLZW(raw, expected)
+        else:
+            data = zstandard.ZstdDecompressor().decompress(raw,
+                                                max_output_size=expected)
+        count = min(len(data), expected) // itemSize
+        # the last strip may be shorter
+        shape[0] = count // int(numpy.prod(shape[1:]))
+        readout = numpy.frombuffer(data, dtype, count=count)
+        readout = readout[:int(numpy.prod(shape))].reshape(shape)
+        if self._swap:
+            readout = readout.byteswap()
+        if info["predictor"] == PREDICTOR_HORIZONTAL:
+            readout = numpy.cumsum(readout, axis=1, dtype=readout.dtype)
+        if colormap is not None:
+            readout = colormap[readout]
+        rowEnd = min(rowStart + shape[0], nRows)
+        columnEnd = min(columnStart + chunkColumns, nColumns)
+        image[rowStart:rowEnd, columnStart:columnEnd] = \
+                    readout[:rowEnd - rowStart, :columnEnd - columnStart]
+
     def writeImage(self, image0, info=None, software=None, date=None):
         if software is None:
             software = 'PyMca.TiffIO'
@@ -138,6 +138,7 @@ typedef struct _SpecFile{
   long           *data_info;
   SfCursor        cursor;
   short           updating;
+  short           index_modified;
 } SpecFile;
 
 typedef struct _SpecFileOut{
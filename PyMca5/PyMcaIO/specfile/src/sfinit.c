@@ -125,6 +125,12 @@
 
 #define SF_ISFX      ".sfI"
 
+/*
+ * Files smaller than this are indexed faster than the index file
+ * can be validated. The index file is not used for them.
+ */
+#define SF_INDEX_MINSIZE  (4 * 1024 * 1024)
+
 #define SF_INIT      0
 #define SF_READY     1
 #define SF_MODIFIED  2
@@ -141,9 +147,9 @@ DllExport char     * SfError  ( int error);
 
 
 #ifdef linux
-char SF_SIGNATURE[] =  "Linux 2ruru Sf2.0";
+char SF_SIGNATURE[] =  "Linux 2ruru Sf2.1";
 #else
-char SF_SIGNATURE[] =  "2ruru Sf2.0";
+char SF_SIGNATURE[] =  "2ruru Sf2.1";
 #endif
 
 /*
@@ -155,10 +161,14 @@ static void  sfNewLine     ( SpecFile *sf, SfCursor *cursor, char c0,char c1,int
 static void  sfHeaderLine  ( SpecFile *sf, SfCursor *cursor, char c,int *error);
 static void  sfNewBlock    ( SpecFile *sf, SfCursor *cursor, short how,int *error);
 static void  sfSaveScan    ( SpecFile *sf, SfCursor *cursor, int *error);
-static void  sfAssignScanNumbers (SpecFile *sf);
+static void  sfAssignScanNumbers (SpecFile *sf, ObjectList *from);
+static void  sfInitCursor  ( SfCursor *cursor);
+static void  sfFreeScans   ( SpecFile *sf);
 static void  sfReadFile    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error);
 #ifdef SPECFILE_USE_INDEX_FILE
+static int   sfUseIndex    ( SpecFile *sf);
+static char *sfIndexName   ( SpecFile *sf);
 static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, int *error);
 static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error);
@@ -256,6 +266,7 @@ SfOpen2(int fd, char *name,int *error) {
    short       idxret;
    SfCursor      cursor;
    struct stat mystat;
+   ObjectList *last;
 
    if ( fd == -1 ) {
       *error = SF_ERR_FILE_OPEN;
@@ -296,19 +307,12 @@ SfOpen2(int fd, char *name,int *error) {
    sf->data            = (double **)NULL;
    sf->data_info       = (long *)NULL;
    sf->updating        = 0;
+   sf->index_modified  = 0;
 
   /*
    * Init cursor
    */
-   cursor.bytecnt      = 0;
-   cursor.cursor       = 0;
-   cursor.scanno       = 0;
-   cursor.hdafoffset   = -1;
-   cursor.dataoffset   = -1;
-   cursor.mcaspectra   = 0;
-   cursor.what         = 0;
-   cursor.data         = 0;
-   cursor.file_header  = 0;
+   sfInitCursor(&cursor);
 
 
 #ifdef SPECFILE_USE_INDEX_FILE
@@ -321,8 +325,13 @@ SfOpen2(int fd, char *name,int *error) {
    idxret = SF_INIT;
 #endif
 
+   /*
+    * Scans read from the index file already have their numbers
+    */
+   last = (ObjectList *)NULL;
    switch(idxret) {
       case SF_MODIFIED:
+          last = sf->list.last;
           sfResumeRead(sf,&cursor,error);
           sfReadFile(sf,&cursor,error);
           break;
@@ -343,7 +352,10 @@ SfOpen2(int fd, char *name,int *error) {
   /*
    * Once is all done assign scan numbers and orders
    */
-   sfAssignScanNumbers(sf);
+   if (idxret != SF_READY) {
+       if (last == (ObjectList *)NULL) last = sf->list.first;
+       sfAssignScanNumbers(sf,last);
+   }
 
 #ifdef SPECFILE_USE_INDEX_FILE
    if (idxret != SF_READY) sfWriteIndex(sf,&cursor,error);
@@ -371,16 +383,18 @@ SfOpen2(int fd, char *name,int *error) {
 DllExport int
 SfClose( SpecFile *sf )
 {
-     register ObjectList  *ptr;
-     register ObjectList  *prevptr;
+#ifdef SPECFILE_USE_INDEX_FILE
+     int error;
+
+    /*
+     * Save what SfUpdate has read since the index was written
+     */
+     if (sf->index_modified) sfWriteIndex(sf,&(sf->cursor),&error);
+#endif
 
      freeAllData(sf);
 
-     for( ptr=sf->list.last ; ptr ; ptr=prevptr ) {
-          free( (SpecScan *)ptr->contents );
-          prevptr = ptr->prev;
-	  free( (ObjectList *)ptr );
-     }
+     sfFreeScans(sf);
 
      free ((char *)sf->sfname);
      if (sf->scanbuffer != NULL)
@@ -426,25 +440,43 @@ SfUpdate ( SpecFile *sf, int *error )
 {
     struct stat mystat;
     long   mtime;
-   /*printf("In SfUpdate\n");
-   __asm("int3");*/
-    stat(sf->sfname,&mystat);
+    ObjectList *last;
 
-    mtime = mystat.st_mtime;
+    if (stat(sf->sfname,&mystat)) return(0);
 
-    if (sf->m_time != mtime)  {
-       sfResumeRead (sf,&(sf->cursor),error);
-       sfReadFile   (sf,&(sf->cursor),error);
+    mtime = mystat.st_mtime;
 
-       sf->m_time = mtime;
-       sfAssignScanNumbers(sf);
-#ifdef SPECFILE_USE_INDEX_FILE
-       sfWriteIndex (sf,&(sf->cursor),error);
-#endif
-       return(1);
-    }else{
+    if (sf->m_time == mtime && (long) mystat.st_size == sf->cursor.bytecnt)
        return(0);
+
+   /*
+    * The scan being read may have changed
+    */
+    freeAllData(sf);
+    sf->current = (ObjectList *)NULL;
+
+    if ((long) mystat.st_size < sf->cursor.bytecnt) {
+      /*
+       * File truncated or rewritten: index it again
+       */
+       sfFreeScans(sf);
+       sfInitCursor(&(sf->cursor));
+       lseek(sf->fd,0,SEEK_SET);
+       last = (ObjectList *)NULL;
+    } else {
+      /*
+       * Only read from the beginning of the last scan
+       */
+       last = sf->list.last;
+       sfResumeRead (sf,&(sf->cursor),error);
     }
+    sfReadFile   (sf,&(sf->cursor),error);
+
+    sf->m_time = mtime;
+    if (last == (ObjectList *)NULL) last = sf->list.first;
+    sfAssignScanNumbers(sf,last);
+    sf->index_modified = 1;
+    return(1);
 }
 
 
@@ -532,8 +564,49 @@ sfReadFile(SpecFile *sf,SfCursor *cursor,int *error) {
 }
 
 
+static void
+sfInitCursor  ( SfCursor *cursor) {
+    cursor->bytecnt      = 0;
+    cursor->cursor       = 0;
+    cursor->scanno       = 0;
+    cursor->hdafoffset   = -1;
+    cursor->dataoffset   = -1;
+    cursor->mcaspectra   = 0;
+    cursor->what         = 0;
+    cursor->data         = 0;
+    cursor->file_header  = 0;
+    cursor->fileh_size   = 0;
+    cursor->datalines    = 0;
+}
+
+
+static void
+sfFreeScans   ( SpecFile *sf) {
+    register ObjectList  *ptr;
+    register ObjectList  *prevptr;
+
+    for( ptr=sf->list.last ; ptr ; ptr=prevptr ) {
+         free( (SpecScan *)ptr->contents );
+         prevptr = ptr->prev;
+         free( (ObjectList *)ptr );
+    }
+    sf->list.first = (ObjectList *)NULL;
+    sf->list.last  = (ObjectList *)NULL;
+    sf->current    = (ObjectList *)NULL;
+    sf->no_scans   = 0;
+}
+
+
 static void
 sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error) {
+    if (cursor->scanno < 1) {
+       /*
+        * No scan to resume from, read from the beginning
+        */
+        sfInitCursor(cursor);
+        lseek(sf->fd,0,SEEK_SET);
+        return;
+    }
     cursor->bytecnt      = cursor->cursor;
     cursor->what         = 0;
     cursor->hdafoffset   = -1;
@@ -548,101 +621,181 @@ sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error) {
 
 
 #ifdef SPECFILE_USE_INDEX_FILE
+/*
+ * The index file keeps next to the data file the scan list and the cursor
+ * obtained from reading it. It is valid as long as the data file has not
+ * been modified or it has only been appended to. In that case only the
+ * bytes from the beginning of the last scan in the index are read.
+ * Setting the SPECFILE_INDEX environment variable to 0 disables it.
+ */
+static int
+sfUseIndex ( SpecFile *sf) {
+    struct stat mystat;
+    char       *env;
+
+    env = getenv("SPECFILE_INDEX");
+    if (env != (char *)NULL && !strcmp(env,"0")) return(0);
+
+    if (fstat(sf->fd,&mystat)) return(0);
+
+    return(mystat.st_size >= SF_INDEX_MINSIZE);
+}
+
+
+static char *
+sfIndexName ( SpecFile *sf) {
+    char *idxname;
+
+    idxname = (char *)malloc(sizeof(char) *
+                             (strlen(sf->sfname) + strlen(SF_ISFX) + 1));
+    if (idxname != (char *)NULL)
+        sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    return(idxname);
+}
+
+
 static short
 sfOpenIndex ( SpecFile *sf, SfCursor *cursor, int *error) {
     char *idxname;
-    short namelength;
     int   sfi;
+    short ret;
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
+    if (!sfUseIndex(sf)) return(SF_INIT);
 
-    idxname = (char *)malloc(sizeof(char) * namelength);
+    if ((idxname = sfIndexName(sf)) == (char *)NULL) return(SF_INIT);
 
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    sfi = open(idxname,SF_OPENFLAG);
+    free(idxname);
+    if (sfi == -1) return(SF_INIT);
 
-    if ((sfi = open(idxname,SF_OPENFLAG)) == -1) {
-        free(idxname);
-        return(SF_INIT);
-    } else {
-        free(idxname);
-        return(sfReadIndex(sfi,sf,cursor,error));
-    }
+    ret = sfReadIndex(sfi,sf,cursor,error);
+    close(sfi);
+    return(ret);
 }
 
-
+
 static short
 sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error) {
     SfCursor   filecurs;
-    char       buffer[200];
-    long       bytesread,i=0;
-    SpecScan   scan;
-    short      modif = 0;
+    char       buffer[sizeof(SF_SIGNATURE)];
+    long       i, nbytes;
+    SpecScan  *scans;
     long       mtime;
+    struct stat mystat;
 
    /*
     * read signature
     */
-    bytesread = read(sfi,buffer,sizeof(SF_SIGNATURE));
-    if (strcmp(buffer,SF_SIGNATURE) || bytesread == 0 ) {
+    if (read(sfi,buffer,sizeof(SF_SIGNATURE)) != sizeof(SF_SIGNATURE) ||
+        memcmp(buffer,SF_SIGNATURE,sizeof(SF_SIGNATURE))) {
         return(SF_INIT);
     }
 
    /*
     * read cursor and specfile structure
     */
-    if ( read(sfi,&mtime,   sizeof(long)) == 0)   return(SF_INIT);
-    if ( read(sfi,&filecurs, sizeof(SfCursor)) == 0) return(SF_INIT);
+    if (read(sfi,&mtime,   sizeof(long)) != sizeof(long))   return(SF_INIT);
+    if (read(sfi,&filecurs, sizeof(SfCursor)) != sizeof(SfCursor))
+        return(SF_INIT);
 
-    if (sf->m_time != mtime)  modif = 1;
+   /*
+    * The data file must be the same or have grown
+    */
+    if (fstat(sf->fd,&mystat)) return(SF_INIT);
+    if ((long) mystat.st_size < filecurs.bytecnt) return(SF_INIT);
+    if ((long) mystat.st_size == filecurs.bytecnt && sf->m_time != mtime)
+        return(SF_INIT);
+    if (filecurs.scanno > 0) {
+        if (lseek(sf->fd,filecurs.cursor,SEEK_SET) != filecurs.cursor ||
+            read(sf->fd,buffer,2) != 2 ||
+            buffer[0] != '#' || buffer[1] != 'S') {
+            return(SF_INIT);
+        }
+    }
 
-    while(read(sfi,&scan, sizeof(SpecScan))) {
-        addToList(&(sf->list), (void *)&scan, (long)sizeof(SpecScan));
-        i++;
+    if (filecurs.scanno < 0) return(SF_INIT);
+    nbytes = filecurs.scanno * sizeof(SpecScan);
+    scans  = (SpecScan *)malloc(nbytes > 0 ? nbytes : 1);
+    if (scans == (SpecScan *)NULL) return(SF_INIT);
+    if (read(sfi,scans,nbytes) != nbytes) {
+        free(scans);
+        return(SF_INIT);
     }
-    sf->no_scans = i;
+    for (i = 0; i < filecurs.scanno; i++) {
+        if (addToList(&(sf->list), (void *)&scans[i], (long)sizeof(SpecScan))) {
+            free(scans);
+            sfFreeScans(sf);
+            return(SF_INIT);
+        }
+    }
+    free(scans);
+    sf->no_scans = filecurs.scanno;
 
     memcpy(cursor,&filecurs,sizeof(SfCursor));
 
-    if (modif) return(SF_MODIFIED);
+    if ((long) mystat.st_size != filecurs.bytecnt) return(SF_MODIFIED);
 
     return(SF_READY);
 }
 
-
+
 static void
 sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error) {
 
     int         fdi;
     char       *idxname;
-    short       namelength;
+    char       *tmpname;
     ObjectList *obj;
+    SpecScan   *scans;
     long        mtime;
+    long        i, nbytes;
+    int         ok;
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
+    sf->index_modified = 0;
 
-    idxname = (char *)malloc(sizeof(char) * namelength);
+    if (!sfUseIndex(sf)) return;
 
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    if ((idxname = sfIndexName(sf)) == (char *)NULL) return;
 
-    /* if ((fdi = open(idxname,SF_WRITEFLAG,SF_UMASK)) == -1) { */
-    if ((fdi = open(idxname,O_CREAT | O_WRONLY,SF_UMASK)) == -1) {
-        printf("    - cannot open. Error: (%d)\n",errno);
+   /*
+    * Write a temporary file and rename it for other processes
+    * not to read it before it is complete
+    */
+    tmpname = (char *)malloc(sizeof(char) * (strlen(idxname) + 32));
+    if (tmpname == (char *)NULL) {
         free(idxname);
         return;
-    } else {
-        mtime = sf->m_time;
-        write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE));
- /*
-  * Swap bytes for linux
-  */
-        write(fdi, (void *) &mtime, sizeof(long));
-        write(fdi, (void *) cursor, sizeof(SfCursor));
-        for( obj = sf->list.first; obj ; obj = obj->next)
-           write(fdi,(void *) obj->contents, sizeof(SpecScan));
-        close(fdi);
+    }
+    sprintf(tmpname,"%s.%ld",idxname,(long) getpid());
+
+    nbytes = cursor->scanno * sizeof(SpecScan);
+    scans  = (SpecScan *)malloc(nbytes > 0 ? nbytes : 1);
+    if (scans == (SpecScan *)NULL ||
+        (fdi = open(tmpname,O_CREAT | O_WRONLY | O_TRUNC,SF_UMASK)) == -1) {
+        free(scans);
+        free(tmpname);
         free(idxname);
         return;
     }
+
+    for( i = 0, obj = sf->list.first; obj && i < cursor->scanno;
+                                      obj = obj->next, i++)
+        memcpy(&scans[i], obj->contents, sizeof(SpecScan));
+
+    mtime = sf->m_time;
+    ok = (i == cursor->scanno) &&
+         (write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE)) == sizeof(SF_SIGNATURE)) &&
+         (write(fdi,(void *) &mtime, sizeof(long)) == sizeof(long)) &&
+         (write(fdi,(void *) cursor, sizeof(SfCursor)) == sizeof(SfCursor)) &&
+         (write(fdi,(void *) scans, nbytes) == nbytes);
+    if (close(fdi)) ok = 0;
+
+    if (!ok || rename(tmpname,idxname)) unlink(tmpname);
+
+    free(scans);
+    free(tmpname);
+    free(idxname);
+    return;
 }
 #endif
 
@@ -789,7 +942,7 @@ sfSaveScan(SpecFile *sf, SfCursor *cursor,int *error) {
 
 
 static void
-sfAssignScanNumbers(SpecFile *sf) {
+sfAssignScanNumbers(SpecFile *sf, ObjectList *from) {
 
   int                    i;
   char                  *ptr;
@@ -801,7 +954,7 @@ sfAssignScanNumbers(SpecFile *sf) {
   SpecScan              *scan,
                         *scan2;
 
-  for ( object = (sf->list).first; object; object=object->next) {
+  for ( object = from; object; object=object->next) {
         scan = (SpecScan *) object->contents;
 
         lseek(sf->fd,scan->offset,SEEK_SET);
@@ -166,7 +166,11 @@ sfSetCurrent( SpecFile *sf, long index,int *error )
      * if different file read fileheader also
      */
      if (!sfSameFile(sf,list)) {
-        if (sf->filebuffer != ( char * ) NULL) free(sf->filebuffer);
+        if (sf->filebuffer != ( char * ) NULL) {
+            free(sf->filebuffer);
+            sf->filebuffer = ( char * ) NULL;
+        }
+        sf->filebuffersize = 0;
 
         start        = scan->file_header;
         flist        = findFirstInFile(&(sf->list),scan->file_header);
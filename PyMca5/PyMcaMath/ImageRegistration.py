@@ -37,6 +37,7 @@
 import os, time
 import numpy
 from numpy.fft import fft2, ifft2, fftshift, ifftshift
+from PyMca5.PyMcaCore.McaStackView import threadedMap
 PYMCA = False
 SCIPY = False
 try:
@@ -200,6 +201,176 @@ def measure_offset_from_ffts(img0_fft2, img1_fft2, withLog=False):
     else:
         return offset
 
+def measure_offsets_from_ffts(img0_fft2, imgs_fft2):
+    """
+    Batched version of measure_offset_from_ffts: measure the offsets of a
+    set of images respect to the same reference image.
+    :param img0_fft2: ndarray, FFT of the reference image
+    :param imgs_fft2: ndarray, FFTs of the images, shape (n,) + img0_fft2.shape
+    :return: ndarray of shape (n, 2) with the offsets of each image respect to the reference
+    """
+    shape = img0_fft2.shape
+    n = imgs_fft2.shape[0]
+    absf0 = abs(img0_fft2)
+    absf0[absf0 < 1.0e-20] = 1.0
+    absf1 = abs(imgs_fft2)
+    absf1[absf1 < 1.0e-20] = 1.0
+    cross = imgs_fft2.conjugate()
+    cross *= img0_fft2
+    cross /= absf1
+    cross /= absf0
+    res = abs(fftshift(ifft2(cross, axes=(-2, -1)), axes=(-2, -1)))
+    cross = None
+    flat = res.reshape(n, -1)
+    a0, a1 = numpy.unravel_index(numpy.argmax(flat, axis=1), shape)
+    resmax = flat[numpy.arange(n), a0 * shape[1] + a1]
+    # refine a bit the position: centroid of the (clipped) 7x7 neighborhood
+    w = 3
+    d = numpy.arange(-w, w + 1)
+    i = a0[:, None, None] + d[None, :, None]
+    j = a1[:, None, None] + d[None, None, :]
+    valid = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1])
+    values = res[numpy.arange(n)[:, None, None],
+                 numpy.clip(i, 0, shape[0] - 1),
+                 numpy.clip(j, 0, shape[1] - 1)]
+    values = numpy.where(valid & (values > 0.1 * resmax[:, None, None]),
+                         values, 0.0)
+    total = values.sum(axis=(1, 2))
+    offsets = numpy.zeros((n, 2), numpy.float64)
+    offsets[:, 0] = shape[0] // 2 - (i * values).sum(axis=(1, 2)) / total
+    offsets[:, 1] = shape[1] // 2 - (j * values).sum(axis=(1, 2)) / total
+    return offsets
+
+def _frames(data, index, start, end, roi=None):
+    """
+    Read the frames start:end of a stack of images as an array of shape (n, d0, d1)
+    :param data: stack (ndarray or HDF5 dataset)
+    :param index: dimension of the stack indexing the frames (0 or 2)
+    :param roi: tuple of two slices to read only part of each frame
+    """
+    if roi is None:
+        roi = slice(None), slice(None)
+    if index == 0:
+        return numpy.asarray(data[start:end, roi[0], roi[1]])
+    else:
+        return numpy.moveaxis(numpy.asarray(data[roi[0], roi[1], start:end]), -1, 0)
+
+def _batches(data, index, frameSize, nbytes):
+    """
+    Frame ranges of the batches of a stack of images
+    """
+    nFrames = data.shape[index]
+    if nbytes is None:
+        nbytes = 32 * 1024 ** 2
+    # the complex FFTs of a batch dominate the memory usage
+    step = max(int(nbytes // (16 * max(frameSize, 1))), 1)
+    return [(i, min(i + step, nFrames)) for i in range(0, nFrames, step)]
+
+def measure_stack_offsets(reference, data, index=0, offsets=None, widths=None,
+                          window=None, dtype=numpy.float32, nbytes=None,
+                          nthreads=None, callback=None):
+    """
+    Measure the offsets of all the images of a stack respect to a reference image.
+    The FFT of the reference is calculated once and the images are read and
+    processed in batches, so the stack does not need to fit in memory.
+    :param reference: 2d numpy array
+    :param data: stack of images (ndarray or HDF5 dataset)
+    :param index: dimension of the stack indexing the images (0, 2 or -1)
+    :param offsets: first row and column of the region to use
+    :param widths: number of rows and columns of the region to use
+    :param window: apodization window, same shape as the region
+    :param dtype: data type of the images before their FFT
+    :param nbytes: approximate memory used per batch (default 32 MB)
+    :param nthreads: number of threads (0: number of CPU's, None: no threads)
+    :param callback: called with the percentage of images processed
+    :return: ndarray of shape (nimages, 2) with the offsets of each image respect to the reference
+    """
+    if index == -1:
+        index = 2
+    if index not in [0, 2]:
+        raise IndexError("Only stacks of images or spectra supported. 1D index should be 0 or 2")
+    if offsets is None:
+        offsets = [0, 0]
+    if widths is None:
+        widths = [reference.shape[0] - offsets[0], reference.shape[1] - offsets[1]]
+    roi = (slice(offsets[0], offsets[0] + widths[0]),
+           slice(offsets[1], offsets[1] + widths[1]))
+    image0 = numpy.array(reference[roi[0], roi[1]], dtype=dtype)
+    if window is not None:
+        image0 *= window
+    image0fft2 = fft2(image0)
+    nFrames = data.shape[index]
+    shifts = numpy.zeros((nFrames, 2), numpy.float64)
+
+    def process(batch):
+        start, end = batch
+        images = numpy.array(_frames(data, index, start, end, roi), dtype=dtype)
+        if window is not None:
+            images *= window
+        return batch, measure_offsets_from_ffts(image0fft2,
+                                                fft2(images, axes=(-2, -1)))
+
+    batches = _batches(data, index, image0.size, nbytes)
+    for (start, end), result in threadedMap(process, batches,
+                                            nthreads=nthreads):
+        shifts[start:end] = result
+        if callback is not None:
+            callback((100. * end) / nFrames)
+    return shifts
+
+def shiftStackFFT(data, shifts, index=0, output=None, window=None,
+                  nbytes=None, nthreads=None, callback=None):
+    """
+    Shift all the images of a stack using FFTs as shiftFFT does. The images are
+    processed in batches and written as soon as they are shifted, so the stack
+    is never held twice in memory.
+    :param data: stack of images (ndarray or HDF5 dataset)
+    :param shifts: ndarray of shape (nimages, 2), shift of each image
+    :param index: dimension of the stack indexing the images (0, 2 or -1)
+    :param output: stack of shape (nimages, d0, d1) receiving the shifted images.
+                   If None, the images of data are replaced.
+    :param window: image multiplying the shifted images (to crop them)
+    :param nbytes: approximate memory used per batch (default 32 MB)
+    :param nthreads: number of threads (0: number of CPU's, None: no threads)
+    :param callback: called with the percentage of images processed
+    """
+    if index == -1:
+        index = 2
+    if index not in [0, 2]:
+        raise IndexError("Only stacks of images or spectra supported. 1D index should be 0 or 2")
+    if index == 0:
+        d0, d1 = data.shape[1:]
+    else:
+        d0, d1 = data.shape[:2]
+    nFrames = data.shape[index]
+    shifts = numpy.asarray(shifts, dtype=numpy.float64)
+    f0 = ifftshift(numpy.arange(-d0 // 2, d0 // 2)) / float(d0)
+    f1 = ifftshift(numpy.arange(-d1 // 2, d1 // 2)) / float(d1)
+
+    def process(batch):
+        start, end = batch
+        images = fft2(_frames(data, index, start, end), axes=(-2, -1))
+        e0 = numpy.exp(-2j * numpy.pi * numpy.outer(shifts[start:end, 0], f0))
+        e1 = numpy.exp(-2j * numpy.pi * numpy.outer(shifts[start:end, 1], f1))
+        images *= e0[:, :, None]
+        images *= e1[:, None, :]
+        images = abs(ifft2(images, axes=(-2, -1)))
+        if window is not None:
+            images *= window
+        return batch, images
+
+    batches = _batches(data, index, d0 * d1, nbytes)
+    for (start, end), images in threadedMap(process, batches,
+                                            nthreads=nthreads):
+        if output is not None:
+            output[start:end] = images
+        elif index == 0:
+            data[start:end] = images
+        else:
+            data[:, :, start:end] = numpy.moveaxis(images, 0, -1)
+        if callback is not None:
+            callback((100. * end) / nFrames)
+
 def get_crop_indices(shape, shifts0, shifts1):
     """
     Get the indices of the valid region to be used when aligning a set of images
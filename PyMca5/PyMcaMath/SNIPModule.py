@@ -35,6 +35,7 @@
 
 snip1d = SpecfitFuns.snip1d
 snip2d = SpecfitFuns.snip2d
+snip1dbackground = SpecfitFuns.snip1dbackground
 
 
 def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing=1):
@@ -48,11 +49,8 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
-def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
-    if roi_min is None:
-        roi_min = 0
-    if roi_max is None:
-        roi_max = len(spectrum)
+def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1,
+                                      nthreads=1):
     mcaIndex = -1
     if hasattr(stack, "info") and hasattr(stack, "data"):
         data = stack.data
@@ -62,22 +60,28 @@ def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,
     if not isinstance(data, numpy.ndarray):
         raise TypeError("This Plugin only supports numpy arrays")
     oldShape = data.shape
+    if roi_min is None:
+        roi_min = 0
+    if roi_max is None:
+        roi_max = oldShape[mcaIndex]
     if mcaIndex in [-1, len(data.shape)-1]:
         data.shape = -1, oldShape[-1]
         if roi_min > 0:
             data[:, 0:roi_min] = 0
         if roi_max < oldShape[-1]:
             data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] -= snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
+        data[:, roi_min:roi_max] -= snip1dbackground(data[:, roi_min:roi_max],
+                                                     width,
+                                                     smoothing=smoothing,
+                                                     nthreads=nthreads)
         data.shape = oldShape
 
     elif mcaIndex == 0:
         data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] -= snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
+        data[roi_min:roi_max, :] -= snip1dbackground(data[roi_min:roi_max, :].T,
+                                                     width,
+                                                     smoothing=smoothing,
+                                                     nthreads=nthreads).T
         data.shape = oldShape
     else:
         raise ValueError("Invalid 1D index %d" % mcaIndex)
@@ -60,7 +60,6 @@ static struct module_state _state;
 #define erf myerf
 #define erfc myerfc
 #endif
-#define MAX_SAVITSKY_GOLAY_WIDTH 101
 #define MIN_SAVITSKY_GOLAY_WIDTH 3
 
 /* SNIP related functions */
@@ -74,6 +73,10 @@ void lsdf(double *data, int size, int fwhm, double f, double A, double M, double
 void smooth1d(double *data, int size);
 void smooth2d(double *data, int size0, int size1);
 void smooth3d(double *data, int size0, int size1, int size2);
+void savitsky_golay1d(double *output, int n, int npoints, double *buffer);
+void snip1d_background_multiple(double *data, int n_channels, int n_spectra,
+                                int snip_width, int sg_width, int smooth_iterations,
+                                int *anchors, int n_anchors, int n_threads);
 /* end of SNIP related functions */
 
 /* --------------------------------------------------------------------- */
@@ -4055,11 +4058,6 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
     PyArrayObject *ret;
     int n, npoints;
     double dpoints = 5.;
-    double coeff[MAX_SAVITSKY_GOLAY_WIDTH];
-    int i, j, m;
-    double  dhelp, den;
-    double  *data;
-    double  *output;
 
     if (!PyArg_ParseTuple(args, "O|d", &input, &dpoints))
         return NULL;
@@ -4082,46 +4080,79 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         return PyArray_Return(ret);
     }
 
-    /* calculate the coefficients */
-    m     = (int) (npoints/2);
-    den = (double) ((2*m-1) * (2*m+1) * (2*m + 3));
-    for (i=0; i<= m; i++){
-        coeff[m+i] = (double) (3 * (3*m*m + 3*m - 1 - 5*i*i ));
-        coeff[m-i] = coeff[m+i];
-    }
-
     /* do the job */
-    output = (double *) PyArray_DATA(ret);
+    savitsky_golay1d((double *) PyArray_DATA(ret), n, npoints, NULL);
+    return PyArray_Return(ret);
 
-    /* simple smoothing at the beginning */
-    for (j=0; j<=(int)(npoints/3); j++)
-    {
-        smooth1d(output, m);
+}
+
+static PyObject *
+SpecfitFuns_snip1dbackground(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *input;
+    PyObject *anchorsInput = NULL;
+    PyArrayObject *ret;
+    PyArrayObject *anchors = NULL;
+    double width0 = 50.;
+    double sgwidth0 = 0.;
+    int smooth_iterations = 0;
+    int nthreads = 1;
+    int n_channels, n_spectra, n_anchors, width, sgwidth;
+    int *anchorsPointer = NULL;
+    static char *kwlist[] = {"spectra", "width", "sgwidth", "smoothing",
+                             "anchors", "nthreads", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Od|diOi", kwlist,
+                                     &input, &width0, &sgwidth0,
+                                     &smooth_iterations, &anchorsInput,
+                                     &nthreads))
+        return NULL;
+
+    ret = (PyArrayObject *)
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 2, NPY_ARRAY_ENSURECOPY);
+
+    if (ret == NULL){
+        printf("Cannot create 1D or 2D array from input\n");
+        return NULL;
     }
 
-    /* simple smoothing at the end */
-    for (j=0; j<=(int)(npoints/3); j++)
+    if(PyArray_NDIM(ret) == 1)
     {
-        smooth1d((output+n-m-1), m);
+        n_spectra = 1;
+        n_channels = (int) (PyArray_DIMS(ret)[0]);
+    }
+    else
+    {
+        n_spectra = (int) (PyArray_DIMS(ret)[0]);
+        n_channels = (int) (PyArray_DIMS(ret)[1]);
     }
 
-    /*one does not need the whole spectrum buffer, but code is clearer */
-    data = (double *) malloc(n * sizeof(double));
-    memcpy(data, output, n * sizeof(double));
-
-    /* the actual SG smoothing in the middle */
-    for (i=m; i<(n-m); i++){
-        dhelp = 0;
-        for (j=-m;j<=m;j++) {
-            dhelp += coeff[m+j] * (*(data+i+j));
-        }
-        if(dhelp > 0.0){
-            *(output+i) = dhelp / den;
+    n_anchors = 0;
+    if ((anchorsInput != NULL) && (anchorsInput != Py_None))
+    {
+        anchors = (PyArrayObject *)
+             PyArray_ContiguousFromObject(anchorsInput, NPY_INT, 0, 1);
+        if (anchors == NULL)
+        {
+            printf("Cannot create anchors array from input\n");
+            Py_DECREF(ret);
+            return NULL;
         }
+        n_anchors = (int) PyArray_Size((PyObject *) anchors);
+        anchorsPointer = (int *) PyArray_DATA(anchors);
     }
-    free(data);
-    return PyArray_Return(ret);
 
+    width = (int) width0;
+    sgwidth = (int) sgwidth0;
+
+    Py_BEGIN_ALLOW_THREADS
+    snip1d_background_multiple((double *) PyArray_DATA(ret), n_channels, n_spectra,
+                               width, sgwidth, smooth_iterations,
+                               anchorsPointer, n_anchors, nthreads);
+    Py_END_ALLOW_THREADS
+
+    Py_XDECREF(anchors);
+    return PyArray_Return(ret);
 }
 
 /* List of functions defined in the module */
@@ -4152,6 +4183,8 @@ static PyMethodDef SpecfitFuns_methods[] = {
     {"voxelize",    SpecfitFuns_voxelize,   METH_VARARGS},
     {"pileup",      SpecfitFuns_pileup,   METH_VARARGS},
     {"SavitskyGolay",   SpecfitFuns_SavitskyGolay,   METH_VARARGS},
+    {"snip1dbackground",   (PyCFunction) SpecfitFuns_snip1dbackground,
+                           METH_VARARGS | METH_KEYWORDS},
     {"splitgauss",  SpecfitFuns_splitgauss,   METH_VARARGS},
     {"splitlorentz",SpecfitFuns_splitlorentz, METH_VARARGS},
     {"splitpvoigt", SpecfitFuns_splitpvoigt, METH_VARARGS},
@@ -35,6 +35,7 @@
 void smooth1d(double *data, int size);
 void smooth2d(double *data, int size0, int size1);
 void smooth3d(double *data, int size0, int size1, int size2);
+void savitsky_golay1d(double *output, int n, int npoints, double *buffer);
 
 void smooth1d(double *data, int size)
 {
@@ -133,3 +134,69 @@ void smooth3d(double *data, int size0, int size1, int size2)
 	}
 	free(p);
 }
+
+/* Savitsky-Golay smoothing of data in place. The buffer must have the size
+   of the data (it can be NULL in which case it is allocated here) */
+void savitsky_golay1d(double *output, int n, int npoints, double *buffer)
+{
+	double *coeff;
+	double *data;
+	double dhelp, den;
+	int i, j, m;
+
+	if (!(npoints % 2)) npoints +=1;
+
+	if((npoints < 3) ||  (n < npoints))
+	{
+		/* do not smooth data */
+		return;
+	}
+
+	/* calculate the coefficients */
+	m     = (int) (npoints/2);
+	coeff = (double *) malloc(npoints * sizeof(double));
+	den = (double) ((2*m-1) * (2*m+1) * (2*m + 3));
+	for (i=0; i<= m; i++){
+		coeff[m+i] = (double) (3 * (3*m*m + 3*m - 1 - 5*i*i ));
+		coeff[m-i] = coeff[m+i];
+	}
+
+	/* simple smoothing at the beginning */
+	for (j=0; j<=(int)(npoints/3); j++)
+	{
+		smooth1d(output, m);
+	}
+
+	/* simple smoothing at the end */
+	for (j=0; j<=(int)(npoints/3); j++)
+	{
+		smooth1d((output+n-m-1), m);
+	}
+
+	/*one does not need the whole spectrum buffer, but code is clearer */
+	if (buffer == NULL)
+	{
+		data = (double *) malloc(n * sizeof(double));
+	}
+	else
+	{
+		data = buffer;
+	}
+	memcpy(data, output, n * sizeof(double));
+
+	/* the actual SG smoothing in the middle */
+	for (i=m; i<(n-m); i++){
+		dhelp = 0;
+		for (j=-m;j<=m;j++) {
+			dhelp += coeff[m+j] * (*(data+i+j));
+		}
+		if(dhelp > 0.0){
+			*(output+i) = dhelp / den;
+		}
+	}
+	if (buffer == NULL)
+	{
+		free(data);
+	}
+	free(coeff);
+}
@@ -36,6 +36,9 @@
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#ifndef WIN32
+#include <pthread.h>
+#endif
 #define MIN(x, y) (((x) < (y)) ? (x) : (y))
 #define MAX(x, y) (((x) > (y)) ? (x) : (y))
 
@@ -44,6 +47,11 @@ void lls_inv(double *data, int size);
 void snip1d(double *data, int n_channels, int snip_width);
 void snip1d_multiple(double *data, int n_channels, int snip_width, int n_spectra);
 void lsdf(double *data, int size, int fwhm, double f, double A, double M, double ratio);
+void snip1d_background_multiple(double *data, int n_channels, int n_spectra,
+                                int snip_width, int sg_width, int smooth_iterations,
+                                int *anchors, int n_anchors, int n_threads);
+void smooth1d(double *data, int size);
+void savitsky_golay1d(double *output, int n, int npoints, double *buffer);
 
 void lls(double *data, int size)
 {
@@ -152,3 +160,129 @@ void snip1d_multiple(double *data, int n_channels, int snip_width, int n_spectra
 	}
 	free(w);
 }
+
+/* Background of a set of spectra: smoothing, Savitsky-Golay filtering and
+   SNIP applied in between the anchor channels. The spectra are replaced
+   by their background. The spectra can be divided among threads. */
+
+struct snip1d_background_task {
+	double *data;
+	int n_channels;
+	int first_spectrum;
+	int last_spectrum;
+	int snip_width;
+	int sg_width;
+	int smooth_iterations;
+	int *anchors;
+	int n_anchors;
+};
+
+static void *snip1d_background_worker(void *arg)
+{
+	struct snip1d_background_task *task;
+	double *spectrum;
+	double *buffer;
+	int i, j, anchor, last_anchor;
+	int n_channels;
+
+	task = (struct snip1d_background_task *) arg;
+	n_channels = task->n_channels;
+	buffer = (double *) malloc(n_channels * sizeof(double));
+	for (j = task->first_spectrum; j < task->last_spectrum; j++)
+	{
+		spectrum = task->data + (long) j * n_channels;
+		for (i=0; i<task->smooth_iterations; i++)
+		{
+			smooth1d(spectrum, n_channels);
+		}
+		if (task->sg_width > 0)
+		{
+			savitsky_golay1d(spectrum, n_channels, task->sg_width, buffer);
+		}
+		last_anchor = 0;
+		for (i=0; i<task->n_anchors; i++)
+		{
+			anchor = task->anchors[i];
+			if ((anchor > last_anchor) && (anchor < n_channels))
+			{
+				snip1d(spectrum + last_anchor, anchor - last_anchor, task->snip_width);
+				last_anchor = anchor;
+			}
+		}
+		if (last_anchor < n_channels)
+		{
+			snip1d(spectrum + last_anchor, n_channels - last_anchor, task->snip_width);
+		}
+	}
+	free(buffer);
+	return NULL;
+}
+
+void snip1d_background_multiple(double *data, int n_channels, int n_spectra,
+                                int snip_width, int sg_width, int smooth_iterations,
+                                int *anchors, int n_anchors, int n_threads)
+{
+	struct snip1d_background_task *tasks;
+	int i, n_per_thread;
+#ifndef WIN32
+	pthread_t *threads;
+	int *started;
+#endif
+
+	if (n_spectra < 1)
+		return;
+	if (n_threads > n_spectra)
+		n_threads = n_spectra;
+	if (n_threads < 1)
+		n_threads = 1;
+#ifdef WIN32
+	n_threads = 1;
+#endif
+	tasks = (struct snip1d_background_task *) \
+				malloc(n_threads * sizeof(struct snip1d_background_task));
+	n_per_thread = n_spectra / n_threads + ((n_spectra % n_threads) ? 1 : 0);
+	for (i=0; i<n_threads; i++)
+	{
+		tasks[i].data = data;
+		tasks[i].n_channels = n_channels;
+		tasks[i].first_spectrum = MIN(i * n_per_thread, n_spectra);
+		tasks[i].last_spectrum = MIN((i + 1) * n_per_thread, n_spectra);
+		tasks[i].snip_width = snip_width;
+		tasks[i].sg_width = sg_width;
+		tasks[i].smooth_iterations = smooth_iterations;
+		tasks[i].anchors = anchors;
+		tasks[i].n_anchors = n_anchors;
+	}
+	if (n_threads == 1)
+	{
+		snip1d_background_worker(tasks);
+	}
+#ifndef WIN32
+	else
+	{
+		threads = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
+		started = (int *) malloc(n_threads * sizeof(int));
+		for (i=1; i<n_threads; i++)
+		{
+			started[i] = !pthread_create(&threads[i], NULL,
+			                             snip1d_background_worker, &tasks[i]);
+			if (!started[i])
+			{
+				/* do it ourselves */
+				snip1d_background_worker(&tasks[i]);
+			}
+		}
+		snip1d_background_worker(tasks);
+		for (i=1; i<n_threads; i++)
+		{
+			if (started[i])
+			{
+				pthread_join(threads[i], NULL);
+			}
+		}
+		free(started);
+		free(threads);
+	}
+#endif
+	free(tasks);
+}
@@ -32,7 +32,9 @@
 __license__ = "BSD"
 __doc__ = """
 This module is a simple wrapper to the py_nnma module of Uwe Schmitt (uschmitt@mineway.de)
-in order to integrate it into PyMca. What follows is the documentation of py_nnma
+in order to integrate it into PyMca. Stacks not fitting in memory can be
+decomposed by chunkedNNMA (HALS updates reading the stack in blocks, optionally
+as online mini-batches). What follows is the documentation of py_nnma
 
 py_nnma:  python modules for nonnegative matrix approximation (NNMA)
 
@@ -185,6 +187,7 @@
 """
 import numpy
 import logging
+import time
 try:
     import os
     os.environ["MDP_DISABLE_SKLEARN"] = "yes"
@@ -197,6 +200,7 @@
     MDP = False
 
 from . import py_nnma
+from PyMca5.PyMcaCore import McaStackView
 
 
 _logger = logging.getLogger(__name__)
@@ -357,6 +361,43 @@ def nnma(stack, ncomponents, binning=None,
         images.shape = ncomponents, r, c
         return images, numpy.ones((ncomponents), numpy.float32),X
 
+    #original data intensity
+    original_intensity = numpy.sum(data)
+
+    #final values
+    if kmeans:
+        n_more = 1
+    else:
+        n_more = 0
+    new_images, values, new_vectors = _sortComponents(images, X,
+                                                      original_intensity,
+                                                      n_more=n_more)
+    new_images.shape = ncomponents + n_more, r, c
+    if kmeans:
+        classifier = mdp.nodes.KMeansClassifier(ncomponents)
+        for i in range(ncomponents):
+            classifier.train(new_vectors[i:i+1])
+        k = 0
+        for i in range(r):
+            for j in range(c):
+                spectrum = data[k:k+1,:]
+                new_images[-1, i,j] = classifier.label(spectrum)[0]
+                k += 1
+    return new_images, values, new_vectors
+
+
+def _sortComponents(images, X, original_intensity, n_more=0):
+    """
+    Normalize the maps to the range [0, 1] and sort the maps and the
+    spectra by decreasing intensity (Gerd Wellenreuther's recipe)
+
+    :param images: Maps of the components (ncomponents, npixels)
+    :param X: Spectra of the components (ncomponents, nchannels)
+    :param original_intensity: Sum of the decomposed data
+    :param n_more: Number of extra (empty) maps and spectra to allocate
+    :returns: images, values, spectra
+    """
+    ncomponents = images.shape[0]
     #order and scale images according to Gerd Wellenreuthers' recipe
     #normalize all maps to be in the range [0, 1]
     for i in range(ncomponents):
@@ -374,43 +415,250 @@ def nnma(stack, ncomponents, binning=None,
     sorted_idx = [item[1] for item in sorted(total_nnma_intensity)]
     sorted_idx.reverse()
 
-    #original data intensity
-    original_intensity = numpy.sum(data)
-
-    #final values
-    if kmeans:
-        n_more = 1
-    else:
-        n_more = 0
-    new_images  = numpy.zeros((ncomponents + n_more, r*c), numpy.float32)
+    new_images  = numpy.zeros((ncomponents + n_more, images.shape[1]),
+                              numpy.float32)
     new_vectors = numpy.zeros((X.shape[0]+n_more, X.shape[1]), numpy.float32)
     values      = numpy.zeros((ncomponents+n_more,), numpy.float32)
     for i in range(ncomponents):
         idx = sorted_idx[i]
-        if 1:
-            new_images[i, :] = images[idx, :]
-        else:
-            #imaging the projected sum gives same results
-            Atmp = images[idx, :]
-            Atmp.shape = -r*c, 1
-            Xtmp = X[idx,:]
-            Xtmp.shape = 1, -1
-            new_images[i, :] = numpy.sum(numpy.dot(Atmp, Xtmp), axis=1)
+        new_images[i, :] = images[idx, :]
         new_vectors[i,:] = X[idx,:]
         values[i] = 100.*total_nnma_intensity[idx][0]/original_intensity
-    new_images.shape = ncomponents + n_more, r, c
-    if kmeans:
-        classifier = mdp.nodes.KMeansClassifier(ncomponents)
-        for i in range(ncomponents):
-            classifier.train(new_vectors[i:i+1])
-        k = 0
-        for i in range(r):
-            for j in range(c):
-                spectrum = data[k:k+1,:]
-                new_images[-1, i,j] = classifier.label(spectrum)[0]
-                k += 1
     return new_images, values, new_vectors
 
+
+def chunkedNNMA(stack, ncomponents, binning=None,
+                mask=None, spectral_mask=None, eps=5e-5, verbose=VERBOSE,
+                maxcount=1000, online=False, rho=None, nthreads=None,
+                nbytes=None, seed=None, **kw):
+    """
+    Out-of-core NNMA (hierarchical alternating least squares, as FastHALS)
+    of a stack which does not need to fit in memory. The spectra are read
+    in blocks of whole rows (aligned with the HDF5 chunks when possible):
+    the maps of each block are updated and the Gram matrices needed to
+    update the component spectra are accumulated, so the stack is read
+    once per iteration. Only the maps, the spectra and the (ncomponents,
+    nchannels) Gram matrices are kept in memory.
+
+    With `online` each block is a mini-batch: the spectra are updated
+    after each block with running Gram matrices, which converges in a
+    few passes through very large maps. A final pass updates the maps
+    with the final spectra.
+
+    The relative distance reported and compared to `eps` is the one of
+    `nnma`, ||D - A X|| / ||D||, evaluated from the Gram matrices
+    (approximated during the online passes).
+
+    :param stack: Array of data or PyMca data object (numpy array or
+                  HDF5 dataset) with the spectra along the last dimension
+    :param ncomponents: Number of components
+    :param binning: Number of channels summed together
+    :param mask: Spatial mask: only pixels with a mask value of at least 1
+                 are used (to skip non finite data)
+    :param spectral_mask: Channels with a value of at least 1 are used
+    :param eps: Termination threshold of the change of relative distance
+    :param verbose: Report the relative distance every `verbose` passes
+    :param maxcount: Maximum number of passes through the stack
+    :param online: Update the spectra after each block
+    :param rho: Forgetting factor of the online Gram matrices
+                (default: 1 - 1 / number of blocks)
+    :param nthreads: Number of threads processing the blocks
+                     (0: number of CPU's, None: no threads)
+    :param nbytes: Memory of one block (default: 16 MB)
+    :param seed: Seed of the random start spectra
+    :returns: images, values, spectra (as for `nnma`)
+    """
+    _logger.debug("NNMAModule.chunkedNNMA")
+    if kw.get("kmeans", False):
+        raise ValueError("K Means not supported")
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    oldShape = data.shape
+    if len(oldShape) == 3:
+        r, c, nChannels = oldShape
+    else:
+        r, nChannels = oldShape
+        c = 1
+    if binning is None:
+        binning = 1
+    if nbytes is None:
+        nbytes = 16 * 1024 ** 2
+    N = nChannels // binning
+    k = ncomponents
+    if k < 1 or k > N or k > r * c:
+        raise ValueError("number k of components is invalid")
+
+    # Blocks of whole rows
+    nMca = McaStackView.chunkAlignedNMca(data,
+                                         max(nbytes // (nChannels * 8), 1))
+    view = McaStackView.FullView(data, mcaAxis=len(oldShape) - 1,
+                                 mcaSlice=slice(0, N * binning),
+                                 nMca=nMca, dtype=numpy.float64)
+    if spectral_mask is None:
+        channels = None
+    else:
+        channels = numpy.asarray(spectral_mask).reshape(-1)
+        if channels.size != N:
+            channels = channels[::binning][:N]
+        channels = channels < 1
+    if mask is None:
+        spatialMask = None
+    else:
+        spatialMask = numpy.asarray(mask).reshape(oldShape[:-1]) >= 1
+    def readBlock(key, chunk):
+        if binning > 1:
+            chunk = chunk.reshape(-1, N, binning).sum(axis=-1)
+        elif channels is not None or spatialMask is not None:
+            # the block may be a view of the stack
+            chunk = chunk.copy()
+        if channels is not None:
+            chunk[:, channels] = 0
+        if spatialMask is not None:
+            used = spatialMask[key[0]].reshape(-1)
+            chunk[~used] = 0
+        return chunk
+
+    def updateMaps(D, A, X, XXt):
+        """
+        HALS update of the maps of a block (rows are independent)
+        """
+        P = numpy.dot(D, X.T)
+        for i in range(k):
+            a = A[:, i] + (P[:, i] - numpy.dot(A, XXt[:, i])) / \
+                max(XXt[i, i], 1e-300)
+            a[a < 0] = 0
+            A[:, i] = a
+        return A
+
+    def updateSpectra(X, AtA, AtD):
+        """
+        HALS update of the spectra from the Gram matrices
+        """
+        for i in range(k):
+            x = X[i] + (AtD[i] - numpy.dot(AtA[i], X)) / \
+                max(AtA[i, i], 1e-300)
+            x[x < 0] = 0
+            X[i] = x
+        return X
+
+    def distance2(normD2, AtA, AtD, X):
+        """
+        ||D - A X||^2 from the Gram matrices
+        """
+        return normD2 - 2 * numpy.sum(X * AtD) + \
+            numpy.sum(AtA * numpy.dot(X, X.T))
+
+    def process(key, chunk, X, XXt):
+        """
+        Update the maps of a block and return its Gram matrices
+        """
+        idx, shape = key
+        D = readBlock(key, chunk)
+        A = maps[idx].reshape(-1, k).astype(numpy.float64)
+        A = updateMaps(D, A, X, XXt)
+        return key, A, numpy.dot(A.T, A), numpy.dot(A.T, D), \
+            numpy.sum(D * D), numpy.sum(D)
+
+    def blockPass(X):
+        """
+        One pass through the data updating the maps with fixed spectra
+        """
+        XXt = numpy.dot(X, X.T)
+        return view.imapItems(lambda key, chunk: process(key, chunk, X, XXt),
+                              keyType='select', nthreads=nthreads)
+
+    def fullPass(X):
+        AtA = numpy.zeros((k, k), numpy.float64)
+        AtD = numpy.zeros((k, N), numpy.float64)
+        normD2 = 0.0
+        total = 0.0
+        for key, A, ata, atd, d2, s in blockPass(X):
+            idx, shape = key
+            maps[idx] = A.reshape(shape + (k,))
+            AtA += ata
+            AtD += atd
+            normD2 += d2
+            total += s
+        return AtA, AtD, normD2, total
+
+    # the maps are started at zero: the first update is a projection
+    state = numpy.random.RandomState(seed)
+    maps = numpy.zeros(oldShape[:-1] + (k,), numpy.float32)
+    X = state.random_sample((k, N))
+    if channels is not None:
+        X[:, channels] = 0
+    chunkIndices = list(view.chunkIndex())
+    if rho is None:
+        rho = 1.0 - 1.0 / len(chunkIndices)
+
+    t0 = time.time()
+    count = 0
+    obj_old = 1e99
+    normD2 = None
+    while True:
+        if online:
+            AtA = numpy.zeros((k, k), numpy.float64)
+            AtD = numpy.zeros((k, N), numpy.float64)
+            epochD2 = 0.0
+            epochTotal = 0.0
+            dist2 = 0.0
+            state.shuffle(chunkIndices)
+            for chunkIndex in chunkIndices:
+                key, chunk = view.getItem(chunkIndex, keyType='select')
+                key, A, ata, atd, d2, s = process(key, chunk,
+                                                  X, numpy.dot(X, X.T))
+                idx, shape = key
+                maps[idx] = A.reshape(shape + (k,))
+                epochD2 += d2
+                epochTotal += s
+                dist2 += distance2(d2, ata, atd, X)
+                AtA *= rho
+                AtA += ata
+                AtD *= rho
+                AtD += atd
+                X = updateSpectra(X, AtA, AtD)
+            normD2 = epochD2
+            original_intensity = epochTotal
+        else:
+            AtA, AtD, normD2, original_intensity = fullPass(X)
+            X = updateSpectra(X, AtA, AtD)
+            dist2 = distance2(normD2, AtA, AtD, X)
+        if normD2 <= 0:
+            raise ValueError("No data to decompose")
+        if not numpy.isfinite(dist2):
+            raise ValueError("NNMA diverged")
+        count += 1
+        obj = numpy.sqrt(max(dist2, 0.0) / normD2)
+        delta_obj = obj - obj_old
+        if verbose and (count % verbose == 0):
+            print("count=%6d obj=%E d_obj=%E" % (count, obj, delta_obj))
+        if count >= maxcount:
+            break
+        if -eps < delta_obj <= 1e-12:
+            break
+        obj_old = obj
+    if online:
+        # maps consistent with the final spectra
+        AtA, AtD, normD2, original_intensity = fullPass(X)
+        obj = numpy.sqrt(max(distance2(normD2, AtA, AtD, X), 0.0) / normD2)
+    if verbose:
+        print("FINISHED:")
+        print("count=%6d obj=%E d_obj=%E" % (count, obj, delta_obj))
+    if count >= maxcount:
+        _logger.warning("WARNING: Possible problems converging")
+    _logger.debug("chunkedNNMA elapsed = %s", time.time() - t0)
+
+    images = numpy.moveaxis(maps, -1, 0).reshape(k, -1)
+    images = numpy.ascontiguousarray(images)
+    maps = None
+    new_images, values, new_vectors = _sortComponents(images, X,
+                                                      original_intensity)
+    new_images.shape = k, r, c
+    return new_images, values, new_vectors
+
+
 if __name__ == "__main__":
     from PyMca.PyMcaIO import EDFStack
     from PyMca.PyMcaIO import EdfFile
@@ -546,6 +546,84 @@ def numpyPCA(stack, ncomponents=10, binning=None, legacy=True,
                              spectral_mask=spectral_mask,
                              force=force)
 
+def randomizedPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    """
+    Covariance method by randomized decomposition. The stack is read in
+    blocks and does not need to fit in memory.
+    """
+    _logger.debug("PCAModule.randomizedPCA called")
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    else:
+        index = kw.get("index", -1)
+    return PCATools.randomizedPCA(stack,
+                                  index=index,
+                                  ncomponents=ncomponents,
+                                  binning=binning,
+                                  legacy=legacy,
+                                  center=True,
+                                  scale=kw.get("scale", False),
+                                  mask=kw.get("mask", None),
+                                  spectral_mask=kw.get("spectral_mask", None),
+                                  nthreads=kw.get("nthreads", 0))
+
+def incrementalPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    """
+    Covariance method updated with the rows of the stack not fitted yet
+    by a previous calculation (keyword `incremental`, the
+    `PCATools.IncrementalPCA` instance returned in the result dictionary),
+    to follow a growing map during a scan.
+    """
+    _logger.debug("PCAModule.incrementalPCA called")
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+        index = stack.info.get('McaIndex', -1)
+    else:
+        data = stack
+        index = kw.get("index", -1)
+    if index not in [-1, len(data.shape) - 1]:
+        raise IndexError("Incremental PCA needs spectra in the last dimension")
+    if binning is None:
+        binning = 1
+    scale = kw.get("scale", False)
+    mask = kw.get("mask", None)
+    spectral_mask = kw.get("spectral_mask", None)
+    ipca = kw.get("incremental", None)
+    if ipca is not None:
+        # only continue a calculation on the same stack and parameters
+        start = ipca.nRows
+        if spectral_mask is None or ipca.spectral_mask is None:
+            sameMask = spectral_mask is ipca.spectral_mask
+        else:
+            sameMask = numpy.array_equal(spectral_mask, ipca.spectral_mask)
+        if (ipca.binning != binning) or (ipca.scale != scale) or \
+           (not sameMask) or \
+           (start > data.shape[0]) or (start < 1) or \
+           (ipca.nChannels != data.shape[-1]) or \
+           (float(data[start - 1].sum()) != ipca.lastRowSum):
+            ipca = None
+    if ipca is None:
+        ipca = PCATools.IncrementalPCA(ncomponents=ncomponents,
+                                       binning=binning,
+                                       center=True,
+                                       scale=scale,
+                                       spectral_mask=spectral_mask)
+    ipca.ncomponents = ncomponents
+    if mask is not None:
+        mask = numpy.asarray(mask).reshape(data.shape[:-1])
+    # fit the new rows in blocks of about 16 MB
+    rowSize = int(numpy.prod(data.shape[1:])) * 8
+    step = max((16 * 1024 ** 2) // max(rowSize, 1), 1)
+    for i in range(ipca.nRows, data.shape[0], step):
+        if mask is None:
+            ipca.partial_fit(data[i:i + step])
+        else:
+            ipca.partial_fit(data[i:i + step], mask=mask[i:i + step])
+    result = ipca.result(data, legacy=legacy)
+    if not legacy:
+        result["incremental"] = ipca
+    return result
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None,
                      mask=None, spectral_mask=None, legacy=True, **kw):
     return mdpPCA(stack, ncomponents, binning=binning, dtype='float32',
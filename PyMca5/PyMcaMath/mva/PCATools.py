@@ -42,6 +42,7 @@
     # _dotblas was removed in numpy 1.10
     #print("WARNING: Not using BLAS/ATLAS, PCA calculation will be slower")
     dotblas = numpy
+from PyMca5.PyMcaCore import McaStackView
 
 _logger = logging.getLogger(__name__)
 
@@ -723,6 +724,431 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                 "covariance":cov}
 
 
+def randomizedPCA(stack, index=-1, ncomponents=10, binning=None,
+                  center=True, scale=False, mask=None, spectral_mask=None,
+                  legacy=True, oversampling=10, niter=2, nthreads=None,
+                  nbytes=None, seed=None):
+    """
+    Randomized PCA (range finder with power iterations, see Halko et al.,
+    SIAM Review 53 (2011) 217-288) of a stack which does not need to fit
+    in memory. The spectra are read in blocks of whole rows (aligned with
+    the HDF5 chunks when possible) and only products of the blocks with
+    a few vectors are kept, so neither the data nor the covariance
+    matrix are ever loaded. The stack is read `niter + 2` times.
+
+    The results are the same as the ones of `numpyPCA` within the
+    accuracy of the method, which is very good for the components which
+    explain much more variance than the first component not calculated.
+
+    :param stack: Array of data or PyMca data object (numpy array or
+                  HDF5 dataset)
+    :param index: Dimension of the spectra (0 or -1)
+    :param ncomponents: Number of principal components
+    :param binning: Spectral sampling, as in `getCovarianceMatrix`
+    :param center: Subtract the average spectrum
+    :param scale: Normalize to unit standard deviation (correlation matrix)
+    :param mask: Spatial mask: only pixels with a mask value of at least 1
+                 are used (to skip non finite data)
+    :param spectral_mask: Weight of each channel
+    :param legacy: Return a tuple instead of a dictionary
+    :param oversampling: Number of extra vectors used to find the range
+    :param niter: Number of power iterations
+    :param nthreads: Number of threads processing the blocks
+                     (0: number of CPU's, None: no threads)
+    :param nbytes: Memory of one block (default: 16 MB)
+    :param seed: Seed of the random test matrix
+    :returns: scores, eigenvalues, eigenvectors (as for `numpyPCA`)
+    """
+    _logger.debug("PCATools.randomizedPCA")
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    oldShape = data.shape
+    if index not in [0, -1, len(oldShape) - 1]:
+        data = None
+        raise IndexError("1D index must be one of 0, -1 or %d, got %d" %\
+                             (len(oldShape) - 1, index))
+    if index < 0:
+        actualIndex = len(oldShape) + index
+    else:
+        actualIndex = index
+    if binning is None:
+        binning = 1
+    if nbytes is None:
+        nbytes = 16 * 1024 ** 2
+
+    spatialShape = tuple(n for i, n in enumerate(oldShape)
+                         if i != actualIndex)
+    nPixels = int(numpy.prod(spatialShape))
+    mcaSlice = slice(None, None, binning)
+    N = McaStackView.sliceLen(mcaSlice, oldShape[actualIndex])
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+
+    # Blocks of whole rows
+    nMca = McaStackView.chunkAlignedNMca(data, max(nbytes // (N * 8), 1),
+                                         mcaAxis=actualIndex)
+    view = McaStackView.FullView(data, mcaAxis=actualIndex,
+                                 mcaSlice=mcaSlice, nMca=nMca,
+                                 dtype=numpy.float64)
+
+    if spectral_mask is None:
+        weights = None
+    else:
+        weights = numpy.asarray(spectral_mask, dtype=numpy.float64)
+        if weights.size != N:
+            weights = weights[::binning]
+        weights = weights.reshape(1, N)
+    if mask is None:
+        spatialMask = None
+        usedPixels = nPixels
+    else:
+        spatialMask = numpy.asarray(mask).reshape(spatialShape) >= 1
+        usedPixels = int(spatialMask.sum())
+    if usedPixels < 2:
+        raise ValueError("At least two spectra are needed")
+
+    def blockProducts(Q, Qscores):
+        """
+        One pass through the data: X.T X Q, sum and sum of squares
+        over the used spectra and the projection of all spectra on
+        Qscores (when not None)
+        """
+        def process(key, chunk):
+            x = chunk
+            if weights is not None:
+                x = x * weights
+            if spatialMask is not None:
+                used = spatialMask[key[0]].reshape(-1)
+                if not used.all():
+                    if x is chunk:
+                        x = x.copy()
+                    x[~used] = 0
+            xQ = dotblas.dot(x, Q)
+            result = [dotblas.dot(x.T, xQ), x.sum(axis=0), (x * x).sum(axis=0)]
+            if Qscores is None:
+                result.append(None)
+            elif Qscores is Q and x is chunk:
+                result.append(xQ)
+            else:
+                result.append(dotblas.dot(chunk, Qscores))
+            return key, result
+
+        return view.imapItems(process, keyType='select', nthreads=nthreads)
+
+    nVectors = min(ncomponents + oversampling, N)
+    state = numpy.random.RandomState(seed)
+    Q = state.standard_normal((N, nVectors))
+    scaling = None
+    scoresBasis = None
+    t0 = time.time()
+    for i in range(niter + 2):
+        last = i == niter + 1
+        if last:
+            # projection of the spectra on the final basis
+            scoresBasis = numpy.zeros((nPixels, nVectors), numpy.float64)
+            scoresBasis.shape = spatialShape + (nVectors,)
+        if scale and scaling is not None:
+            Qw = Q / scaling.reshape(-1, 1)
+        else:
+            Qw = Q
+        XtXQ = numpy.zeros((N, nVectors), numpy.float64)
+        sumSpectrum = numpy.zeros((N,), numpy.float64)
+        sumSquares = numpy.zeros((N,), numpy.float64)
+        for key, (xtxq, s, ss, xq) in blockProducts(Qw, Q if last else None):
+            XtXQ += xtxq
+            sumSpectrum += s
+            sumSquares += ss
+            if last:
+                idx, shape = key
+                scoresBasis[idx] = xq.reshape(shape + (nVectors,))
+        # the covariance matrix times Qw
+        CQ = XtXQ
+        if center:
+            CQ -= numpy.outer(sumSpectrum,
+                              dotblas.dot(sumSpectrum, Qw) / usedPixels)
+        CQ /= usedPixels - 1
+        if scaling is None:
+            variance = sumSquares
+            if center:
+                variance = variance - sumSpectrum ** 2 / usedPixels
+            variance /= usedPixels - 1
+            if scale:
+                scaling = numpy.sqrt(numpy.clip(variance, 0, None))
+                scaling[scaling == 0] = 1
+                totalVariance = (variance / scaling ** 2).sum()
+            else:
+                scaling = numpy.ones((N,), numpy.float64)
+                totalVariance = variance.sum()
+            _logger.info("Total Variance = %s", totalVariance)
+        # the (scaled) covariance matrix times Q
+        CQ /= scaling.reshape(-1, 1)
+        if last:
+            break
+        Q, r = numpy.linalg.qr(CQ)
+    _logger.debug("Randomized range finder elapsed = %s", time.time() - t0)
+
+    # Rayleigh-Ritz: eigen decomposition in the subspace spanned by Q
+    T = dotblas.dot(Q.T, CQ)
+    T = 0.5 * (T + T.T)
+    evalues, evectors = numpy.linalg.eigh(T)
+    order = numpy.argsort(evalues)[::-1][:ncomponents]
+
+    dtype = numpy.float32
+    eigenvalues = evalues[order].astype(dtype)
+    vectors = dotblas.dot(Q, evectors[:, order])
+    avgSpectrum = sumSpectrum / usedPixels
+    if avgSpectrum.sum() > 0:
+        for i0 in range(ncomponents):
+            if vectors[:, i0].sum() < 0.0:
+                _logger.info("PC%02d multiplied by -1" % i0)
+                vectors[:, i0] *= -1
+                evectors[:, order[i0]] *= -1
+    eigenvectors = vectors.T.astype(dtype)
+    for i0 in range(ncomponents):
+        _logger.info("PC%02d  Explained variance %.5f %% ",
+                     i0 + 1, 100. * eigenvalues[i0] / totalVariance)
+    images = dotblas.dot(scoresBasis, evectors[:, order]).astype(dtype)
+    scoresBasis = None
+    images = numpy.moveaxis(images, -1, 0)
+    images = numpy.ascontiguousarray(images)
+    if legacy:
+        return images, eigenvalues, eigenvectors
+    else:
+        return {"scores": images,
+                "eigenvalues": eigenvalues,
+                "eigenvectors": eigenvectors,
+                "average": avgSpectrum,
+                "pixels": usedPixels,
+                "variance": totalVariance}
+
+
+class IncrementalPCA(object):
+    """
+    PCA of a map updated as new rows of spectra arrive (for instance
+    during a scan). Each call to `partial_fit` merges the mean and the
+    centered cross-product matrix of the new spectra with the ones
+    already accumulated (Chan et al., "Updating formulae and a pairwise
+    algorithm for computing sample variances", 1979), so the cost only
+    depends on the new data. The components are obtained on demand from
+    the covariance matrix as in `numpyPCA` and give the same results.
+
+    Spectra are along the last dimension of the data.
+    """
+    def __init__(self, ncomponents=10, binning=None, center=True,
+                 scale=False, spectral_mask=None):
+        """
+        :param ncomponents: Number of principal components
+        :param binning: Spectral sampling, as in `getCovarianceMatrix`
+        :param center: Subtract the average spectrum
+        :param scale: Normalize to unit standard deviation
+                      (correlation matrix)
+        :param spectral_mask: Weight of each channel
+        """
+        if binning is None:
+            binning = 1
+        self._components = None
+        self.ncomponents = ncomponents
+        self.binning = binning
+        self.center = center
+        self.scale = scale
+        self.spectral_mask = spectral_mask
+        self.reset()
+
+    @property
+    def ncomponents(self):
+        return self._ncomponents
+
+    @ncomponents.setter
+    def ncomponents(self, value):
+        self._ncomponents = value
+        self._components = None
+
+    @property
+    def nChannels(self):
+        """
+        Number of channels of the spectra fitted (before sampling)
+        """
+        return self._nChannels
+
+    def reset(self):
+        """
+        Forget all the spectra fitted
+        """
+        # rows (first dimension) of the data fitted
+        self.nRows = 0
+        # spectra used
+        self.nPixels = 0
+        # sum of the last row fitted, to check a growing stack
+        self.lastRowSum = None
+        self._nChannels = None
+        self._weights = None
+        self._mean = None
+        self._comoment = None
+        self._components = None
+
+    def _spectra(self, data):
+        """
+        Sampled spectra of the data as a (nspectra, nchannels) array
+        """
+        nChannels = data.shape[-1]
+        x = numpy.asarray(data).reshape(-1, nChannels)
+        return x[:, ::self.binning]
+
+    def partial_fit(self, data, mask=None):
+        """
+        Add spectra to the decomposition
+
+        :param data: Array of spectra (new rows of the map)
+        :param mask: Spatial mask of the data: only pixels with a mask
+                     value of at least 1 are used
+        :returns: self
+        """
+        data = numpy.asarray(data)
+        x = self._spectra(data)
+        N = x.shape[1]
+        if self._nChannels is None:
+            self._nChannels = data.shape[-1]
+            if self.ncomponents > N:
+                msg = "Requested %d components for a maximum of %d" % \
+                      (self.ncomponents, N)
+                raise ValueError(msg)
+            if self.spectral_mask is not None:
+                weights = numpy.asarray(self.spectral_mask,
+                                        dtype=numpy.float64).reshape(-1)
+                if weights.size != N:
+                    weights = weights[::self.binning]
+                self._weights = weights.reshape(1, N)
+            self._mean = numpy.zeros((N,), numpy.float64)
+            self._comoment = numpy.zeros((N, N), numpy.float64)
+        elif data.shape[-1] != self._nChannels:
+            raise ValueError("Expected spectra of %d channels, got %d" %
+                             (self._nChannels, data.shape[-1]))
+        if data.ndim > 1:
+            self.nRows += data.shape[0]
+            if data.shape[0]:
+                self.lastRowSum = float(data[-1].sum())
+        else:
+            self.nRows += 1
+            self.lastRowSum = float(data.sum())
+        if mask is not None:
+            x = x[numpy.asarray(mask).reshape(-1) >= 1]
+        nNew = x.shape[0]
+        if not nNew:
+            return self
+        x = numpy.array(x, dtype=numpy.float64)
+        if self._weights is not None:
+            x *= self._weights
+        mean = x.mean(axis=0)
+        x -= mean
+        n = self.nPixels + nNew
+        delta = mean - self._mean
+        self._comoment += dotblas.dot(x.T, x)
+        self._comoment += numpy.outer(delta, delta) * \
+                          (self.nPixels * float(nNew) / n)
+        self._mean += delta * (float(nNew) / n)
+        self.nPixels = n
+        self._components = None
+        return self
+
+    def average(self):
+        """
+        :returns: The average (weighted) spectrum of the used pixels
+        """
+        return self._mean.copy()
+
+    def covariance(self):
+        """
+        :returns: The covariance matrix, as `getCovarianceMatrix`
+        """
+        if self.nPixels < 2:
+            raise ValueError("At least two spectra are needed")
+        cov = self._comoment.copy()
+        if not self.center:
+            cov += numpy.outer(self._mean, self._mean) * self.nPixels
+        cov /= self.nPixels - 1
+        return cov
+
+    def components(self):
+        """
+        Principal components of the spectra fitted so far
+
+        :returns: eigenvalues, eigenvectors, total variance
+        """
+        if self._components is not None:
+            return self._components
+        cov = self.covariance()
+        variance = numpy.diag(cov).copy()
+        if self.scale:
+            standardDeviation = numpy.sqrt(numpy.clip(variance, 0, None))
+            standardDeviation[standardDeviation == 0] = 1
+            cov /= standardDeviation.reshape(-1, 1)
+            cov /= standardDeviation.reshape(1, -1)
+        totalVariance = numpy.diag(cov).sum()
+        evalues, evectors = numpy.linalg.eigh(cov)
+        cov = None
+        order = numpy.argsort(evalues)[::-1][:self.ncomponents]
+        dtype = numpy.float32
+        eigenvalues = evalues[order].astype(dtype)
+        eigenvectors = evectors[:, order].T.astype(dtype)
+        if self._mean.sum() > 0:
+            for i0 in range(self.ncomponents):
+                if eigenvectors[i0].sum() < 0.0:
+                    eigenvectors[i0] *= -1
+        self._components = eigenvalues, eigenvectors, totalVariance
+        return self._components
+
+    def transform(self, data, nbytes=None):
+        """
+        Projection of the spectra on the principal components, as the
+        scores of `numpyPCA`
+
+        :param data: Array of spectra (numpy array or HDF5 dataset)
+        :param nbytes: Memory of the rows read at once (default: 16 MB)
+        :returns: Array of shape (ncomponents,) + data.shape[:-1]
+        """
+        eigenvalues, eigenvectors, totalVariance = self.components()
+        if nbytes is None:
+            nbytes = 16 * 1024 ** 2
+        shape = data.shape
+        images = numpy.zeros(shape[:-1] + (self.ncomponents,),
+                             numpy.float32)
+        if len(shape) == 1:
+            images[:] = dotblas.dot(self._spectra(data), eigenvectors.T)[0]
+        else:
+            rowSize = int(numpy.prod(shape[1:])) * 8
+            step = max(nbytes // max(rowSize, 1), 1)
+            for i in range(0, shape[0], step):
+                x = self._spectra(data[i:i + step])
+                images[i:i + step] = dotblas.dot(x, eigenvectors.T).\
+                    reshape(images[i:i + step].shape)
+        images = numpy.moveaxis(images, -1, 0)
+        return numpy.ascontiguousarray(images)
+
+    def result(self, data=None, legacy=True):
+        """
+        :param data: Spectra to project (None for no scores)
+        :param legacy: Return a tuple instead of a dictionary
+        :returns: scores, eigenvalues, eigenvectors (as for `numpyPCA`)
+        """
+        eigenvalues, eigenvectors, totalVariance = self.components()
+        if data is None:
+            images = None
+        else:
+            images = self.transform(data)
+        if legacy:
+            return images, eigenvalues, eigenvectors
+        else:
+            return {"scores": images,
+                    "eigenvalues": eigenvalues,
+                    "eigenvectors": eigenvectors,
+                    "average": self.average(),
+                    "pixels": self.nPixels,
+                    "variance": totalVariance}
+
+
 def test():
     x = numpy.array([[0.0,  2.0,  3.0],
                      [3.0,  0.0, -1.0],
@@ -27,17 +27,26 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 """
 Module Sift for calculating SIFT keypoint using PyOpenCL
+
+Without PyOpenCL, SiftPlan, MatchPlan and LinearAlign are provided by a
+numpy implementation (module cpu) with the same interface.
 """
 version = "0.2.0"
 import os
 sift_home = os.path.dirname(os.path.abspath(__file__))
 import sys, logging
 logging.basicConfig()
-from .plan import SiftPlan
-from .match import MatchPlan
-from .alignment import LinearAlign
-
-
 _logger = logging.getLogger(__name__)
-_logger.warning("The sift module in PyMca is deprecated. "
-                "You should import sift from the silx library.")
+try:
+    from .plan import SiftPlan
+    from .match import MatchPlan
+    from .alignment import LinearAlign
+    OPENCL = True
+except ImportError:
+    _logger.info("PyOpenCL not available, using the numpy implementation")
+    from .cpu import SiftPlan, MatchPlan, LinearAlign
+    OPENCL = False
+
+if OPENCL:
+    _logger.warning("The sift module in PyMca is deprecated. "
+                    "You should import sift from the silx library.")
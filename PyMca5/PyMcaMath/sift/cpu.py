@@ -0,0 +1,903 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: Sift implementation in Python + numpy
+#
+#
+#    Copyright (C) European Synchrotron Radiation Facility, Grenoble, France
+#
+#
+"""
+Pure numpy implementation of the SiftPlan, MatchPlan and LinearAlign classes,
+used when no OpenCL device is available.
+
+The keypoints and the matching follow the same algorithm and parameters
+(param.par) as the OpenCL kernels: all the scales of an octave are blurred
+at once, and the extrema detection, the orientation assignment and the
+descriptors are computed for all the keypoints of an octave with array
+operations.
+"""
+
+from __future__ import division, print_function
+
+__authors__ = ["agent"]
+__contact__ = "agent@local"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__status__ = "beta"
+__license__ = """
+Copyright (c) European Synchrotron Radiation Facility
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import time, math, logging, threading
+import numpy
+from PyMca5.PyMcaCore.McaStackView import threadedMap
+from .param import par
+from .utils import kernel_size, matching_correction
+logger = logging.getLogger("sift.cpu")
+
+# size of the descriptor grid and number of orientation bins of each cell
+INDEX_SIZE = 4
+DESC_BINS = 8
+# maximum number of samples processed at once for the descriptors
+MAX_SAMPLES = 2 ** 21
+
+
+def gaussian_kernels(sigmas):
+    """
+    Normalized gaussian kernels of the same (odd) size, one per sigma
+
+    :param sigmas: list of widths
+    :return: 2D array of shape (len(sigmas), size)
+    """
+    sigmas = numpy.asarray(sigmas, dtype=numpy.float64).reshape(-1)
+    size = kernel_size(sigmas.max(), True)
+    x = numpy.arange(size) - (size - 1.0) / 2.0
+    kernels = numpy.exp(-(x[None, :] / sigmas[:, None]) ** 2 / 2.0)
+    kernels /= kernels.sum(axis=1)[:, None]
+    return kernels.astype(numpy.float32)
+
+
+def blur(image, sigmas):
+    """
+    Separable gaussian blurs of an image with several widths at once.
+    Borders are extended with the edge values.
+
+    :param image: 2D array
+    :param sigmas: list of widths
+    :return: 3D array of shape (len(sigmas),) + image.shape
+    """
+    kernels = gaussian_kernels(sigmas)
+    nScales, size = kernels.shape
+    half = size // 2
+    height, width = image.shape
+    image = numpy.asarray(image, dtype=numpy.float32)
+    # along the rows, broadcasting the image over the scales
+    padded = numpy.pad(image, ((0, 0), (half, half)), mode="edge")
+    tmp = numpy.zeros((nScales, height, width), numpy.float32)
+    for k in range(size):
+        tmp += kernels[:, k, None, None] * padded[None, :, k:k + width]
+    # along the columns
+    padded = numpy.pad(tmp, ((0, 0), (half, half), (0, 0)), mode="edge")
+    tmp = None
+    output = numpy.zeros((nScales, height, width), numpy.float32)
+    for k in range(size):
+        output += kernels[:, k, None, None] * padded[:, k:k + height, :]
+    return output
+
+
+def gradients(images):
+    """
+    Gradient magnitude and orientation of a set of images (central
+    differences, zero on the borders)
+
+    :param images: 3D array
+    :return: magnitude, orientation (in [-pi, pi])
+    """
+    dy = numpy.zeros(images.shape, numpy.float32)
+    dx = numpy.zeros(images.shape, numpy.float32)
+    dy[:, 1:-1, :] = images[:, 2:, :] - images[:, :-2, :]
+    dx[:, :, 1:-1] = images[:, :, 2:] - images[:, :, :-2]
+    magnitude = numpy.sqrt(dx * dx + dy * dy)
+    orientation = numpy.arctan2(dy, dx)
+    return magnitude, orientation
+
+
+class SiftPlan(object):
+    """
+    How to calculate a set of SIFT keypoint on an image without OpenCL:
+
+    siftp = sift.SiftPlan(img.shape,img.dtype)
+    kp = siftp.keypoints(img)
+
+    kp is a recarray with the fields x, y, scale, angle and desc (128
+    unsigned bytes describing the keypoint), as for the OpenCL plan.
+    """
+    sigmaRatio = 2.0 ** (1.0 / par.Scales)
+    dtype_kp = numpy.dtype([('x', numpy.float32),
+                            ('y', numpy.float32),
+                            ('scale', numpy.float32),
+                            ('angle', numpy.float32),
+                            ('desc', (numpy.uint8, 128))
+                            ])
+
+    def __init__(self, shape=None, dtype=None, devicetype="CPU", template=None,
+                 profile=False, device=None, PIX_PER_KP=None, max_workgroup_size=128,
+                 context=None, init_sigma=None):
+        """
+        Contructor of the class. The OpenCL related parameters (devicetype,
+        device, PIX_PER_KP, max_workgroup_size, context) are accepted for
+        compatibility and ignored.
+
+        :param shape: shape of the input image
+        :param dtype: data type of the input image
+        :param template: extract shape and dtype from an image
+        :param profile: collect timing info
+        :param init_sigma: bluring width, you should have good reasons to modify the 1.6 default value
+        """
+        if init_sigma is None:
+            init_sigma = par.InitSigma
+        self._initSigma = float(init_sigma)
+        if template is not None:
+            self.shape = template.shape
+            self.dtype = template.dtype
+        else:
+            self.shape = shape
+            self.dtype = numpy.dtype(dtype)
+        if len(self.shape) == 3:
+            self.RGB = True
+            self.shape = self.shape[:2]
+        elif len(self.shape) == 2:
+            self.RGB = False
+        else:
+            raise RuntimeError("Unable to process image of shape %s" % (tuple(self.shape,)))
+        self.profile = bool(profile)
+        self.events = []
+        self.devicetype = "CPU"
+        self.USE_CPU = True
+        self._sem = threading.Semaphore()
+        self.scales = []
+        self._calc_scales()
+
+    def _calc_scales(self):
+        """
+        Nota scales are in XY order
+        """
+        shape = self.shape[-1::-1]
+        self.scales = [tuple(int(i) for i in shape)]
+        min_size = 2 * par.BorderDist + 2
+        while min(shape) > min_size:
+            shape = tuple(int(i // 2) for i in shape)
+            self.scales.append(shape)
+        self.scales.pop()
+        self.octave_max = len(self.scales)
+
+    def preprocess(self, image):
+        """
+        Convert the image to float and normalize it to the range [0, 255]
+
+        :param image: ndimage of 2D (or 3D if RGB)
+        :return: normalized image, minimum of the original image
+        """
+        image = numpy.asarray(image)
+        if image.ndim == 3:
+            image = image.mean(axis=-1)
+        data = numpy.array(image, dtype=numpy.float32)
+        vmin = data.min()
+        vmax = data.max()
+        if vmax > vmin:
+            data -= vmin
+            data *= 255.0 / (vmax - vmin)
+        else:
+            data[:] = 0
+        return data, vmin
+
+    def keypoints(self, image):
+        """
+        Calculates the keypoints of the image
+        :param image: ndimage of 2D (or 3D if RGB)
+        """
+        assert image.shape[:2] == self.shape
+        t0 = time.time()
+        data, self.vmin = self.preprocess(image)
+        curSigma = 1.0 if par.DoubleImSize else 0.5
+        if self._initSigma > curSigma:
+            sigma = math.sqrt(self._initSigma ** 2 - curSigma ** 2)
+            data = blur(data, [sigma])[0]
+        keypoints = []
+        descriptors = []
+        for octave in range(self.octave_max):
+            kp, descriptor, data = self._one_octave(data, octave)
+            logger.info("in octave %i found %i kp" % (octave, kp.shape[0]))
+            if kp.shape[0] > 0:
+                keypoints.append(kp)
+                descriptors.append(descriptor)
+        total_size = sum(kp.shape[0] for kp in keypoints)
+        output = numpy.recarray(shape=(total_size,), dtype=self.dtype_kp)
+        last = 0
+        for ds, desc in zip(keypoints, descriptors):
+            l = ds.shape[0]
+            output[last:last + l].x = ds[:, 0]
+            output[last:last + l].y = ds[:, 1]
+            output[last:last + l].scale = ds[:, 2]
+            output[last:last + l].angle = ds[:, 3]
+            output[last:last + l].desc = desc
+            last += l
+        if self.profile:
+            self.events.append(("keypoints", time.time() - t0))
+        logger.info("Execution time: %.3fms" % (1000 * (time.time() - t0)))
+        return output
+
+    def _one_octave(self, base, octave):
+        """
+        Does all scales within an octave
+
+        :param base: image of the octave blurred at the initial sigma
+        :param octave: number of the octave
+        :return: keypoints (x, y, scale, angle), descriptors and the base
+                 image of the next octave
+        """
+        # all the scales are blurred at once from the base image
+        nScales = par.Scales + 3
+        increase = [self._initSigma * math.sqrt(self.sigmaRatio ** (2 * s) - 1.0)
+                    for s in range(1, nScales)]
+        gaussians = numpy.empty((nScales,) + base.shape, numpy.float32)
+        gaussians[0] = base
+        gaussians[1:] = blur(base, increase)
+        dogs = gaussians[1:] - gaussians[:-1]
+        octsize = 2 ** octave
+        if octave == 0:
+            edgeThresh = par.EdgeThresh1
+        else:
+            edgeThresh = par.EdgeThresh
+        kp = self._extrema(dogs, edgeThresh)
+        kp = self._interpolate(dogs, kp)
+        if kp.shape[0]:
+            magnitude, orientation = gradients(gaussians)
+            kp = self._orientation(kp, magnitude, orientation)
+            descriptors = self._descriptors(kp, magnitude, orientation)
+        else:
+            descriptors = numpy.zeros((0, 128), numpy.uint8)
+        kp = kp.astype(numpy.float32)
+        # in image coordinates
+        kp[:, :3] *= octsize
+        nextBase = gaussians[par.Scales][::2, ::2].copy()
+        return kp, descriptors, nextBase
+
+    def _extrema(self, dogs, edgeThresh):
+        """
+        Local extrema of the DoG in space and scale
+
+        :return: array of (scale index, row, column) of the candidates
+        """
+        center = dogs[1:-1, 1:-1, 1:-1]
+        isMax = numpy.abs(center) > 0.8 * par.PeakThresh
+        isMin = isMax.copy()
+        nS, nR, nC = center.shape
+        for ds in range(3):
+            for dr in range(3):
+                for dc in range(3):
+                    if ds == dr == dc == 1:
+                        continue
+                    neighbor = dogs[ds:ds + nS, dr:dr + nR, dc:dc + nC]
+                    isMax &= center > neighbor
+                    isMin &= center < neighbor
+        candidates = isMax | isMin
+        border = par.BorderDist - 1
+        if border > 0:
+            candidates[:, :border, :] = False
+            candidates[:, -border:, :] = False
+            candidates[:, :, :border] = False
+            candidates[:, :, -border:] = False
+        s, r, c = numpy.nonzero(candidates)
+        s += 1
+        r += 1
+        c += 1
+        # reject the edges from the 2D hessian
+        dxx = dogs[s, r, c + 1] + dogs[s, r, c - 1] - 2 * dogs[s, r, c]
+        dyy = dogs[s, r + 1, c] + dogs[s, r - 1, c] - 2 * dogs[s, r, c]
+        dxy = 0.25 * (dogs[s, r + 1, c + 1] - dogs[s, r + 1, c - 1] -
+                      dogs[s, r - 1, c + 1] + dogs[s, r - 1, c - 1])
+        det = dxx * dyy - dxy * dxy
+        trace = dxx + dyy
+        keep = det > edgeThresh * trace * trace
+        return numpy.array([s[keep], r[keep], c[keep]]).T
+
+    def _interpolate(self, dogs, candidates):
+        """
+        Sub-pixel and sub-scale position of the extrema by fitting a
+        quadratic function to the DoG
+
+        :return: array of (x, y, scale, scale index) in octave coordinates
+        """
+        nS, nR, nC = dogs.shape
+        if not candidates.shape[0]:
+            return numpy.zeros((0, 4), numpy.float64)
+        s, r, c = [numpy.array(v, dtype=numpy.int64) for v in candidates.T]
+        done = numpy.zeros(s.shape, dtype=bool)
+        offset = numpy.zeros((s.size, 3), numpy.float64)
+        value = numpy.zeros(s.shape, numpy.float64)
+        active = numpy.ones(s.shape, dtype=bool)
+        for iteration in range(5):
+            idx = numpy.nonzero(active & ~done)[0]
+            if not idx.size:
+                break
+            si, ri, ci = s[idx], r[idx], c[idx]
+            d = dogs.astype(numpy.float64) if iteration == 0 else d
+            v = d[si, ri, ci]
+            g = numpy.empty((idx.size, 3), numpy.float64)
+            g[:, 0] = 0.5 * (d[si + 1, ri, ci] - d[si - 1, ri, ci])
+            g[:, 1] = 0.5 * (d[si, ri + 1, ci] - d[si, ri - 1, ci])
+            g[:, 2] = 0.5 * (d[si, ri, ci + 1] - d[si, ri, ci - 1])
+            h = numpy.empty((idx.size, 3, 3), numpy.float64)
+            h[:, 0, 0] = d[si + 1, ri, ci] + d[si - 1, ri, ci] - 2 * v
+            h[:, 1, 1] = d[si, ri + 1, ci] + d[si, ri - 1, ci] - 2 * v
+            h[:, 2, 2] = d[si, ri, ci + 1] + d[si, ri, ci - 1] - 2 * v
+            h[:, 0, 1] = h[:, 1, 0] = 0.25 * (d[si + 1, ri + 1, ci] - d[si + 1, ri - 1, ci] -
+                                               d[si - 1, ri + 1, ci] + d[si - 1, ri - 1, ci])
+            h[:, 0, 2] = h[:, 2, 0] = 0.25 * (d[si + 1, ri, ci + 1] - d[si + 1, ri, ci - 1] -
+                                               d[si - 1, ri, ci + 1] + d[si - 1, ri, ci - 1])
+            h[:, 1, 2] = h[:, 2, 1] = 0.25 * (d[si, ri + 1, ci + 1] - d[si, ri + 1, ci - 1] -
+                                               d[si, ri - 1, ci + 1] + d[si, ri - 1, ci - 1])
+            singular = numpy.abs(numpy.linalg.det(h)) < 1.0e-12
+            h[singular] = numpy.identity(3)
+            x = -numpy.linalg.solve(h, g[:, :, None])[:, :, 0]
+            x[singular] = 0
+            offset[idx] = x
+            value[idx] = v + 0.5 * (g * x).sum(axis=1)
+            # move to the neighbor pixel when the offset is too large
+            dr = numpy.where(x[:, 1] > 0.6, 1, numpy.where(x[:, 1] < -0.6, -1, 0))
+            dc = numpy.where(x[:, 2] > 0.6, 1, numpy.where(x[:, 2] < -0.6, -1, 0))
+            moved = (dr != 0) | (dc != 0)
+            done[idx[~moved]] = True
+            newr = ri + dr
+            newc = ci + dc
+            inside = (newr > par.BorderDist - 1) & (newr < nR - par.BorderDist) & \
+                     (newc > par.BorderDist - 1) & (newc < nC - par.BorderDist)
+            active[idx[moved & ~inside]] = False
+            r[idx[moved & inside]] = newr[moved & inside]
+            c[idx[moved & inside]] = newc[moved & inside]
+        keep = done & active & (numpy.abs(offset) <= 1.5).all(axis=1) & \
+               (numpy.abs(value) > par.PeakThresh)
+        s, r, c, offset = s[keep], r[keep], c[keep], offset[keep]
+        result = numpy.empty((s.size, 4), numpy.float64)
+        result[:, 0] = c + offset[:, 2]
+        result[:, 1] = r + offset[:, 1]
+        result[:, 2] = self._initSigma * 2.0 ** ((s + offset[:, 0]) / par.Scales)
+        result[:, 3] = s
+        return result
+
+    def _window(self, kp, radius, shape):
+        """
+        Pixels of a square window around each keypoint
+
+        :return: rows, columns, valid mask, row and column offsets
+        """
+        d = numpy.arange(-radius, radius + 1)
+        dr, dc = numpy.meshgrid(d, d, indexing="ij")
+        dr = dr.reshape(1, -1)
+        dc = dc.reshape(1, -1)
+        rows = numpy.round(kp[:, 1]).astype(numpy.int64)[:, None] + dr
+        cols = numpy.round(kp[:, 0]).astype(numpy.int64)[:, None] + dc
+        valid = (rows > 0) & (rows < shape[0] - 1) & (cols > 0) & (cols < shape[1] - 1)
+        rows = numpy.clip(rows, 0, shape[0] - 1)
+        cols = numpy.clip(cols, 0, shape[1] - 1)
+        return rows, cols, valid, dr, dc
+
+    def _orientation(self, kp, magnitude, orientation):
+        """
+        Assign one or more orientations to each keypoint from the
+        histogram of the gradients around it
+
+        :return: array of (x, y, scale, angle)
+        """
+        shape = magnitude.shape[1:]
+        sIndex = numpy.clip(numpy.round(kp[:, 3]).astype(numpy.int64),
+                            0, magnitude.shape[0] - 1)
+        sigma = par.OriSigma * kp[:, 2]
+        radius = int(3.0 * sigma.max())
+        rows, cols, valid, dr, dc = self._window(kp, radius, shape)
+        distance2 = dr * dr + dc * dc
+        valid &= distance2 <= (3.0 * sigma[:, None]) ** 2 + 0.5
+        weight = numpy.exp(-distance2 / (2.0 * sigma[:, None] ** 2))
+        weight *= magnitude[sIndex[:, None], rows, cols]
+        weight[~valid] = 0
+        nBins = par.OriBins
+        bins = (nBins * (orientation[sIndex[:, None], rows, cols] + math.pi) /
+                (2 * math.pi)).astype(numpy.int64) % nBins
+        bins += numpy.arange(kp.shape[0])[:, None] * nBins
+        hist = numpy.bincount(bins.reshape(-1), weights=weight.reshape(-1),
+                              minlength=kp.shape[0] * nBins)
+        hist = hist.reshape(-1, nBins)
+        for i in range(6):
+            hist = (numpy.roll(hist, 1, axis=1) + hist +
+                    numpy.roll(hist, -1, axis=1)) / 3.0
+        left = numpy.roll(hist, 1, axis=1)
+        right = numpy.roll(hist, -1, axis=1)
+        peaks = (hist > left) & (hist > right) & \
+                (hist >= par.OriHistThresh * hist.max(axis=1)[:, None])
+        k, b = numpy.nonzero(peaks)
+        l, c, r = left[k, b], hist[k, b], right[k, b]
+        denominator = l - 2 * c + r
+        denominator[denominator == 0] = 1
+        position = b + 0.5 + 0.5 * (l - r) / denominator
+        result = numpy.empty((k.size, 5), numpy.float64)
+        result[:, :3] = kp[k, :3]
+        result[:, 3] = 2 * math.pi * position / nBins - math.pi
+        result[:, 4] = kp[k, 3]
+        return result
+
+    def _descriptors(self, kp, magnitude, orientation):
+        """
+        128 values descriptor of each keypoint: histograms of the gradient
+        orientations relative to the keypoint angle in a 4x4 grid
+        """
+        nKp = kp.shape[0]
+        shape = magnitude.shape[1:]
+        spacing = par.MagFactor * kp[:, 2]
+        radius = int(1.414 * spacing.max() * (INDEX_SIZE + 1) / 2.0 + 0.5)
+        nSamples = (2 * radius + 1) ** 2
+        step = max(MAX_SAMPLES // nSamples, 1)
+        descriptors = numpy.zeros((nKp, 128), numpy.float64)
+        sigma = par.IndexSigma * 0.5 * INDEX_SIZE
+        for start in range(0, nKp, step):
+            end = min(start + step, nKp)
+            k = kp[start:end]
+            n = end - start
+            sIndex = numpy.clip(numpy.round(k[:, 4]).astype(numpy.int64),
+                                0, magnitude.shape[0] - 1)[:, None]
+            rows, cols, valid, dr, dc = self._window(k, radius, shape)
+            cosine = numpy.cos(k[:, 3])[:, None]
+            sine = numpy.sin(k[:, 3])[:, None]
+            # position in the (rotated) descriptor grid
+            rpos = (cosine * dr - sine * dc) / spacing[start:end, None]
+            cpos = (sine * dr + cosine * dc) / spacing[start:end, None]
+            rx = rpos + INDEX_SIZE / 2.0 - 0.5
+            cx = cpos + INDEX_SIZE / 2.0 - 0.5
+            valid &= (rx > -1.0) & (rx < INDEX_SIZE) & (cx > -1.0) & (cx < INDEX_SIZE)
+            weight = numpy.exp(-(rpos * rpos + cpos * cpos) / (2.0 * sigma * sigma))
+            weight *= magnitude[sIndex, rows, cols]
+            weight[~valid] = 0
+            angle = (orientation[sIndex, rows, cols] - k[:, 3][:, None]) % (2 * math.pi)
+            ox = DESC_BINS * angle / (2 * math.pi)
+            r0 = numpy.floor(rx).astype(numpy.int64)
+            c0 = numpy.floor(cx).astype(numpy.int64)
+            o0 = numpy.floor(ox).astype(numpy.int64)
+            rf = rx - r0
+            cf = cx - c0
+            of = ox - o0
+            offset = numpy.arange(n)[:, None] * 128
+            hist = numpy.zeros((n * 128,), numpy.float64)
+            # trilinear distribution to the 8 neighbor bins
+            for ri in (0, 1):
+                wr = weight * (rf if ri else 1 - rf)
+                rr = r0 + ri
+                okr = (rr >= 0) & (rr < INDEX_SIZE)
+                for ci in (0, 1):
+                    wc = wr * (cf if ci else 1 - cf)
+                    cc = c0 + ci
+                    ok = okr & (cc >= 0) & (cc < INDEX_SIZE)
+                    for oi in (0, 1):
+                        wo = wc * (of if oi else 1 - of)
+                        oo = (o0 + oi) % DESC_BINS
+                        index = offset + (rr * INDEX_SIZE + cc) * DESC_BINS + oo
+                        hist += numpy.bincount(index[ok], weights=wo[ok],
+                                               minlength=n * 128)
+            descriptors[start:end] = hist.reshape(n, 128)
+        # normalize, clip large values and normalize again
+        norm = numpy.sqrt((descriptors * descriptors).sum(axis=1))
+        norm[norm == 0] = 1
+        descriptors /= norm[:, None]
+        numpy.clip(descriptors, 0, par.MaxIndexVal, out=descriptors)
+        norm = numpy.sqrt((descriptors * descriptors).sum(axis=1))
+        norm[norm == 0] = 1
+        descriptors /= norm[:, None]
+        return numpy.minimum(512 * descriptors, 255).astype(numpy.uint8)
+
+    def reset_timer(self):
+        """
+        Resets the profiling timers
+        """
+        with self._sem:
+            self.events = []
+
+    def log_profile(self):
+        """
+        Prints the timing of the keypoint calculations
+        """
+        if self.profile:
+            for name, elapsed in self.events:
+                print("%50s:\t%.3fms" % (name, 1000 * elapsed))
+
+
+class MatchPlan(object):
+    """
+    Plan to compare sets of SIFT keypoint without OpenCL
+
+    siftp = sift.MatchPlan()
+    kp = siftp.match(kp1,kp2)
+    """
+    dtype_kp = SiftPlan.dtype_kp
+
+    def __init__(self, size=16384, devicetype="CPU", profile=False, device=None,
+                 max_workgroup_size=128, roi=None, context=None):
+        """
+        Constructor of the class. The OpenCL related parameters are accepted
+        for compatibility and ignored.
+
+        :param size: number of keypoints of the first list compared at once
+        :param profile: set to true to activate profiling information collection
+        :param roi: Region Of Interest
+        """
+        self.kpsize = size
+        self.profile = bool(profile)
+        self.events = []
+        self.devicetype = "CPU"
+        self.USE_CPU = True
+        self._sem = threading.Semaphore()
+        self.roi = None
+        if roi is not None:
+            self.set_roi(roi)
+
+    def match(self, nkp1, nkp2, raw_results=False):
+        """
+        calculate the matching of 2 keypoint list: the nearest keypoint of
+        the second list is accepted when it is significantly closer than the
+        second nearest one (par.MatchRatio).
+
+        :param nkp1, nkp2: numpy 1D recarray of keypoints
+        :param raw_results: if true return the 2D array of indexes of matching keypoints (not the actual keypoints)
+        """
+        assert len(nkp1.shape) == 1
+        assert len(nkp2.shape) == 1
+        t0 = time.time()
+        index1 = numpy.arange(nkp1.size)
+        if self.roi is not None and nkp1.size:
+            x = numpy.clip(numpy.round(nkp1.x).astype(numpy.int64), 0, self.roi.shape[1] - 1)
+            y = numpy.clip(numpy.round(nkp1.y).astype(numpy.int64), 0, self.roi.shape[0] - 1)
+            index1 = index1[self.roi[y, x] != 0]
+        if (index1.size == 0) or (nkp2.size < 2):
+            match = numpy.zeros((0, 2), dtype=numpy.int32)
+        else:
+            desc2 = nkp2.desc.astype(numpy.float32)
+            norm2 = (desc2 * desc2).sum(axis=1)
+            matches = []
+            ratio2 = par.MatchRatio * par.MatchRatio
+            for start in range(0, index1.size, self.kpsize):
+                idx = index1[start:start + self.kpsize]
+                desc1 = nkp1.desc[idx].astype(numpy.float32)
+                # squared distances between all the descriptors
+                distance = norm2[None, :] - 2 * numpy.dot(desc1, desc2.T)
+                distance += (desc1 * desc1).sum(axis=1)[:, None]
+                best = numpy.argpartition(distance, 1, axis=1)[:, :2]
+                d = numpy.take_along_axis(distance, best, axis=1)
+                swap = d[:, 0] > d[:, 1]
+                best[swap] = best[swap][:, ::-1]
+                d[swap] = d[swap][:, ::-1]
+                ok = d[:, 0] < ratio2 * d[:, 1]
+                matches.append(numpy.array([idx[ok], best[ok, 0]]).T)
+            match = numpy.concatenate(matches).astype(numpy.int32)
+        if self.profile:
+            self.events.append(("matching", time.time() - t0))
+        if raw_results:
+            return match
+        result = numpy.recarray(shape=(match.shape[0], 2), dtype=self.dtype_kp)
+        result[:, 0] = nkp1[match[:, 0]]
+        result[:, 1] = nkp2[match[:, 1]]
+        return result
+
+    def reset_timer(self):
+        """
+        Resets the profiling timers
+        """
+        with self._sem:
+            self.events = []
+
+    def set_roi(self, roi):
+        """
+        Defines the region of interest
+
+        :param roi: region of interest as 2D numpy array with non zero where
+        valid pixels are.
+        """
+        with self._sem:
+            self.roi = numpy.ascontiguousarray(roi, numpy.int8)
+
+    def unset_roi(self):
+        """
+        Unset the region of interest
+        """
+        with self._sem:
+            self.roi = None
+
+
+def transform(image, matrix, offset, outshape, fill):
+    """
+    Bilinear interpolation of image at matrix . (y, x) + offset, as the
+    transform OpenCL kernel
+
+    :param image: 2D array
+    :param matrix: 2x2 array
+    :param offset: (offset_y, offset_x)
+    :param outshape: shape of the output image
+    :param fill: value outside the image
+    """
+    height, width = image.shape
+    y, x = numpy.mgrid[0:outshape[0], 0:outshape[1]].astype(numpy.float32)
+    ty = matrix[0, 0] * y + matrix[0, 1] * x + offset[0]
+    tx = matrix[1, 0] * y + matrix[1, 1] * x + offset[1]
+    inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < height)
+    tx0 = numpy.clip(tx.astype(numpy.int64), 0, width - 1)
+    ty0 = numpy.clip(ty.astype(numpy.int64), 0, height - 1)
+    tx1 = tx0 + 1
+    ty1 = ty0 + 1
+    fx = tx - tx0
+    fy = ty - ty0
+    padded = numpy.empty((height + 1, width + 1), numpy.float32)
+    padded[:height, :width] = image
+    padded[height, :] = fill
+    padded[:, width] = fill
+    interp1 = (1 - fx) * padded[ty0, tx0] + fx * padded[ty0, tx1]
+    interp2 = (1 - fx) * padded[ty1, tx0] + fx * padded[ty1, tx1]
+    output = (1 - fy) * interp1 + fy * interp2
+    output[~inside] = fill
+    return output.astype(numpy.float32)
+
+
+class LinearAlign(object):
+    """
+    Align images on a reference image based on an Afine transformation
+    (bi-linear + offset) without OpenCL
+    """
+    def __init__(self, image, devicetype="CPU", profile=False, device=None, max_workgroup_size=128,
+                 ROI=None, extra=0, context=None, init_sigma=None):
+        """
+        Constructor of the class. The OpenCL related parameters are accepted
+        for compatibility and ignored.
+
+        :param image: reference image on which other image should be aligned
+        :param profile:collect profiling information ?
+        :param ROI: Region of interest
+        :param extra: extra space around the image, can be an integer, or a 2 tuple in YX convention
+        :param init_sigma: bluring width, you should have good reasons to modify the 1.6 default value...
+        """
+        self.profile = bool(profile)
+        self.ref = numpy.ascontiguousarray(image, numpy.float32)
+        self.shape = image.shape
+        if len(self.shape) == 3:
+            self.RGB = True
+            self.shape = self.shape[:2]
+        elif len(self.shape) == 2:
+            self.RGB = False
+        else:
+            raise RuntimeError("Unable to process image of shape %s" % (tuple(self.shape,)))
+        if "__len__" not in dir(extra):
+            self.extra = (int(extra), int(extra))
+        else:
+            self.extra = extra[:2]
+        self.outshape = tuple(i + 2 * j for i, j in zip(self.shape, self.extra))
+        self.ROI = ROI
+        self.sift = SiftPlan(template=image, profile=self.profile,
+                             init_sigma=init_sigma)
+        self.ref_kp = self.sift.keypoints(image)
+        if self.ROI is not None:
+            self.ref_kp = self._in_roi(self.ref_kp)
+        self.match = MatchPlan(profile=self.profile)
+        self.fill_value = 0
+        self.sem = threading.Semaphore()
+        self.relative_transfo = None
+
+    def _in_roi(self, kp):
+        kpx = numpy.round(kp.x).astype(numpy.int32)
+        kpy = numpy.round(kp.y).astype(numpy.int32)
+        masked = self.ROI[(kpy, kpx)].astype(bool)
+        logger.warning("Reducing keypoint list from %i to %i because of the ROI" % (kp.size, masked.sum()))
+        return kp[masked]
+
+    def align(self, img, shift_only=False, return_all=False, double_check=False, relative=False, orsa=False):
+        """
+        Align image on reference image. Different images can be aligned
+        at the same time from different threads unless relative is set.
+
+        :param img: numpy array containing the image to align to reference
+        :param return_all: return in addition ot the image, keypoints, matching keypoints, and transformations as a dict
+        :param relative: update reference keypoints with those from current image to perform relative alignment
+        :param orsa: not available without OpenCL, ignored
+        :return: aligned image or all informations
+        """
+        logger.debug("ref_keypoints: %s" % self.ref_kp.size)
+        if self.RGB:
+            data = numpy.ascontiguousarray(img, numpy.uint8)
+        else:
+            data = numpy.ascontiguousarray(img, numpy.float32)
+        kp = self.sift.keypoints(data)
+        logger.debug("mod image keypoints: %s" % kp.size)
+        ref_kp = self.ref_kp
+        raw_matching = self.match.match(ref_kp, kp, raw_results=True)
+        matching = numpy.recarray(shape=raw_matching.shape, dtype=MatchPlan.dtype_kp)
+        len_match = raw_matching.shape[0]
+        if len_match == 0:
+            logger.warning("No matching keypoints")
+            return
+        matching[:, 0] = ref_kp[raw_matching[:, 0]]
+        matching[:, 1] = kp[raw_matching[:, 1]]
+        if orsa:
+            logger.warning("feature is not available. No ORSA filtering")
+
+        if (len_match < 3 * 6) or (shift_only):  # 3 points per DOF
+            if shift_only:
+                logger.debug("Shift Only mode: Common keypoints: %s" % len_match)
+            else:
+                logger.warning("Shift Only mode: Common keypoints: %s" % len_match)
+            dx = matching[:, 1].x - matching[:, 0].x
+            dy = matching[:, 1].y - matching[:, 0].y
+            matrix = numpy.identity(2, dtype=numpy.float32)
+            offset = numpy.array([+numpy.median(dy), +numpy.median(dx)], numpy.float32)
+        else:
+            logger.debug("Common keypoints: %s" % len_match)
+            transform_matrix = matching_correction(matching)
+            offset = numpy.array([transform_matrix[5], transform_matrix[2]], dtype=numpy.float32)
+            matrix = numpy.empty((2, 2), dtype=numpy.float32)
+            matrix[0, 0], matrix[0, 1] = transform_matrix[4], transform_matrix[3]
+            matrix[1, 0], matrix[1, 1] = transform_matrix[1], transform_matrix[0]
+        if double_check and (len_match >= 3 * 6):
+            logger.warning("Validating keypoints, %s,%s" % (matrix, offset))
+            dx = matching[:, 1].x - matching[:, 0].x
+            dy = matching[:, 1].y - matching[:, 0].y
+            dangle = matching[:, 1].angle - matching[:, 0].angle
+            dscale = numpy.log(matching[:, 1].scale / matching[:, 0].scale)
+            distance = numpy.sqrt(dx * dx + dy * dy)
+            outlayer = numpy.zeros(distance.shape, numpy.int8)
+            outlayer += abs((distance - distance.mean()) / distance.std()) > 4
+            outlayer += abs((dangle - dangle.mean()) / dangle.std()) > 4
+            outlayer += abs((dscale - dscale.mean()) / dscale.std()) > 4
+            outlayersum = outlayer.sum()
+            if outlayersum > 0 and not numpy.isinf(outlayersum):
+                matching2 = matching[outlayer == 0]
+                transform_matrix = matching_correction(matching2)
+                offset = numpy.array([transform_matrix[5], transform_matrix[2]], dtype=numpy.float32)
+                matrix = numpy.empty((2, 2), dtype=numpy.float32)
+                matrix[0, 0], matrix[0, 1] = transform_matrix[4], transform_matrix[3]
+                matrix[1, 0], matrix[1, 1] = transform_matrix[1], transform_matrix[0]
+        if relative:  # update stable part to perform a relative alignment
+            with self.sem:
+                self.ref_kp = kp
+                if self.ROI is not None:
+                    self.ref_kp = self._in_roi(self.ref_kp)
+                transfo = numpy.zeros((3, 3), dtype=numpy.float64)
+                transfo[:2, :2] = matrix
+                transfo[0, 2] = offset[0]
+                transfo[1, 2] = offset[1]
+                transfo[2, 2] = 1
+                if self.relative_transfo is None:
+                    self.relative_transfo = transfo
+                else:
+                    self.relative_transfo = numpy.dot(transfo, self.relative_transfo)
+                matrix = numpy.ascontiguousarray(self.relative_transfo[:2, :2], dtype=numpy.float32)
+                offset = numpy.ascontiguousarray(self.relative_transfo[:2, 2], dtype=numpy.float32)
+        if self.RGB:
+            result = numpy.empty(self.outshape + (data.shape[2],), numpy.uint8)
+            for i in range(data.shape[2]):
+                result[:, :, i] = numpy.clip(transform(data[:, :, i], matrix, offset,
+                                                       self.outshape, 0), 0, 255)
+        else:
+            result = transform(data, matrix, offset, self.outshape, data.min())
+        if return_all:
+            corr = numpy.dot(matrix, numpy.vstack((matching[:, 0].y, matching[:, 0].x))).T + offset.T - numpy.vstack((matching[:, 1].y, matching[:, 1].x)).T
+            rms = numpy.sqrt((corr * corr).sum(axis=-1).mean())
+            return {"result": result, "keypoint": kp, "matching": matching, "offset": offset, "matrix": matrix, "rms": rms}
+        return result
+
+    def align_all(self, images, nthreads=0, **kw):
+        """
+        Align a sequence of images on the reference image, several images
+        being processed at the same time by a pool of threads.
+
+        :param images: iterable of images
+        :param nthreads: number of threads (0: number of CPU's, None: no threads)
+        :param kw: keyword arguments of align (relative is not supported)
+        :return: generator of the results of align, in the order of the images
+        """
+        if kw.get("relative", False):
+            raise ValueError("Relative alignment needs the images in sequence")
+
+        def process(image):
+            return self.align(image, **kw)
+
+        return threadedMap(process, images, nthreads=nthreads)
+
+    def log_profile(self):
+        """
+        Prints the timing of the keypoint calculations
+        """
+        self.sift.log_profile()
+
+
+def benchmark(shape=(256, 256), nimages=10, nthreads=0, seed=0,
+              background=True):
+    """
+    Compare the shifts and the execution time of the SIFT alignment on CPU
+    and of the FFT registration of ImageRegistration on a synthetic stack
+    of randomly shifted images of random blobs.
+
+    :param background: add a smooth, non periodic background to the images
+    :return: dictionary with the elapsed times and the maximum errors
+    """
+    from PyMca5.PyMcaMath import ImageRegistration
+    state = numpy.random.RandomState(seed)
+    # random blobs, optionally on a smooth background
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]].astype(numpy.float64)
+    shifts = state.uniform(-5, 5, (nimages, 2))
+    centers = state.uniform(0.1, 0.9, (40, 2)) * numpy.array(shape)
+    widths = state.uniform(2, 6, 40)
+    heights = state.uniform(0.5, 1.0, 40)
+
+    def image(s0, s1):
+        if background:
+            img = 0.2 * numpy.sin((x - s1) / 40.) * numpy.cos((y - s0) / 50.)
+        else:
+            img = numpy.zeros(shape, numpy.float64)
+        for (c0, c1), w, h in zip(centers, widths, heights):
+            img += h * numpy.exp(-((y - c0 - s0) ** 2 + (x - c1 - s1) ** 2) / (2 * w * w))
+        return img.astype(numpy.float32)
+
+    reference = image(0, 0)
+    stack = numpy.array([image(s0, s1) for s0, s1 in shifts])
+    t0 = time.time()
+    aligner = LinearAlign(reference)
+    siftShifts = numpy.zeros(shifts.shape)
+    for i, result in enumerate(aligner.align_all(stack, nthreads=nthreads,
+                                                 shift_only=True, return_all=True)):
+        if result is not None:
+            siftShifts[i] = result["offset"]
+        else:
+            siftShifts[i] = numpy.nan
+    siftTime = time.time() - t0
+    t0 = time.time()
+    fftShifts = ImageRegistration.measure_stack_offsets(reference, stack,
+                                                        nthreads=nthreads)
+    fftTime = time.time() - t0
+    return {"images": nimages,
+            "shape": shape,
+            "background": background,
+            "sift_time": siftTime,
+            "fft_time": fftTime,
+            "sift_error": numpy.abs(siftShifts - shifts).max(),
+            "fft_error": numpy.abs(fftShifts - shifts).max()}
+
+
+if __name__ == "__main__":
+    import sys
+    nimages = 10
+    if len(sys.argv) > 1:
+        nimages = int(sys.argv[1])
+    print("Maximum errors (px) and times (s), with | without background")
+    for shape in [(128, 128), (256, 256), (512, 512)]:
+        results = [benchmark(shape=shape, nimages=nimages,
+                             background=background)
+                   for background in [True, False]]
+        print("%d images %dx%d: " % ((nimages,) + tuple(shape)) + " | ".join(
+              "SIFT %.3f px %.3f s FFT %.3f px %.3f s" % \
+              (result["sift_error"], result["sift_time"],
+               result["fft_error"], result["fft_time"])
+              for result in results))
@@ -45,17 +45,57 @@
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaMath.fitting import Gefit
 from PyMca5 import PyMcaDataDir
+from PyMca5.PyMcaCore import DiskCache
+import PyMca5
 _logger = logging.getLogger(__name__)
 #"python ClassMcaTheory.py -s1.1 --file=03novs060sum.mca --pkm=McaTheory.dat --continuum=0 --strip=1 --sumflag=1 --maxiter=4"
 CONTINUUM_LIST = [None,'Constant','Linear','Parabolic','Linear Polynomial','Exp. Polynomial']
 OLDESCAPE = 0
 MAX_ATTENUATION = 1.0E-300
+# anything else than the configuration the peak tables depend on
+CACHE_VERSION = ["McaTheory", 2, PyMca5.version(), OLDESCAPE, MAX_ATTENUATION]
+if FISX:
+    import fisx
+    CACHE_VERSION.append(getattr(fisx, "__version__", None))
+_configurationCache = None
+_configurationCacheInitialized = False
+
+
+def getConfigurationCache():
+    """
+    Returns the cache of the peak tables and fluorescence rates calculated
+    when configuring McaTheory (None when disabled). The cache is disabled
+    unless the PYMCA_CACHE_DIR environment variable gives its directory
+    or it is set with setConfigurationCache. The cache files are pickled,
+    so only use a directory no one else can write to.
+    """
+    global _configurationCache, _configurationCacheInitialized
+    if not _configurationCacheInitialized:
+        _configurationCacheInitialized = True
+        _configurationCache = None
+        directory = os.getenv("PYMCA_CACHE_DIR")
+        if directory:
+            _configurationCache = DiskCache.DiskCache(
+                                    os.path.join(directory, "McaTheory"))
+    return _configurationCache
+
+
+def setConfigurationCache(cache):
+    """
+    :param DiskCache cache: None to disable caching
+    """
+    global _configurationCache, _configurationCacheInitialized
+    _configurationCacheInitialized = True
+    _configurationCache = cache
+
 class McaTheory(object):
     def __init__(self, initdict=None, filelist=None, **kw):
         self.ydata0  = None
         self.xdata0  = None
         self.sigmay0 = None
         self.__lastTime = None
+        self.__niter = None
+        self.__lastEstimate = None
         self.strategyInstances = {}
         self.__toBeConfigured = False
         self.useFisxEscape(False)
@@ -170,6 +210,7 @@ def _updateCallback(self):
 
     def __configure(self):
         self.linearMatrix = None
+        self.__lastEstimate = None
         #multilayer key
         self.config['multilayer'] = self.config.get('multilayer',{})
         #update Elements material information
@@ -178,6 +219,63 @@ def __configure(self):
             Elements.Material[material] = copy.deepcopy(self.config['materials'][material])
         #that was it
 
+        #peak tables and rates only depend on the configuration
+        cache = getConfigurationCache()
+        if cache is None:
+            self.__configurePeaks()
+        else:
+            key = cache.key(CACHE_VERSION,
+                            {k: v for k, v in self.config.items() if k != 'fisx'},
+                            Elements.Material,
+                            self.attflag,
+                            self.__USE_FISX_ESCAPE)
+            cached = cache.get(key)
+            if cached is None:
+                self.__configurePeaks()
+                cache.set(key, self.__getPeakTables())
+            else:
+                _logger.debug("Peak tables from cache %s", cache.filename(key))
+                self.__setPeakTables(cached)
+        self.__configureFit()
+
+    def __getPeakTables(self):
+        return {'config': dict(self.config),
+                'PEAKS0': self.PEAKS0,
+                'PEAKS0ESCAPE': self.PEAKS0ESCAPE,
+                'PEAKS0NAMES': self.PEAKS0NAMES,
+                'PEAKSW': self.PEAKSW,
+                'HYPERMET': self.__HYPERMET,
+                'NGLOBAL': self.NGLOBAL,
+                'PARAMETERS': self.PARAMETERS,
+                'fluoRates': self._fluoRates,
+                'ELEMENTS_ENERGY': self.__elementsEnergy}
+
+    def __setPeakTables(self, ddict):
+        # configuration with defaults and fisx corrections
+        self.config.update(ddict['config'])
+        self.PEAKS0 = ddict['PEAKS0']
+        self.PEAKS0ESCAPE = ddict['PEAKS0ESCAPE']
+        self.PEAKS0NAMES = ddict['PEAKS0NAMES']
+        self.PEAKSW = ddict['PEAKSW']
+        self.__HYPERMET = ddict['HYPERMET']
+        self.NGLOBAL = ddict['NGLOBAL']
+        self.PARAMETERS = ddict['PARAMETERS']
+        self._fluoRates = ddict['fluoRates']
+        # same side effect on the Elements module as __configurePeaks
+        self.__elementsEnergy = ddict['ELEMENTS_ENERGY']
+        if len(self.__elementsEnergy):
+            energy = self.__elementsEnergy[0]
+            for element in self.config['peaks'].keys():
+                if len(element) > 1:
+                    ele = element[0:1].upper()+element[1:2].lower()
+                else:
+                    ele = element.upper()
+                if energy != Elements.Element[ele]['buildparameters']['energy']:
+                    Elements.updateDict(energy=energy)
+
+    def __configurePeaks(self):
+        # energy the Elements module dictionaries are updated to (if any)
+        self.__elementsEnergy = []
         #default peak shape parameters for pseudo-voigt function
         self.config['peakshape']['eta_factor'] = self.config['peakshape'].get('eta_factor', 0.02)
         self.config['peakshape']['fixedeta_factor'] = self.config['peakshape'].get('fixedeta_factor',
@@ -310,6 +408,7 @@ def __configure(self):
         if (maxenergy is not None) and usematrix:
           #sort the peaks by atomic number
           data  = []
+          self.__elementsEnergy = [maxenergy]
           for element in self.config['peaks'].keys():
               if len(element) > 1:
                   ele = element[0:1].upper()+element[1:2].lower()
@@ -518,6 +617,7 @@ def __configure(self):
                  ((not usematrix) and (len(energylist) == 1)):
                 #print "OLD METHOD"
                 data  = []
+                self.__elementsEnergy = [maxenergy]
                 for element in self.config['peaks'].keys():
                     if len(element) > 1:
                         ele = element[0:1].upper()+element[1:2].lower()
@@ -959,13 +1059,15 @@ def __configure(self):
         #    print self.PEAKS0ESCAPE[i]
         self.PEAKS0NAMES= PEAKS0NAMES
         self.PEAKSW     = PEAKSW
-        self.FASTER     = 1
         self.__HYPERMET   = HYPERMET
         self.NGLOBAL    = NGLOBAL
         self.PARAMETERS = PARAMETERS
+
+    def __configureFit(self):
+        self.FASTER     = 1
         self.ESCAPE     = self.config['fit']['escapeflag']
         self.__SUM        = self.config['fit']['sumflag']
-        self.__CONTINUUM     = CONTINUUM
+        self.__CONTINUUM     = self.config['fit']['continuum']
         self.MAXITER    = self.config['fit']['maxiter']
         self.STRIP      = self.config['fit']['stripflag']
         #if self.laststrip is not None:
@@ -1162,6 +1264,9 @@ def setData(self,*var,**kw):
     def getLastTime(self):
         return self.__lastTime
 
+    def getLastNumberOfIterations(self):
+        return self.__niter
+
     def __smooth(self,y):
         f=[0.25,0.5,0.25]
         try:
@@ -1797,10 +1902,41 @@ def estimate(self):
             _logger.debug("CONFIGURING FROM ESTIMATION")
             self.configure(self.__originalConfiguration)
         self.parameters, self.codes = self.specfitestimate(self.xdata, self.ydata,self.zz)
+        self.__lastEstimate = self.__getFitRegion(), numpy.array(self.codes)
         #self.estimatelinpoly(self.xdata, self.ydata,self.zz)
         #self.estimateexppoly(self.xdata, self.ydata,self.zz)
         #print self.codes[:,3]
 
+    def warmStartEstimate(self, parameters):
+        """
+        Use the fitted parameters of a previous spectrum (for example a
+        neighbouring pixel of a map) as starting values of the next fit.
+        The constraints of the last estimation are reused so the peak
+        search and the parameter estimation are skipped. When the
+        configuration or the fitting region changed since the last call
+        to estimate, estimate is called instead.
+
+        :param parameters: fitted parameters of a previous fit or None
+        :returns bool: False when the parameters had to be estimated
+        """
+        if parameters is None or self.__toBeConfigured or \
+           self.__lastEstimate is None:
+            self.estimate()
+            return False
+        fitRegion, codes = self.__lastEstimate
+        if fitRegion != self.__getFitRegion() or \
+           len(parameters) != codes.shape[1]:
+            self.estimate()
+            return False
+        self.parameters = list(parameters)
+        # the fit may modify the constraints
+        self.codes = numpy.array(codes)
+        return True
+
+    def __getFitRegion(self):
+        x = numpy.ravel(self.xdata)
+        return len(x), x[0], x[-1]
+
     def specfitestimate(self,x,y,z,xscaling=1.0,yscaling=1.0):
         if self.PARAMETERS is None:
             self.__configure()
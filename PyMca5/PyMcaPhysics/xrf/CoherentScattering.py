@@ -34,6 +34,7 @@
 import numpy
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import PyMcaDataDir
+from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
 
 dirmod = PyMcaDataDir.PYMCA_DATA_DIR
 ffile = os.path.join(dirmod, "attdata")
@@ -51,8 +52,12 @@
     if not os.path.exists(ffile):
         print("Cannot find file ", ffile)
         raise IOError("Cannot find file %s" % ffile)
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+COEFFICIENTS = None
+if PhysicsDatabase.getDatabase() is not None:
+    COEFFICIENTS = PhysicsDatabase.getDatabase().get("CoherentScattering")
+if COEFFICIENTS is None:
+    COEFFICIENTS = ConfigDict.ConfigDict()
+    COEFFICIENTS.read(ffile)
 KEVTOANG = 12.39852000
 R0 = 2.82E-13 #electron radius in cm
 
@@ -41,6 +41,7 @@
 from . import CoherentScattering
 from . import IncoherentScattering
 from . import PyMcaEPDL97
+from . import PhysicsDatabase
 from PyMca5 import PyMcaDataDir
 
 """
@@ -2208,14 +2209,6 @@ def getmassattcoef(compound, energy=None):
     div      = sum(fraction)
     fraction = [x/div for x in fraction]
     #print "fraction = ",fraction
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
-    eltindex = 0
     if energy is None:
         energy=[]
         for ele in elts:
@@ -2224,74 +2217,31 @@ def getmassattcoef(compound, energy=None):
                 if ene not in energy:
                     energy.append(ene)
         energy.sort()
+    if not hasattr(energy, "__len__"):
+        energy =[energy]
 
-    for ele in elts:
-        xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if not hasattr(energy, "__len__"):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                ddict['energy'].append(ene)
-                ddict['coherent'].append(cohe *fraction[eltindex])
-                ddict['compton'].append(comp *fraction[eltindex])
-                ddict['photo'].append(photo *fraction[eltindex])
-                ddict['pair'].append(pair*fraction[eltindex])
-                ddict['total'].append((cohe+comp+photo+pair)*fraction[eltindex])
-            else:
-                ddict['coherent'][eneindex] += cohe  *fraction[eltindex]
-                ddict['compton'] [eneindex] += comp  *fraction[eltindex]
-                ddict['photo']   [eneindex] += photo *fraction[eltindex]
-                ddict['pair']    [eneindex] += pair  *fraction[eltindex]
-                ddict['total']   [eneindex] += (cohe+comp+photo+pair) * fraction[eltindex]
-            eneindex += 1
-        eltindex += 1
+    for eltindex, ele in enumerate(elts):
+        #interpolate at all the energies at once
+        cohe, comp, photo, pair = _getElementCrossSections(ele, energy)
+        if eltindex == 0:
+            coherent = cohe * fraction[eltindex]
+            compton  = comp * fraction[eltindex]
+            photoeff = photo * fraction[eltindex]
+            pairprod = pair * fraction[eltindex]
+            total    = (cohe+comp+photo+pair) * fraction[eltindex]
+        else:
+            coherent += cohe  * fraction[eltindex]
+            compton  += comp  * fraction[eltindex]
+            photoeff += photo * fraction[eltindex]
+            pairprod += pair  * fraction[eltindex]
+            total    += (cohe+comp+photo+pair) * fraction[eltindex]
+    ddict={}
+    ddict['energy']   = list(energy)
+    ddict['coherent'] = coherent.tolist()
+    ddict['compton']  = compton.tolist()
+    ddict['photo']    = photoeff.tolist()
+    ddict['pair']     = pairprod.tolist()
+    ddict['total']    = total.tolist()
     return ddict
 
 def __materialInCompoundList(lst):
@@ -2452,84 +2402,39 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
         energy.sort()
 
     #I have the energy grid, the elements and their fractions
-    dict={}
-    dict['energy']   = []
-    dict['coherent'] = []
-    dict['compton']  = []
-    dict['photo']    = []
-    dict['pair']     = []
-    dict['total']    = []
-    eltindex = 0
-    for ele in materialElements.keys():
-        if 'xcom' in Element[ele]:
-            xcom_data = Element[ele]['xcom']
+    if (type(energy) != type([])):
+        energy =[energy]
+    for eltindex, ele in enumerate(materialElements.keys()):
+        #interpolate at all the energies at once
+        cohe, comp, photo, pair = _getElementCrossSections(ele, energy)
+        fraction = materialElements[ele]
+        if eltindex == 0:
+            coherent = cohe * fraction
+            compton  = comp * fraction
+            photoeff = photo * fraction
+            pairprod = pair * fraction
+            total    = (cohe+comp+photo+pair) * fraction
         else:
-            xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if (type(energy) != type([])):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                dict['energy'].append(ene)
-                dict['coherent'].append(cohe * materialElements[ele])
-                dict['compton'].append(comp * materialElements[ele])
-                dict['photo'].append(photo * materialElements[ele])
-                dict['pair'].append(pair* materialElements[ele])
-                dict['total'].append((cohe+comp+photo+pair)* materialElements[ele])
-            else:
-                dict['coherent'][eneindex] += cohe  * materialElements[ele]
-                dict['compton'] [eneindex] += comp  * materialElements[ele]
-                dict['photo']   [eneindex] += photo * materialElements[ele]
-                dict['pair']    [eneindex] += pair  * materialElements[ele]
-                dict['total']   [eneindex] += (cohe+comp+photo+pair) *  materialElements[ele]
-            eneindex += 1
-        eltindex += 1
+            coherent += cohe  * fraction
+            compton  += comp  * fraction
+            photoeff += photo * fraction
+            pairprod += pair  * fraction
+            total    += (cohe+comp+photo+pair) * fraction
+    dict={}
+    dict['energy']   = list(energy)
+    if len(materialElements):
+        dict['coherent'] = coherent.tolist()
+        dict['compton']  = compton.tolist()
+        dict['photo']    = photoeff.tolist()
+        dict['pair']     = pairprod.tolist()
+        dict['total']    = total.tolist()
+    else:
+        dict['energy']   = []
+        dict['coherent'] = []
+        dict['compton']  = []
+        dict['photo']    = []
+        dict['pair']     = []
+        dict['total']    = []
     return dict
 
 
@@ -2621,186 +2526,221 @@ def getElementComptonDifferentialCrossSection(ele, theta, energy, p1=None):
           raise ValueError("Unknown element %s" % ele)
     return (value * 6.022142E23)/ Element[ele]['mass']
 
-def getelementmassattcoef(ele,energy=None):
+def _readXCOMFile(ele):
     """
-    Usage: getelementmassattcoef(element symbol, energy in kev)
-        It gets the info from files generated by XCOM
-        If energy is not given, it gives back a dictionary with the form:
-            dict['energy']     = [energies]
-            dict['coherent']   = [coherent scattering cross section(energies)]
-            dict['compton']    = [incoherent scattering cross section(energies)]
-            dict['photo']      = [photoelectic effect cross section(energies)]
-            dict['pair']       = [pair production cross section(energies)]
-            dict['total']      = [total cross section]
+    Read the XCOM cross sections of an element from its attdata file.
     """
-    if 'xcom' not in Element[ele].keys():
-        dirmod = PyMcaDataDir.PYMCA_DATA_DIR
-        #read xcom file
-        #print dirmod+"/"+ele+".mat"
+    dirmod = PyMcaDataDir.PYMCA_DATA_DIR
+    #read xcom file
+    #print dirmod+"/"+ele+".mat"
+    xcomfile = os.path.join(dirmod, "attdata")
+    xcomfile = os.path.join(xcomfile, ele+".mat")
+    if not os.path.exists(xcomfile):
+        #freeze does bad things with the path ...
+        dirmod = os.path.dirname(dirmod)
         xcomfile = os.path.join(dirmod, "attdata")
         xcomfile = os.path.join(xcomfile, ele+".mat")
-        if not os.path.exists(xcomfile):
-            #freeze does bad things with the path ...
+        if dirmod.lower().endswith(".zip"):
             dirmod = os.path.dirname(dirmod)
             xcomfile = os.path.join(dirmod, "attdata")
             xcomfile = os.path.join(xcomfile, ele+".mat")
-            if dirmod.lower().endswith(".zip"):
-                dirmod = os.path.dirname(dirmod)
-                xcomfile = os.path.join(dirmod, "attdata")
-                xcomfile = os.path.join(xcomfile, ele+".mat")
-            if not os.path.exists(xcomfile):
-                print("Cannot find file ",xcomfile)
-                raise IOError("Cannot find %s" % xcomfile)
-        f = open(xcomfile, 'r')
-        line=f.readline()
-        while (line.split('ENERGY')[0] == line):
-            line = f.readline()
-        Element[ele]['xcom'] = {}
-        Element[ele]['xcom']['energy']   =[]
-        Element[ele]['xcom']['coherent'] =[]
-        Element[ele]['xcom']['compton']  =[]
-        Element[ele]['xcom']['photo']  =[]
-        Element[ele]['xcom']['pair']     =[]
-        Element[ele]['xcom']['total']    =[]
+        if not os.path.exists(xcomfile):
+            print("Cannot find file ",xcomfile)
+            raise IOError("Cannot find %s" % xcomfile)
+    f = open(xcomfile, 'r')
+    line=f.readline()
+    while (line.split('ENERGY')[0] == line):
         line = f.readline()
-        while (line.split('COHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['energy'].append(float(value)*1000.)
-            line = f.readline()
-        Element[ele]['xcom']['energy']=numpy.array(Element[ele]['xcom']['energy'])
+    ddict = {}
+    ddict['energy']   =[]
+    ddict['coherent'] =[]
+    ddict['compton']  =[]
+    ddict['photo']  =[]
+    ddict['pair']     =[]
+    ddict['total']    =[]
+    line = f.readline()
+    while (line.split('COHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            ddict['energy'].append(float(value)*1000.)
         line = f.readline()
-        while (line.split('INCOHERENT')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['coherent'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['coherent']=numpy.array(Element[ele]['xcom']['coherent'])
+    ddict['energy']=numpy.array(ddict['energy'])
+    line = f.readline()
+    while (line.split('INCOHERENT')[0] == line):
+        line = line.split()
+        for value in line:
+            ddict['coherent'].append(float(value))
         line = f.readline()
-        while (line.split('PHOTO')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['compton'].append(float(value))
-            line = f.readline()
-        Element[ele]['xcom']['compton']=numpy.array(Element[ele]['xcom']['compton'])
+    ddict['coherent']=numpy.array(ddict['coherent'])
+    line = f.readline()
+    while (line.split('PHOTO')[0] == line):
+        line = line.split()
+        for value in line:
+            ddict['compton'].append(float(value))
         line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['photo'].append(float(value))
-            line = f.readline()
+    ddict['compton']=numpy.array(ddict['compton'])
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            ddict['photo'].append(float(value))
         line = f.readline()
-        while (line.split('PAIR')[0] == line):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'].append(float(value))
-            line = f.readline()
-        i = 0
+    line = f.readline()
+    while (line.split('PAIR')[0] == line):
+        line = line.split()
+        for value in line:
+            ddict['pair'].append(float(value))
         line = f.readline()
-        while (len(line)):
-            line = line.split()
-            for value in line:
-                Element[ele]['xcom']['pair'][i] += float(value)
-                i += 1
-            line = f.readline()
-        f.close()
-        if sys.version >= '3.0':
-            # next line gave problems under under windows
-            # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
-            # what I mean
-            # i1=numpy.argsort(Element[ele]['xcom']['energy']) did not work
-            # (uses quicksort and gives problems with Pb not passing tests)
-            i1=numpy.argsort(Element[ele]['xcom']['energy'], kind='mergesort')
-        else:
-            sset = map(None,Element[ele]['xcom']['energy'],range(len(Element[ele]['xcom']['energy'])))
-            sset.sort()
-            i1=numpy.array([x[1] for x in sset])
-        Element[ele]['xcom']['energy']=numpy.take(Element[ele]['xcom']['energy'],i1)
-        Element[ele]['xcom']['coherent']=numpy.take(Element[ele]['xcom']['coherent'],i1)
-        Element[ele]['xcom']['compton']=numpy.take(Element[ele]['xcom']['compton'],i1)
-        Element[ele]['xcom']['photo']=numpy.take(Element[ele]['xcom']['photo'],i1)
-        Element[ele]['xcom']['pair']=numpy.take(Element[ele]['xcom']['pair'],i1)
-        if Element[ele]['xcom']['coherent'][0] <= 0:
-           Element[ele]['xcom']['coherent'][0] = Element[ele]['xcom']['coherent'][1] * 1.0
-        try:
-            Element[ele]['xcom']['energylog10']=numpy.log10(Element[ele]['xcom']['energy'])
-            Element[ele]['xcom']['coherentlog10']=numpy.log10(Element[ele]['xcom']['coherent'])
-            Element[ele]['xcom']['comptonlog10']=numpy.log10(Element[ele]['xcom']['compton'])
-            Element[ele]['xcom']['photolog10']=numpy.log10(Element[ele]['xcom']['photo'])
-        except:
-            raise ValueError("Problem calculating logaritm of %s.mat file data" % ele)
-        for i in range(0,len(Element[ele]['xcom']['energy'])):
-            Element[ele]['xcom']['total'].append(Element[ele]['xcom']['coherent'][i]+\
-                                                 Element[ele]['xcom']['compton'] [i]+\
-                                                 Element[ele]['xcom']['photo'] [i]+\
-                                                 Element[ele]['xcom']['pair'] [i])
+    i = 0
+    line = f.readline()
+    while (len(line)):
+        line = line.split()
+        for value in line:
+            ddict['pair'][i] += float(value)
+            i += 1
+        line = f.readline()
+    f.close()
+    if sys.version >= '3.0':
+        # next line gave problems under under windows
+        # just try numpy.argsort([1,1,1,1,1]) under linux and windows to see
+        # what I mean
+        # i1=numpy.argsort(ddict['energy']) did not work
+        # (uses quicksort and gives problems with Pb not passing tests)
+        i1=numpy.argsort(ddict['energy'], kind='mergesort')
+    else:
+        sset = map(None,ddict['energy'],range(len(ddict['energy'])))
+        sset.sort()
+        i1=numpy.array([x[1] for x in sset])
+    ddict['energy']=numpy.take(ddict['energy'],i1)
+    ddict['coherent']=numpy.take(ddict['coherent'],i1)
+    ddict['compton']=numpy.take(ddict['compton'],i1)
+    ddict['photo']=numpy.take(ddict['photo'],i1)
+    ddict['pair']=numpy.take(ddict['pair'],i1)
+    if ddict['coherent'][0] <= 0:
+       ddict['coherent'][0] = ddict['coherent'][1] * 1.0
+    try:
+        ddict['energylog10']=numpy.log10(ddict['energy'])
+        ddict['coherentlog10']=numpy.log10(ddict['coherent'])
+        ddict['comptonlog10']=numpy.log10(ddict['compton'])
+        ddict['photolog10']=numpy.log10(ddict['photo'])
+    except:
+        raise ValueError("Problem calculating logaritm of %s.mat file data" % ele)
+    for i in range(0,len(ddict['energy'])):
+        ddict['total'].append(ddict['coherent'][i]+\
+                              ddict['compton'] [i]+\
+                              ddict['photo'] [i]+\
+                              ddict['pair'] [i])
+    return ddict
+
+def getelementmassattcoef(ele,energy=None):
+    """
+    Usage: getelementmassattcoef(element symbol, energy in kev)
+        It gets the info from files generated by XCOM
+        If energy is not given, it gives back a dictionary with the form:
+            dict['energy']     = [energies]
+            dict['coherent']   = [coherent scattering cross section(energies)]
+            dict['compton']    = [incoherent scattering cross section(energies)]
+            dict['photo']      = [photoelectic effect cross section(energies)]
+            dict['pair']       = [pair production cross section(energies)]
+            dict['total']      = [total cross section]
+    """
+    if 'xcom' not in Element[ele].keys():
+        xcom = None
+        database = PhysicsDatabase.getDatabase()
+        if database is not None:
+            xcom = database.get("XCOM/" + ele)
+        if xcom is None:
+            xcom = _readXCOMFile(ele)
+        Element[ele]['xcom'] = xcom
 
     if energy is None:
         return  Element[ele]['xcom']
-    ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
     if not hasattr(energy, "__len__"):
         energy =[energy]
-    for ene in energy:
-        if ene < 1.0:
-            if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                #make sure the binding energies are those used by this module and not EADL ones
-                PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                      Element[ele]['binding'])
-            tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-            cohe  = tmpDict['coherent'][0]
-            comp  = tmpDict['compton'][0]
-            photo = tmpDict['photo'][0]
-            pair  = 0.0
-        else:
-            i0=max(numpy.nonzero(Element[ele]['xcom']['energy'] <= ene)[0])
-            i1=min(numpy.nonzero(Element[ele]['xcom']['energy'] >= ene)[0])
-            if i1 <= i0:
-                cohe=Element[ele]['xcom']['coherent'][i1]
-                comp=Element[ele]['xcom']['compton'][i1]
-                photo=Element[ele]['xcom']['photo'][i1]
-                pair=Element[ele]['xcom']['pair'][i1]
-            else:
-                if LOGLOG:
-                    A=Element[ele]['xcom']['energylog10'][i0]
-                    B=Element[ele]['xcom']['energylog10'][i1]
-                    logene = numpy.log10(ene)
-                    c2=(logene-A)/(B-A)
-                    c1=(B-logene)/(B-A)
-                else:
-                    A=Element[ele]['xcom']['energy'][i0]
-                    B=Element[ele]['xcom']['energy'][i1]
-                    c2=(ene-A)/(B-A)
-                    c1=(B-ene)/(B-A)
-
-                cohe= pow(10.0,c2*Element[ele]['xcom']['coherentlog10'][i1]+\
-                               c1*Element[ele]['xcom']['coherentlog10'][i0])
-                comp= pow(10.0,c2*Element[ele]['xcom']['comptonlog10'][i1]+\
-                               c1*Element[ele]['xcom']['comptonlog10'][i0])
-                photo=pow(10.0,c2*Element[ele]['xcom']['photolog10'][i1]+\
-                               c1*Element[ele]['xcom']['photolog10'][i0])
-                if Element[ele]['xcom']['pair'][i1] > 0.0:
-                    c2 = c2*numpy.log10(Element[ele]['xcom']['pair'][i1])
-                    if Element[ele]['xcom']['pair'][i0] > 0.0:
-                        c1 = c1*numpy.log10(Element[ele]['xcom']['pair'][i0])
-                        pair = pow(10.0,c1+c2)
-                    else:
-                        pair =0.0
-                else:
-                    pair =0.0
-        ddict['energy'].append(ene)
-        ddict['coherent'].append(cohe)
-        ddict['compton'].append(comp)
-        ddict['photo'].append(photo)
-        ddict['pair'].append(pair)
-        ddict['total'].append(cohe+comp+photo+pair)
+    cohe, comp, photo, pair = _getElementCrossSections(ele, energy)
+    ddict={}
+    ddict['energy']   = list(energy)
+    ddict['coherent'] = cohe.tolist()
+    ddict['compton']  = comp.tolist()
+    ddict['photo']    = photo.tolist()
+    ddict['pair']     = pair.tolist()
+    ddict['total']    = (cohe+comp+photo+pair).tolist()
     return ddict
 
+def _getElementCrossSections(ele, energy):
+    """
+    Interpolate the XCOM cross sections of an element at all the given
+    energies (in keV) at once. Below 1 keV EPDL97 data are used.
+
+    Returns the coherent, compton, photo and pair arrays in cm2/g.
+    """
+    xcom_data = getelementmassattcoef(ele, None)
+    energy = numpy.array(energy, dtype=numpy.float64, ndmin=1)
+    cohe  = numpy.zeros(energy.shape, numpy.float64)
+    comp  = numpy.zeros(energy.shape, numpy.float64)
+    photo = numpy.zeros(energy.shape, numpy.float64)
+    pair  = numpy.zeros(energy.shape, numpy.float64)
+    low = energy < 1.0
+    if low.any():
+        if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
+            #make sure the binding energies are those used by this module and not EADL ones
+            PyMcaEPDL97.setElementBindingEnergies(ele,
+                                                  Element[ele]['binding'])
+        tmpDict = PyMcaEPDL97.getElementCrossSections(ele, energy[low])
+        cohe[low]  = tmpDict['coherent']
+        comp[low]  = tmpDict['compton']
+        photo[low] = tmpDict['photo']
+    high = numpy.nonzero(~low)[0]
+    if not len(high):
+        return cohe, comp, photo, pair
+    ene = energy[high]
+    # i0 is the last grid point <= ene and i1 the first one >= ene.
+    # At an absorption edge the energy is repeated and i1 < i0 selects
+    # the value below the edge.
+    i0 = numpy.searchsorted(xcom_data['energy'], ene, side='right') - 1
+    i1 = numpy.searchsorted(xcom_data['energy'], ene, side='left')
+    if (i0 < 0).any() or (i1 >= len(xcom_data['energy'])).any():
+        raise ValueError("Energy outside the tabulated range of %s" % ele)
+    exact = i1 <= i0
+    idx = high[exact]
+    j1 = i1[exact]
+    cohe[idx]  = xcom_data['coherent'][j1]
+    comp[idx]  = xcom_data['compton'][j1]
+    photo[idx] = xcom_data['photo'][j1]
+    pair[idx]  = xcom_data['pair'][j1]
+
+    interp = ~exact
+    idx = high[interp]
+    j0 = i0[interp]
+    j1 = i1[interp]
+    ene = ene[interp]
+    if LOGLOG:
+        A = xcom_data['energylog10'][j0]
+        B = xcom_data['energylog10'][j1]
+        logene = numpy.log10(ene)
+        c2 = (logene-A)/(B-A)
+        c1 = (B-logene)/(B-A)
+    else:
+        A = xcom_data['energy'][j0]
+        B = xcom_data['energy'][j1]
+        c2 = (ene-A)/(B-A)
+        c1 = (B-ene)/(B-A)
+    cohe[idx]  = numpy.power(10.0, c2*xcom_data['coherentlog10'][j1]+\
+                                   c1*xcom_data['coherentlog10'][j0])
+    comp[idx]  = numpy.power(10.0, c2*xcom_data['comptonlog10'][j1]+\
+                                   c1*xcom_data['comptonlog10'][j0])
+    photo[idx] = numpy.power(10.0, c2*xcom_data['photolog10'][j1]+\
+                                   c1*xcom_data['photolog10'][j0])
+    # pair production is zero below threshold
+    pair0 = xcom_data['pair'][j0]
+    pair1 = xcom_data['pair'][j1]
+    positive = (pair0 > 0.0) & (pair1 > 0.0)
+    if positive.any():
+        pair[idx[positive]] = numpy.power(10.0,
+                            c1[positive]*numpy.log10(pair0[positive])+\
+                            c2[positive]*numpy.log10(pair1[positive]))
+    return cohe, comp, photo, pair
+
 def getElementLShellRates(symbol,energy=None,photoweights = None):
     """
     getElementLShellRates(symbol,energy=None, photoweights = None)
@@ -3069,48 +3009,61 @@ def _updateCallback():
             method()
 
 
-Element={}
-for ele in ElementList:
-    z = getz(ele)
-    Element[ele]={}
-    Element[ele]['Z']       = z
-    Element[ele]['name']    = ElementsInfo[z-1][4]
-    Element[ele]['mass']    = ElementsInfo[z-1][5]
-    Element[ele]['density'] = ElementsInfo[z-1][6]/1000.
-    Element[ele]['binding'] = {}
-    i=0
-    for shell in ElementShells:
-        i = i + 1
-        if z > len(ElementBinding):
-            #Give the bindings of the last element
-            Element[ele]['binding'][shell] = ElementBinding[-1][i]
-        else:
-            Element[ele]['binding'][shell] = ElementBinding[z-1][i]
-    #fluorescence yields
-    Element[ele]['omegak']  = getomegak(ele)
-    Element[ele]['omegal1'] = getomegal1(ele)
-    Element[ele]['omegal2'] = getomegal2(ele)
-    Element[ele]['omegal3'] = getomegal3(ele)
-    Element[ele]['omegam1'] = getomegam1(ele)
-    Element[ele]['omegam2'] = getomegam2(ele)
-    Element[ele]['omegam3'] = getomegam3(ele)
-    Element[ele]['omegam4'] = getomegam4(ele)
-    Element[ele]['omegam5'] = getomegam5(ele)
-
-
-    #Coster-Kronig
-    Element[ele]['CosterKronig'] = {}
-    Element[ele]['CosterKronig']['L'] = getCosterKronig(ele)
-    Element[ele]['CosterKronig']['M'] = MShell.getCosterKronig(ele)
-
-    #jump ratios
-
-    #xrays
-    #Element[ele]['rays']=[]
-    #updateElementDict(ele, Element[ele], energy=None, minenergy=0.399, minrate=0.001,cb=False)
-Material = _getMaterialDict()
+def _getElementDict():
+    """
+    Build the dictionary of element properties and x-ray transitions from
+    the data files.
+    """
+    ddict={}
+    for ele in ElementList:
+        z = getz(ele)
+        ddict[ele]={}
+        ddict[ele]['Z']       = z
+        ddict[ele]['name']    = ElementsInfo[z-1][4]
+        ddict[ele]['mass']    = ElementsInfo[z-1][5]
+        ddict[ele]['density'] = ElementsInfo[z-1][6]/1000.
+        ddict[ele]['binding'] = {}
+        i=0
+        for shell in ElementShells:
+            i = i + 1
+            if z > len(ElementBinding):
+                #Give the bindings of the last element
+                ddict[ele]['binding'][shell] = ElementBinding[-1][i]
+            else:
+                ddict[ele]['binding'][shell] = ElementBinding[z-1][i]
+        #fluorescence yields
+        ddict[ele]['omegak']  = getomegak(ele)
+        ddict[ele]['omegal1'] = getomegal1(ele)
+        ddict[ele]['omegal2'] = getomegal2(ele)
+        ddict[ele]['omegal3'] = getomegal3(ele)
+        ddict[ele]['omegam1'] = getomegam1(ele)
+        ddict[ele]['omegam2'] = getomegam2(ele)
+        ddict[ele]['omegam3'] = getomegam3(ele)
+        ddict[ele]['omegam4'] = getomegam4(ele)
+        ddict[ele]['omegam5'] = getomegam5(ele)
+
+
+        #Coster-Kronig
+        ddict[ele]['CosterKronig'] = {}
+        ddict[ele]['CosterKronig']['L'] = getCosterKronig(ele)
+        ddict[ele]['CosterKronig']['M'] = MShell.getCosterKronig(ele)
+
+        #jump ratios
+
+        #xrays
+        #ddict[ele]['rays']=[]
+        #updateElementDict(ele, ddict[ele], energy=None, minenergy=0.399, minrate=0.001,cb=False)
+    for ele in ElementList:
+        _updateElementDict(ele, ddict[ele])
+    return ddict
 
-updateDict()
+Element = None
+_database = PhysicsDatabase.getDatabase()
+if _database is not None:
+    Element = _database.get("Elements")
+if Element is None:
+    Element = _getElementDict()
+Material = _getMaterialDict()
 
 
 if __name__ == "__main__":
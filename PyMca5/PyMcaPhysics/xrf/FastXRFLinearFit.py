@@ -39,6 +39,11 @@
 import time
 import h5py
 import collections
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from . import ClassMcaTheory
 from . import ConcentrationsTool
 from PyMca5.PyMcaMath.linalg import lstsq
@@ -47,6 +52,7 @@
 from PyMca5.PyMcaIO import ConfigDict
 from .XRFBatchFitOutput import OutputBuffer
 from PyMca5.PyMcaCore import McaStackView
+from PyMca5.PyMcaIO import HDF5Stack1D
 
 _logger = logging.getLogger(__name__)
 
@@ -73,7 +79,8 @@ def setFitConfigurationFile(self, ffile):
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
                            ysum=None, weight=None, refit=True, livetime=None,
-                           outbuffer=None, save=True, **outbufferinitargs):
+                           outbuffer=None, save=True, nworkers=None,
+                           **outbufferinitargs):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -90,6 +97,8 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                          automatic time. The default is None.
         :param outbuffer:
         :param save: set to False to postpone saving the in-memory buffers
+        :param nworkers: number of worker processes for the fit of all spectra.
+                         None or 1 means serial fitting, 0 means one worker per CPU.
         :return OutputBuffer: works like a dict
         """
         # Parse data
@@ -187,6 +196,9 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                                                 dataAttrs=dataAttrs,
                                                 groupAttrs=None,
                                                 memtype='ram')
+            # HDF5 chunks aligned with the chunks of spectra being fitted
+            fitstack = self._fitDataView(data, sliceChan, mcaIndex)
+            chunks = fitstack.chunkShape
             fitAttrs = {}
             if outbuffer.saveDataDiagnostics:
                 # Generic axes
@@ -223,20 +235,16 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
             else:
                 nFreeParameters = None
             if outbuffer.saveFit:
+                # not fitted channels: NaN
                 fitmodel = outbuffer.allocateMemory('model',
                                                     group='fit',
                                                     shape=stackShape,
                                                     dtype=dtypeResult,
-                                                    chunks=True,
-                                                    fill_value=0,
+                                                    chunks=chunks,
+                                                    fill_value=numpy.nan,
                                                     dataAttrs=dataAttrs,
                                                     groupAttrs=fitAttrs,
                                                     memtype='hdf5')
-                idx = [slice(None)]*fitmodel.ndim
-                idx[mcaIndex] = slice(0, iXMin)
-                fitmodel[tuple(idx)] = numpy.nan
-                idx[mcaIndex] = slice(iXMax, None)
-                fitmodel[tuple(idx)] = numpy.nan
             else:
                 fitmodel = None
 
@@ -244,11 +252,13 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
             t0 = time.time()
 
             # Fit all spectra
-            self._fitLstSqAll(data=data, sliceChan=sliceChan, mcaIndex=mcaIndex,
-                            derivatives=derivatives, fitmodel=fitmodel,
-                            results=results, uncertainties=uncertainties,
-                            config=config, anchorslist=anchorslist,
-                            lstsq_kwargs=lstsq_kwargs)
+            with outbuffer.chunkWriter() as writer:
+                self._fitLstSqAll(data=data, sliceChan=sliceChan, mcaIndex=mcaIndex,
+                                derivatives=derivatives, fitmodel=fitmodel,
+                                results=results, uncertainties=uncertainties,
+                                config=config, anchorslist=anchorslist,
+                                lstsq_kwargs=lstsq_kwargs, nworkers=nworkers,
+                                writer=writer)
 
             t = time.time() - t0
             _logger.debug("First fit elapsed = %f", t)
@@ -271,24 +281,35 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
 
             # Return results as a dictionary
             if outbuffer.saveData:
-                outbuffer.allocateMemory('data',
+                outdata = outbuffer.allocateMemory('data',
                                      group='fit',
-                                     data=data,
+                                     shape=stackShape,
                                      dtype=dtypeResult,
-                                     chunks=True,
+                                     chunks=chunks,
                                      dataAttrs=dataAttrs,
                                      groupAttrs=fitAttrs,
                                      memtype='hdf5')
+            else:
+                outdata = None
             if outbuffer.saveResiduals:
                 residuals = outbuffer.allocateMemory('residuals',
                                                  group='fit',
-                                                 data=data,
+                                                 shape=stackShape,
                                                  dtype=dtypeResult,
-                                                 chunks=True,
+                                                 chunks=chunks,
                                                  dataAttrs=dataAttrs,
                                                  groupAttrs=fitAttrs,
                                                  memtype='hdf5')
-                residuals[()] -= fitmodel
+            else:
+                residuals = None
+            if outdata is not None or residuals is not None:
+                with outbuffer.chunkWriter() as writer:
+                    self._fitDataDiagnostics(data=data, mcaIndex=mcaIndex,
+                                             nMca=fitstack.nMca,
+                                             fitmodel=fitmodel,
+                                             outdata=outdata,
+                                             residuals=residuals,
+                                             writer=writer)
 
             if concentrations:
                 t0 = time.time()
@@ -484,7 +505,7 @@ def _fitReferenceSpectrum(self, data=None, mcaIndex=None, sumover='all'):
             # First spectrum
             idx = [0]*data.ndim
             idx[mcaIndex] = slice(None)
-            yref = data[idx].astype(dtype)
+            yref = data[tuple(idx)].astype(dtype)
         return yref
 
     def _fitCreateModel(self, dtype=None):
@@ -579,6 +600,60 @@ def _fitMcaTrimInfo(self, x=None):
                 iXMax = iXMax[0]
         return iXMin, iXMax+1
 
+    def _fitDataView(self, data, sliceChan, mcaIndex):
+        """View of the spectra in the chunks in which they are fitted
+        """
+        return McaStackView.FullView(data, readonly=True,
+                                     mcaSlice=sliceChan, mcaAxis=mcaIndex,
+                                     nMca=(1, 'MB'),
+                                     dtype=self._fitDtypeResult(data))
+
+    def _fitModelView(self, fitmodel, datastack, writer=None):
+        """View of the fit model (all channels) in the chunks
+        of the fitted spectra
+        """
+        if fitmodel is None:
+            return None
+        return McaStackView.FullView(fitmodel, readonly=False,
+                                     mcaAxis=datastack.mcaAxis,
+                                     nMca=datastack.nMca,
+                                     dtype=datastack.dtype,
+                                     writer=writer)
+
+    def _fitDataDiagnostics(self, data=None, mcaIndex=None, nMca=None,
+                            fitmodel=None, outdata=None, residuals=None,
+                            writer=None):
+        """
+        Copy the data and calculate the residuals chunk by chunk
+        """
+        viewkwargs = {'mcaAxis': mcaIndex, 'nMca': nMca,
+                      'dtype': self._fitDtypeResult(data)}
+        datastack = McaStackView.FullView(data, readonly=True, **viewkwargs)
+        if outdata is None:
+            outstack = None
+        else:
+            outstack = McaStackView.FullView(outdata, readonly=False,
+                                             writer=writer, **viewkwargs)
+        if residuals is None:
+            residualstack = None
+        else:
+            residualstack = McaStackView.FullView(residuals, readonly=False,
+                                                  writer=writer, **viewkwargs)
+        if residuals is None or fitmodel is None:
+            modelstack = None
+        else:
+            modelstack = McaStackView.FullView(fitmodel, readonly=True,
+                                               **viewkwargs)
+        for chunkIndex in datastack.chunkIndex():
+            _, chunk = datastack.getItem(chunkIndex)
+            if outstack is not None:
+                outstack.setItem(chunkIndex, chunk)
+            if residualstack is not None:
+                if modelstack is not None:
+                    _, chunkModel = modelstack.getItem(chunkIndex)
+                    chunk = chunk - chunkModel
+                residualstack.setItem(chunkIndex, chunk)
+
     def _dataChunkIter(self, slicecls, data=None, fitmodel=None, **kwargs):
         dtype = self._fitDtypeResult(data)
         datastack = slicecls(data, dtype=dtype,
@@ -594,51 +669,151 @@ def _dataChunkIter(self, slicecls, data=None, fitmodel=None, **kwargs):
     def _fitLstSqAll(self, data=None, sliceChan=None, mcaIndex=None,
                      derivatives=None, results=None, uncertainties=None,
                      fitmodel=None, config=None, anchorslist=None,
-                     lstsq_kwargs=None):
+                     lstsq_kwargs=None, nworkers=None, writer=None):
         """
         Fit all spectra
         """
+        if nworkers == 0:
+            nworkers = multiprocessing.cpu_count()
+        if nworkers is not None and nworkers > 1:
+            if _parallelDataSource(data) is not None:
+                return self._fitLstSqAllParallel(data=data, sliceChan=sliceChan,
+                                                 mcaIndex=mcaIndex,
+                                                 derivatives=derivatives,
+                                                 results=results,
+                                                 uncertainties=uncertainties,
+                                                 fitmodel=fitmodel,
+                                                 config=config,
+                                                 anchorslist=anchorslist,
+                                                 lstsq_kwargs=lstsq_kwargs,
+                                                 nworkers=nworkers,
+                                                 writer=writer)
+            _logger.warning("Parallel fitting not supported for data of type %s",
+                            type(data))
         nChan, nFree = derivatives.shape
         bkgsub = bool(config['fit']['stripflag'])
 
-        nMca = 1, 'MB'
-        _logger.debug('Fit spectra in chunks of {}'.format(nMca))
-        chunkItems = self._dataChunkIter(McaStackView.FullView,
-                                         data=data,
-                                         fitmodel=fitmodel,
-                                         mcaSlice=sliceChan,
-                                         mcaAxis=mcaIndex,
-                                         nMca=nMca)
-        for chunk in chunkItems:
-            if fitmodel is None:
-                (idx, idxShape), chunk = chunk
+        datastack = self._fitDataView(data, sliceChan, mcaIndex)
+        _logger.debug('Fit spectra in chunks of {}'.format(datastack.nMca))
+        chunkIndex = datastack.chunkIndex()
+        # the model is written for all channels (NaN when not fitted)
+        # so that complete HDF5 chunks are written
+        modelstack = self._fitModelView(fitmodel, datastack, writer=writer)
+        if modelstack is None:
+            modelIndex = [None] * len(chunkIndex)
+        else:
+            modelIndex = modelstack.chunkIndex()
+        for dataChunkIndex, modelChunkIndex in zip(chunkIndex, modelIndex):
+            (idx, idxShape), chunk = datastack.getItem(dataChunkIndex,
+                                                       keyType='select')
+            if modelstack is None:
                 chunkModel = None
             else:
-                ((idx, idxShape), chunk), (_, chunkModel) = chunk
-                chunkModel = chunkModel.T
+                modelChunk = numpy.full((chunk.shape[0], modelstack.nChan),
+                                        numpy.nan, dtype=chunk.dtype)
+                chunkModel = modelChunk[:, sliceChan].T
             chunk = chunk.T
 
-            # Subtract background
-            if bkgsub:
-                self._fitBkgSubtract(chunk, config=config,
-                                     anchorslist=anchorslist,
-                                     fitmodel=chunkModel)
-
-            # Solve linear system of equations
-            ddict = lstsq(derivatives, chunk, digested_output=True,
-                          **lstsq_kwargs)
-            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+            # Fit the chunk
+            ddict = self._fitLstSqChunk(chunk, chunkModel=chunkModel,
+                                        derivatives=derivatives,
+                                        config=config, bkgsub=bkgsub,
+                                        anchorslist=anchorslist,
+                                        lstsq_kwargs=lstsq_kwargs)
 
             # Save results
             idx = (slice(None),) + idx
             idxShape = (nFree,) + idxShape
             results[idx] = ddict['parameters'].reshape(idxShape)
             uncertainties[idx] = ddict['uncertainties'].reshape(idxShape)
-            if chunkModel is not None:
-                if bkgsub:
-                    chunkModel += numpy.dot(derivatives, ddict['parameters'])
-                else:
-                    chunkModel[()] = numpy.dot(derivatives, ddict['parameters'])
+            if modelstack is not None:
+                modelstack.setItem(modelChunkIndex, modelChunk)
+
+    def _fitLstSqAllParallel(self, data=None, sliceChan=None, mcaIndex=None,
+                             derivatives=None, results=None, uncertainties=None,
+                             fitmodel=None, config=None, anchorslist=None,
+                             lstsq_kwargs=None, nworkers=None, writer=None):
+        """
+        Fit all spectra with a pool of worker processes. Each worker reads
+        its own chunks from the source and fits them with the same SVD of
+        the model matrix. The chunks are identical to those of the serial
+        fit so the results are identical as well.
+        """
+        nChan, nFree = derivatives.shape
+        datastack = self._fitDataView(data, sliceChan, mcaIndex)
+        nMca = datastack.nMca
+        viewkwargs = {'mcaSlice': sliceChan, 'mcaAxis': mcaIndex,
+                      'nMca': nMca, 'dtype': datastack.dtype}
+
+        # Model matrix decomposition shared by all workers
+        lstsq_kwargs = dict(lstsq_kwargs)
+        if lstsq_kwargs.get('last_svd', None) is None:
+            ddict = lstsq(derivatives, numpy.zeros((nChan, 1)),
+                          digested_output=True, **lstsq_kwargs)
+            lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+
+        chunkIndex = datastack.chunkIndex()
+        modelstack = self._fitModelView(fitmodel, datastack, writer=writer)
+        if modelstack is not None:
+            modelIndex = modelstack.chunkIndex()
+        _logger.debug('Fit %d chunks of %s with %d processes',
+                      len(chunkIndex), nMca, nworkers)
+
+        initargs = (_parallelDataSource(data), viewkwargs,
+                    derivatives, config, anchorslist, lstsq_kwargs,
+                    fitmodel is not None)
+        pool = multiprocessing.Pool(processes=nworkers,
+                                    initializer=_fitLstSqWorkerInit,
+                                    initargs=initargs)
+        try:
+            tasks = enumerate(chunkIndex)
+            chunksize = max(len(chunkIndex)//(4*nworkers), 1)
+            for i, parameters, sigmas, chunkModel in \
+                    pool.imap_unordered(_fitLstSqWorker, tasks,
+                                        chunksize=chunksize):
+                idx, idxShape = datastack.getKey(chunkIndex[i],
+                                                 keyType='select')
+                idx = (slice(None),) + idx
+                idxShape = (nFree,) + idxShape
+                results[idx] = parameters.reshape(idxShape)
+                uncertainties[idx] = sigmas.reshape(idxShape)
+                if modelstack is not None:
+                    modelChunk = numpy.full((chunkModel.shape[1],
+                                             modelstack.nChan),
+                                            numpy.nan, dtype=chunkModel.dtype)
+                    modelChunk[:, sliceChan] = chunkModel.T
+                    modelstack.setItem(modelIndex[i], modelChunk)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    @staticmethod
+    def _fitLstSqChunk(chunk, chunkModel=None, derivatives=None, config=None,
+                       bkgsub=False, anchorslist=None, lstsq_kwargs=None):
+        """
+        Fit one chunk of spectra (nChan x nMca) and fill the chunk model
+        """
+        # Subtract background
+        if bkgsub:
+            FastXRFLinearFit._fitBkgSubtract(chunk, config=config,
+                                             anchorslist=anchorslist,
+                                             fitmodel=chunkModel)
+
+        # Solve linear system of equations
+        ddict = lstsq(derivatives, chunk, digested_output=True,
+                      **lstsq_kwargs)
+        lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+
+        # Add peaks to the background
+        if chunkModel is not None:
+            if bkgsub:
+                chunkModel += numpy.dot(derivatives, ddict['parameters'])
+            else:
+                chunkModel[()] = numpy.dot(derivatives, ddict['parameters'])
+        return ddict
 
     def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                          derivatives=None, results=None, uncertainties=None,
@@ -686,16 +861,12 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                     chunkModel = chunkModel.T
                 chunk = chunk.T
 
-                # Subtract background
-                if bkgsub:
-                    self._fitBkgSubtract(chunk, config=config,
-                                         anchorslist=anchorslist,
-                                         fitmodel=chunkModel)
-
-                # Solve linear system of equations
-                ddict = lstsq(A, chunk, digested_output=True,
-                              **lstsq_kwargs)
-                lstsq_kwargs['last_svd'] = ddict.get('svd', None)
+                # Fit the chunk
+                ddict = self._fitLstSqChunk(chunk, chunkModel=chunkModel,
+                                            derivatives=A,
+                                            config=config, bkgsub=bkgsub,
+                                            anchorslist=anchorslist,
+                                            lstsq_kwargs=lstsq_kwargs)
 
                 # Save results
                 iParam = 0
@@ -709,11 +880,6 @@ def _fitLstSqReduced(self, data=None, sliceChan=None, mcaIndex=None,
                         uncertainties[iFree][idx] = ddict['uncertainties'][iParam]\
                                                 .reshape(idxShape)
                         iParam += 1
-                if chunkModel is not None:
-                    if bkgsub:
-                        chunkModel += numpy.dot(A, ddict['parameters'])
-                    else:
-                        chunkModel[()] = numpy.dot(A, ddict['parameters'])
                 if nFreeParameters is not None:
                     nFreeParameters[idx] = nFree
 
@@ -736,26 +902,14 @@ def _fitDtypeCalculation(data):
     def _fitBkgSubtract(spectra, config=None, anchorslist=None, fitmodel=None):
         """Subtract brackground from data and add it to fit model
         """
-        for k in range(spectra.shape[1]):
-            # obtain the smoothed spectrum
-            background = SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                    config['fit']['stripfilterwidth'])
-            lastAnchor = 0
-            for anchor in anchorslist:
-                if (anchor > lastAnchor) and (anchor < background.size):
-                    background[lastAnchor:anchor] =\
-                            SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                               config['fit']['snipwidth'],
-                                               0)
-                    lastAnchor = anchor
-            if lastAnchor < background.size:
-                background[lastAnchor:] =\
-                        SpecfitFuns.snip1d(background[lastAnchor:],
-                                           config['fit']['snipwidth'],
-                                           0)
-            spectra[:, k] -= background
-            if fitmodel is not None:
-                fitmodel[:, k] = background
+        # smoothed spectra + SNIP in between the anchors
+        background = SpecfitFuns.snip1dbackground(spectra.T,
+                                    config['fit']['snipwidth'],
+                                    sgwidth=config['fit']['stripfilterwidth'],
+                                    anchors=anchorslist).T
+        spectra -= background
+        if fitmodel is not None:
+            fitmodel[()] = background
 
     def _fitLstSqNegative(self, data=None, freeNames=None, nFreeBkg=None,
                           results=None, **kwargs):
@@ -955,6 +1109,71 @@ def _fitDeriveMassFractions(self, config=None, results=None, nFreeBkg=None,
         return labels, massFractions
 
 
+# State of a worker process of FastXRFLinearFit._fitLstSqAllParallel
+_workerState = {}
+
+
+def _parallelDataSource(data):
+    """
+    Description of the data that allows a worker process to
+    access it (None when not supported)
+    """
+    if isinstance(data, h5py.Dataset):
+        # Each worker opens the file itself
+        return 'hdf5', (data.file.filename, data.name)
+    elif isinstance(data, numpy.ndarray):
+        # Inherited by the workers (pickled on platforms without fork)
+        return 'ndarray', data
+    elif isinstance(data, HDF5Stack1D.VirtualStack):
+        # Each worker maps the source files again
+        return 'virtual', pickle.dumps(data, protocol=2)
+    else:
+        return None
+
+
+def _fitLstSqWorkerInit(source, viewkwargs, derivatives, config,
+                        anchorslist, lstsq_kwargs, withModel):
+    sourcetype, data = source
+    if sourcetype == 'hdf5':
+        filename, name = data
+        h5file = h5py.File(filename, mode='r')
+        _workerState['h5file'] = h5file
+        data = h5file[name]
+    elif sourcetype == 'virtual':
+        data = pickle.loads(data)
+    _workerState['datastack'] = McaStackView.FullView(data, readonly=True,
+                                                      **viewkwargs)
+    _workerState['derivatives'] = derivatives
+    _workerState['config'] = config
+    _workerState['anchorslist'] = anchorslist
+    _workerState['lstsq_kwargs'] = lstsq_kwargs
+    _workerState['bkgsub'] = bool(config['fit']['stripflag'])
+    _workerState['withModel'] = withModel
+
+
+def _fitLstSqWorker(task):
+    """
+    Fit one chunk in a worker process
+
+    :param tuple task: chunk number, chunk index (see McaStackView.chunkIndex)
+    :returns tuple: chunk number, parameters, uncertainties, model (or None)
+    """
+    i, chunkIndex = task
+    _, chunk = _workerState['datastack'].getItem(chunkIndex)
+    chunk = chunk.T
+    if _workerState['withModel']:
+        chunkModel = numpy.zeros(chunk.shape, dtype=chunk.dtype)
+    else:
+        chunkModel = None
+    ddict = FastXRFLinearFit._fitLstSqChunk(chunk, chunkModel=chunkModel,
+                                    derivatives=_workerState['derivatives'],
+                                    config=_workerState['config'],
+                                    bkgsub=_workerState['bkgsub'],
+                                    anchorslist=_workerState['anchorslist'],
+                                    lstsq_kwargs=_workerState['lstsq_kwargs'])
+    return i, ddict['parameters'], ddict['uncertainties'], chunkModel
+
+
 def getFileListFromPattern(pattern, begin, end, increment=None):
     if type(begin) == type(1):
         begin = [begin]
@@ -1033,7 +1252,8 @@ def main():
                    'tif=', 'edf=', 'csv=', 'h5=', 'dat=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
                    'outroot=', 'outentry=', 'outprocess=',
-                   'diagnostics=', 'debug=', 'overwrite=', 'multipage=']
+                   'diagnostics=', 'debug=', 'overwrite=', 'multipage=',
+                   'nworkers=', 'compression=']
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -1063,6 +1283,8 @@ def main():
     debug = 0
     overwrite = 1
     multipage = 0
+    nworkers = None
+    compression = None
     for opt, arg in opts:
         if opt == '--cfg':
             configurationFile = arg
@@ -1116,6 +1338,10 @@ def main():
             overwrite = int(arg)
         elif opt == '--multipage':
             multipage = int(arg)
+        elif opt == '--nworkers':
+            nworkers = int(arg)
+        elif opt == '--compression':
+            compression = arg
 
     logging.basicConfig()
     if debug:
@@ -1154,7 +1380,8 @@ def main():
                              tif=tif, edf=edf, csv=csv,
                              h5=h5, dat=dat,
                              multipage=multipage,
-                             overwrite=overwrite)
+                             overwrite=overwrite,
+                             compression=compression)
 
     from PyMca5.PyMcaMisc import ProfilingUtils
     with ProfilingUtils.profile(memory=debug, time=debug):
@@ -1163,7 +1390,8 @@ def main():
                                                 weight=weight,
                                                 refit=refit,
                                                 concentrations=concentrations,
-                                                outbuffer=outbuffer)
+                                                outbuffer=outbuffer,
+                                                nworkers=nworkers)
         print("Total Elapsed = % s " % (time.time() - t0))
 
 
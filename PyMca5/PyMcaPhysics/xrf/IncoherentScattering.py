@@ -34,6 +34,7 @@
 import numpy
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import PyMcaDataDir
+from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
 
 ElementList= ['H','He','Li','Be','B','C','N','O','F','Ne',
               'Na','Mg','Al','Si','P','S','Cl','Ar','K','Ca','Sc','Ti','V','Cr','Mn','Fe','Co','Ni','Cu','Zn',
@@ -62,8 +63,12 @@
         print("Cannot find file ", ffile)
         raise IOError("Cannot find file %s" % ffile)
 
-COEFFICIENTS = ConfigDict.ConfigDict()
-COEFFICIENTS.read(ffile)
+COEFFICIENTS = None
+if PhysicsDatabase.getDatabase() is not None:
+    COEFFICIENTS = PhysicsDatabase.getDatabase().get("IncoherentScattering")
+if COEFFICIENTS is None:
+    COEFFICIENTS = ConfigDict.ConfigDict()
+    COEFFICIENTS.read(ffile)
 xvalues = COEFFICIENTS['ISCADT']['XSVAL']
 svalues = numpy.reshape(COEFFICIENTS['ISCADT']['SCATF'], (100, len(xvalues)))
 #svalues = COEFFICIENTS['ISCADT']['SCATF']
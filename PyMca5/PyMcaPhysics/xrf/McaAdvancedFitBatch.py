@@ -33,11 +33,13 @@
 import sys
 import os
 import time
+import hashlib
 import logging
 import numpy
 from . import ClassMcaTheory
 from PyMca5.PyMcaCore import SpecFileLayer
 from PyMca5.PyMcaCore import EdfFileLayer
+from PyMca5.PyMcaCore import McaStackView
 from PyMca5.PyMcaIO import EdfFile
 from PyMca5.PyMcaIO import LuciaMap
 from PyMca5.PyMcaIO import AifiraMap
@@ -118,7 +120,8 @@ def __init__(self, initdict, filelist=None, outputdir=None,
                  mcaoffset=0, chunk=None,
                  selection=None, lock=None, nosave=None,
                  quiet=False, outbuffer=None,
-                 **outbufferkwargs):
+                 readbuffer=None, warmstart=False, checkpoint=None,
+                 rows=None, **outbufferkwargs):
         """
         Range of filelist indices to be processed:
 
@@ -132,6 +135,33 @@ def __init__(self, initdict, filelist=None, outputdir=None,
 
             range(mcaoffset, nColumns, mcastep)
 
+        Stacks are read row by row. When the stack is not in memory
+        (e.g. an HDF5 dataset) the next rows are read in the background
+        while fitting. `readbuffer` is the maximal memory (in MB) used
+        for this read-ahead (default: depends on the available memory).
+
+        With `warmstart` the parameters of the first spectrum of each row
+        are estimated as usual. The other spectra of the row start from the
+        fitted parameters of that spectrum, which skips the estimation.
+        Starting from the previous spectrum instead would let poorly
+        determined parameters drift along the row.
+
+        With `checkpoint` (minimal time in seconds between checkpoints)
+        the output buffer and the mask of the fitted spectra are saved
+        regularly during the processing. When the processing is
+        interrupted, running it again with the same configuration and
+        files resumes from the last checkpoint: the fitted spectra are
+        not fitted again (no need for the .fit files).
+
+        With `rows=(start, stop)` only these rows of the map are processed
+        (one row is one file or one row of a stack). The output buffer then
+        only contains these rows.
+
+        The other keyword arguments are passed to the output buffer. When
+        several processes fit parts of the same map (`chunk`), passing the
+        same `sharedDir` to all of them lets them fill the same
+        memory-mapped buffers instead of writing partial outputs. These are
+        saved once with `OutputBuffer.saveSharedBuffers` afterwards.
         """
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
@@ -157,6 +187,15 @@ def __init__(self, initdict, filelist=None, outputdir=None,
         self.mcaStep = mcastep
         self.mcaOffset = mcaoffset
         self.chunk = chunk
+        self.readBuffer = readbuffer
+        self.warmStart = warmstart
+        self._warmStartParameters = None
+        self.checkpoint = checkpoint
+        self.rows = rows
+        self._processed = None
+        self._checkpointTime = 0
+        self._signature = None
+        self._fitStatistics = {'nfit': 0, 'nwarm': 0, 'niter': 0, 'time': 0.}
 
         if isinstance(initdict, list):
             self.mcafit = ClassMcaTheory.McaTheory(initdict[mcaoffset])
@@ -224,7 +263,9 @@ def _outputSuffix(self):
         #if (self.fileStep > 1) or (self.mcaStep > 1):
         #    suffix += "_filestep_%02d_mcastep_%02d" %\
         #                (self.fileStep, self.mcaStep)
-        if self.chunk is not None:
+        if self.chunk is not None and \
+           not self.outbufferkwargs.get('sharedDir', None):
+            # Shared buffers are saved once: no partial output to merge
             suffix += "_%06d_partial" % self.chunk
         return suffix
 
@@ -253,17 +294,101 @@ def processList(self):
         if self.outbuffer is None:
             self._processList()
         else:
-            with self.outbuffer.saveContext():
-                self._processList()
+            resume = False
+            if self._checkpointing:
+                self._signature = self._checkpointSignature()
+                resume = self.outbuffer.hasCheckpoint(signature=self._signature)
+            # Resuming updates the HDF5 output of the interrupted processing
+            with self.outbuffer.saveContext(update=resume):
+                self._processList(resume=resume)
+            if self._checkpointing and not self.pleaseBreak:
+                self.outbuffer.removeCheckpoint()
         self.onEnd()
 
-    def _processList(self):
+    @property
+    def _checkpointing(self):
+        return self.checkpoint is not None and self.outbuffer is not None
+
+    def _checkpointSignature(self):
+        """
+        A checkpoint can only be resumed by the same processing
+        """
+        items = [self.roiFit, self.roiWidth, self._concentrations,
+                 self.selection, self.fileBeginOffset, self.fileEndOffset,
+                 self.fileStep, self.mcaOffset, self.mcaStep, self.rows]
+        for item in self._filelist:
+            if isinstance(item, numpy.ndarray):
+                items.append((item.shape, item.dtype.str))
+            else:
+                items.append(item)
+        signature = repr(items) + self.mcafit.getConfiguration().tostring()
+        return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+    def _saveCheckpoint(self):
+        if self._processed is None:
+            return
+        self.outbuffer.saveCheckpoint(self._processed,
+                                      signature=self._signature)
+        self._checkpointTime = time.time()
+
+    def _updateCheckpoint(self):
+        if not self._checkpointing or not self.outbuffer.hasAllocatedMemory():
+            return
+        if self._processed is None:
+            self._processed = numpy.zeros((self._nOutputRows(), self.__ncols),
+                                          dtype=bool)
+        self._processed[self.__irow, self.__col] = True
+        if (time.time() - self._checkpointTime) >= self.checkpoint:
+            self._saveCheckpoint()
+
+    def _rowRange(self, nrows):
+        """
+        Rows of the map to be processed
+        """
+        if self.rows is None:
+            return 0, nrows
+        start, stop = self.rows
+        return max(start, 0), min(stop, nrows)
+
+    def _inRows(self, row):
+        if self.rows is None:
+            return True
+        return self.rows[0] <= row < self.rows[1]
+
+    def _nOutputRows(self):
+        start, stop = self._rowRange(self.__nrows)
+        return stop - start
+
+    def _restoreOutputInfo(self):
+        """
+        Information needed to store results, normally obtained when
+        allocating the output buffer
+        """
+        outbuffer = self.outbuffer
+        if 'molarconcentrations' in outbuffer:
+            self._concentration_key = 'molarconcentrations'
+            self.__conKey = "mmolar"
+        elif 'massfractions' in outbuffer:
+            self._concentration_key = 'massfractions'
+            self.__conKey = "mass fraction"
+        # depends on the fit limits (see _storeFitResult)
+        self._mcaIdx = None
+
+    def _processList(self, resume=False):
         # Initialize list processing variables
         self.counter = 0  # spectrum counter
         self.__ncols = 0
         self.__nrows = 0
         self.__stack = None
         self._fitlistfile = None
+        self._fitStatistics = {'nfit': 0, 'nwarm': 0, 'niter': 0, 'time': 0.}
+        self._processed = None
+        if resume:
+            # mask of the spectra fitted before the interruption
+            self._processed = self.outbuffer.loadCheckpoint(signature=self._signature)
+            if self._processed is not None:
+                self._restoreOutputInfo()
+        self._checkpointTime = time.time()
 
         # Loop over the files in filelist (1 file = 1 row in image)
         start = self.fileBeginOffset
@@ -278,9 +403,14 @@ def _processList(self):
                         #       Only the first one is saved.
             self.mcafit.enableOptimizedLinearFit()  # TODO: why????
 
+            if self.__stack is False and not self._inRows(i):
+                # one file is one row of the map
+                continue
+
             # Load file
             inputfile = self._filelist[i]
             self.__row = i
+            self._warmStartParameters = None
             self.onNewFile(inputfile, self._filelist)
             self.filehandle = self.getFileHandle(inputfile)
             if self.pleaseBreak:
@@ -292,6 +422,9 @@ def _processList(self):
                         if self.filehandle.info["SourceType"] in\
                         ["EdfFileStack", "HDF5Stack1D"]:
                             self.__stack = True
+            if not self.__stack and not self._inRows(i):
+                self.filehandle = None
+                continue
 
             # Fit spectra in current file
             if self.__stack:
@@ -310,12 +443,26 @@ def _processList(self):
             # Needed for cleanup
             self.filehandle = None
 
+        if self.pleaseBreak and self._checkpointing:
+            self._saveCheckpoint()
+
         if self.counter:
             # Finish list of FIT files
             if not self.roiFit and self.fitFiles and \
                 self._fitlistfile is not None:
                     self._fitlistfile.write(']\n')
                     self._fitlistfile.close()
+        self._logFitStatistics()
+
+    def _logFitStatistics(self):
+        stats = self._fitStatistics
+        nfit = stats['nfit']
+        if not nfit:
+            return
+        _logger.info("%d spectra fitted (%d warm started): "
+                     "%.1f iterations and %.1f ms per spectrum",
+                     nfit, stats['nwarm'], stats['niter'] / float(nfit),
+                     1000 * stats['time'] / nfit)
 
     def getFileHandle(self, inputfile):
         try:
@@ -448,16 +595,27 @@ def __processStack(self):
         for i in range(nrows):
             keylist[i] = "1.%04d" % i
 
-        for i in range(nrows):
+        if self.readBuffer:
+            nbytes = int(self.readBuffer * 1024**2)
+        else:
+            nbytes = None
+        first, stop = self._rowRange(nrows)
+        start = first
+        if self._processed is not None:
+            # skip the rows fitted before the interruption
+            while start < stop and \
+                  self._processed[start - first, mcaIndices].all():
+                start += 1
+        rows = McaStackView.ReadAheadRows(data, nbytes=nbytes,
+                                          start=start, stop=stop)
+        for i, cache_data in rows:
             if self.pleaseBreak:
                 break
             self.onImage(keylist[i], keylist)
             self.__row = i
-            try:
-                cache_data = data[i, :, :]
-            except:
-                _logger.error("Error reading dataset row %d" % i)
-                _logger.error(str(sys.exc_info()))
+            self._warmStartParameters = None
+            if cache_data is None:
+                # error already logged by the reader
                 _logger.error("Batch resumed")
                 continue
             for imca, mcaIndex in enumerate(mcaIndices):
@@ -655,6 +813,12 @@ def os_path_join(self, a, b):
     def __processOneMca(self,x,y,filename,key,info=None):
         if not self.__nrows:
             self.__nrows = len(self._filelist)
+        # row in the output buffer
+        self.__irow = self.__row - self._rowRange(self.__nrows)[0]
+        if self._processed is not None and \
+           self._processed[self.__irow, self.__col]:
+            # restored from a checkpoint
+            return
         bOutput = self.outbuffer is not None and \
                   self.__ncols and self.__nrows
         if self.roiFit:
@@ -679,6 +843,7 @@ def __processOneMca(self,x,y,filename,key,info=None):
                 else:
                     self._storeFitResult(result, concentrations)
         self.counter += 1
+        self._updateCheckpoint()
 
     def __fitOneMca(self,x,y,filename,key,info=None):
         fitresult = None
@@ -766,8 +931,13 @@ def _fitMca(self, filename):
         result = None
         concentrations = None
         fitresult = None
+        t0 = time.time()
         try:
-            self.mcafit.estimate()
+            if self.warmStart:
+                warm = self.mcafit.warmStartEstimate(self._warmStartParameters)
+            else:
+                self.mcafit.estimate()
+                warm = False
             # Avoid digest=1 when possible (slow but more detailed information)
             digest = self.fitFiles or\
                      (self._concentrations and (self.mcafit._fluoRates is None))
@@ -803,7 +973,16 @@ def _fitMca(self, filename):
                 #just images
                 fitresult = self.mcafit.startfit(digest=0)
         except:
+            self._warmStartParameters = None
             self._restoreFitConfig(filename, 'fitting data')
+        else:
+            if self.warmStart and not warm:
+                self._warmStartParameters = self.mcafit.fittedpar
+            stats = self._fitStatistics
+            stats['nfit'] += 1
+            stats['nwarm'] += warm
+            stats['niter'] += self.mcafit.getLastNumberOfIterations()
+            stats['time'] += time.time() - t0
         return fitresult, result, concentrations
 
     def _concentrationsFromResult(self, fitresult, result):
@@ -895,8 +1074,9 @@ def _allocateMemoryFit(self, result, concentrations):
         # Fit parameters and their uncertainties
         labels = result['groups']
         nFree = len(labels)
-        imageShape = self.__nrows, self.__ncols
-        paramShape = nFree, self.__nrows, self.__ncols
+        nrows = self._nOutputRows()
+        imageShape = nrows, self.__ncols
+        paramShape = nFree, nrows, self.__ncols
         dtypeResult = numpy.float32
         dataAttrs = {} #{'units':'counts'}
         paramAttrs = {'errors': 'uncertainties', 'default': not self._concentrations}
@@ -934,7 +1114,7 @@ def _allocateMemoryFit(self, result, concentrations):
                             for group in concentrations['groups']
                             for layer in layerlist]
             nConcFree = len(concentrations['groups'])
-            paramShape = nConcFree, self.__nrows, self.__ncols
+            paramShape = nConcFree, nrows, self.__ncols
             outbuffer.allocateMemory(concentration_key,
                                      shape=paramShape,
                                      dtype=dtypeResult,
@@ -948,7 +1128,7 @@ def _allocateMemoryFit(self, result, concentrations):
         if outbuffer.diagnostics:
             xdata0 = self.mcafit.xdata0.flatten().astype(numpy.int32)  # channels
             xdata = self.mcafit.xdata.flatten().astype(numpy.int32)  # channels after limits
-            stackShape = self.__nrows, self.__ncols, len(xdata0)
+            stackShape = nrows, self.__ncols, len(xdata0)
             mcaIndex = 2
             iXMin, iXMax = xdata[0], xdata[-1]+1
             self._mcaIdx = slice(iXMin, iXMax)
@@ -1045,23 +1225,26 @@ def _storeFitResult(self, result, concentrations):
         output = outbuffer['parameters']
         outputs = outbuffer['uncertainties']
         for i, group in enumerate(outbuffer.labels('parameters')):
-            output[i, self.__row, self.__col] = result[group]['fitarea']
-            outputs[i, self.__row, self.__col] = result[group]['sigmaarea']
+            output[i, self.__irow, self.__col] = result[group]['fitarea']
+            outputs[i, self.__irow, self.__col] = result[group]['sigmaarea']
         # Concentrations
         if self._concentrations:
             output = outbuffer[self._concentration_key]
             for i, label in enumerate(outbuffer.labels(self._concentration_key)):
                 if isinstance(label, tuple):
                     group, layer = label
-                    output[i, self.__row, self.__col] = concentrations[layer][self.__conKey][group]
+                    output[i, self.__irow, self.__col] = concentrations[layer][self.__conKey][group]
                 else:
-                    output[i, self.__row, self.__col] = concentrations[self.__conKey][label]
+                    output[i, self.__irow, self.__col] = concentrations[self.__conKey][label]
         # Diagnostics: model, residuals, chisq ,...
         if outbuffer.diagnostics:
             if outbuffer.saveFOM:
-                outbuffer['chisq'][self.__row, self.__col] = result['chisq']
-            idx = self.__row, self.__col, self._mcaIdx
-            idxall = self.__row, self.__col, slice(None)
+                outbuffer['chisq'][self.__irow, self.__col] = result['chisq']
+            if self._mcaIdx is None:
+                xdata = self.mcafit.xdata.flatten().astype(numpy.int32)
+                self._mcaIdx = slice(xdata[0], xdata[-1]+1)
+            idx = self.__irow, self.__col, self._mcaIdx
+            idxall = self.__irow, self.__col, slice(None)
             if outbuffer.saveFit:
                 output = outbuffer['model']
                 output[idx] = result['yfit']
@@ -1080,7 +1263,7 @@ def _allocateMemoryRoiFit(self, result):
                   for group, rois in result.items()
                   for roi in rois]
         nFree = len(labels)
-        paramShape = nFree, self.__nrows, self.__ncols
+        paramShape = nFree, self._nOutputRows(), self.__ncols
         dtypeResult = numpy.float32
         dataAttrs = {} #{'units':'counts'}
         groupAttrs = {'default': True}
@@ -1097,7 +1280,7 @@ def _storeRoiFitResult(self, result):
         output = outbuffer['roi']
         for i, label in enumerate(outbuffer.labels('roi')):
             group, roi = label
-            output[i, self.__row, self.__col] = result[group][roi+' ROI']
+            output[i, self.__irow, self.__col] = result[group][roi+' ROI']
 
 
 def main():
@@ -1107,7 +1290,8 @@ def main():
                    'roiwidth=', 'concentrations=', 'overwrite=',
                    'outroot=', 'outentry=', 'outprocess=',
                    'edf=', 'h5=', 'csv=', 'tif=', 'dat=',
-                   'diagnostics=', 'debug=', 'multipage=']
+                   'diagnostics=', 'debug=', 'multipage=',
+                   'readbuffer=', 'warmstart=', 'checkpoint=']
     filelist = None
     cfg = None
     roifit = 0
@@ -1126,6 +1310,9 @@ def main():
     outputRoot = ""
     fileEntry = ""
     fileProcess = ""
+    readbuffer = None
+    warmstart = 0
+    checkpoint = None
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -1173,6 +1360,12 @@ def main():
             dat = int(arg)
         elif opt == '--multipage':
             multipage = int(arg)
+        elif opt == '--readbuffer':
+            readbuffer = float(arg)
+        elif opt == '--warmstart':
+            warmstart = int(arg)
+        elif opt == '--checkpoint':
+            checkpoint = float(arg)
 
     logging.basicConfig()
     if debug:
@@ -1205,7 +1398,10 @@ def main():
                                 roiwidth=roiwidth,
                                 concentrations=concentrations,
                                 outbuffer=outbuffer,
-                                overwrite=overwrite)
+                                overwrite=overwrite,
+                                readbuffer=readbuffer,
+                                warmstart=warmstart,
+                                checkpoint=checkpoint)
         b.processList()
         print("Total Elapsed = % s " % (time.time() - t0))
 
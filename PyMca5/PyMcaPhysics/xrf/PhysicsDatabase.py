@@ -0,0 +1,376 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Precompiled binary version of the physical data read by the Elements,
+PyMcaEPDL97, Scofield1973 and scattering modules.
+
+Parsing the text data files and building the Elements dictionary takes
+a significant fraction of the time needed to start a fitting process.
+The database keeps the result in a single file. Every entry is stored
+as JSON, which cannot execute code when read, and its arrays are stored
+uncompressed and memory mapped on reading, so that they are not copied
+and only the pages actually used are read from disk.
+
+The database is built once with::
+
+    python -m PyMca5.PyMcaPhysics.xrf.PhysicsDatabase [filename]
+
+It is only used when the PYMCA_CACHE_DIR environment variable is set,
+from the directory it gives. The database is ignored when it was written
+by another version of this module or when any of the data files it was
+built from has changed.
+"""
+import os
+import sys
+import mmap
+import struct
+import logging
+import json
+import tempfile
+import numpy
+
+import PyMca5
+from PyMca5 import PyMcaDataDir
+from PyMca5 import getDataFile
+
+_logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 2
+MAGIC = b"PYMCADB2"
+FILENAME = "PhysicsDatabase.bin"
+ALIGNMENT = 64
+
+DATA_FILES = ["BindingEnergies.dat",
+              "KShellRates.dat",
+              "KShellConstants.dat",
+              "LShellRates.dat",
+              "LShellConstants.dat",
+              "EADL97_LShellConstants.dat",
+              "MShellRates.dat",
+              "MShellConstants.dat",
+              "EADL97_MShellConstants.dat",
+              "Scofield1973.dict",
+              "EPDL97_CrossSections.dat",
+              "EADL97_BindingEnergies.dat"]
+
+MODULES = ["Elements", "PyMcaEPDL97", "Scofield1973", "BindingEnergies",
+           "KShell", "LShell", "MShell",
+           "CoherentScattering", "IncoherentScattering", "PhysicsDatabase"]
+
+_database = None
+_databaseInitialized = False
+
+# JSON objects standing for the values JSON does not have
+_TAGS = ["__array__", "__scalar__", "__tuple__", "__ConfigDict__",
+         "__dict__"]
+
+
+class PhysicsDatabase(object):
+    """
+    Read access to a database file written by :func:`build`.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not a physics database" % filename)
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        offset, = struct.unpack("<Q",
+                        self._buffer[len(MAGIC):len(MAGIC) + 8])
+        index = json.loads(self._buffer[offset:].decode("utf-8"))
+        self.version = index["version"]
+        # JSON has no tuples
+        self.sources = [index["sources"][0]] + \
+                       [tuple(item) for item in index["sources"][1:]]
+        self._entries = index["entries"]
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """
+        :param str name:
+        :returns: a new copy of the entry or None when not present.
+            Its arrays are memory mapped copy-on-write: modifying them
+            does not change the file but it is seen by the entries read
+            later on by the same process.
+        """
+        if name not in self._entries:
+            return None
+        offset, nbytes = self._entries[name]
+        text = self._buffer[offset:offset + nbytes].decode("utf-8")
+        return json.loads(text, object_hook=self._decode)
+
+    def isValid(self):
+        """
+        :returns bool: True when built by this version of PyMca from the
+            current data files
+        """
+        return self.version == FORMAT_VERSION and \
+               self.sources == getSources()
+
+    def _decode(self, obj):
+        if len(obj) != 1:
+            return obj
+        tag, value = list(obj.items())[0]
+        if tag == "__array__":
+            return self._loadArray(*value)
+        elif tag == "__scalar__":
+            return _numericDtype(value[0]).type(value[1])
+        elif tag == "__tuple__":
+            return tuple(value)
+        elif tag == "__ConfigDict__":
+            from PyMca5.PyMcaIO import ConfigDict
+            cDict = ConfigDict.ConfigDict()
+            cDict.update(value)
+            return cDict
+        elif tag == "__dict__":
+            return value
+        return obj
+
+    def _loadArray(self, dtype, shape, offset):
+        dtype = _numericDtype(dtype)
+        shape = tuple(shape)
+        count = int(numpy.prod(shape))
+        if count == 0:
+            return numpy.zeros(shape, dtype=dtype)
+        array = numpy.frombuffer(self._buffer, dtype=dtype,
+                                 count=count, offset=offset)
+        array.shape = shape
+        return array
+
+
+def _numericDtype(dtype):
+    dtype = numpy.dtype(str(dtype))
+    if dtype.kind not in "biufc":
+        raise TypeError("Unexpected data type %s" % dtype)
+    return dtype
+
+
+class _Writer(object):
+    def __init__(self, f):
+        self._file = f
+        self._file.write(MAGIC)
+        self._file.write(struct.pack("<Q", 0))
+        self._entries = {}
+
+    def _align(self):
+        padding = (-self._file.tell()) % ALIGNMENT
+        if padding:
+            self._file.write(b"\0" * padding)
+
+    def _saveArray(self, obj):
+        _numericDtype(obj.dtype)
+        self._align()
+        offset = self._file.tell()
+        self._file.write(numpy.ascontiguousarray(obj).tobytes())
+        return {"__array__": [obj.dtype.str, list(obj.shape), offset]}
+
+    def _encode(self, obj):
+        """
+        JSON compatible version of obj, its arrays are written to the file
+        """
+        if isinstance(obj, numpy.ndarray):
+            return self._saveArray(obj)
+        elif isinstance(obj, numpy.generic):
+            return {"__scalar__": [_numericDtype(obj.dtype).str,
+                                   obj.item()]}
+        elif isinstance(obj, (bool, int, float, str)) or obj is None:
+            return obj
+        elif isinstance(obj, list):
+            return [self._encode(item) for item in obj]
+        elif isinstance(obj, tuple):
+            return {"__tuple__": [self._encode(item) for item in obj]}
+        elif isinstance(obj, dict):
+            ddict = {}
+            for key, value in obj.items():
+                if not isinstance(key, str):
+                    raise TypeError("Unsupported key %r" % (key,))
+                ddict[key] = self._encode(value)
+            if type(obj) is not dict:
+                from PyMca5.PyMcaIO import ConfigDict
+                if type(obj) is not ConfigDict.ConfigDict:
+                    raise TypeError("Unsupported type %s" % type(obj))
+                return {"__ConfigDict__": ddict}
+            if len(ddict) == 1 and list(ddict.keys())[0] in _TAGS:
+                return {"__dict__": ddict}
+            return ddict
+        raise TypeError("Unsupported type %s" % type(obj))
+
+    def add(self, name, obj):
+        # the arrays are written while encoding
+        text = json.dumps(self._encode(obj))
+        offset = self._file.tell()
+        self._file.write(text.encode("utf-8"))
+        self._entries[name] = (offset, self._file.tell() - offset)
+
+    def close(self, sources):
+        offset = self._file.tell()
+        text = json.dumps({"version": FORMAT_VERSION,
+                           "sources": sources,
+                           "entries": self._entries})
+        self._file.write(text.encode("utf-8"))
+        self._file.seek(len(MAGIC))
+        self._file.write(struct.pack("<Q", offset))
+
+
+def getSources():
+    """
+    :returns list: the data files and modules the database is built from
+        together with their size and modification time
+    """
+    filenames = [getDataFile(name) for name in DATA_FILES]
+    attdata = os.path.join(PyMcaDataDir.PYMCA_DATA_DIR, "attdata")
+    for name in sorted(os.listdir(attdata)):
+        if name.endswith(".mat") or name in ["atomsf.dict", "incoh.dict"]:
+            filenames.append(os.path.join(attdata, name))
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    for name in MODULES:
+        filenames.append(os.path.join(dirname, name + ".py"))
+    sources = [PyMca5.version()]
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            sources.append((filename, stat.st_size, int(stat.st_mtime)))
+        except OSError:
+            sources.append((filename, None, None))
+    return sources
+
+
+def getDefaultFilename():
+    """
+    :returns str: None when PYMCA_CACHE_DIR is not set
+    """
+    directory = os.getenv("PYMCA_CACHE_DIR")
+    if not directory:
+        return None
+    return os.path.join(directory, FILENAME)
+
+
+def getDatabase():
+    """
+    :returns PhysicsDatabase: the default database or None when it does
+        not exist, PYMCA_CACHE_DIR is not set or it is out of date
+    """
+    global _database, _databaseInitialized
+    if not _databaseInitialized:
+        _databaseInitialized = True
+        filename = getDefaultFilename()
+        if filename and os.path.exists(filename):
+            try:
+                database = PhysicsDatabase(filename)
+                if database.isValid():
+                    _database = database
+                else:
+                    _logger.warning("Physics database %s is out of date",
+                                    filename)
+            except Exception:
+                _logger.warning("Cannot read physics database %s", filename)
+    return _database
+
+
+def setDatabase(database):
+    """
+    :param PhysicsDatabase database: None to read the text data files
+    """
+    global _database, _databaseInitialized
+    _databaseInitialized = True
+    _database = database
+
+
+def build(filename=None):
+    """
+    Parse all the data files and write the database.
+
+    :param str filename: the default database when not given
+    :returns str: the database file name
+    """
+    from PyMca5.PyMcaIO import ConfigDict
+    from PyMca5.PyMcaPhysics.xrf import Elements
+    from PyMca5.PyMcaPhysics.xrf import PyMcaEPDL97
+    from PyMca5.PyMcaPhysics.xrf import Scofield1973
+    from PyMca5.PyMcaPhysics.xrf import CoherentScattering
+    from PyMca5.PyMcaPhysics.xrf import IncoherentScattering
+    if filename is None:
+        filename = getDefaultFilename()
+        if filename is None:
+            raise ValueError("Set PYMCA_CACHE_DIR or give a file name")
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    sources = getSources()
+    # write to a temporary file first so that concurrent
+    # processes never read a partial file
+    fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            writer = _Writer(f)
+            writer.add("Elements", Elements._getElementDict())
+            for name, dictfile in \
+                    [("Scofield1973", Scofield1973.dictfile),
+                     ("CoherentScattering", CoherentScattering.ffile),
+                     ("IncoherentScattering", IncoherentScattering.ffile)]:
+                cDict = ConfigDict.ConfigDict()
+                cDict.read(dictfile)
+                writer.add(name, cDict)
+            writer.add("EPDL97/binding", PyMcaEPDL97._readBindingEnergies())
+            attdata = os.listdir(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                              "attdata"))
+            for ele in Elements.ElementList:
+                writer.add("EPDL97/" + ele, PyMcaEPDL97._readElement(ele))
+                if ele + ".mat" in attdata:
+                    writer.add("XCOM/" + ele, Elements._readXCOMFile(ele))
+            writer.close(sources)
+        if hasattr(os, "replace"):
+            os.replace(tmpname, filename)
+        else:
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    return filename
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    if len(sys.argv) > 1:
+        fname = build(sys.argv[1])
+    else:
+        fname = build()
+    print("Physics database written to %s" % fname)
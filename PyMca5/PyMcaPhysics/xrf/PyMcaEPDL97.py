@@ -35,6 +35,7 @@
 import sys
 from PyMca5.PyMcaIO import specfile
 from PyMca5 import getDataFile
+from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
 import numpy
 log = numpy.log
 exp = numpy.exp
@@ -70,7 +71,10 @@
     EPDL97_DICT[element]['original'] = True
 
 #fill the dictionary with the binding energies
-def _initializeBindingEnergies():
+def _readBindingEnergies():
+    """
+    Read the EADL97 binding energies of all the elements.
+    """
     #read the specfile data
     sf = specfile.Specfile(EADL97_FILE)
     scan = sf[0]
@@ -78,18 +82,30 @@ def _initializeBindingEnergies():
     data = scan.data()
     scan = None
     sf = None
+    ddict = {}
     i = -1
     for element in ElementList:
         if element == 'Md':
             break
         i += 1
-        EPDL97_DICT[element]['binding'] = {}
+        ddict[element] = {}
         for j in range(len(labels)):
             if j == 0:
                 #this is the atomic number
                 continue
             label = labels[j].replace(" ","").split("(")[0]
-            EPDL97_DICT[element]['binding'][label] = data[j, i]
+            ddict[element][label] = data[j, i]
+    return ddict
+
+def _initializeBindingEnergies():
+    ddict = None
+    database = PhysicsDatabase.getDatabase()
+    if database is not None:
+        ddict = database.get("EPDL97/binding")
+    if ddict is None:
+        ddict = _readBindingEnergies()
+    for element in ddict:
+        EPDL97_DICT[element]['binding'] = ddict[element]
 
 _initializeBindingEnergies()
 
@@ -109,12 +125,10 @@ def setElementBindingEnergies(element, ddict):
     else:
         EPDL97_DICT[element]['binding'].update(ddict)
 
-def _initializeElement(element):
+def _readElement(element):
     """
-    _initializeElement(element)
-    Supposed to be of internal use.
-    Reads the file and loads all the relevant element information contained
-    int the EPDL97 file into the internal dictionary.
+    Reads the file and returns all the relevant element information
+    contained in the EPDL97 file.
     """
     #read the specfile data
     sf = specfile.Specfile(EPDL97_FILE)
@@ -129,70 +143,80 @@ def _initializeElement(element):
     scan = None
 
     #fill the information into the dictionary
+    ddict = {}
     i = -1
     for label0 in labels:
         i += 1
         label = label0.lower()
         #translate the label to the PyMca keys
         if ('coherent' in label) and ('incoherent' not in label):
-            EPDL97_DICT[element]['EPDL97']['coherent'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['coherent'].shape = -1
+            ddict['coherent'] = data[i, :]
+            ddict['coherent'].shape = -1
             continue
         if ('incoherent' in label) and ('plus' not in label):
-            EPDL97_DICT[element]['EPDL97']['compton'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['compton'].shape = -1
+            ddict['compton'] = data[i, :]
+            ddict['compton'].shape = -1
             continue
         if 'allother' in label:
-            EPDL97_DICT[element]['EPDL97']['all other'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['all other'].shape = -1
+            ddict['all other'] = data[i, :]
+            ddict['all other'].shape = -1
             continue
         label = label.replace(" ","").split("(")[0]
         if 'energy' in label:
-            EPDL97_DICT[element]['EPDL97']['energy'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['energy'].shape = -1
+            ddict['energy'] = data[i, :]
+            ddict['energy'].shape = -1
             continue
         if 'photoelectric' in label:
-            EPDL97_DICT[element]['EPDL97']['photo'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['photo'].shape = -1
+            ddict['photo'] = data[i, :]
+            ddict['photo'].shape = -1
             #a reference should not be expensive ...
-            EPDL97_DICT[element]['EPDL97']['photoelectric'] =\
-                                EPDL97_DICT[element]['EPDL97']['photo']
+            ddict['photoelectric'] = ddict['photo']
             continue
         if 'total' in label:
-            EPDL97_DICT[element]['EPDL97']['total'] = data[i, :]
-            EPDL97_DICT[element]['EPDL97']['total'].shape = -1
+            ddict['total'] = data[i, :]
+            ddict['total'].shape = -1
             continue
         if label[0].upper() in ['K', 'L', 'M']:
             #for the time being I do not use the other shells in PyMca
-            EPDL97_DICT[element]['EPDL97'][label.upper()] = data[i, :]
-            EPDL97_DICT[element]['EPDL97'][label.upper()].shape = -1
+            ddict[label.upper()] = data[i, :]
+            ddict[label.upper()].shape = -1
             continue
-    EPDL97_DICT[element]['EPDL97']['pair'] = 0.0 *\
-                                             EPDL97_DICT[element]['EPDL97']['energy']
-    EPDL97_DICT[element]['EPDL97']['photo'] = \
-            EPDL97_DICT[element]['EPDL97']['total'] -\
-            EPDL97_DICT[element]['EPDL97']['compton']-\
-            EPDL97_DICT[element]['EPDL97']['coherent']-\
-            EPDL97_DICT[element]['EPDL97']['pair']
+    ddict['pair'] = 0.0 * ddict['energy']
+    ddict['photo'] = ddict['total'] - ddict['compton'] -\
+                     ddict['coherent'] - ddict['pair']
 
     atomic_shells = ['M5', 'M4', 'M3', 'M2', 'M1', 'L3', 'L2', 'L1', 'K']
 
     # with the new (short) version of the cross-sections file, "all other" contains all
     # shells above the M5. Nevertheless, we calculate it
     if scan_index > 17:
-        idx = EPDL97_DICT[element]['EPDL97']['all other'] > 0.0
+        idx = ddict['all other'] > 0.0
         delta = 0.0
         for key in atomic_shells:
-            delta += EPDL97_DICT[element]['EPDL97'][key]
-        EPDL97_DICT[element]['EPDL97']['all other'] =\
-                        (EPDL97_DICT[element]['EPDL97']['photo'] - delta) * idx
+            delta += ddict[key]
+        ddict['all other'] = (ddict['photo'] - delta) * idx
     else:
-        EPDL97_DICT[element]['EPDL97']['all other'] = 0.0 * \
-                        EPDL97_DICT[element]['EPDL97']['photo']
+        ddict['all other'] = 0.0 * ddict['photo']
 
     #take care of rounding problems
-    idx = EPDL97_DICT[element]['EPDL97']['all other'] < 0.0
-    EPDL97_DICT[element]['EPDL97']['all other'][idx] = 0.0
+    idx = ddict['all other'] < 0.0
+    ddict['all other'][idx] = 0.0
+    return ddict
+
+def _initializeElement(element):
+    """
+    _initializeElement(element)
+    Supposed to be of internal use.
+    Loads all the relevant element information contained in the EPDL97
+    file into the internal dictionary.
+    """
+    ddict = None
+    database = PhysicsDatabase.getDatabase()
+    if database is not None:
+        ddict = database.get("EPDL97/" + element)
+    if ddict is None:
+        ddict = _readElement(element)
+    EPDL97_DICT[element]['EPDL97'].update(ddict)
 
 
 def getElementCrossSections(element, energy=None, forced_shells=None):
@@ -34,7 +34,12 @@
 import os
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5 import getDataFile
+from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
 
-dict = ConfigDict.ConfigDict()
 dictfile = getDataFile("Scofield1973.dict")
-dict.read(dictfile)
+dict = None
+if PhysicsDatabase.getDatabase() is not None:
+    dict = PhysicsDatabase.getDatabase().get("Scofield1973")
+if dict is None:
+    dict = ConfigDict.ConfigDict()
+    dict.read(dictfile)
@@ -0,0 +1,560 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V.A. Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Fit of an XRF map by a pool of worker processes.
+
+The coordinator (:class:`BatchScheduler`) divides the map in blocks of
+rows, aligned with the chunks of the HDF5 dataset when possible, and puts
+them in a queue. A worker takes the next block as soon as it is idle, so
+that expensive parts of the map do not leave the other workers idle. The
+results of each block are sent back to the coordinator and merged in its
+output buffer, which is saved as a single output.
+
+The queues are served over TCP by a `multiprocessing` manager. The local
+workers started by the coordinator connect to it in the same way remote
+workers do (see :func:`runWorker`). Remote workers need the address the
+coordinator listens on, its authentication key (the `authkey` argument
+or the PYMCA_BATCH_AUTHKEY environment variable) and access to the input
+files under the same names:
+
+.. code:: python
+
+    batch = BatchScheduler(cfgfile, filelist=filelist, outputdir=outputdir,
+                           nworkers=4)
+    batch.processList()
+
+.. code:: bash
+
+    # coordinator
+    export PYMCA_BATCH_AUTHKEY=secret
+    python -m PyMca5.PyMcaPhysics.xrf.XRFBatchScheduler --cfg=fit.cfg \
+        --outdir=results --address=0.0.0.0:50000 map.h5
+    # on another computer
+    export PYMCA_BATCH_AUTHKEY=secret
+    python -m PyMca5.PyMcaPhysics.xrf.XRFBatchScheduler --worker \
+        --address=coordinator:50000
+
+The blocks that could not be fitted are listed in `failedRows` and
+`processList` raises RuntimeError without saving the output.
+"""
+import os
+import sys
+import time
+import logging
+import traceback
+import multiprocessing
+from multiprocessing.managers import BaseManager, DictProxy
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy
+from .McaAdvancedFitBatch import McaAdvancedFitBatch
+from . import McaAdvancedFitBatch as McaAdvancedFitBatchModule
+from .XRFBatchFitOutput import OutputBuffer
+
+_logger = logging.getLogger(__name__)
+
+STACK_TYPES = ["EdfFileStack", "HDF5Stack1D"]
+
+# Served by the manager process of the coordinator
+_tasks = None
+_results = None
+_job = None
+
+AUTHKEY_ENV = "PYMCA_BATCH_AUTHKEY"
+
+
+def getAuthKey(authkey=None):
+    """
+    :param authkey: bytes or str (default: the PYMCA_BATCH_AUTHKEY
+                    environment variable or a random key)
+    :returns bytes:
+    """
+    if authkey is None:
+        authkey = os.getenv(AUTHKEY_ENV) or os.urandom(16)
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode("utf-8")
+    return authkey
+
+
+def _getTasks():
+    global _tasks
+    if _tasks is None:
+        _tasks = queue.Queue()
+    return _tasks
+
+
+def _getResults():
+    global _results
+    if _results is None:
+        _results = queue.Queue()
+    return _results
+
+
+def _getJob():
+    global _job
+    if _job is None:
+        _job = {}
+    return _job
+
+
+class _QueueManager(BaseManager):
+    pass
+
+
+_QueueManager.register('tasks', callable=_getTasks)
+_QueueManager.register('results', callable=_getResults)
+_QueueManager.register('job', callable=_getJob, proxytype=DictProxy)
+
+
+class _WorkerBatch(McaAdvancedFitBatch):
+    """
+    Keeps a stack open for all the blocks it processes
+    """
+
+    _cachedStack = None
+
+    def getFileHandle(self, inputfile):
+        cached = self._cachedStack
+        if cached is not None and cached[0] is inputfile:
+            self._HDF5 = cached[2]
+            return cached[1]
+        handle = super(_WorkerBatch, self).getFileHandle(inputfile)
+        info = getattr(handle, "info", {})
+        if info.get("SourceType", None) in STACK_TYPES:
+            self._cachedStack = inputfile, handle, self._HDF5
+        return handle
+
+
+def runWorker(address, authkey):
+    """
+    Fit the blocks of a :class:`BatchScheduler` until there are none left.
+
+    :param tuple address: (host, port) of the coordinator
+    :param authkey: authentication key of the coordinator (see
+                    :func:`getAuthKey`)
+    """
+    manager = _QueueManager(address=address, authkey=getAuthKey(authkey))
+    manager.connect()
+    tasks = manager.tasks()
+    results = manager.results()
+    job = manager.job().copy()
+    batch = None
+    while True:
+        block = tasks.get()
+        if block is None:
+            break
+        try:
+            outbuffer = OutputBuffer(**job["outbuffer"])
+            if batch is None:
+                batch = _WorkerBatch(job["initdict"],
+                                     filelist=job["filelist"],
+                                     outbuffer=outbuffer,
+                                     **job["batch"])
+            else:
+                batch.outbuffer = outbuffer
+                batch._initOutputBuffer()
+            batch.rows = block
+            batch.processList()
+            buffers = [allocation + (numpy.asarray(outbuffer[allocation[0]]),)
+                       for allocation in outbuffer.allocations()]
+            results.put(("result", block, buffers, batch._fitStatistics))
+        except Exception:
+            _logger.error("Error fitting rows %d-%d", block[0], block[1] - 1)
+            results.put(("error", block, traceback.format_exc(), None))
+
+
+class BatchScheduler(McaAdvancedFitBatch):
+    """
+    XRF fit of a map by a pool of worker processes with dynamic load
+    balancing (see module documentation).
+    """
+
+    def __init__(self, initdict, filelist=None, nworkers=None,
+                 blockrows=None, address=None, authkey=None, **kwargs):
+        """
+        :param initdict: see `McaAdvancedFitBatch`
+        :param list filelist: see `McaAdvancedFitBatch`
+        :param int nworkers: number of local worker processes
+                             (default: number of CPU's)
+        :param int blockrows: number of map rows in one block (default:
+                              a multiple of the HDF5 chunk size which
+                              gives a few blocks per worker)
+        :param tuple address: (host, port) on which the blocks are served
+                              (default: any free port on localhost)
+        :param authkey: key of the workers connecting to the coordinator
+                        (see :func:`getAuthKey`)
+        :param **kwargs: see `McaAdvancedFitBatch`. The .fit files and
+                         the concentrations text file are not supported.
+        """
+        for name in ["fitfiles", "fitconcfile", "chunk"]:
+            if kwargs.pop(name, None):
+                _logger.warning("Option '%s' is ignored by the scheduler", name)
+        McaAdvancedFitBatch.__init__(self, initdict, filelist=filelist,
+                                     fitfiles=0, fitconcfile=0, **kwargs)
+        if self.outbuffer is None:
+            raise ValueError("The results are merged in the output buffer")
+        self._initdict = initdict
+        if not nworkers:
+            nworkers = multiprocessing.cpu_count()
+        self.nWorkers = nworkers
+        self.blockRows = blockrows
+        if address is None:
+            address = "127.0.0.1", 0
+        self.address = address
+        self.authkey = getAuthKey(authkey)
+        self.failedRows = []
+
+    def processList(self):
+        with self.outbuffer.saveContext():
+            self._processBlocks()
+        self.onEnd()
+
+    def _job(self):
+        """
+        Everything a worker needs to process a block
+        """
+        outbuffer = self.outbuffer
+        batch = {"roifit": self.roiFit,
+                 "roiwidth": self.roiWidth,
+                 "concentrations": self._concentrations,
+                 "selection": self.selection,
+                 "filebeginoffset": self.fileBeginOffset,
+                 "fileendoffset": self.fileEndOffset,
+                 "filestep": self.fileStep,
+                 "mcaoffset": self.mcaOffset,
+                 "mcastep": self.mcaStep,
+                 "readbuffer": self.readBuffer,
+                 "warmstart": self.warmStart,
+                 "outputdir": self.outputdir,
+                 "fitfiles": 0,
+                 "fitconcfile": 0,
+                 "nosave": True,
+                 "quiet": True}
+        # Worker buffers stay in memory
+        outbufferkwargs = {"nosave": True,
+                           "dtype": outbuffer._forcedtype,
+                           "saveFit": outbuffer.saveFit,
+                           "saveData": outbuffer.saveData,
+                           "saveResiduals": outbuffer.saveResiduals}
+        return {"initdict": self._initdict,
+                "filelist": self._filelist,
+                "batch": batch,
+                "outbuffer": outbufferkwargs}
+
+    def _mapRows(self):
+        """
+        :returns tuple: number of rows in the map and in one HDF5 chunk
+        """
+        inputfile = self._filelist[self.fileBeginOffset]
+        if McaAdvancedFitBatchModule.HDF5SUPPORT and \
+           not isinstance(inputfile, numpy.ndarray) and \
+           McaAdvancedFitBatchModule.h5py.is_hdf5(inputfile):
+            # Only the shape is needed: do not load the data
+            handle = McaAdvancedFitBatchModule.HDF5Stack1D.HDF5Stack1D(
+                        self._filelist, self.selection, lazy=True)
+        else:
+            handle = self.getFileHandle(inputfile)
+        try:
+            info = getattr(handle, "info", {})
+            if info.get("SourceType", None) in STACK_TYPES:
+                nrows = info["Dim_1"]
+                chunks = getattr(handle.data, "chunks", None)
+                if chunks:
+                    chunkrows = chunks[0]
+                else:
+                    chunkrows = 1
+            else:
+                # one file is one row
+                nrows = len(self._filelist) - self.fileEndOffset
+                chunkrows = 1
+        finally:
+            self.filehandle = None
+        return nrows, chunkrows
+
+    def _blocks(self):
+        """
+        Blocks of rows (start, stop) aligned with the HDF5 chunks
+        """
+        nrows, chunkrows = self._mapRows()
+        start, stop = self._rowRange(nrows)
+        blockrows = self.blockRows
+        if not blockrows:
+            # A few blocks per worker for load balancing
+            blockrows = max((stop - start) // (4 * self.nWorkers), 1)
+            blockrows = max(blockrows // chunkrows, 1) * chunkrows
+        blocks = []
+        first = (start // blockrows) * blockrows
+        for i in range(first, stop, blockrows):
+            blocks.append((max(i, start), min(i + blockrows, stop)))
+        return (start, stop), blocks
+
+    def _processBlocks(self):
+        self._fitStatistics = {'nfit': 0, 'nwarm': 0, 'niter': 0, 'time': 0.}
+        self._mapRange, blocks = self._blocks()
+        nblocks = len(blocks)
+        keylist = ["block %d" % i for i in range(nblocks)]
+        nworkers = min(self.nWorkers, nblocks)
+        _logger.info("Fit %d blocks of rows with %d workers", nblocks, nworkers)
+
+        manager = _QueueManager(address=self.address, authkey=self.authkey)
+        manager.start()
+        workers = []
+        errors = []
+        try:
+            tasks = manager.tasks()
+            results = manager.results()
+            manager.job().update(self._job())
+            for block in blocks:
+                tasks.put(block)
+            for i in range(nworkers):
+                tasks.put(None)
+            for i in range(nworkers):
+                worker = multiprocessing.Process(target=runWorker,
+                                                 args=(manager.address,
+                                                       self.authkey))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            nfinished = 0
+            with self.outbuffer.chunkWriter() as writer:
+                while nfinished < nblocks:
+                    if self.pleaseBreak:
+                        break
+                    try:
+                        status, block, result, stats = results.get(timeout=1)
+                    except queue.Empty:
+                        if not any(worker.is_alive() for worker in workers):
+                            raise RuntimeError("Workers stopped with {} blocks left"
+                                               .format(nblocks - nfinished))
+                        continue
+                    nfinished += 1
+                    if status == "result":
+                        self._mergeBlock(block, result, writer)
+                        for k, v in stats.items():
+                            self._fitStatistics[k] += v
+                    else:
+                        _logger.error("Rows %d-%d not fitted:\n%s",
+                                      block[0], block[1] - 1, result)
+                        errors.append(block)
+                    self.onImage(keylist[nfinished - 1], keylist)
+            # remote workers may have taken the end markers of local ones
+            for worker in workers:
+                tasks.put(None)
+        finally:
+            for worker in workers:
+                if self.pleaseBreak:
+                    worker.terminate()
+                worker.join()
+            manager.shutdown()
+        self._logFitStatistics()
+        self.failedRows = sorted(errors)
+        if errors:
+            # do not save results which look complete
+            raise RuntimeError("%d blocks out of %d could not be fitted "
+                               "(rows %s)" % (len(errors), nblocks,
+                               ", ".join("%d-%d" % (start, stop - 1)
+                                         for start, stop in self.failedRows)))
+
+    def _mergeBlock(self, block, buffers, writer):
+        """
+        Copy the results of a worker in the output buffer
+
+        :param tuple block: rows (start, stop)
+        :param list buffers: label, group, memtype, allocH5, allocation
+                             arguments and data of each buffer
+        :param BackgroundWriter writer:
+        """
+        outbuffer = self.outbuffer
+        first, stop = self._mapRange
+        rows = slice(block[0] - first, block[1] - first)
+        for label, group, memtype, allocH5, kwargs, data in buffers:
+            # Parameter images are stacked along the first axis
+            labels = kwargs.get("labels", None)
+            if labels:
+                rowaxis = 1
+            else:
+                rowaxis = 0
+            if label not in outbuffer:
+                kwargs = dict(kwargs)
+                shape = list(kwargs["shape"])
+                shape[rowaxis] = stop - first
+                kwargs["shape"] = tuple(shape)
+                outbuffer.allocateMemory(label, group=group,
+                                         memtype=memtype, **kwargs)
+            buffer = outbuffer[label]
+            if isinstance(buffer, list):
+                # HDF5 dataset for each label
+                for dset, values in zip(buffer, data):
+                    writer.write(dset, (rows, ), values)
+            else:
+                idx = (slice(None), ) * rowaxis + (rows, )
+                writer.write(buffer, idx, data)
+
+
+def main():
+    import getopt
+    options = 'f'
+    longoptions = ['cfg=', 'outdir=', 'roifit=', 'roiwidth=',
+                   'concentrations=', 'overwrite=', 'outroot=',
+                   'outentry=', 'outprocess=', 'edf=', 'h5=', 'csv=',
+                   'tif=', 'dat=', 'diagnostics=', 'debug=', 'multipage=',
+                   'readbuffer=', 'warmstart=', 'workers=', 'blockrows=',
+                   'address=', 'authkey=', 'worker']
+    cfg = None
+    outputDir = None
+    roifit = 0
+    roiwidth = 250.
+    concentrations = 0
+    overwrite = 1
+    outputRoot = ""
+    fileEntry = ""
+    fileProcess = ""
+    tif = 0
+    edf = 1
+    csv = 0
+    h5 = 1
+    dat = 0
+    diagnostics = 0
+    debug = 0
+    multipage = 0
+    readbuffer = None
+    warmstart = 0
+    nworkers = None
+    blockrows = None
+    address = None
+    authkey = None
+    worker = False
+    opts, args = getopt.getopt(sys.argv[1:], options, longoptions)
+    for opt, arg in opts:
+        if opt in ('--pkm', '--cfg'):
+            cfg = arg
+        elif opt == '--outdir':
+            outputDir = arg
+        elif opt == '--roifit':
+            roifit = int(arg)
+        elif opt == '--roiwidth':
+            roiwidth = float(arg)
+        elif opt == '--concentrations':
+            concentrations = int(arg)
+        elif opt == '--overwrite':
+            overwrite = int(arg)
+        elif opt == '--outroot':
+            outputRoot = arg
+        elif opt == '--outentry':
+            fileEntry = arg
+        elif opt == '--outprocess':
+            fileProcess = arg
+        elif opt == '--tif':
+            tif = int(arg)
+        elif opt == '--edf':
+            edf = int(arg)
+        elif opt == '--csv':
+            csv = int(arg)
+        elif opt == '--h5':
+            h5 = int(arg)
+        elif opt == '--dat':
+            dat = int(arg)
+        elif opt == '--diagnostics':
+            diagnostics = int(arg)
+        elif opt == '--debug':
+            debug = int(arg)
+        elif opt == '--multipage':
+            multipage = int(arg)
+        elif opt == '--readbuffer':
+            readbuffer = float(arg)
+        elif opt == '--warmstart':
+            warmstart = int(arg)
+        elif opt == '--workers':
+            nworkers = int(arg)
+        elif opt == '--blockrows':
+            blockrows = int(arg)
+        elif opt == '--address':
+            host, port = arg.rsplit(':', 1)
+            address = host, int(port)
+        elif opt == '--authkey':
+            authkey = arg
+        elif opt == '--worker':
+            worker = True
+
+    logging.basicConfig()
+    if debug:
+        _logger.setLevel(logging.DEBUG)
+    else:
+        _logger.setLevel(logging.INFO)
+
+    if worker:
+        if address is None:
+            _logger.error("A worker needs the --address of the coordinator")
+            sys.exit(1)
+        runWorker(address, authkey)
+        return
+    filelist = args
+    if len(filelist) == 0:
+        _logger.error("No input files")
+        sys.exit(0)
+    t0 = time.time()
+    outbuffer = OutputBuffer(outputDir=outputDir,
+                             outputRoot=outputRoot,
+                             fileEntry=fileEntry,
+                             fileProcess=fileProcess,
+                             diagnostics=diagnostics,
+                             tif=tif, edf=edf, csv=csv,
+                             h5=h5, dat=dat,
+                             multipage=multipage,
+                             overwrite=overwrite)
+    b = BatchScheduler(cfg, filelist=filelist,
+                       outputdir=outputDir,
+                       roifit=roifit,
+                       roiwidth=roiwidth,
+                       concentrations=concentrations,
+                       outbuffer=outbuffer,
+                       overwrite=overwrite,
+                       readbuffer=readbuffer,
+                       warmstart=warmstart,
+                       nworkers=nworkers,
+                       blockrows=blockrows,
+                       address=address,
+                       authkey=authkey)
+    try:
+        b.processList()
+    except RuntimeError as e:
+        _logger.error("%s", e)
+        sys.exit(1)
+    print("Total Elapsed = % s " % (time.time() - t0))
+
+
+if __name__ == "__main__":
+    main()
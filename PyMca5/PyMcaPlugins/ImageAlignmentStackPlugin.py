@@ -25,7 +25,8 @@
 #############################################################################*/
 """
 This plugin provides two methods to align stack images, one based on a FFT
-algorithm and the other one based on the SIFT algorithm (on GPU).
+algorithm and the other one based on the SIFT algorithm (on GPU, or on the
+CPU without OpenCL).
 
 The result of the alignment computation may be applied directly to the data,
 or saved to a file.
@@ -57,7 +58,10 @@
 try:
     from PyMca5.PyMcaGui.math import SIFTAlignmentWindow
     sift = SIFTAlignmentWindow.sift
-    ocl = SIFTAlignmentWindow.silx.opencl.ocl
+    if SIFTAlignmentWindow.silx is None:
+        ocl = None
+    else:
+        ocl = SIFTAlignmentWindow.silx.opencl.ocl
     SIFT = True
 except:
     _logger.info("SIFTAlignmentWindow not successful")
@@ -272,8 +276,6 @@ def _siftAlignment(self):
                 import pyopencl
             except:
                 raise ImportError("PyOpenCL does not seem to be installed on your system")
-        if ocl is None:
-            raise ImportError("PyOpenCL does not seem to be installed on your system")
         stack = self.getStackDataObject()
         if stack is None:
             return
@@ -319,18 +321,41 @@ def calculateShiftsSIFT(self, stack, reference, mask=None, device=None, crop=Non
         if mask is not None:
             if mask.sum() == 0:
                 mask = None
-        if device is None:
+        if (ocl is None) or ((device is not None) and (device[0] < 0)):
+            # numpy implementation, several images aligned at a time
+            from PyMca5.PyMcaMath.sift import cpu
+            siftInstance = cpu.LinearAlign(reference.astype(numpy.float32),
+                                           init_sigma=sigma)
+            nthreads = 0
+        elif device is None:
             siftInstance = sift.LinearAlign(reference.astype(numpy.float32),
                                             devicetype="cpu",
                                             init_sigma=sigma)
+            nthreads = None
         else:
             siftInstance = sift.LinearAlign(reference.astype(numpy.float32),
                                             deviceid=device,
                                             init_sigma=sigma)
+            nthreads = None
         data = stack.data
         mcaIndex = stack.info['McaIndex']
         if not (mcaIndex in [0, 2, -1]):
              raise IndexError("Unsupported 1D index %d" % mcaIndex)
+
+        def frames():
+            for i in range(data.shape[mcaIndex]):
+                _logger.debug("SIFT Shifting image %d", i)
+                if mcaIndex == 0:
+                    yield data[i].astype(numpy.float32)
+                else:
+                    yield numpy.array(data[:, :, i], dtype=numpy.float32)
+
+        if nthreads is None:
+            results = (siftInstance.align(image, shift_only=True, return_all=True)
+                       for image in frames())
+        else:
+            results = siftInstance.align_all(frames(), nthreads=nthreads,
+                                             shift_only=True, return_all=True)
         total = float(data.shape[mcaIndex])
         if filename is not None:
             hdf = self.__hdf5
@@ -346,34 +371,28 @@ def calculateShiftsSIFT(self, stack, reference, mask=None, device=None, crop=Non
                                                       dtype=numpy.float32,
                                                       attributes=attributes)
         shifts = numpy.zeros((data.shape[mcaIndex], 2), dtype=numpy.float32)
-        if mcaIndex == 0:
-            for i in range(data.shape[mcaIndex]):
-                _logger.debug("SIFT Shifting image %d", i)
-                result = siftInstance.align(data[i].astype(numpy.float32), shift_only=True, return_all=True)
-                _logger.debug("Index = %d shift = %.4f, %.4f",
-                              i, result['offset'][0], result['offset'][1])
-                if filename is None:
-                    stack.data[i] = result['result']
-                else:
-                    outputStack[i] = result['result']
-                shifts[i, 0] = result['offset'][0]
-                shifts[i, 1] = result['offset'][1]
-                self._progress = (100 * i) / total
-        else:
-            image2 = numpy.zeros(reference.shape, dtype=numpy.float32)
-            for i in range(data.shape[mcaIndex]):
-                _logger.debug("SIFT Shifting image %d", i)
-                image2[:, :] = data[:, :, i]
-                result = siftInstance.align(image2, shift_only=True, return_all=True)
-                _logger.debug("Index = %d shift = %.4f, %.4f",
-                              i, result['offset'][0], result['offset'][1])
-                if filename is None:
-                    stack.data[:, :, i] = result['result']
-                else:
-                    outputStack[i] = result['result']
-                shifts[i, 0] = result['offset'][0]
-                shifts[i, 1] = result['offset'][1]
-                self._progress = (100 * i) / total
+        for i, result in enumerate(results):
+            self._progress = (100 * i) / total
+            if result is None:
+                # no matching keypoints: the image is kept as it is
+                _logger.warning("Image %d not aligned: no matching keypoints",
+                                i)
+                if filename is not None:
+                    if mcaIndex == 0:
+                        outputStack[i] = data[i]
+                    else:
+                        outputStack[i] = data[:, :, i]
+                continue
+            _logger.debug("Index = %d shift = %.4f, %.4f",
+                          i, result['offset'][0], result['offset'][1])
+            if filename is not None:
+                outputStack[i] = result['result']
+            elif mcaIndex == 0:
+                stack.data[i] = result['result']
+            else:
+                stack.data[:, :, i] = result['result']
+            shifts[i, 0] = result['offset'][0]
+            shifts[i, 1] = result['offset'][1]
         if filename is not None:
             hdf = self.__hdf5
             alignmentGroup = hdf['/entry_000/Alignment']
@@ -432,13 +451,11 @@ def calculateShiftsFFT(self, stack, reference, offsets=None, widths=None, crop=F
             offsets = [0.0, 0.0]
         if widths is None:
             widths = [reference.shape[0], reference.shape[1]]
-        fft2Function = numpy.fft.fft2
         if 1:
             DTYPE = numpy.float32
         else:
             DTYPE = numpy.float64
-        image2 = numpy.zeros((widths[0], widths[1]), dtype=DTYPE)
-        shape = image2.shape
+        shape = widths[0], widths[1]
 
         USE_APODIZATION_WINDOW = False
         apo = [10, 10]
@@ -451,37 +468,24 @@ def calculateShiftsFFT(self, stack, reference, offsets=None, widths=None, crop=F
         else:
             window = numpy.zeros((shape[0], shape[1]), dtype=DTYPE)
             window[apo[0]:shape[0] - apo[0], apo[1]:shape[1] - apo[1]] = 1
-        image2[:,:] = window * reference[offsets[0]:offsets[0]+widths[0],
-                                         offsets[1]:offsets[1]+widths[1]]
-        image2fft2 = fft2Function(image2)
         mcaIndex = stack.info.get('McaIndex')
-        shifts = numpy.zeros((data.shape[mcaIndex], 2), numpy.float)
-        image1 = numpy.zeros(image2.shape, dtype=DTYPE)
-        total = float(data.shape[mcaIndex])
-        if mcaIndex == 0:
-            for i in range(data.shape[mcaIndex]):
-                image1[:,:] = window * data[i][offsets[0]:offsets[0]+widths[0],
-                                               offsets[1]:offsets[1]+widths[1]]
-
-                image1fft2 = fft2Function(image1)
-                shifts[i] = ImageRegistration.measure_offset_from_ffts(image2fft2,
-                                                                       image1fft2)
-                _logger.debug("Index = %d shift = %.4f, %.4f",
-                              i, shifts[i][0], shifts[i][1])
-                self._progress = (100 * i) / total
-        elif mcaIndex in [2, -1]:
-            for i in range(data.shape[mcaIndex]):
-                image1[:,:] = window * data[:,:,i][offsets[0]:offsets[0]+widths[0],
-                                               offsets[1]:offsets[1]+widths[1]]
-
-                image1fft2 = fft2Function(image1)
-                shifts[i] = ImageRegistration.measure_offset_from_ffts(image2fft2,
-                                                                       image1fft2)
+        if mcaIndex not in [0, 2, -1]:
+            raise IndexError("Only stacks of images or spectra supported. 1D index should be 0 or 2")
+        # the reference FFT is calculated once and the images are
+        # processed in batches
+        shifts = ImageRegistration.measure_stack_offsets(reference,
+                                                         data,
+                                                         index=mcaIndex,
+                                                         offsets=offsets,
+                                                         widths=widths,
+                                                         window=window,
+                                                         dtype=DTYPE,
+                                                         nthreads=0,
+                                                         callback=self._setProgress)
+        if _logger.getEffectiveLevel() == logging.DEBUG:
+            for i in range(shifts.shape[0]):
                 _logger.debug("Index = %d shift = %.4f, %.4f",
                               i, shifts[i][0], shifts[i][1])
-                self._progress = (100 * i) / total
-        else:
-            raise IndexError("Only stacks of images or spectra supported. 1D index should be 0 or 2")
         return shifts
 
     def _shiftFromFile(self):
@@ -643,7 +647,6 @@ def shiftStack(self, stack, shifts, crop=False, filename=None):
         window = numpy.zeros(shape, numpy.float32)
         window[d0_start:d0_end, d1_start:d1_end] = 1.0
         self._progress = 0.0
-        total = float(data.shape[mcaIndex])
         if filename is not None:
             hdf = self.__hdf5
             dataGroup = hdf['/entry_000/Data']
@@ -657,23 +660,19 @@ def shiftStack(self, stack, shifts, crop=False, filename=None):
                                                       name="data",
                                                       dtype=numpy.float32,
                                                       attributes=attributes)
-        for i in range(data.shape[mcaIndex]):
-            #tmpImage = ImageRegistration.shiftFFT(data[i], shifts[i])
-            if mcaIndex == 0:
-                tmpImage = ImageRegistration.shiftBilinear(data[i], shifts[i])
-                #tmpImage = ImageRegistration.shiftImage(data[i], -shifts[i], method="fft")
-                if filename is None:
-                    stack.data[i] = tmpImage * window
-                else:
-                    outputStack[i] = tmpImage * window
-            else:
-                tmpImage = ImageRegistration.shiftBilinear(data[:,:,i], shifts[i])
-                if filename is None:
-                    stack.data[:, :, i] = tmpImage * window
-                else:
-                    outputStack[i] = tmpImage * window
-            _logger.debug("Index %d bilinear shifted", i)
-            self._progress = (100 * i) / total
+        else:
+            outputStack = None
+        # Fourier shifts applied in batches, written as they are obtained
+        ImageRegistration.shiftStackFFT(data,
+                                        -numpy.asarray(shifts),
+                                        index=mcaIndex,
+                                        output=outputStack,
+                                        window=window,
+                                        nthreads=0,
+                                        callback=self._setProgress)
+
+    def _setProgress(self, value):
+        self._progress = value
 
     def initializeHDF5File(self, fname):
         #for the time being overwriting
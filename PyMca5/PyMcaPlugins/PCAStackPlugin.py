@@ -31,7 +31,8 @@
 
 The user can configure following parameters:
 
-  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays*)
+  - PCA method (*Covariance, Expectation Max, Covariance Multiple Arrays,
+    Randomized, Incremental*)
   - Number of Principal Components
   - Spectral Binning
   - Spectral Regions
@@ -39,6 +40,16 @@
 After the configuration dialog is validated, the eigenimages and the
 eigenvectors are computed and displayed in another window.
 
+The *Randomized* method gives the same results as the *Covariance* method
+for the first components but it reads the stack in blocks, without loading
+it in memory. Use it for stacks which are too large for the other methods.
+
+The *Incremental* method gives the results of the *Covariance* method and,
+when calculated again on a stack which has grown (for instance during a
+scan), only the rows added since the previous calculation are read to
+update the covariance matrix. The eigenimages are calculated on the whole
+stack.
+
 """
 # TODO: explain PCA methods and regions
 # TODO: provide a practical use case for a PCA. Isolating elements?
@@ -74,6 +85,9 @@ def __init__(self, stackWindow, **kw):
         self.configurationWidget = None
         self.widget = None
         self.thread = None
+        # kept across stack updates to only fit the new rows of a
+        # growing stack with the incremental method
+        self._incrementalPCA = None
 
     def stackUpdated(self):
         _logger.debug("PCAStackPlugin.stackUpdated() called")
@@ -213,6 +227,8 @@ def actualCalculation(self):
             spatial_mask = numpy.isfinite(self.getStackOriginalImage())
             pcaParameters['mask'] = spatial_mask
         pcaParameters["legacy"] = False
+        if self.__methodlabel == "Incremental":
+            pcaParameters["incremental"] = self._incrementalPCA
         _logger.info("PCA function %s" % function.__name__)
         _logger.info("PCA parameters %s" % pcaParameters)
         if "Multiple" in self.__methodlabel:
@@ -259,6 +275,8 @@ def threadFinished(self):
         self.configurationWidget.close()
         if hasattr(result, "keys"):
             # new way
+            if "incremental" in result:
+                self._incrementalPCA = result["incremental"]
             images = result["scores"]
             eigenValues = result["eigenvalues"]
             eigenVectors = result["eigenvectors"]
@@ -35,8 +35,48 @@
 import os
 import gc
 import tempfile
+import struct
 import numpy
 
+def _encodeByteOffset(data):
+    values = numpy.asarray(data, dtype=numpy.int64).ravel()
+    diffs = numpy.diff(numpy.concatenate(([0], values)))
+    stream = []
+    for delta in diffs.tolist():
+        if abs(delta) < 128:
+            stream.append(struct.pack("<b", delta))
+        elif abs(delta) < 32768:
+            stream.append(b"\x80" + struct.pack("<h", delta))
+        elif abs(delta) < 2**31:
+            stream.append(b"\x80\x00\x80" + struct.pack("<i", delta))
+        else:
+            stream.append(b"\x80\x00\x80\x00\x00\x00\x80" + \
+                          struct.pack("<q", delta))
+    return b"".join(stream)
+
+def _writePilatusCBF(fname, data):
+    binary = _encodeByteOffset(data)
+    header = "###CBF: VERSION 1.5\r\n" + \
+             "data_test\r\n\r\n" + \
+             "_array_data.data\r\n" + \
+             ";\r\n" + \
+             "--CIF-BINARY-FORMAT-SECTION--\r\n" + \
+             "Content-Type: application/octet-stream;\r\n" + \
+             "     conversions=\"x-CBF_BYTE_OFFSET\"\r\n" + \
+             "Content-Transfer-Encoding: BINARY\r\n" + \
+             "X-Binary-Size: %d\r\n" % len(binary) + \
+             "X-Binary-ID: 1\r\n" + \
+             "X-Binary-Element-Type: \"signed 32-bit integer\"\r\n" + \
+             "X-Binary-Element-Byte-Order: LITTLE_ENDIAN\r\n" + \
+             "X-Binary-Number-of-Elements: %d\r\n" % data.size + \
+             "X-Binary-Size-Fastest-Dimension: %d\r\n" % data.shape[1] + \
+             "X-Binary-Size-Second-Dimension: %d\r\n" % data.shape[0] + \
+             "X-Binary-Size-Padding: 4095\r\n\r\n"
+    with open(fname, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(b"\x0c\x1a\x04\xd5" + binary + b"\x00" * 4095)
+        f.write(b"\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n")
+
 class testEdfFile(unittest.TestCase):
     def setUp(self):
         """
@@ -116,6 +156,130 @@ def testEdfFileReadWrite(self):
         edf =None
         gc.collect()
 
+    def testEdfFileMemmap(self):
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(10000).astype(numpy.uint16)
+        data.shape = 100, 100
+        edf = self.fileClass(self.fname, 'wb+')
+        edf.WriteImage({'Title': "title"}, data)
+        edf.WriteImage({'Title': "title2"}, data.astype(numpy.float64) / 3.,
+                       Append=1, ByteOrder="HighByteFirst")
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb')
+        for i in range(2):
+            self.assertTrue(edf.IsMemmapSupported(i))
+            mapped = edf.GetMemmap(i)
+            self.assertTrue(isinstance(mapped, numpy.memmap))
+            readData = edf.GetData(i)
+            self.assertEqual(mapped.shape, readData.shape)
+            self.assertTrue(numpy.array_equal(mapped, readData))
+        self.assertEqual(edf.GetMemmap(1).dtype.byteorder, ">")
+        mapped = None
+        edf = None
+        gc.collect()
+
+    def testEdfStackMemmap(self):
+        from PyMca5.PyMcaIO import EDFStack
+        tmpDir = tempfile.mkdtemp()
+        try:
+            data = numpy.arange(7 * 20 * 30).astype(numpy.int32)
+            data.shape = 7, 20, 30
+            filelist = []
+            for i in range(data.shape[0]):
+                fname = os.path.join(tmpDir, "image_%04d.edf" % i)
+                edf = self.fileClass(fname, 'wb+')
+                edf.WriteImage({'Title': "image %d" % i}, data[i])
+                edf = None
+                filelist.append(fname)
+            for imagestack in [False, True]:
+                for fileindex in [0, 1]:
+                    stack = EDFStack.EDFStack(imagestack=imagestack,
+                                              dynamic=False)
+                    stack.loadFileList(filelist, fileindex=fileindex)
+                    dynamicStack = EDFStack.EDFStack(imagestack=imagestack,
+                                                     dynamic=True)
+                    dynamicStack.loadFileList(filelist, fileindex=fileindex)
+                    self.assertTrue(isinstance(dynamicStack.data,
+                                               EDFStack.EdfArray))
+                    self.assertEqual(stack.info.get("McaIndex"),
+                                     dynamicStack.info.get("McaIndex"))
+                    self.assertEqual(stack.info["FileIndex"],
+                                     dynamicStack.info["FileIndex"])
+                    expected = stack.data
+                    virtual = dynamicStack.data
+                    self.assertEqual(expected.shape, virtual.shape)
+                    self.assertEqual(expected.dtype, virtual.dtype)
+                    for key in [(), Ellipsis, 2, (slice(None), 3),
+                                (slice(1, 5), slice(None), 4),
+                                (slice(None), slice(2, 3), slice(None, 10, 3)),
+                                (1, 2, 3), (-1, slice(None), -1),
+                                ([0, 3], slice(None))]:
+                        self.assertTrue(numpy.array_equal(expected[key],
+                                                          virtual[key]),
+                                        "Wrong data for %s" % (key,))
+                    self.assertTrue(numpy.array_equal(expected,
+                                                      numpy.array(virtual)))
+            stack = dynamicStack = virtual = None
+            gc.collect()
+        finally:
+            for fname in os.listdir(tmpDir):
+                os.remove(os.path.join(tmpDir, fname))
+            os.rmdir(tmpDir)
+
+    def testPilatusCBF(self):
+        from PyMca5.PyMcaIO import PilatusCBF
+        from PyMca5.PyMcaIO import EDFStack
+        tmpDir = tempfile.mkdtemp()
+        try:
+            # differences of 8, 16, 32 and 64 bits
+            data = numpy.random.poisson(5, (5, 30, 20)).astype(numpy.int32)
+            data[0, 1, 2] = 1000
+            data[1, 3, 4] = -100000
+            data[2, 5, 6] = 2**31 - 1
+            data[2, 5, 7] = -2**31
+            filelist = []
+            for i in range(data.shape[0]):
+                fname = os.path.join(tmpDir, "image_%04d.cbf" % i)
+                _writePilatusCBF(fname, data[i])
+                filelist.append(fname)
+
+            # compiled and python decoders
+            stream = _encodeByteOffset(data[2])
+            decoded = PilatusCBF.decodeByteOffset(stream, data[2].size)
+            self.assertEqual(decoded.dtype, numpy.int32)
+            self.assertTrue(numpy.array_equal(decoded, data[2].ravel()))
+            decoded = numpy.hstack(PilatusCBF._analyseByteOffset(stream))
+            self.assertTrue(numpy.array_equal(decoded.cumsum(),
+                                              data[2].ravel()))
+            self.assertRaises(IOError, PilatusCBF.decodeByteOffset,
+                              stream, data[2].size + 1)
+            self.assertRaises(IOError, PilatusCBF.decodeByteOffset,
+                              stream[:-3], data[2].size)
+
+            for i, fname in enumerate(filelist):
+                edf = self.fileClass(fname, 'rb')
+                self.assertTrue(numpy.array_equal(edf.GetData(0), data[i]))
+
+            for nthreads in [None, 3]:
+                stack = PilatusCBF.readStack(filelist, nthreads=nthreads)
+                self.assertEqual(stack.dtype, numpy.int32)
+                self.assertTrue(numpy.array_equal(stack, data))
+            out = numpy.zeros((5, 32, 18), numpy.float64)
+            PilatusCBF.readStack(filelist, out=out, nthreads=2)
+            self.assertTrue(numpy.array_equal(out[:, :30], data[:, :, :18]))
+            self.assertTrue(numpy.all(out[:, 30:] == 0))
+
+            for imagestack in [False, True]:
+                stack = EDFStack.EDFStack(filelist, imagestack=imagestack,
+                                          dynamic=False)
+                self.assertTrue(numpy.array_equal(stack.data, data))
+            stack = None
+        finally:
+            for fname in os.listdir(tmpDir):
+                os.remove(os.path.join(tmpDir, fname))
+            os.rmdir(tmpDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -125,6 +289,9 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testEdfFile("testEdfFileImport"))
         testSuite.addTest(testEdfFile("testEdfFileReadWrite"))
+        testSuite.addTest(testEdfFile("testEdfFileMemmap"))
+        testSuite.addTest(testEdfFile("testEdfStackMemmap"))
+        testSuite.addTest(testEdfFile("testPilatusCBF"))
     return testSuite
 
 def test(auto=False):
@@ -295,6 +295,119 @@ def testMaterialCrossSectionsCalculation(self):
                     self.assertTrue((100.0 * abs(yTest-yRef)/yRef) < 0.01)
                 energyIndex += 1
 
+    def testVectorizedCrossSectionsCalculation(self):
+        if DEBUG:
+            print()
+            print("Testing Cross Sections Calculation on Energy Arrays")
+        from PyMca5.PyMcaPhysics.xrf import PyMcaEPDL97
+        for ele in ['Fe', 'Pb']:
+            xcomData = self._elements.getelementmassattcoef(ele)
+            grid = xcomData['energy']
+            grid = grid[(grid > 1.0) & (grid < 100.)]
+            # grid points (including absorption edges), points in
+            # between and points below 1 keV
+            energy = numpy.concatenate([grid, 0.5 * (grid[1:] + grid[:-1]),
+                                        [0.3, 0.75, 1.0]])
+            data = self._elements.getMaterialMassAttenuationCoefficients(\
+                                                        ele, 1.0, energy)
+            self.assertEqual(len(data['total']), len(energy))
+            for i, x in enumerate(energy):
+                if x < 1.0:
+                    refData = PyMcaEPDL97.getElementCrossSections(ele, x)
+                    refData = dict((key, refData[key][0]) for key in
+                               ['coherent', 'compton', 'photo', 'total'])
+                else:
+                    refData = self.getCrossSections(ele, x)
+                for key in ['coherent', 'compton', 'photo']:
+                    yRef = refData[key]
+                    yTest = data[key][i]
+                    self.assertTrue(abs(yTest - yRef) <= 1.0e-10 * yRef,
+                        "%s %s at %f keV: %g != %g" % (ele, key, x,
+                                                       yTest, yRef))
+                # vector and scalar calculations must be identical
+                scalar = self._elements.getmassattcoef(ele, x)
+                self.assertEqual(scalar['total'][0], data['total'][i])
+
+    def testPhysicsDatabase(self):
+        if DEBUG:
+            print()
+            print("Testing the precompiled physics database")
+        import shutil
+        import tempfile
+        from PyMca5.PyMcaPhysics.xrf import PhysicsDatabase
+        from PyMca5.PyMcaPhysics.xrf import PyMcaEPDL97
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpDir, "PhysicsDatabase.bin")
+            PhysicsDatabase.build(fname)
+            database = PhysicsDatabase.PhysicsDatabase(fname)
+            self.assertTrue(database.isValid())
+
+            # the element properties and transitions
+            ddict = self._elements._getElementDict()
+            self.assertEqual(database.get("Elements"), ddict)
+
+            # cross sections are memory mapped
+            for ele in ["Fe", "Pb"]:
+                ref = PyMcaEPDL97._readElement(ele)
+                data = database.get("EPDL97/" + ele)
+                self.assertEqual(sorted(ref.keys()), sorted(data.keys()))
+                for key in ref:
+                    self.assertTrue(numpy.array_equal(ref[key], data[key]))
+                self.assertFalse(data["energy"].flags.owndata)
+                ref = self._elements._readXCOMFile(ele)
+                data = database.get("XCOM/" + ele)
+                for key in ref:
+                    self.assertTrue(numpy.array_equal(ref[key], data[key]))
+                # modifications are not written to the file
+                data["energy"][0] = -1.0
+                data = PhysicsDatabase.PhysicsDatabase(fname).get("XCOM/" + ele)
+                self.assertEqual(data["energy"][0], ref["energy"][0])
+            self.assertEqual(database.get("XCOM/Unknown"), None)
+            # values and types
+            def assertSame(value, ref):
+                self.assertEqual(type(value), type(ref))
+                if isinstance(ref, dict):
+                    self.assertEqual(sorted(value.keys()), sorted(ref.keys()))
+                    for key in ref:
+                        assertSame(value[key], ref[key])
+                elif isinstance(ref, (list, tuple)):
+                    self.assertEqual(len(value), len(ref))
+                    for item, refItem in zip(value, ref):
+                        assertSame(item, refItem)
+                elif isinstance(ref, numpy.ndarray):
+                    self.assertEqual(value.dtype, ref.dtype)
+                    self.assertTrue(numpy.array_equal(value, ref))
+                else:
+                    self.assertEqual(value, ref)
+            assertSame(database.get("Elements"), ddict)
+            from PyMca5.PyMcaIO import ConfigDict
+            from PyMca5.PyMcaPhysics.xrf import Scofield1973
+            ref = ConfigDict.ConfigDict()
+            ref.read(Scofield1973.dictfile)
+            assertSame(database.get("Scofield1973"), ref)
+            database = None
+
+            # only used when PYMCA_CACHE_DIR is set
+            oldValue = os.environ.pop("PYMCA_CACHE_DIR", None)
+            try:
+                self.assertEqual(PhysicsDatabase.getDefaultFilename(), None)
+                os.environ["PYMCA_CACHE_DIR"] = tmpDir
+                self.assertEqual(PhysicsDatabase.getDefaultFilename(), fname)
+            finally:
+                if oldValue is None:
+                    del os.environ["PYMCA_CACHE_DIR"]
+                else:
+                    os.environ["PYMCA_CACHE_DIR"] = oldValue
+
+            # a file of another format is rejected without reading it
+            with open(fname, "wb") as f:
+                f.write(b"PYMCADB1" + b"\0" * 64)
+            self.assertRaises(IOError, PhysicsDatabase.PhysicsDatabase,
+                              fname)
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
     def testMaterialCompositionCalculation(self):
         if DEBUG:
             print()
@@ -320,7 +433,9 @@ def getSuite(auto=True):
         testSuite.addTest(testElements("testElementCrossSectionsReadout"))
         testSuite.addTest(testElements("testElementCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCrossSectionsCalculation"))
+        testSuite.addTest(testElements("testVectorizedCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCompositionCalculation"))
+        testSuite.addTest(testElements("testPhysicsDatabase"))
     return testSuite
 
 def test(auto=False):
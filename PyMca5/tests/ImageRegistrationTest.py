@@ -0,0 +1,237 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+from numpy.fft import fft2
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+# subpixel shifts of the images of the synthetic stack
+SHIFTS = numpy.array([[0.0, 0.0],
+                      [1.3, -2.6],
+                      [-3.5, 0.7],
+                      [2.2, 4.1],
+                      [-0.4, -1.8],
+                      [5.0, 3.0],
+                      [-2.9, -4.4]])
+
+
+def _syntheticImage(shape=(64, 72)):
+    """
+    Sum of gaussians far from the borders: its FFT shifts are (almost)
+    exact for shifts of a few pixels
+    """
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]].astype(numpy.float64)
+    image = numpy.zeros(shape, numpy.float64)
+    for y0, x0, sigma, height in [(20., 25., 3., 1.),
+                                  (40., 50., 4., 0.7),
+                                  (35., 20., 2., 0.5),
+                                  (15., 52., 2.5, 0.8)]:
+        image += height * numpy.exp(-0.5 * ((y - y0) ** 2 +
+                                            (x - x0) ** 2) / sigma ** 2)
+    return image
+
+
+def _syntheticStack(shape=(64, 72)):
+    """
+    Stack of shape (nimages,) + shape with the reference image shifted
+    by SHIFTS
+
+    :returns: reference image, stack
+    """
+    from PyMca5.PyMcaMath import ImageRegistration
+    reference = _syntheticImage(shape)
+    stack = numpy.array([ImageRegistration.shiftFFT(reference, shift)
+                         for shift in SHIFTS])
+    return reference, stack
+
+
+class testImageRegistration(unittest.TestCase):
+    def setUp(self):
+        self._tmpDir = None
+
+    def tearDown(self):
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir)
+
+    def testImageRegistrationImport(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+
+    def testMeasureStackOffsets(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+        reference, stack = _syntheticStack()
+        offsets = [2, 3]
+        widths = [56, 60]
+        roi = (slice(offsets[0], offsets[0] + widths[0]),
+               slice(offsets[1], offsets[1] + widths[1]))
+        window = numpy.zeros(widths, numpy.float32)
+        window[5:-5, 5:-5] = 1
+        dtype = numpy.float32
+        # the loop measure_stack_offsets replaces
+        image0 = reference[roi].astype(dtype) * window
+        image0fft2 = fft2(image0)
+        expected = numpy.zeros((len(stack), 2), numpy.float64)
+        for i, image in enumerate(stack):
+            image = image[roi].astype(dtype) * window
+            expected[i] = ImageRegistration.measure_offset_from_ffts(
+                                                    image0fft2, fft2(image))
+        # small batches to have several of them
+        nbytes = 16 * widths[0] * widths[1] * 2
+        for index in [0, 2]:
+            if index == 0:
+                data = stack
+            else:
+                data = numpy.ascontiguousarray(numpy.moveaxis(stack, 0, -1))
+            for nthreads in [None, 2]:
+                progress = []
+                shifts = ImageRegistration.measure_stack_offsets(
+                                    reference, data, index=index,
+                                    offsets=offsets, widths=widths,
+                                    window=window, dtype=dtype,
+                                    nbytes=nbytes, nthreads=nthreads,
+                                    callback=progress.append)
+                numpy.testing.assert_allclose(shifts, expected,
+                                              rtol=1e-7, atol=1e-7)
+                self.assertTrue(len(progress) > 1)
+                self.assertEqual(progress[-1], 100.)
+
+    def testShiftStackFFT(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+        reference, stack = _syntheticStack()
+        shape = stack.shape[1:]
+        shifts = -SHIFTS[::-1]
+        window = numpy.zeros(shape, numpy.float32)
+        window[6:-6, 5:-5] = 1
+        expected = numpy.array([ImageRegistration.shiftFFT(image, shift)
+                                for image, shift in zip(stack, shifts)])
+        nbytes = 16 * stack[0].size * 2
+        # in place
+        for index in [0, 2]:
+            for nthreads in [None, 2]:
+                if index == 0:
+                    data = stack.copy()
+                else:
+                    data = numpy.ascontiguousarray(
+                                            numpy.moveaxis(stack, 0, -1))
+                ImageRegistration.shiftStackFFT(data, shifts, index=index,
+                                                nbytes=nbytes,
+                                                nthreads=nthreads)
+                if index == 2:
+                    data = numpy.moveaxis(data, -1, 0)
+                numpy.testing.assert_allclose(data, expected, atol=1e-10)
+        # into another stack, cropped by the window
+        output = numpy.zeros(stack.shape, numpy.float32)
+        ImageRegistration.shiftStackFFT(stack, shifts, output=output,
+                                        window=window, nbytes=nbytes,
+                                        nthreads=2)
+        numpy.testing.assert_allclose(output, expected * window, atol=1e-6)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testShiftStackFFTHdf5(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+        reference, stack = _syntheticStack()
+        shifts = -SHIFTS
+        expected = numpy.array([ImageRegistration.shiftFFT(image, shift)
+                                for image, shift in zip(stack, shifts)])
+        self._tmpDir = tempfile.mkdtemp(prefix="pymca")
+        fname = os.path.join(self._tmpDir, "registration.h5")
+        with h5py.File(fname, "w") as h5:
+            h5.create_dataset("data", data=stack, chunks=(1,) + stack.shape[1:])
+            output = h5.create_dataset("shifted", shape=stack.shape,
+                                       dtype=numpy.float32)
+            ImageRegistration.shiftStackFFT(h5["data"], shifts,
+                                            output=output,
+                                            nbytes=16 * stack[0].size * 3,
+                                            nthreads=2)
+        with h5py.File(fname, "r") as h5:
+            numpy.testing.assert_array_equal(h5["data"][()], stack)
+            numpy.testing.assert_allclose(h5["shifted"][()], expected,
+                                          atol=1e-6)
+
+    def testRealignStack(self):
+        # the convention of ImageAlignmentStackPlugin: the offsets are
+        # measured respect to the reference and the stack is shifted by
+        # minus the offsets, cropped to the region common to all images
+        from PyMca5.PyMcaMath import ImageRegistration
+        reference, stack = _syntheticStack()
+        shape = reference.shape
+        for index in [0, 2]:
+            if index == 0:
+                data = stack.copy()
+            else:
+                data = numpy.ascontiguousarray(numpy.moveaxis(stack, 0, -1))
+            shifts = ImageRegistration.measure_stack_offsets(reference, data,
+                                                             index=index,
+                                                             nthreads=2)
+            self.assertTrue(numpy.abs(shifts - SHIFTS).max() < 0.5)
+            d0_start, d0_end, d1_start, d1_end = \
+                ImageRegistration.get_crop_indices(shape, shifts[:, 0],
+                                                   shifts[:, 1])
+            window = numpy.zeros(shape, numpy.float32)
+            window[d0_start:d0_end, d1_start:d1_end] = 1
+            ImageRegistration.shiftStackFFT(data, -shifts, index=index,
+                                            window=window, nthreads=2)
+            if index == 2:
+                data = numpy.moveaxis(data, -1, 0)
+            for image, shifted in zip(data, stack):
+                before = numpy.abs(shifted - reference).max()
+                after = numpy.abs(image - reference * window).max()
+                self.assertTrue(after < 0.1 * reference.max(),
+                                "Image not realigned (%f)" % after)
+                self.assertTrue(after <= 0.25 * before + 1e-10)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testImageRegistration))
+    else:
+        # use a predefined order
+        testSuite.addTest(testImageRegistration("testImageRegistrationImport"))
+        testSuite.addTest(testImageRegistration("testMeasureStackOffsets"))
+        testSuite.addTest(testImageRegistration("testShiftStackFFT"))
+        testSuite.addTest(testImageRegistration("testShiftStackFFTHdf5"))
+        testSuite.addTest(testImageRegistration("testRealignStack"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
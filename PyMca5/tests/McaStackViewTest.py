@@ -241,6 +241,35 @@ def testMaskedViewH5py(self):
                 f.create_dataset(name, data=data, chunks=(1,)*ndim)
                 self._assertMaskedView(f[name])
 
+    @unittest.skipIf(McaStackView is None,
+                     'PyMca5.PyMcaCore.McaStackView cannot be imported')
+    @unittest.skipIf(h5py is None,
+                     'h5py cannot be imported')
+    def testReadAheadRows(self):
+        data = numpy.random.uniform(size=(11, 5, 7))
+        rowbytes = data[0].nbytes
+        with self.h5Open('testReadAheadRows') as f:
+            f.create_dataset('data', data=data, chunks=(2, 5, 7))
+            for source in [data, f['data']]:
+                for nbytes in [None, rowbytes, 3*rowbytes, 20*rowbytes]:
+                    for prefetch in [1, 3]:
+                        rows = McaStackView.ReadAheadRows(source,
+                                                          nbytes=nbytes,
+                                                          prefetch=prefetch,
+                                                          start=1)
+                        if nbytes and nbytes >= 8*rowbytes:
+                            self.assertEqual(rows.nRowsPerSlab % 2, 0)
+                        indices = []
+                        for i, row in rows:
+                            indices.append(i)
+                            numpy.testing.assert_array_equal(row, data[i])
+                        self.assertEqual(indices, list(range(1, 11)))
+                # Interrupted iteration stops the reader
+                for i, row in McaStackView.ReadAheadRows(source, nbytes=rowbytes):
+                    if i == 2:
+                        break
+                self.assertEqual(i, 2)
+
     def _assertFullView(self, data):
         mcaSlice = slice(2, -1)
         for nMca in range(numpy.prod(data.shape[1:])+2):
@@ -316,6 +345,42 @@ def _assertMaskedView(self, data):
                         numpy.testing.assert_array_equal(_data[idxFull],
                                                          dataOrg[idxFull]+npAdd[idxFull])
 
+    @unittest.skipIf(McaStackView is None,
+                     'PyMca5.PyMcaCore.McaStackView cannot be imported')
+    @unittest.skipIf(h5py is None,
+                     'h5py cannot be imported')
+    def testThreadedItems(self):
+        self.assertEqual(McaStackView.chunkAlignedRows(7, None), 7)
+        self.assertEqual(McaStackView.chunkAlignedRows(7, (3, 5, 7)), 6)
+        self.assertEqual(McaStackView.chunkAlignedRows(2, (3, 5, 7)), 2)
+        for nthreads in [None, 1, 0, 3]:
+            result = McaStackView.threadedMap(lambda x: x * x, range(20),
+                                              nthreads=nthreads)
+            self.assertEqual(list(result), [x * x for x in range(20)])
+            result = McaStackView.threadedMap(lambda x: x * x, range(20),
+                                              nthreads=nthreads,
+                                              ordered=False)
+            self.assertEqual(sorted(result), [x * x for x in range(20)])
+        data = numpy.random.uniform(size=(11, 5, 7))
+        with self.h5Open('testThreadedItems') as f:
+            f.create_dataset('data', data=data, chunks=(2, 5, 7))
+            self.assertEqual(McaStackView.chunkAlignedNMca(data, 17), 17)
+            self.assertEqual(McaStackView.chunkAlignedNMca(f['data'], 17), 10)
+            self.assertEqual(McaStackView.chunkAlignedNMca(f['data'], 17,
+                                                           mcaAxis=0), 17)
+            self.assertEqual(McaStackView.chunkAlignedNMca(f['data'], 2), 5)
+            for source in [data, f['data']]:
+                nMca = McaStackView.chunkAlignedNMca(source, 10)
+                view = McaStackView.FullView(source, mcaAxis=2, nMca=nMca)
+                for nthreads in [None, 2]:
+                    result = numpy.zeros(data.shape[:2])
+                    for idx, value in view.imapItems(
+                            lambda key, chunk: (key[0],
+                                                chunk.sum(axis=-1)),
+                            keyType='select', nthreads=nthreads):
+                        result[idx] = value.reshape(result[idx].shape)
+                    numpy.testing.assert_allclose(result, data.sum(axis=-1))
+
     @contextmanager
     def h5Open(self, name):
         filename = os.path.join(self.path, name+'.h5')
@@ -337,6 +402,8 @@ def getSuite(auto=True):
         testSuite.addTest(testMcaStackView('testMaskedChunkIndex'))
         testSuite.addTest(testMcaStackView('testMaskedViewNumpy'))
         testSuite.addTest(testMcaStackView('testMaskedViewH5py'))
+        testSuite.addTest(testMcaStackView('testReadAheadRows'))
+        testSuite.addTest(testMcaStackView('testThreadedItems'))
     return testSuite
 
 
@@ -0,0 +1,246 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+
+def _syntheticStack(nRows=12, nColumns=10, nChannels=64):
+    """
+    Nonnegative stack of two components with separated peaks and pure
+    pixels, so the decomposition is unique (up to the scale)
+
+    :returns: stack (nRows, nColumns, nChannels), maps (2, nRows, nColumns),
+              spectra (2, nChannels)
+    """
+    x = numpy.arange(nChannels, dtype=numpy.float64)
+    spectra = numpy.zeros((2, nChannels), numpy.float64)
+    spectra[0] = numpy.exp(-0.5 * ((x - 0.25 * nChannels) / 3.) ** 2)
+    spectra[1] = 0.6 * numpy.exp(-0.5 * ((x - 0.6 * nChannels) / 4.) ** 2)
+    y, z = numpy.mgrid[0:nRows, 0:nColumns]
+    maps = numpy.zeros((2, nRows, nColumns), numpy.float64)
+    maps[0] = 1.0 + numpy.cos(y / 3.0)
+    maps[1] = 1.0 + numpy.sin(z / 2.0 + 1.0)
+    # pure pixels
+    maps[0, 0, :3] = 0
+    maps[1, -1, -3:] = 0
+    stack = numpy.tensordot(maps, spectra, axes=(0, 0))
+    return stack, maps, spectra
+
+
+class testNNMAModule(unittest.TestCase):
+    def setUp(self):
+        self._tmpDir = None
+
+    def tearDown(self):
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir)
+
+    def assertSpectra(self, vectors, spectra, channels=None):
+        """
+        The spectra are found, in any order and scale
+        """
+        if channels is None:
+            channels = slice(None)
+        self.assertFalse(numpy.isnan(vectors).any())
+        found = []
+        for spectrum in spectra:
+            spectrum = spectrum[channels]
+            cosines = [numpy.dot(v[channels], spectrum) / \
+                       max(numpy.linalg.norm(v[channels]) * \
+                           numpy.linalg.norm(spectrum), 1e-300)
+                       for v in vectors]
+            found.append(int(numpy.argmax(cosines)))
+            self.assertTrue(max(cosines) > 0.999,
+                            "Component not found (cosine %f)" % max(cosines))
+        self.assertEqual(sorted(found), list(range(len(spectra))))
+
+    def testNNMAModuleImport(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+
+    def testNNMASortComponents(self):
+        # nnma results as before the sorting was moved to _sortComponents
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        from PyMca5.PyMcaMath.mva import py_nnma
+        stack, maps, spectra = _syntheticStack()
+        r, c, N = stack.shape
+        ncomponents = 2
+        numpy.random.seed(1)
+        images, values, vectors = NNMAModule.nnma(stack.copy(), ncomponents,
+                                                  function="FastHALS",
+                                                  eps=1e-8, maxcount=200,
+                                                  verbose=False)
+
+        numpy.random.seed(1)
+        data = stack.copy().reshape(r * c, N)
+        param = dict(alpha=.1, tau=2, regul=1e-2, sparse_par=1e-1, psi=1e-3)
+        A, X, obj, count, converged = py_nnma.FastHALS(data, ncomponents,
+                                                       None, None,
+                                                       eps=1e-8, maxcount=200,
+                                                       verbose=False, **param)
+        images0 = A.T
+        for i in range(ncomponents):
+            norm_factor = numpy.max(images0[i, :])
+            if norm_factor > 0:
+                images0[i, :] *= 1.0/norm_factor
+                X[i, :] *= norm_factor
+        total_nnma_intensity = []
+        for i in range(ncomponents):
+            total_nnma_intensity += [[numpy.sum(images0[i,:])*\
+                                      numpy.sum(X[i,:]), i]]
+        sorted_idx = [item[1] for item in sorted(total_nnma_intensity)]
+        sorted_idx.reverse()
+        original_intensity = numpy.sum(data)
+        new_images = numpy.zeros((ncomponents, r*c), numpy.float32)
+        new_vectors = numpy.zeros((X.shape[0], X.shape[1]), numpy.float32)
+        new_values = numpy.zeros((ncomponents,), numpy.float32)
+        for i in range(ncomponents):
+            idx = sorted_idx[i]
+            new_images[i, :] = images0[idx, :]
+            new_vectors[i,:] = X[idx,:]
+            new_values[i] = 100.*total_nnma_intensity[idx][0]/original_intensity
+        new_images.shape = ncomponents, r, c
+
+        numpy.testing.assert_array_equal(images, new_images)
+        numpy.testing.assert_array_equal(values, new_values)
+        numpy.testing.assert_array_equal(vectors, new_vectors)
+        self.assertSpectra(vectors, spectra)
+
+    def testChunkedNNMA(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        stack, maps, spectra = _syntheticStack()
+        r, c, N = stack.shape
+        results = {}
+        for online in [False, True]:
+            for nthreads in [None, 2]:
+                # small blocks to have several of them
+                images, values, vectors = NNMAModule.chunkedNNMA(stack, 2,
+                                                    online=online,
+                                                    nthreads=nthreads,
+                                                    nbytes=4 * c * N * 8,
+                                                    eps=1e-10, maxcount=2000,
+                                                    seed=0, verbose=False)
+                self.assertEqual(images.shape, (2, r, c))
+                self.assertEqual(vectors.shape, (2, N))
+                self.assertEqual(values.shape, (2,))
+                self.assertAlmostEqual(images.max(), 1.0, places=5)
+                self.assertTrue(values[0] >= values[1])
+                self.assertSpectra(vectors, spectra)
+                results[online, nthreads] = images, values, vectors
+        # the threads only change the order of the sums
+        for online in [False, True]:
+            for serial, threaded in zip(results[online, None],
+                                        results[online, 2]):
+                numpy.testing.assert_allclose(threaded, serial,
+                                              rtol=1e-4, atol=1e-6)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testChunkedNNMAHdf5(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        stack, maps, spectra = _syntheticStack()
+        r, c, N = stack.shape
+        self._tmpDir = tempfile.mkdtemp(prefix="pymca")
+        fname = os.path.join(self._tmpDir, "nnma.h5")
+        with h5py.File(fname, "w") as h5:
+            h5.create_dataset("data", data=stack, chunks=(3, c, N))
+        binned = stack.reshape(r, c, N // 2, 2).sum(axis=-1)
+        binnedSpectra = spectra.reshape(2, N // 2, 2).sum(axis=-1)
+        kw = dict(binning=2, eps=1e-10, maxcount=2000, seed=0, verbose=False,
+                  nbytes=5 * c * N * 8)
+        with h5py.File(fname, "r") as h5:
+            images, values, vectors = NNMAModule.chunkedNNMA(h5["data"], 2,
+                                                             nthreads=2, **kw)
+        self.assertEqual(vectors.shape, (2, N // 2))
+        self.assertSpectra(vectors, binnedSpectra)
+        images0, values0, vectors0 = NNMAModule.chunkedNNMA(stack, 2, **kw)
+        numpy.testing.assert_allclose(images, images0, rtol=1e-4, atol=1e-6)
+        numpy.testing.assert_allclose(vectors, vectors0, rtol=1e-4, atol=1e-6)
+        numpy.testing.assert_allclose(values, values0, rtol=1e-4)
+
+    def testChunkedNNMAMasks(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        stack, maps, spectra = _syntheticStack()
+        r, c, N = stack.shape
+        data = stack.copy()
+        # non finite pixels excluded by the spatial mask
+        mask = numpy.ones((r, c), numpy.uint8)
+        data[2, 3] = numpy.nan
+        data[7, :] = numpy.inf
+        mask[2, 3] = 0
+        mask[7, :] = 0
+        # channels with a spurious signal excluded by the spectral mask
+        spectralMask = numpy.ones((N,), numpy.uint8)
+        spectralMask[-8:] = 0
+        data[:, :, -8:] += 100.0
+        for online in [False, True]:
+            images, values, vectors = NNMAModule.chunkedNNMA(data, 2,
+                                                    mask=mask,
+                                                    spectral_mask=spectralMask,
+                                                    online=online,
+                                                    nbytes=3 * c * N * 8,
+                                                    eps=1e-10, maxcount=2000,
+                                                    seed=0, verbose=False)
+            self.assertTrue(numpy.isfinite(images).all())
+            self.assertTrue(numpy.isfinite(values).all())
+            self.assertTrue((vectors[:, -8:] == 0).all())
+            self.assertTrue((images[:, 2, 3] == 0).all())
+            self.assertTrue((images[:, 7, :] == 0).all())
+            self.assertSpectra(vectors, spectra, channels=slice(0, N - 8))
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testNNMAModule))
+    else:
+        # use a predefined order
+        testSuite.addTest(testNNMAModule("testNNMAModuleImport"))
+        testSuite.addTest(testNNMAModule("testNNMASortComponents"))
+        testSuite.addTest(testNNMAModule("testChunkedNNMA"))
+        testSuite.addTest(testNNMAModule("testChunkedNNMAHdf5"))
+        testSuite.addTest(testNNMAModule("testChunkedNNMAMasks"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
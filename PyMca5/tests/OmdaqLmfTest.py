@@ -0,0 +1,178 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import gc
+import struct
+import tempfile
+import numpy
+
+BLOCK_SIZE = 2420
+N_CHANNELS = [512, 0, 256, 0, 0, 0, 0, 1024]
+
+def _writeLmf(fname, events, lmf_version):
+    header = struct.pack("BBBBH", 1, 66, 2, lmf_version, BLOCK_SIZE)
+    header += b"\0" * 1043
+    for nChannels in N_CHANNELS:
+        adc = struct.pack("H3f9s", 1, 0.1, 0.01, nChannels, b"ADC")
+        header += adc + b"\0" * (122 - len(adc))
+    if lmf_version < 2:
+        fmt = "<BBH"
+    else:
+        fmt = "<III"
+    size = struct.calcsize(fmt)
+    nMax = (BLOCK_SIZE - 20) // size
+    blocks = []
+    i = 0
+    while i < len(events):
+        n = min(numpy.random.randint(nMax // 2, nMax + 1), len(events) - i)
+        block = b"\1" * 20
+        for adc, row, col, energy in events[i:i + n]:
+            block += struct.pack(fmt, row, col, (adc << 12) | energy)
+        block += b"\xff" * (BLOCK_SIZE - len(block))
+        blocks.append(block)
+        i += n
+    with open(fname, "wb") as f:
+        f.write(header)
+        f.write(b"".join(blocks))
+
+class testOmdaqLmf(unittest.TestCase):
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix=".lmf")
+        os.close(fd)
+
+    def tearDown(self):
+        gc.collect()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def _events(self, n, lmf_version):
+        events = numpy.zeros((n, 4), dtype=numpy.int64)
+        events[:, 0] = numpy.random.choice([0, 1, 2, 7], n)
+        events[:, 1] = numpy.random.randint(0, 256, n)
+        events[:, 2] = numpy.random.randint(0, 256, n)
+        events[:, 3] = numpy.random.randint(0, 1100, n)
+        # a few events at the same position
+        events[:100, 1:3] = 10
+        if lmf_version >= 2:
+            # out of the 256 x 256 map
+            events[-5:, 1] = 300
+        return events
+
+    def _expected(self, events):
+        expected = [None] * 8
+        for adc, nChannels in enumerate(N_CHANNELS):
+            if nChannels < 1 or not (events[:, 0] == adc).any():
+                continue
+            data = numpy.zeros((256, 256, nChannels), dtype=numpy.uint32)
+            selected = events[(events[:, 0] == adc) & \
+                              (events[:, 1] < 256) & \
+                              (events[:, 3] < nChannels)]
+            numpy.add.at(data, (selected[:, 1], selected[:, 2],
+                                selected[:, 3]), 1)
+            expected[adc] = data
+        return expected
+
+    def _check(self, stacks, expected):
+        self.assertEqual(len(stacks), 8)
+        for adc in range(8):
+            if expected[adc] is None:
+                self.assertTrue(stacks[adc] is None)
+                continue
+            self.assertEqual(stacks[adc].data.dtype, numpy.uint32)
+            self.assertTrue(numpy.array_equal(stacks[adc].data,
+                                              expected[adc]),
+                            "Wrong data for ADC %d" % adc)
+            self.assertEqual(stacks[adc].info["McaCalib"][2], 0.0)
+            self.assertEqual(stacks[adc].info["SourceName"], "ADC")
+
+    def testOmdaqLmfBinning(self):
+        from PyMca5.PyMcaIO import OmdaqLmf
+        for lmf_version in [1, 2]:
+            events = self._events(5000, lmf_version)
+            _writeLmf(self.fname, events, lmf_version)
+            self.assertTrue(OmdaqLmf.isOmdaqLmf(self.fname))
+            self._check(OmdaqLmf.OmdaqLmf(self.fname),
+                        self._expected(events))
+
+            # single block
+            with open(self.fname, "rb") as f:
+                d = f.read()
+            block = d[-BLOCK_SIZE:]
+            blockEvents = OmdaqLmf.parseLmfBlock(block,
+                                                 lmf_version=lmf_version)
+            self.assertTrue(numpy.array_equal(
+                                blockEvents,
+                                events[-len(blockEvents):] & 0xffff))
+
+            # sparse and dense histograms in chunks
+            stacks = OmdaqLmf.OmdaqLmf([])
+            header = OmdaqLmf.parseInformationHeader(d[:6])
+            adc_list = OmdaqLmf.parseAdcInfo(d, 1, offset=6 + 1043)
+            for chunkSize in [1, 5000]:
+                for chunk in OmdaqLmf.iterLmfEvents(
+                                numpy.frombuffer(d, dtype=numpy.uint8),
+                                header, chunkSize=chunkSize):
+                    stacks.addEvents(chunk, adc_list)
+            self._check(stacks, self._expected(numpy.vstack([events,
+                                                             events])))
+
+    def testOmdaqLmfEventWindow(self):
+        from PyMca5.PyMcaIO import OmdaqLmf
+        events = self._events(3000, 1)
+        _writeLmf(self.fname, events, 1)
+        stacks = OmdaqLmf.OmdaqLmf([self.fname, self.fname],
+                                   firstEvent=700, lastEvent=2100)
+        self._check(stacks, self._expected(numpy.vstack([events[700:2100],
+                                                         events[700:2100]])))
+        stacks = OmdaqLmf.OmdaqLmf([])
+        self.assertEqual(stacks.parseFile(self.fname, firstEvent=2990), 10)
+        self._check(stacks, self._expected(events[2990:]))
+        self.assertEqual(stacks.parseFile(self.fname, firstEvent=5000), 0)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testOmdaqLmf))
+    else:
+        # use a predefined order
+        testSuite.addTest(testOmdaqLmf("testOmdaqLmfBinning"))
+        testSuite.addTest(testOmdaqLmf("testOmdaqLmfEventWindow"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -40,6 +40,24 @@
     # MDP can give very weird errors
     MDP = False
 
+
+def _syntheticStack(nRows=6, nColumns=8, nChannels=32):
+    """
+    Poisson stack of 3 spectral components with very different
+    contributions
+
+    :returns: stack (nRows, nColumns, nChannels) of float64
+    """
+    numpy.random.seed(0)
+    x = numpy.linspace(0, 1, nChannels)
+    components = numpy.array([numpy.exp(-((x - m) / 0.05) ** 2)
+                              for m in (0.25, 0.5, 0.75)])
+    maps = numpy.random.uniform(0, 100, (nRows * nColumns, 3)) * \
+           numpy.array([10., 3., 1.])
+    data = numpy.random.poisson(maps.dot(components) + 1)
+    return data.astype(numpy.float64).reshape(nRows, nColumns, nChannels)
+
+
 class testPCATools(unittest.TestCase):
     def testPCAToolsImport(self):
         from PyMca5.PyMcaMath.mva import PCATools
@@ -149,6 +167,116 @@ def testPCAToolsPCA(self):
                     self.assertTrue(numpy.allclose(-eigenvectors[i],
                                                    numpyEigenvectors[i]))
 
+    def testPCAToolsRandomized(self):
+        from PyMca5.PyMcaMath.mva.PCATools import numpyPCA, randomizedPCA
+        data = _syntheticStack()
+        nRows, nColumns, nChannels = data.shape
+
+        ncomp = 3
+        for scale in [False, True]:
+            ref = numpyPCA(data.copy(), ncomponents=ncomp, scale=scale,
+                           legacy=False)
+            for nthreads in [None, 2]:
+                # small blocks to have several of them
+                result = randomizedPCA(data, ncomponents=ncomp, scale=scale,
+                                       legacy=False, nthreads=nthreads,
+                                       nbytes=2048, seed=0)
+                self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                               ref["eigenvalues"],
+                                               rtol=1e-4))
+                self.assertTrue(numpy.allclose(result["eigenvectors"],
+                                               ref["eigenvectors"],
+                                               atol=1e-3))
+                self.assertEqual(result["scores"].shape,
+                                 (ncomp, nRows, nColumns))
+                scores = ref["scores"]
+                self.assertTrue(numpy.abs(result["scores"] - scores).max() <
+                                1e-3 * numpy.abs(scores).max())
+                self.assertTrue(numpy.allclose(result["variance"],
+                                               ref["variance"]))
+
+        # spatial mask: same as the PCA of the used spectra only
+        mask = numpy.ones((nRows, nColumns), dtype=numpy.uint8)
+        mask[2, 3] = 0
+        ref = numpyPCA(data[mask > 0], ncomponents=ncomp, scale=False,
+                       legacy=False)
+        data[2, 3] = numpy.nan
+        result = randomizedPCA(data, ncomponents=ncomp, mask=mask,
+                               legacy=False, seed=0)
+        self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                       ref["eigenvalues"], rtol=1e-4))
+        self.assertTrue(numpy.allclose(result["eigenvectors"],
+                                       ref["eigenvectors"], atol=1e-3))
+        self.assertEqual(result["pixels"], nRows * nColumns - 1)
+
+    def testPCAToolsIncremental(self):
+        from PyMca5.PyMcaMath.mva.PCATools import numpyPCA, \
+             getCovarianceMatrix, IncrementalPCA
+        from PyMca5.PyMcaMath.mva import PCAModule
+        data = _syntheticStack()
+        nRows, nColumns, nChannels = data.shape
+
+        ncomp = 3
+        for scale in [False, True]:
+            ref = numpyPCA(data.copy(), ncomponents=ncomp, scale=scale,
+                           legacy=False)
+            # the rows arrive one by one
+            ipca = IncrementalPCA(ncomponents=ncomp, scale=scale)
+            for i in range(nRows):
+                ipca.partial_fit(data[i:i + 1])
+            self.assertEqual(ipca.nRows, nRows)
+            cov, avg, pixels = getCovarianceMatrix(data.copy())
+            self.assertTrue(numpy.allclose(ipca.covariance(), cov))
+            self.assertTrue(numpy.allclose(ipca.average(), avg))
+            result = ipca.result(data, legacy=False)
+            self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                           ref["eigenvalues"], rtol=1e-4))
+            self.assertTrue(numpy.allclose(result["eigenvectors"],
+                                           ref["eigenvectors"], atol=1e-4))
+            scores = ref["scores"]
+            self.assertEqual(result["scores"].shape, scores.shape)
+            self.assertTrue(numpy.abs(result["scores"] - scores).max() <
+                            1e-4 * numpy.abs(scores).max())
+            self.assertTrue(numpy.allclose(result["variance"],
+                                           ref["variance"]))
+            self.assertEqual(result["pixels"], nRows * nColumns)
+
+        # a growing stack is updated with the new rows only
+        ref = numpyPCA(data.copy(), ncomponents=ncomp, scale=False,
+                       legacy=False)
+        result = PCAModule.incrementalPCA(data[:2], ncomponents=ncomp,
+                                          legacy=False)
+        ipca = result["incremental"]
+        self.assertEqual(ipca.nRows, 2)
+        result = PCAModule.incrementalPCA(data, ncomponents=ncomp,
+                                          legacy=False, incremental=ipca)
+        self.assertTrue(result["incremental"] is ipca)
+        self.assertEqual(ipca.nRows, nRows)
+        self.assertTrue(numpy.allclose(result["eigenvalues"],
+                                       ref["eigenvalues"], rtol=1e-4))
+        self.assertTrue(numpy.allclose(result["eigenvectors"],
+                                       ref["eigenvectors"], atol=1e-4))
+        # a different stack is not mixed with the previous one
+        result = PCAModule.incrementalPCA(data[::-1], ncomponents=ncomp,
+                                          legacy=False, incremental=ipca)
+        self.assertFalse(result["incremental"] is ipca)
+
+        # spatial mask: same as the PCA of the used spectra only
+        mask = numpy.ones((nRows, nColumns), dtype=numpy.uint8)
+        mask[2, 3] = 0
+        ref = numpyPCA(data[mask > 0], ncomponents=ncomp, scale=False,
+                       legacy=False)
+        data[2, 3] = numpy.nan
+        ipca = IncrementalPCA(ncomponents=ncomp)
+        for i in range(0, nRows, 4):
+            ipca.partial_fit(data[i:i + 4], mask=mask[i:i + 4])
+        eigenvalues, eigenvectors, variance = ipca.components()
+        self.assertTrue(numpy.allclose(eigenvalues,
+                                       ref["eigenvalues"], rtol=1e-4))
+        self.assertTrue(numpy.allclose(eigenvectors,
+                                       ref["eigenvectors"], atol=1e-4))
+        self.assertEqual(ipca.nPixels, nRows * nColumns - 1)
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -195,6 +323,8 @@ def getSuite(auto=True):
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testPCAToolsRandomized"))
+        testSuite.addTest(testPCATools("testPCAToolsIncremental"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
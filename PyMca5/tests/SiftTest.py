@@ -0,0 +1,165 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import sys
+import importlib
+import numpy
+
+# subpixel shifts of the images respect to the reference
+SHIFTS = numpy.array([[1.3, -2.6],
+                      [-3.5, 0.7],
+                      [2.2, 4.1],
+                      [-0.4, -1.8]])
+
+
+def _syntheticImage(shift=(0.0, 0.0), shape=(128, 128), seed=0):
+    """
+    Random blobs (the same for a given seed) shifted by shift
+    """
+    state = numpy.random.RandomState(seed)
+    centers = state.uniform(0.1, 0.9, (30, 2)) * numpy.array(shape)
+    widths = state.uniform(2, 5, 30)
+    heights = state.uniform(0.5, 1.0, 30)
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]].astype(numpy.float64)
+    image = numpy.zeros(shape, numpy.float64)
+    for (c0, c1), w, h in zip(centers, widths, heights):
+        image += h * numpy.exp(-((y - c0 - shift[0]) ** 2 +
+                                 (x - c1 - shift[1]) ** 2) / (2 * w * w))
+    return image.astype(numpy.float32)
+
+
+class testSift(unittest.TestCase):
+    def testSiftImport(self):
+        from PyMca5.PyMcaMath.sift import cpu
+
+    def testSiftKeypointsMatching(self):
+        from PyMca5.PyMcaMath.sift import cpu
+        reference = _syntheticImage()
+        shift = SHIFTS[0]
+        image = _syntheticImage(shift)
+        plan = cpu.SiftPlan(template=reference)
+        kp0 = plan.keypoints(reference)
+        kp1 = plan.keypoints(image)
+        self.assertTrue(kp0.size > 10)
+        self.assertTrue(kp1.size > 10)
+        self.assertTrue(numpy.isfinite(kp0.x).all())
+        self.assertTrue(numpy.isfinite(kp0.y).all())
+        self.assertTrue((kp0.scale > 0).all())
+        matching = cpu.MatchPlan().match(kp0, kp1)
+        self.assertEqual(matching.shape[1], 2)
+        self.assertTrue(matching.shape[0] > 10)
+        # the matched keypoints are shifted copies of each other
+        dy = matching[:, 1].y - matching[:, 0].y
+        dx = matching[:, 1].x - matching[:, 0].x
+        self.assertAlmostEqual(numpy.median(dy), shift[0], delta=0.1)
+        self.assertAlmostEqual(numpy.median(dx), shift[1], delta=0.1)
+        raw = cpu.MatchPlan().match(kp0, kp1, raw_results=True)
+        self.assertEqual(raw.shape, matching.shape)
+
+    def testLinearAlignShifts(self):
+        from PyMca5.PyMcaMath.sift import cpu
+        reference = _syntheticImage()
+        aligner = cpu.LinearAlign(reference)
+        for shift in SHIFTS:
+            result = aligner.align(_syntheticImage(shift), shift_only=True,
+                                   return_all=True)
+            self.assertTrue(result is not None)
+            self.assertEqual(result["result"].shape, reference.shape)
+            numpy.testing.assert_allclose(result["offset"], shift, atol=0.1)
+
+    def testLinearAlignAll(self):
+        from PyMca5.PyMcaMath.sift import cpu
+        reference = _syntheticImage()
+        images = [_syntheticImage(shift) for shift in SHIFTS]
+        aligner = cpu.LinearAlign(reference)
+        serial = [aligner.align(image, shift_only=True, return_all=True)
+                  for image in images]
+        threaded = list(aligner.align_all(iter(images), nthreads=2,
+                                          shift_only=True, return_all=True))
+        self.assertEqual(len(threaded), len(serial))
+        for result, expected in zip(threaded, serial):
+            numpy.testing.assert_array_equal(result["offset"],
+                                             expected["offset"])
+            numpy.testing.assert_array_equal(result["result"],
+                                             expected["result"])
+        self.assertRaises(ValueError, aligner.align_all, images,
+                          relative=True)
+
+    def testSiftWithoutOpenCL(self):
+        # the package falls back to the numpy implementation
+        from PyMca5 import PyMcaMath
+        names = [name for name in sys.modules
+                 if name == "pyopencl" or name.startswith("pyopencl.") or \
+                    name.startswith("PyMca5.PyMcaMath.sift")]
+        saved = dict((name, sys.modules.pop(name)) for name in names)
+        savedSift = getattr(PyMcaMath, "sift", None)
+        sys.modules["pyopencl"] = None
+        try:
+            sift = importlib.import_module("PyMca5.PyMcaMath.sift")
+            cpu = importlib.import_module("PyMca5.PyMcaMath.sift.cpu")
+            self.assertTrue(sift.OPENCL is False)
+            self.assertTrue(sift.SiftPlan is cpu.SiftPlan)
+            self.assertTrue(sift.MatchPlan is cpu.MatchPlan)
+            self.assertTrue(sift.LinearAlign is cpu.LinearAlign)
+        finally:
+            for name in list(sys.modules):
+                if name == "pyopencl" or \
+                   name.startswith("PyMca5.PyMcaMath.sift"):
+                    del sys.modules[name]
+            sys.modules.update(saved)
+            if savedSift is None:
+                if hasattr(PyMcaMath, "sift"):
+                    del PyMcaMath.sift
+            else:
+                PyMcaMath.sift = savedSift
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSift))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSift("testSiftImport"))
+        testSuite.addTest(testSift("testSiftKeypointsMatching"))
+        testSuite.addTest(testSift("testLinearAlignShifts"))
+        testSuite.addTest(testSift("testLinearAlignAll"))
+        testSuite.addTest(testSift("testSiftWithoutOpenCL"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
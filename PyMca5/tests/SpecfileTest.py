@@ -143,6 +143,159 @@ def testSpecfileReadingCompatibleWithUserLocale(self):
                     (datacol[1], data[0][1]))
         gc.collect()
 
+    def testSpecfileIndex(self):
+        #"""Test the index of large files and the reading of appended scans"""
+        self.testSpecfileImport()
+        scan  = "#S %d  ascan  x 0 1 %d 0.1\n"
+        scan += "#N 3\n"
+        scan += "#@MCA 16C\n"
+        scan += "#L x  y  z\n"
+        mcaLine = "@A " + " ".join(["%d" % i for i in range(256)]) + "\n"
+        points = "".join(["%d  %d  %d\n" % (i, 2 * i, 3 * i) + mcaLine
+                          for i in range(20)])
+        fd, fname = tempfile.mkstemp(text=False)
+        os.close(fd)
+        idxname = fname + ".sfI"
+        try:
+            f = open(fname, "w")
+            f.write("#F %s\n\n" % fname)
+            nScans = 0
+            while f.tell() < 5 * 1024 * 1024:
+                nScans += 1
+                f.write(scan % (nScans, 20) + points + "\n")
+            f.close()
+            self._sf = self.specfileClass.Specfile(fname)
+            self.assertEqual(self._sf.scanno(), nScans)
+            self._sf = None
+            gc.collect()
+            self.assertTrue(os.path.exists(idxname),
+                            "Index file not written")
+
+            # append one complete scan and the beginning of another one
+            f = open(fname, "a")
+            f.write(scan % (1, 3) + points + "\n")
+            f.write(scan % (nScans + 1, 20) + points[:50])
+            f.close()
+            self._sf = self.specfileClass.Specfile(fname)
+            self.assertEqual(self._sf.scanno(), nScans + 2)
+            self._scan = self._sf.select("1.2")
+            self.assertEqual(self._scan.lines(), 20)
+            self.assertEqual(self._scan.nbmca(), 20)
+            self.assertEqual(list(self._scan.mca(20)[:3]), [0, 1, 2])
+            self._scan = self._sf.select("%d.1" % nScans)
+            self.assertEqual(self._scan.datacol(3)[-1], 57)
+            self._scan = self._sf.select("%d.1" % (nScans + 1))
+            self.assertEqual(self._scan.nbmca(), 1)
+
+            # complete the last scan
+            f = open(fname, "a")
+            f.write(points[50:] + "\n")
+            f.close()
+            self.assertEqual(self._sf.update(), 1)
+            self.assertEqual(self._sf.scanno(), nScans + 2)
+            self._scan = self._sf.select("%d.1" % (nScans + 1))
+            self.assertEqual(self._scan.lines(), 20)
+            self.assertEqual(self._scan.nbmca(), 20)
+
+            # a rewritten file must not use the index
+            self._sf = None
+            self._scan = None
+            gc.collect()
+            f = open(fname, "w")
+            f.write("#F %s\n\n" % fname)
+            for i in range(3):
+                f.write(scan % (i + 1, 20) + points + "\n")
+            while f.tell() < 5 * 1024 * 1024:
+                f.write("#C comment line\n")
+            f.close()
+            self._sf = self.specfileClass.Specfile(fname)
+            self.assertEqual(self._sf.scanno(), 3)
+            self._scan = self._sf.select("3.1")
+            self.assertEqual(self._scan.lines(), 20)
+        finally:
+            self._sf = None
+            self._scan = None
+            gc.collect()
+            for name in [fname, idxname]:
+                if os.path.exists(name):
+                    os.remove(name)
+
+    def testSpecfileMcaBulkReading(self):
+        #"""Test the reading of all the MCA spectra of scans at once"""
+        self.testSpecfileImport()
+        import numpy
+        from PyMca5.PyMcaIO import SpecFileStack
+        text = "#F bulk\n\n"
+        for scan in range(3):
+            text += "#S %d  mesh\n" % (scan + 1)
+            text += "#N 2\n"
+            text += "#@MCA %dC\n" % 4
+            text += "#@CHANN 10 0 9 1\n"
+            text += "#L x  y\n"
+            for point in range(4):
+                text += "%d  %d\n" % (point, scan)
+                for detector in range(2):
+                    values = ["%d" % (100 * scan + 10 * point + channel + \
+                                      detector)
+                              for channel in range(10)]
+                    text += "@A " + " ".join(values[:4]) + "\\\n"
+                    text += " " + " ".join(values[4:]) + "\n"
+            text += "\n"
+        fd, fname = tempfile.mkstemp(text=False)
+        os.write(fd, text.encode("utf-8"))
+        os.close(fd)
+        try:
+            self._sf = self.specfileClass.Specfile(fname)
+            expected = numpy.zeros((3, 8, 10))
+            for i in range(3):
+                self._scan = self._sf[i]
+                for j in range(8):
+                    expected[i, j] = self._scan.mca(j + 1)
+            self._scan = None
+            self._sf = None
+            gc.collect()
+
+            for nthreads in [None, 2]:
+                out = numpy.zeros((3, 8, 10))
+                nSpectra = SpecFileStack.readScanMca(fname, out,
+                                                     nthreads=nthreads)
+                self.assertEqual(nSpectra, [8, 8, 8])
+                self.assertTrue(numpy.array_equal(out, expected))
+
+            # second detector of the last scans, fewer channels
+            out = numpy.zeros((2, 4, 6), dtype=numpy.float32)
+            SpecFileStack.readScanMca(text.encode("utf-8"), out,
+                                      scanlist=[1, -1], first=1, step=2)
+            self.assertTrue(numpy.array_equal(out,
+                                              expected[1:, 1::2, :6]))
+
+            # output not contiguous
+            out = numpy.zeros((3, 8, 20))
+            SpecFileStack.readScanMca(fname, out[:, :, ::2], nthreads=2)
+            self.assertTrue(numpy.array_equal(out[:, :, ::2], expected))
+            self.assertTrue(numpy.all(out[:, :, 1::2] == 0))
+
+            # the python implementation gives the same result
+            helper = SpecFileStack.PyMcaIOHelper
+            try:
+                SpecFileStack.PyMcaIOHelper = None
+                out = numpy.zeros((3, 8, 12))
+                SpecFileStack.readScanMca(fname, out)
+            finally:
+                SpecFileStack.PyMcaIOHelper = helper
+            self.assertTrue(numpy.array_equal(out[:, :, :10], expected))
+            self.assertTrue(numpy.all(out[:, :, 10:] == 0))
+
+            # with several detectors only the last one of the last scan
+            stack = SpecFileStack.SpecFileStack()
+            stack.loadFileList([fname])
+            self.assertTrue(numpy.array_equal(stack.data[0, 0],
+                                              expected[-1, -1]))
+        finally:
+            gc.collect()
+            if os.path.exists(fname):
+                os.remove(fname)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -154,6 +307,8 @@ def getSuite(auto=True):
         testSuite.addTest(testSpecfile("testSpecfileReading"))
         testSuite.addTest(\
             testSpecfile("testSpecfileReadingCompatibleWithUserLocale"))
+        testSuite.addTest(testSpecfile("testSpecfileIndex"))
+        testSuite.addTest(testSpecfile("testSpecfileMcaBulkReading"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,161 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+
+def _spectra(nSpectra=7, nChannels=500):
+    """
+    Peaks on top of a smooth background with some noise, one spectrum
+    per column as used by the fast linear fit
+    """
+    numpy.random.seed(0)
+    x = numpy.arange(nChannels, dtype=numpy.float64)
+    spectra = numpy.zeros((nChannels, nSpectra), numpy.float64)
+    for k in range(nSpectra):
+        spectrum = 100. * numpy.exp(-x / (200. + 10 * k)) + 5.
+        for center in (80., 210. + k, 350.):
+            spectrum += 500. * numpy.exp(-0.5 * ((x - center) / 4.) ** 2)
+        spectra[:, k] = numpy.random.poisson(spectrum)
+    return spectra
+
+
+def _loopBackground(spectra, snipwidth, sgwidth, anchorslist):
+    """
+    Per spectrum background as calculated before snip1dbackground existed
+    """
+    from PyMca5.PyMcaMath.fitting import SpecfitFuns
+    result = numpy.zeros(spectra.shape, numpy.float64)
+    for k in range(spectra.shape[1]):
+        # obtain the smoothed spectrum
+        background = SpecfitFuns.SavitskyGolay(spectra[:, k], sgwidth)
+        lastAnchor = 0
+        for anchor in anchorslist:
+            if (anchor > lastAnchor) and (anchor < background.size):
+                background[lastAnchor:anchor] =\
+                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
+                                           snipwidth,
+                                           0)
+                lastAnchor = anchor
+        if lastAnchor < background.size:
+            background[lastAnchor:] =\
+                    SpecfitFuns.snip1d(background[lastAnchor:],
+                                       snipwidth,
+                                       0)
+        result[:, k] = background
+    return result
+
+
+class testSpecfitFuns(unittest.TestCase):
+    def setUp(self):
+        """
+        import the module
+        """
+        try:
+            from PyMca5.PyMcaMath.fitting import SpecfitFuns
+            self.specfitFuns = SpecfitFuns
+        except:
+            self.specfitFuns = None
+
+    def testSpecfitFunsImport(self):
+        self.assertTrue(self.specfitFuns is not None)
+
+    def testSnip1dBackground(self):
+        self.testSpecfitFunsImport()
+        spectra = _spectra()
+        for anchorslist in [[], [150, 300], [0, 150, 150, 1000]]:
+            expected = _loopBackground(spectra, 30, 7, anchorslist)
+            for nthreads in [1, 3]:
+                # spectra.T is not contiguous
+                background = self.specfitFuns.snip1dbackground(spectra.T,
+                                                    30,
+                                                    sgwidth=7,
+                                                    anchors=anchorslist,
+                                                    nthreads=nthreads)
+                self.assertEqual(background.shape, spectra.T.shape)
+                self.assertTrue(numpy.array_equal(background.T, expected),
+                        "Background differs for anchors %s and %d threads" % \
+                        (anchorslist, nthreads))
+        # input not modified
+        self.assertTrue(numpy.array_equal(spectra, _spectra()))
+        # single spectrum
+        background = self.specfitFuns.snip1dbackground(spectra[:, 0], 30,
+                                                       sgwidth=7)
+        self.assertTrue(numpy.array_equal(background,
+                                _loopBackground(spectra[:, :1], 30, 7, [])[:, 0]))
+
+    def testSnip1dBackgroundSmoothing(self):
+        self.testSpecfitFunsImport()
+        spectra = _spectra().T
+        background = self.specfitFuns.snip1dbackground(spectra, 25,
+                                                       smoothing=3,
+                                                       nthreads=2)
+        for k in range(spectra.shape[0]):
+            expected = self.specfitFuns.snip1d(spectra[k], 25, 3)
+            self.assertTrue(numpy.array_equal(background[k], expected))
+
+    def testFitBkgSubtract(self):
+        self.testSpecfitFunsImport()
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        config = {"fit": {"snipwidth": 20, "stripfilterwidth": 5}}
+        anchorslist = [120, 260]
+        spectra = _spectra()
+        expected = _loopBackground(spectra, 20, 5, anchorslist)
+        fitmodel = numpy.zeros(spectra.shape, numpy.float64)
+        chunk = spectra.copy()
+        FastXRFLinearFit.FastXRFLinearFit._fitBkgSubtract(chunk,
+                                                          config=config,
+                                                          anchorslist=anchorslist,
+                                                          fitmodel=fitmodel)
+        self.assertTrue(numpy.array_equal(fitmodel, expected))
+        self.assertTrue(numpy.array_equal(chunk, spectra - expected))
+
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testSpecfitFuns))
+    else:
+        # use a predefined order
+        testSuite.addTest(testSpecfitFuns("testSpecfitFunsImport"))
+        testSuite.addTest(testSpecfitFuns("testSnip1dBackground"))
+        testSuite.addTest(testSpecfitFuns("testSnip1dBackgroundSmoothing"))
+        testSuite.addTest(testSpecfitFuns("testFitBkgSubtract"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -32,6 +32,9 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import unittest
 import numpy
+import os
+import shutil
+import tempfile
 
 class DummyArray(object):
     def __init__(self, data):
@@ -200,6 +203,87 @@ def testStackBaseStack2DDataHandling(self):
         dummyArray = None
         referenceData = None
 
+    def testStackBaseROIImageIndex(self):
+        from PyMca5.PyMcaCore import StackBase
+        numpy.random.seed(0)
+        # integer counts with many repeated values to test the
+        # position of the maximum and minimum
+        referenceData = numpy.random.poisson(3, size=(20, 30, 203))
+        referenceData = referenceData.astype(numpy.uint16)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for mcaindex in [0, 2]:
+                if mcaindex == 0:
+                    data = numpy.ascontiguousarray(
+                                referenceData.transpose(2, 0, 1))
+                else:
+                    data = referenceData
+                filename = os.path.join(tmpDir, "index%d" % mcaindex)
+                ranges = [(0, 203), (0, 1), (5, 6), (16, 32), (15, 33),
+                          (3, 200), (190, 203), (1, 202)]
+                for i in range(20):
+                    i0 = numpy.random.randint(0, 202)
+                    ranges.append((i0, numpy.random.randint(i0 + 1, 204)))
+                stackBase = StackBase.StackBase()
+                stackBase.setStack(data, mcaindex=mcaindex)
+                expected = [stackBase.calculateROIImages(i0, i1)
+                            for i0, i1 in ranges]
+                for dynamic in [False, True]:
+                    stackBase = StackBase.StackBase()
+                    if dynamic:
+                        stackBase.setStack(DummyArray(data), mcaindex=mcaindex)
+                    else:
+                        stackBase.setStack(data, mcaindex=mcaindex)
+                    index = stackBase.buildROIImageIndex(filename=filename,
+                                                         blockSize=4)
+                    for (i0, i1), ddict in zip(ranges, expected):
+                        imageDict = stackBase.calculateROIImages(i0, i1)
+                        self.assertEqual(set(imageDict.keys()),
+                                         set(ddict.keys()))
+                        for key in ddict:
+                            self.assertTrue(numpy.allclose(imageDict[key],
+                                                           ddict[key]),
+                                "Incorrect %s image from ROI index (%d, %d)" %
+                                (key, i0, i1))
+                    # the saved index is reused
+                    index2 = stackBase.buildROIImageIndex(filename=filename,
+                                                          blockSize=4)
+                    self.assertTrue(isinstance(index2.cumsum, numpy.memmap))
+                    self.assertTrue(numpy.array_equal(index2.sum(10, 100),
+                                                      index.sum(10, 100)))
+                    # the index is discarded when the stack is updated
+                    stackBase.stackUpdated()
+                    self.assertTrue(stackBase.getROIImageIndex() is None)
+                # a saved index of different data is not reused
+                modified = data.copy()
+                if mcaindex == 0:
+                    modified[:, 0, 0] += 1
+                else:
+                    modified[0, 0, :] += 1
+                stackBase = StackBase.StackBase()
+                stackBase.setStack(modified, mcaindex=mcaindex)
+                index = stackBase.buildROIImageIndex(filename=filename,
+                                                     blockSize=4)
+                self.assertEqual(index.sum(0, 203)[0, 0],
+                                 referenceData[0, 0].sum() + 203)
+            # an index not fitting in memory needs a file
+            from PyMca5.PyMcaCore import StackROIIndex
+            getPhysicalMemoryOrNone = \
+                StackROIIndex.PhysicalMemory.getPhysicalMemoryOrNone
+            StackROIIndex.PhysicalMemory.getPhysicalMemoryOrNone = \
+                lambda: referenceData.nbytes
+            try:
+                self.assertRaises(MemoryError, StackROIIndex.StackROIIndex,
+                                  referenceData, mcaAxis=2)
+                index = StackROIIndex.StackROIIndex(referenceData, mcaAxis=2,
+                                    filename=os.path.join(tmpDir, "large"))
+                self.assertTrue(isinstance(index.cumsum, numpy.memmap))
+            finally:
+                StackROIIndex.PhysicalMemory.getPhysicalMemoryOrNone = \
+                    getPhysicalMemoryOrNone
+        finally:
+            shutil.rmtree(tmpDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -210,6 +294,7 @@ def getSuite(auto=True):
         testSuite.addTest(testStackBase("testStackBaseImport"))
         testSuite.addTest(testStackBase("testStackBaseStack1DDataHandling"))
         testSuite.addTest(testStackBase("testStackBaseStack2DDataHandling"))
+        testSuite.addTest(testStackBase("testStackBaseROIImageIndex"))
     return testSuite
 
 def test(auto=False):
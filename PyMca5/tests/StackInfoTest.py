@@ -36,6 +36,7 @@
 import numpy
 import gc
 import shutil
+import json
 
 try:
     import h5py
@@ -230,6 +231,421 @@ def testStackFastFit(self):
             configuration['fit']['stripalgorithm'] = 1
             self._verifyFastFit(stack, configuration, live_time, nTimes)
 
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testStackFastFitParallel(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration['fit']['stripflag'] = 1
+        configuration['fit']['stripalgorithm'] = 1
+
+        # pixels with different intensities and noise
+        nRows = 4
+        nColumns = 7
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.5, 2, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float32)
+
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        self._h5File = os.path.join(self._outputDir, "stack.h5")
+        with h5py.File(self._h5File, "w") as h5:
+            h5["data"] = data
+
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.setFitConfiguration(configuration)
+        with h5py.File(self._h5File, "r") as h5:
+            for i, source in enumerate([data, h5["data"]]):
+                results = []
+                for nworkers in [None, 2]:
+                    outputRoot = "fit%d_%s" % (i, nworkers)
+                    outbuffer = ffit.fitMultipleSpectra(y=source,
+                                                        weight=0,
+                                                        refit=1,
+                                                        nworkers=nworkers,
+                                                        outputDir=self._outputDir,
+                                                        outputRoot=outputRoot,
+                                                        saveFit=True,
+                                                        save=False)
+                    with outbuffer.bufferContext():
+                        results.append((outbuffer["parameters"].copy(),
+                                        outbuffer["uncertainties"].copy(),
+                                        outbuffer["model"][()]))
+                for serial, parallel in zip(*results):
+                    numpy.testing.assert_array_equal(serial, parallel)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testStackFastFitCompression(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import OutputBuffer
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration['fit']['stripflag'] = 1
+        configuration['fit']['stripalgorithm'] = 1
+
+        nRows = 31
+        nColumns = 11
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.5, 2, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float32)
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.setFitConfiguration(configuration)
+        results = []
+        for compression, background in [(None, False),
+                                         ("gzip", True),
+                                         ("lzf", True)]:
+            outputRoot = "fit_%s" % compression
+            outbuffer = ffit.fitMultipleSpectra(y=data,
+                                                weight=0,
+                                                refit=1,
+                                                outputDir=self._outputDir,
+                                                outputRoot=outputRoot,
+                                                diagnostics=True,
+                                                compression=compression,
+                                                backgroundWriter=background)
+            filename = os.path.join(self._outputDir, outputRoot + ".h5")
+            with h5py.File(filename, "r") as h5:
+                fit = h5["/images/xrf_fit/results/fit"]
+                result = {}
+                for name in ["model", "data", "residuals"]:
+                    dset = fit[name]
+                    self.assertEqual(dset.compression, compression)
+                    # complete spectra in each chunk
+                    self.assertEqual(dset.chunks[-1], data.shape[-1])
+                    result[name] = dset[()]
+                parameters = h5["/images/xrf_fit/results/parameters"]
+                for name in parameters:
+                    if isinstance(parameters[name], h5py.Dataset):
+                        result[name] = parameters[name][()]
+            results.append(result)
+        reference = results[0]
+        numpy.testing.assert_array_equal(reference["data"], data)
+        model = reference["model"]
+        fitted = numpy.isfinite(model[0, 0])
+        self.assertTrue(fitted.any() and not fitted.all())
+        self.assertTrue(numpy.isfinite(model[..., fitted]).all())
+        numpy.testing.assert_array_equal(reference["residuals"],
+                                         data - model)
+        for result in results[1:]:
+            for name, value in reference.items():
+                numpy.testing.assert_array_equal(result[name], value,
+                                                 err_msg=name)
+
+        # raw chunk writing of gzip compressed blocks (incomplete edge chunks)
+        filename = os.path.join(self._outputDir, "writer.h5")
+        block = numpy.random.random((7, 5, 9))
+        with h5py.File(filename, "w") as h5:
+            dset = h5.create_dataset("data", shape=block.shape,
+                                     dtype=block.dtype, chunks=(3, 5, 9),
+                                     **OutputBuffer.compressionArguments("gzip"))
+            with OutputBuffer.BackgroundWriter() as writer:
+                writer.write(dset, (slice(0, 3), slice(None), slice(None)),
+                             block[:3])
+                writer.write(dset, (slice(3, 7), slice(None), slice(None)),
+                             block[3:])
+                # not chunk aligned
+                writer.write(dset, (slice(1, 2), slice(None), slice(None)),
+                             block[1:2] * 2)
+        block[1] *= 2
+        with h5py.File(filename, "r") as h5:
+            numpy.testing.assert_array_equal(h5["data"][()], block)
+
+    def testStackBatchFitWarmStart(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+
+        # pixels with different intensities and noise
+        nRows = 2
+        nColumns = 4
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.8, 1.2, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float64)
+
+        # the solution of a linear fit does not depend on the
+        # starting values
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration["fit"]["linearfitflag"] = 1
+        cfgFile = os.path.join(self._outputDir, "SteelLinear.cfg")
+        configuration.write(cfgFile)
+
+        results = []
+        for warmstart in [False, True]:
+            batch = McaAdvancedFitBatch.McaAdvancedFitBatch(cfgFile,
+                                                            filelist=[data],
+                                                            outputdir=self._outputDir,
+                                                            warmstart=warmstart,
+                                                            nosave=True,
+                                                            quiet=True)
+            batch.processList()
+            stats = batch._fitStatistics
+            self.assertEqual(stats['nfit'], nRows * nColumns)
+            if warmstart:
+                # the first spectrum of each row is estimated
+                self.assertEqual(stats['nwarm'], nRows * (nColumns - 1))
+            else:
+                self.assertEqual(stats['nwarm'], 0)
+            results.append(numpy.array(batch.outbuffer["parameters"]))
+        numpy.testing.assert_allclose(results[0], results[1], rtol=1e-6)
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testStackBatchFitCheckpoint(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+
+        nRows = 3
+        nColumns = 4
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.8, 1.2, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float64)
+
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration["fit"]["linearfitflag"] = 1
+        cfgFile = os.path.join(self._outputDir, "SteelLinear.cfg")
+        configuration.write(cfgFile)
+
+        class InterruptedBatch(McaAdvancedFitBatch.McaAdvancedFitBatch):
+            nInterrupt = None
+            def onMca(self, imca, nmca, filename=None, key=None, info=None):
+                self.nInterrupt -= 1
+                if not self.nInterrupt:
+                    self.pleaseBreak = 1
+
+        def fit(outputDir, checkpoint=None, nInterrupt=None):
+            if nInterrupt:
+                cls = InterruptedBatch
+                cls.nInterrupt = nInterrupt
+            else:
+                cls = McaAdvancedFitBatch.McaAdvancedFitBatch
+            batch = cls(cfgFile, filelist=[data], outputdir=outputDir,
+                        checkpoint=checkpoint, quiet=True,
+                        saveFit=True, edf=False)
+            batch.processList()
+            return batch
+
+        def results(batch):
+            filename = batch.outbuffer.filename(".h5")
+            with h5py.File(filename, "r") as f:
+                model = f["/images/xrf_fit/results/fit/model"][()]
+            return numpy.array(batch.outbuffer["parameters"]), model
+
+        reference = fit(os.path.join(self._outputDir, "reference"))
+        parameters, model = results(reference)
+        self.assertFalse(numpy.isnan(parameters).any())
+
+        outputDir = os.path.join(self._outputDir, "checkpoint")
+        # the spectra restored from the checkpoint are not fitted again
+        # (they are still reported to `onMca`)
+        for nInterrupt, nFit, nProcessed in [(6, 6, 6), (3, 1, 7)]:
+            batch = fit(outputDir, checkpoint=0, nInterrupt=nInterrupt)
+            self.assertTrue(os.path.exists(batch.outbuffer.checkpointFilename))
+            # the allocations are saved as JSON text, not pickled
+            with h5py.File(batch.outbuffer.checkpointFilename, "r") as f:
+                text = f["allocations"][()]
+            if isinstance(text, bytes):
+                text = text.decode("utf-8")
+            labels = [allocation["label"] for allocation in json.loads(text)]
+            self.assertEqual(labels, [allocation[0] for allocation in
+                                      batch.outbuffer.allocations()])
+            self.assertEqual(batch._fitStatistics['nfit'], nFit)
+            self.assertEqual(batch._processed.sum(), nProcessed)
+        batch = fit(outputDir, checkpoint=0)
+        self.assertEqual(batch._fitStatistics['nfit'], nRows * nColumns - 7)
+        self.assertFalse(os.path.exists(batch.outbuffer.checkpointFilename))
+        parameters2, model2 = results(batch)
+        numpy.testing.assert_array_equal(parameters2, parameters)
+        numpy.testing.assert_array_equal(model2, model)
+
+        # a different configuration does not resume
+        batch = fit(outputDir, checkpoint=0, nInterrupt=6)
+        configuration["fit"]["linearfitflag"] = 0
+        configuration.write(cfgFile)
+        batch = fit(outputDir, checkpoint=0)
+        self.assertEqual(batch._fitStatistics['nfit'], nRows * nColumns)
+
+    def testStackBatchFitScheduler(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        from PyMca5.PyMcaPhysics.xrf import XRFBatchScheduler
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+
+        nRows = 7
+        nColumns = 4
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.5, 2.0, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float64)
+
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration["fit"]["linearfitflag"] = 1
+        cfgFile = os.path.join(self._outputDir, "SteelLinear.cfg")
+        configuration.write(cfgFile)
+
+        kwargs = {"filelist": [data], "quiet": True, "saveFit": True,
+                  "edf": False, "concentrations": 1}
+        reference = McaAdvancedFitBatch.McaAdvancedFitBatch(
+                        cfgFile,
+                        outputdir=os.path.join(self._outputDir, "reference"),
+                        **kwargs)
+        reference.processList()
+        # blocks of 2 rows: the last block is incomplete
+        batch = XRFBatchScheduler.BatchScheduler(
+                        cfgFile,
+                        outputdir=os.path.join(self._outputDir, "scheduler"),
+                        nworkers=2, blockrows=2, **kwargs)
+        batch.processList()
+        self.assertEqual(batch._fitStatistics['nfit'], nRows * nColumns)
+
+        for name in ["parameters", "uncertainties", "massfractions", "chisq"]:
+            numpy.testing.assert_array_equal(batch.outbuffer[name],
+                                             reference.outbuffer[name])
+        path = "/images/xrf_fit/results/fit/model"
+        with h5py.File(reference.outbuffer.filename(".h5"), "r") as f:
+            model = f[path][()]
+        with h5py.File(batch.outbuffer.filename(".h5"), "r") as f:
+            model2 = f[path][()]
+        numpy.testing.assert_array_equal(model2, model)
+
+        # blocks which cannot be fitted are reported and nothing is saved
+        import multiprocessing
+        if multiprocessing.get_start_method() == "fork":
+            # the forked workers inherit the failing method
+            def processList(worker):
+                if worker.rows[0] == 2:
+                    raise ValueError("Fit failure")
+                McaAdvancedFitBatch.McaAdvancedFitBatch.processList(worker)
+            XRFBatchScheduler._WorkerBatch.processList = processList
+            try:
+                batch = XRFBatchScheduler.BatchScheduler(
+                        cfgFile,
+                        outputdir=os.path.join(self._outputDir, "failed"),
+                        nworkers=2, blockrows=2, **kwargs)
+                self.assertRaises(RuntimeError, batch.processList)
+                self.assertEqual(batch.failedRows, [(2, 4)])
+                self.assertFalse(os.path.exists(batch.outbuffer.filename(".h5")))
+            finally:
+                del XRFBatchScheduler._WorkerBatch.processList
+
+        # the key of remote workers
+        oldValue = os.environ.pop(XRFBatchScheduler.AUTHKEY_ENV, None)
+        try:
+            self.assertEqual(len(XRFBatchScheduler.getAuthKey()), 16)
+            self.assertEqual(XRFBatchScheduler.getAuthKey("key"), b"key")
+            os.environ[XRFBatchScheduler.AUTHKEY_ENV] = "secret"
+            self.assertEqual(XRFBatchScheduler.getAuthKey(), b"secret")
+        finally:
+            if oldValue is None:
+                del os.environ[XRFBatchScheduler.AUTHKEY_ENV]
+            else:
+                os.environ[XRFBatchScheduler.AUTHKEY_ENV] = oldValue
+
+    def testStackBatchFitShared(self):
+        import tempfile
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import OutputBuffer
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+
+        nRows = 3
+        nColumns = 5
+        numpy.random.seed(0)
+        scale = numpy.random.uniform(0.5, 2.0, (nRows, nColumns, 1))
+        data = numpy.random.poisson(scale * counts).astype(numpy.float64)
+
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration["fit"]["linearfitflag"] = 1
+        cfgFile = os.path.join(self._outputDir, "SteelLinear.cfg")
+        configuration.write(cfgFile)
+
+        kwargs = {"filelist": [data], "quiet": True, "saveFit": True,
+                  "edf": False, "concentrations": 1}
+        reference = McaAdvancedFitBatch.McaAdvancedFitBatch(
+                        cfgFile,
+                        outputdir=os.path.join(self._outputDir, "reference"),
+                        **kwargs)
+        reference.processList()
+
+        # Each batch fits every other column of the map, as the
+        # processes launched by PyMcaBatch do
+        outputDir = os.path.join(self._outputDir, "shared")
+        sharedDir = os.path.join(outputDir, "buffers")
+        for chunk in range(2):
+            batch = McaAdvancedFitBatch.McaAdvancedFitBatch(
+                        cfgFile, outputdir=outputDir, chunk=chunk,
+                        mcaoffset=chunk, mcastep=2, sharedDir=sharedDir,
+                        fitconcfile=0, **kwargs)
+            batch.processList()
+            self.assertFalse(os.path.exists(batch.outbuffer.filename(".h5")))
+        # memory-mapped buffers and JSON files, nothing is pickled
+        extensions = set(os.path.splitext(name)[1]
+                         for name in os.listdir(sharedDir))
+        self.assertEqual(extensions, set([".npy", ".json"]))
+        outbuffer = OutputBuffer.saveSharedBuffers(sharedDir)
+        self.assertFalse(os.path.exists(sharedDir))
+        self.assertEqual(os.listdir(outputDir), ["IMAGES.h5"])
+        self.assertTrue(isinstance(outbuffer["configuration"],
+                                   ConfigDict.ConfigDict))
+        self.assertEqual(outbuffer["configuration"]["fit"]["linearfitflag"], 1)
+        self.assertEqual(outbuffer.fileProcess, "xrf_fit")
+
+        for name in ["parameters", "uncertainties", "massfractions", "chisq"]:
+            numpy.testing.assert_array_equal(outbuffer[name],
+                                             reference.outbuffer[name])
+        path = "/images/xrf_fit/results/fit/model"
+        with h5py.File(reference.outbuffer.filename(".h5"), "r") as f:
+            model = f[path][()]
+        with h5py.File(outbuffer.filename(".h5"), "r") as f:
+            model2 = f[path][()]
+        numpy.testing.assert_array_equal(model2, model)
+
     def _verifyFastFit(self, stack, configuration, live_time, nTimes):
         from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
         ffit = FastXRFLinearFit.FastXRFLinearFit()
@@ -548,6 +964,151 @@ def _verifyBatchFitResult(self, imageFile, nRows, nColumns, live_time, nTimes, l
                                     "Incorrect value for point %d" % point)
 
 
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testLazyHdf5Stack(self):
+        import tempfile
+        from PyMca5.PyMcaIO import HDF5Stack1D
+        from PyMca5.PyMcaCore import StackROIBatch
+        self._outputDir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        nFiles = 3
+        nEntries = 2
+        mcaShape = (2, 3)
+        nChannels = 32
+        calibration = [0.1, 0.02, 0.0]
+        fileList = []
+        for i in range(nFiles):
+            fileName = os.path.join(self._outputDir, "lazy%d.h5" % i)
+            with h5py.File(fileName, "w") as h5:
+                for j in range(nEntries):
+                    entry = "/entry%d" % (j + 1)
+                    detector = entry + "/instrument/detector"
+                    h5[detector + "/data"] = numpy.random.poisson(100,
+                                size=mcaShape + (nChannels,)).astype(numpy.int32)
+                    h5[detector + "/live_time"] = \
+                                numpy.random.random(mcaShape).reshape(-1) + 1
+                    h5[detector + "/calibration"] = calibration
+                    h5[detector + "/channels"] = numpy.arange(nChannels)
+                    h5[entry + "/measurement/I0"] = \
+                                numpy.random.random(mcaShape) + 0.5
+                    h5[entry].attrs["NX_class"] = u"NXentry"
+            fileList.append(fileName)
+
+        selection = {"y": "/instrument/detector/data",
+                     "m": "/measurement/I0"}
+        eager = HDF5Stack1D.HDF5Stack1D(fileList, selection, lazy=False)
+        lazy = HDF5Stack1D.HDF5Stack1D(fileList, selection, lazy=True)
+        self.assertTrue(isinstance(eager.data, numpy.ndarray))
+        self.assertTrue(isinstance(lazy.data, HDF5Stack1D.VirtualStack))
+        self.assertEqual(lazy.data.shape,
+                         (nFiles, nEntries * 6, nChannels))
+        self.assertEqual(lazy.data.shape, eager.data.shape)
+        self.assertEqual(lazy.data.dtype, eager.data.dtype)
+        for key in ["McaIndex", "Dim_1", "Dim_2", "Dim_3"]:
+            self.assertEqual(lazy.info[key], eager.info[key])
+        numpy.testing.assert_array_equal(lazy.info["McaCalib"], calibration)
+        numpy.testing.assert_array_equal(lazy.info["McaLiveTime"],
+                                         eager.info["McaLiveTime"])
+        numpy.testing.assert_array_equal(lazy.x[0], eager.x[0])
+        numpy.testing.assert_array_equal(numpy.asarray(lazy.data),
+                                         eager.data)
+        for idx in [(1,), (slice(None), 4), (2, slice(3, 9), slice(5, 10)),
+                    (slice(0, 3, 2), slice(None), 7), (0, 11, 31)]:
+            numpy.testing.assert_array_equal(lazy.data[idx], eager.data[idx],
+                                             err_msg="index %s" % (idx,))
+
+        # the ROI imaging works on the files
+        config = {"ROI": {"roilist": ["ICR", "roi"],
+                          "roidict": {"ICR": {"from": 0, "to": -1,
+                                              "type": "Channel"},
+                                      "roi": {"from": 5, "to": 20,
+                                              "type": "Channel"}}}}
+        results = []
+        for stack in [eager, lazy]:
+            outbuffer = StackROIBatch.StackROIBatch().batchROIMultipleSpectra(
+                                    y=stack, configuration=config, save=False)
+            results.append(outbuffer["roisum"])
+        numpy.testing.assert_allclose(results[1], results[0], rtol=1e-6)
+
+        # a monitor value per channel cannot be applied on access
+        selection = {"y": "/instrument/detector/data",
+                     "m": "/instrument/detector/data"}
+        stack = HDF5Stack1D.HDF5Stack1D(fileList, selection, lazy=True)
+        self.assertTrue(isinstance(stack.data, numpy.ndarray))
+        lazy = eager = stack = None
+
+    @unittest.skipIf(not HAS_H5PY, "skipped h5py missing")
+    def testLazyHdf5StackFastFit(self):
+        import tempfile
+        import pickle
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import HDF5Stack1D
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfg = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        counts = sf[0].mca(1)
+        sf = None
+        configuration = ConfigDict.ConfigDict()
+        configuration.read(cfg)
+        configuration['fit']['stripflag'] = 1
+        configuration['fit']['stripalgorithm'] = 1
+
+        self._outputDir = tempfile.mkdtemp(prefix="pymca")
+        numpy.random.seed(0)
+        mcaShape = (2, 3)
+        fileList = []
+        for i in range(2):
+            fileName = os.path.join(self._outputDir, "lazyfit%d.h5" % i)
+            with h5py.File(fileName, "w") as h5:
+                entry = "/entry1"
+                scale = numpy.random.uniform(0.5, 2, mcaShape + (1,))
+                h5[entry + "/instrument/detector/data"] = \
+                        numpy.random.poisson(scale * counts).astype(numpy.int32)
+                h5[entry + "/measurement/I0"] = \
+                        numpy.random.uniform(0.8, 1.2, mcaShape)
+                h5[entry].attrs["NX_class"] = u"NXentry"
+            fileList.append(fileName)
+        selection = {"y": "/instrument/detector/data",
+                     "m": "/measurement/I0"}
+        eager = HDF5Stack1D.HDF5Stack1D(fileList, selection, lazy=False)
+        lazy = HDF5Stack1D.HDF5Stack1D(fileList, selection, lazy=True)
+        self.assertTrue(isinstance(lazy.data, HDF5Stack1D.VirtualStack))
+
+        # the lazy stack can be sent to worker processes
+        copy = pickle.loads(pickle.dumps(lazy.data))
+        numpy.testing.assert_array_equal(numpy.asarray(copy),
+                                         numpy.asarray(lazy.data))
+        copy = None
+        self.assertTrue(
+            FastXRFLinearFit._parallelDataSource(lazy.data) is not None)
+
+        ffit = FastXRFLinearFit.FastXRFLinearFit()
+        ffit.setFitConfiguration(configuration)
+        results = []
+        for name, stack, nworkers in [("eager", eager, None),
+                                      ("lazy", lazy, None),
+                                      ("lazyparallel", lazy, 2)]:
+            outbuffer = ffit.fitMultipleSpectra(y=stack.data,
+                                                weight=0,
+                                                refit=1,
+                                                nworkers=nworkers,
+                                                outputDir=self._outputDir,
+                                                outputRoot=name,
+                                                saveFit=True,
+                                                save=False)
+            with outbuffer.bufferContext():
+                results.append((outbuffer["parameters"].copy(),
+                                outbuffer["uncertainties"].copy(),
+                                outbuffer["model"][()]))
+        for eagerResult, lazyResult in zip(results[0], results[1]):
+            numpy.testing.assert_allclose(lazyResult, eagerResult,
+                                          rtol=1e-5, atol=1e-8)
+        for serial, parallel in zip(results[1], results[2]):
+            numpy.testing.assert_array_equal(serial, parallel)
+        lazy = eager = None
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -558,7 +1119,15 @@ def getSuite(auto=True):
         testSuite.addTest(testStackInfo("testStackBaseAverageAndSum"))
         testSuite.addTest(testStackInfo("testDataFilePresence"))
         testSuite.addTest(testStackInfo("testStackFastFit"))
+        testSuite.addTest(testStackInfo("testStackFastFitParallel"))
+        testSuite.addTest(testStackInfo("testStackFastFitCompression"))
+        testSuite.addTest(testStackInfo("testStackBatchFitWarmStart"))
+        testSuite.addTest(testStackInfo("testStackBatchFitCheckpoint"))
+        testSuite.addTest(testStackInfo("testStackBatchFitScheduler"))
+        testSuite.addTest(testStackInfo("testStackBatchFitShared"))
         testSuite.addTest(testStackInfo("testFitHdf5Stack"))
+        testSuite.addTest(testStackInfo("testLazyHdf5Stack"))
+        testSuite.addTest(testStackInfo("testLazyHdf5StackFastFit"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,368 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2020 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import sys
+import gc
+import time
+import zlib
+import struct
+import tempfile
+import numpy
+
+def _encodeLZW(data):
+    """
+    TIFF LZW encoder used to write test images.
+    """
+    codes = [256]
+    table = dict((struct.pack("B", i), i) for i in range(256))
+    widths = [9]
+    codeWidth = 9
+    nextCode = 258
+    string = b""
+    for i in range(len(data)):
+        char = data[i:i + 1]
+        if (string + char) in table:
+            string = string + char
+            continue
+        codes.append(table[string])
+        widths.append(codeWidth)
+        table[string + char] = nextCode
+        nextCode += 1
+        if nextCode == (1 << codeWidth) and codeWidth < 12:
+            codeWidth += 1
+        if nextCode == 4094:
+            codes.append(256)
+            widths.append(codeWidth)
+            table = dict((struct.pack("B", i), i) for i in range(256))
+            codeWidth = 9
+            nextCode = 258
+        string = char
+    if string:
+        codes.append(table[string])
+        widths.append(codeWidth)
+        nextCode += 1
+        if nextCode == (1 << codeWidth) and codeWidth < 12:
+            codeWidth += 1
+    codes.append(257)
+    widths.append(codeWidth)
+    value = 0
+    nBits = 0
+    for code, width in zip(codes, widths):
+        value = (value << width) | code
+        nBits += width
+    padding = (-nBits) % 8
+    value <<= padding
+    return value.to_bytes((nBits + padding) // 8, "big")
+
+def _packBits(data):
+    # literal runs only
+    out = []
+    for i in range(0, len(data), 128):
+        piece = data[i:i + 128]
+        out.append(struct.pack("b", len(piece) - 1) + piece)
+    return b"".join(out)
+
+def _writeTiff(fname, images, compression=1, rowsPerStrip=None,
+               tile=None, predictor=1, byteorder="<"):
+    """
+    Write a multi page TIFF file with the data in strips or in tiles.
+    """
+    if byteorder == "<":
+        header = b"II" + struct.pack("<HI", 42, 8)
+    else:
+        header = b"MM" + struct.pack(">HI", 42, 8)
+    output = [header]
+    position = len(header)
+    for n, image in enumerate(images):
+        nRows, nColumns = image.shape
+        data = image.astype(image.dtype.newbyteorder(byteorder))
+        if tile is None:
+            chunkRows = rowsPerStrip or nRows
+            chunks = [data[i:i + chunkRows] for i in range(0, nRows, chunkRows)]
+        else:
+            chunkRows, chunkColumns = tile
+            chunks = []
+            for i in range(0, nRows, chunkRows):
+                for j in range(0, nColumns, chunkColumns):
+                    chunk = numpy.zeros((chunkRows, chunkColumns), data.dtype)
+                    piece = data[i:i + chunkRows, j:j + chunkColumns]
+                    chunk[:piece.shape[0], :piece.shape[1]] = piece
+                    chunks.append(chunk)
+        encoded = []
+        for chunk in chunks:
+            if predictor == 2:
+                chunk = chunk.astype(chunk.dtype.newbyteorder("="))
+                chunk = numpy.diff(chunk, axis=1, prepend=0).astype(chunk.dtype)
+                chunk = chunk.astype(chunk.dtype.newbyteorder(byteorder))
+            raw = chunk.tobytes()
+            if compression == 8:
+                raw = zlib.compress(raw)
+            elif compression == 5:
+                raw = _encodeLZW(raw)
+            elif compression == 32773:
+                raw = _packBits(raw)
+            encoded.append(raw)
+        if image.dtype.kind == "f":
+            sampleFormat = 3
+        elif image.dtype.kind == "i":
+            sampleFormat = 2
+        else:
+            sampleFormat = 1
+        entries = [(256, 4, [nColumns]),
+                   (257, 4, [nRows]),
+                   (258, 3, [image.dtype.itemsize * 8]),
+                   (259, 3, [compression]),
+                   (262, 3, [1])]
+        if tile is None:
+            entries += [(273, 4, None),
+                        (278, 4, [chunkRows]),
+                        (279, 4, [len(raw) for raw in encoded])]
+        entries += [(317, 3, [predictor])]
+        if tile is not None:
+            entries += [(322, 4, [tile[1]]),
+                        (323, 4, [tile[0]]),
+                        (324, 4, None),
+                        (325, 4, [len(raw) for raw in encoded])]
+        entries += [(339, 3, [sampleFormat])]
+        ifdSize = 2 + 12 * len(entries) + 4
+        extra = 4 * len(encoded) * 2
+        dataStart = position + ifdSize + extra
+        offsets = []
+        for raw in encoded:
+            offsets.append(dataStart)
+            dataStart += len(raw)
+        ifd = struct.pack(byteorder + "H", len(entries))
+        extraData = b""
+        extraPosition = position + ifdSize
+        for tag, fieldType, values in entries:
+            if values is None:
+                values = offsets
+            fmt = "H" if fieldType == 3 else "I"
+            if len(values) == 1:
+                value = struct.pack(byteorder + fmt, values[0])
+                value += b"\0" * (4 - len(value))
+            else:
+                value = struct.pack(byteorder + "I",
+                                    extraPosition + len(extraData))
+                extraData += struct.pack(byteorder + "%d%s" % (len(values), fmt),
+                                         *values)
+            ifd += struct.pack(byteorder + "HHI", tag, fieldType,
+                               len(values)) + value
+        if n == len(images) - 1:
+            nextIFD = 0
+        else:
+            nextIFD = dataStart
+        ifd += struct.pack(byteorder + "I", nextIFD)
+        extraData += b"\0" * (extra - len(extraData))
+        output += [ifd, extraData] + encoded
+        position = dataStart
+    with open(fname, "wb") as f:
+        f.write(b"".join(output))
+
+class testTiffIO(unittest.TestCase):
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix=".tif")
+        os.close(fd)
+
+    def tearDown(self):
+        gc.collect()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def _images(self, dtype, nImages=3, shape=(37, 29)):
+        images = []
+        for i in range(nImages):
+            image = numpy.random.randint(0, 1000, shape)
+            # repeated values for the compression
+            image[::3] = i
+            images.append(image.astype(dtype))
+        return images
+
+    def testTiffIOLZW(self):
+        from PyMca5.PyMcaIO import TiffIO
+        data = numpy.random.randint(0, 4, 20000).astype(numpy.uint8).tobytes()
+        data += b"\1" * 5000
+        encoded = _encodeLZW(data)
+        self.assertEqual(bytes(TiffIO.decodeLZW(encoded, len(data))), data)
+        self.assertEqual(bytes(TiffIO.decodeLZW(encoded, 100)), data[:100])
+        # python implementation
+        helper = TiffIO._decodeLZW
+        try:
+            TiffIO._decodeLZW = None
+            self.assertEqual(TiffIO.decodeLZW(encoded, len(data)), data)
+        finally:
+            TiffIO._decodeLZW = helper
+
+    def testTiffIOCompressed(self):
+        from PyMca5.PyMcaIO import TiffIO
+        for dtype in [numpy.uint16, numpy.int32, numpy.float32]:
+            images = self._images(dtype)
+            for compression in [1, 5, 8, 32773]:
+                for layout in [{}, {"rowsPerStrip": 5},
+                               {"tile": (16, 16)}]:
+                    for byteorder in ["<", ">"]:
+                        for predictor in [1, 2]:
+                            if predictor == 2 and \
+                               (compression == 1 or dtype == numpy.float32):
+                                continue
+                            _writeTiff(self.fname, images,
+                                       compression=compression,
+                                       predictor=predictor,
+                                       byteorder=byteorder, **layout)
+                            for nthreads in [None, 3]:
+                                tif = TiffIO.TiffIO(self.fname,
+                                                    nthreads=nthreads)
+                                self.assertEqual(tif.getNumberOfImages(), 3)
+                                for i in range(3):
+                                    image = tif.getImage(i)
+                                    self.assertEqual(image.dtype, dtype)
+                                    self.assertTrue(
+                                        numpy.array_equal(image, images[i]),
+                                        "Wrong %s image for %d %s %s %d" % \
+                                        (dtype.__name__, compression, layout,
+                                         byteorder, predictor))
+                                # the cache returns the same array
+                                self.assertTrue(tif.getImage(1) is \
+                                                tif.getImage(1))
+                                # partial read
+                                tif = TiffIO.TiffIO(self.fname,
+                                                    nthreads=nthreads)
+                                image = tif.getData(2, rowMin=6, rowMax=20)
+                                self.assertTrue(numpy.array_equal(
+                                                    image[6:21],
+                                                    images[2][6:21]))
+                                tif = None
+
+    def testTiffIOThreadPools(self):
+        # instances with different numbers of threads used concurrently
+        import threading
+        from PyMca5.PyMcaIO import TiffIO
+        images = self._images(numpy.uint16)
+        _writeTiff(self.fname, images, compression=8, tile=(16, 16))
+        errors = []
+
+        def read(nthreads):
+            try:
+                for j in range(5):
+                    tif = TiffIO.TiffIO(self.fname, cache_length=0,
+                                        nthreads=nthreads)
+                    for i in range(3):
+                        if not numpy.array_equal(tif.getImage(i), images[i]):
+                            errors.append("Wrong image %d with %d threads" % \
+                                          (i, nthreads))
+                    tif = None
+            except Exception as e:
+                errors.append("%s with %d threads" % (e, nthreads))
+
+        threads = [threading.Thread(target=read, args=(nthreads,))
+                   for nthreads in [2, 3, 2, 4]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(TiffIO._getThreadPool(2) is TiffIO._getThreadPool(2))
+        self.assertTrue(TiffIO._getThreadPool(2) is not \
+                        TiffIO._getThreadPool(3))
+
+    def testTiffStackCompressed(self):
+        from PyMca5.PyMcaIO import TiffIO
+        from PyMca5.PyMcaIO import TiffStack
+        images = self._images(numpy.uint16, nImages=4)
+        _writeTiff(self.fname, images, compression=8, tile=(16, 16))
+        for dynamic in [False, True]:
+            stack = TiffStack.TiffStack(imagestack=True)
+            stack.loadFileList([self.fname], dynamic=dynamic)
+            self.assertTrue(numpy.array_equal(stack.data[:, :, :],
+                                              numpy.array(images)))
+        stack = None
+
+def benchmark(nImages=50, shape=(1024, 1024)):
+    """
+    Compare the loading time of TIFF stacks written with different
+    compressions and layouts, decoding in one or several threads.
+    """
+    from PyMca5.PyMcaIO import TiffStack
+    from PyMca5.PyMcaIO import TiffIO
+    images = [(numpy.random.poisson(10, shape) + i).astype(numpy.uint16)
+              for i in range(nImages)]
+    fd, fname = tempfile.mkstemp(suffix=".tif")
+    os.close(fd)
+    try:
+        for compression, name in [(1, "none"), (8, "deflate"),
+                                  (5, "LZW"), (32773, "packbits")]:
+            for layout in [{"rowsPerStrip": 16}, {"tile": (256, 256)}]:
+                # the LZW test encoder is slow
+                n = 5 if compression == 5 else nImages
+                _writeTiff(fname, images[:n], compression=compression,
+                           **layout)
+                t0 = time.time()
+                stack = TiffStack.TiffStack(imagestack=True)
+                stack.loadFileList([fname])
+                elapsed = [time.time() - t0]
+                for nthreads in [None, 0]:
+                    t0 = time.time()
+                    tif = TiffIO.TiffIO(fname, cache_length=0,
+                                        nthreads=nthreads)
+                    for i in range(n):
+                        tif.getImage(i)
+                    elapsed.append(time.time() - t0)
+                print("%-8s %-26s %3d images  TiffStack %.3f s  "
+                      "TiffIO 1 thread %.3f s  all CPUs %.3f s" % \
+                      ((name, layout, n) + tuple(elapsed)))
+                stack = tif = None
+    finally:
+        os.remove(fname)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testTiffIO))
+    else:
+        # use a predefined order
+        testSuite.addTest(testTiffIO("testTiffIOLZW"))
+        testSuite.addTest(testTiffIO("testTiffIOCompressed"))
+        testSuite.addTest(testTiffIO("testTiffIOThreadPools"))
+        testSuite.addTest(testTiffIO("testTiffStackCompressed"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        test()
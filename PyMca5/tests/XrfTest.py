@@ -546,6 +546,90 @@ def testStainlessSteelDataFit(self):
                 "Strategy: Element %s discrepancy too large %.1f %%" % \
                   (element.split()[0], delta))
 
+    def testConfigurationCache(self):
+        import tempfile
+        import shutil
+        from PyMca5.PyMcaIO import specfilewrapper as specfile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaCore import DiskCache
+        spe = os.path.join(self.dataDir, "Steel.spe")
+        cfgFile = os.path.join(self.dataDir, "Steel.cfg")
+        sf = specfile.Specfile(spe)
+        y = sf[0].mca(1)
+        sf = None
+        x = numpy.arange(y.size).astype(numpy.float64)
+
+        cacheDir = tempfile.mkdtemp(prefix="pymca")
+        previousCache = ClassMcaTheory.getConfigurationCache()
+        try:
+            cache = DiskCache.DiskCache(cacheDir)
+            results = []
+            # no cache, cache filled, cache used
+            for enabled in [False, True, True]:
+                if enabled:
+                    ClassMcaTheory.setConfigurationCache(cache)
+                else:
+                    ClassMcaTheory.setConfigurationCache(None)
+                mcaFit = ClassMcaTheory.McaTheory(cfgFile)
+                mcaFit.setData(x, y)
+                mcaFit.estimate()
+                fitResult, result = mcaFit.startFit(digest=1)
+                results.append((mcaFit, fitResult))
+                if enabled:
+                    self.assertTrue(cache.size() > 0)
+            mcaFit0, fitResult0 = results[0]
+            for mcaFit, fitResult in results[1:]:
+                self.assertEqual(mcaFit.PARAMETERS, mcaFit0.PARAMETERS)
+                self.assertEqual(mcaFit.PEAKS0NAMES, mcaFit0.PEAKS0NAMES)
+                for peaks, peaks0 in zip(mcaFit.PEAKS0, mcaFit0.PEAKS0):
+                    numpy.testing.assert_array_equal(peaks, peaks0)
+                numpy.testing.assert_array_equal(fitResult[0], fitResult0[0])
+                self.assertEqual(mcaFit.config["fisx"], mcaFit0.config["fisx"])
+
+            # the Elements module is updated as without the cache
+            from PyMca5.PyMcaPhysics.xrf import Elements
+            ele = list(mcaFit0.config["peaks"].keys())[0]
+            energy = Elements.Element[ele]["buildparameters"]["energy"]
+            self.assertTrue(energy is not None)
+            Elements.updateDict(energy=energy + 5.0)
+            mcaFit = ClassMcaTheory.McaTheory(cfgFile)
+            self.assertEqual(Elements.Element[ele]["buildparameters"]["energy"],
+                             energy)
+            numpy.testing.assert_array_equal(mcaFit.PEAKS0[0],
+                                             mcaFit0.PEAKS0[0])
+
+            # a different configuration is not taken from the cache
+            configuration = mcaFit0.getConfiguration()
+            configuration["fit"]["escapeflag"] = 0
+            mcaFit = ClassMcaTheory.McaTheory(cfgFile)
+            mcaFit.configure(configuration)
+            self.assertNotEqual(mcaFit.PEAKSW[0].shape,
+                                mcaFit0.PEAKSW[0].shape)
+
+            # least recently used entries are removed
+            cache.maxsize = 1
+            cache.evict()
+            self.assertEqual(cache.size(), 0)
+
+            # the disk cache is only used on request
+            previousDirectory = os.environ.pop("PYMCA_CACHE_DIR", None)
+            try:
+                ClassMcaTheory._configurationCacheInitialized = False
+                self.assertTrue(ClassMcaTheory.getConfigurationCache() is None)
+                os.environ["PYMCA_CACHE_DIR"] = cacheDir
+                ClassMcaTheory._configurationCacheInitialized = False
+                cache = ClassMcaTheory.getConfigurationCache()
+                self.assertEqual(cache.directory,
+                                 os.path.join(cacheDir, "McaTheory"))
+            finally:
+                if previousDirectory is None:
+                    os.environ.pop("PYMCA_CACHE_DIR", None)
+                else:
+                    os.environ["PYMCA_CACHE_DIR"] = previousDirectory
+        finally:
+            ClassMcaTheory.setConfigurationCache(previousCache)
+            shutil.rmtree(cacheDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -556,6 +640,7 @@ def getSuite(auto=True):
         testSuite.addTest(testXrf("testTrainingDataFilePresence"))
         testSuite.addTest(testXrf("testTrainingDataFit"))
         testSuite.addTest(testXrf("testStainlessSteelDataFit"))
+        testSuite.addTest(testXrf("testConfigurationCache"))
     return testSuite
 
 def test(auto=False):
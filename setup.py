@@ -271,6 +271,8 @@ def build_specfile(ext_modules):
         # because that enables the use of strtod_l
         if SPECFILE_USE_GNU_SOURCE:
             specfile_define_macros = [('_GNU_SOURCE', 1)]
+        # keep the scan index of large files next to them
+        specfile_define_macros.append(('SPECFILE_USE_INDEX_FILE', None))
     else:
         specfile_define_macros = define_macros
     srcfiles = ['sfheader', 'sfinit', 'sflists', 'sfdata', 'sfindex',
@@ -292,9 +294,16 @@ def build_specfile(ext_modules):
 
 
 def build_specfit(ext_modules):
+    if sys.platform == "win32":
+        extra_compile_args = []
+    else:
+        # threaded background calculation
+        extra_compile_args = ['-pthread']
     module = Extension(name='PyMca5.PyMcaMath.fitting.SpecfitFuns',
                        sources=glob.glob('PyMca5/PyMcaMath/fitting/specfit/*.c'),
                        define_macros=define_macros,
+                       extra_compile_args=extra_compile_args,
+                       extra_link_args=extra_compile_args,
                        include_dirs=['PyMca5/PyMcaMath/fitting/specfit',
                                      numpy.get_include()])
     ext_modules.append(module)